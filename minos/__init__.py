@@ -7,19 +7,30 @@ except:
 
 
 __all__ = [
+    'adjudication_server',
     'adjudicator',
     'bam_read_extract',
+    'batch_adjudicator',
+    'cohort_store',
+    'cost_estimator',
     'dependencies',
     'genotyper',
     'genotype_confidence_simulator',
     'gramtools',
+    'local_executor',
     'mapping_based_verifier',
     'multi_sample_pipeline',
+    'pileup_genotyper',
     'plots',
+    'resource_predictor',
+    'streaming_api',
     'tasks',
+    'unmapped_reads_splitter',
     'utils',
     'vcf_chunker',
     'vcf_file_split_deletions',
+    'vcf_tree_merge',
 ]
 
 from minos import *
+from minos.streaming_api import adjudicate_iter
@@ -0,0 +1,315 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import ipaddress
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import threading
+import time
+
+from minos import batch_adjudicator, dependencies, vcf_chunker
+
+class Error (Exception): pass
+
+
+def _run_job(adjudicator_args, adjudicator_kwargs):
+    '''Runs one adjudicator job in a worker process.
+    Returns tuple (error message, metrics dict). Error message is None if
+    the job ran successfully'''
+    start_time = time.time()
+    outdir, error_message = batch_adjudicator._run_one_sample(adjudicator_args, adjudicator_kwargs)
+    metrics = {'wall_clock_seconds': round(time.time() - start_time, 2)}
+    if error_message is None:
+        with open(os.path.join(outdir, 'final.vcf')) as f:
+            metrics['final_vcf_records'] = len([x for x in f if not x.startswith('#')])
+    return error_message, metrics
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    def _send_json(self, status, data):
+        body = json.dumps(data, sort_keys=True).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def do_GET(self):
+        adjudication_server = self.server.adjudication_server
+        if self.path == '/status':
+            self._send_json(200, adjudication_server.status())
+        elif self.path.startswith('/jobs/'):
+            job = adjudication_server.get_job(self.path[len('/jobs/'):])
+            if job is None:
+                self._send_json(404, {'error': 'Job not found'})
+            else:
+                self._send_json(200, job)
+        else:
+            self._send_json(404, {'error': 'Unknown path ' + self.path})
+
+
+    def do_POST(self):
+        if self.path != '/jobs':
+            self._send_json(404, {'error': 'Unknown path ' + self.path})
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            job_request = json.loads(self.rfile.read(length))
+            job = self.server.adjudication_server.submit_job(job_request)
+        except Error as e:
+            self._send_json(400, {'error': str(e)})
+        except ValueError as e:
+            self._send_json(400, {'error': 'Error parsing JSON request: ' + str(e)})
+        else:
+            self._send_json(202, job)
+
+
+    def log_message(self, format, *args):
+        logging.info('minos serve request from ' + self.address_string() + ': ' + (format % args))
+
+
+class AdjudicationServer:
+    '''Long-running service that adjudicates samples against one gramtools
+    build directory. The dependency check and loading of the split VCF
+    metadata are done once at startup, and shared by a fixed pool of threads
+    worker processes that run the jobs. Listens for HTTP requests on host:port.
+    There is no authentication, so host must be a loopback address unless
+    allow_remote is True. Endpoints (all JSON):
+      POST /jobs - submit a job. Request is a dict with keys: outdir (required),
+                   reads (required, list of reads filenames), and optionally
+                   sample_name, max_read_length, read_error_rate.
+                   Returns the job, including its id
+      GET /jobs/<id> - returns the job, with status "queued", "finished" or "failed",
+                   final VCF filename and run metrics
+      GET /status - returns counts of jobs in each status
+    Job output directories are relative to outdir_root, and must be inside
+    it after resolving symlinks (they are deleted when overwrite_outdirs is
+    True, so must not be anywhere else).
+    At most max_queued_jobs jobs can be waiting to finish at the same time,
+    after which new jobs are rejected. Finished and failed jobs are
+    forgotten after finished_job_ttl seconds, or when there are more than
+    max_finished_jobs of them (oldest first)'''
+    def __init__(self,
+        gramtools_build_dir,
+        ref_fasta,
+        vcf_file,
+        outdir_root='.',
+        host='127.0.0.1',
+        port=8910,
+        allow_remote=False,
+        threads=1,
+        max_queued_jobs=100,
+        max_finished_jobs=1000,
+        finished_job_ttl=86400,
+        overwrite_outdirs=False,
+        clean=True,
+        genotype_simulation_iterations=10000,
+        read_stats_cache_dir=None,
+    ):
+        self.gramtools_build_dir = os.path.abspath(gramtools_build_dir)
+        self.ref_fasta = os.path.abspath(ref_fasta)
+        self.vcf_file = os.path.abspath(vcf_file)
+        self.outdir_root = os.path.realpath(outdir_root)
+        self.host = host
+        self.port = port
+        self.threads = threads
+        self.max_queued_jobs = max_queued_jobs
+        self.max_finished_jobs = max_finished_jobs
+        self.finished_job_ttl = finished_job_ttl
+        self.adjudicator_kwargs = {
+            'overwrite_outdir': overwrite_outdirs,
+            'gramtools_build_dir': self.gramtools_build_dir,
+            'gramtools_kmer_size': None,
+            'clean': clean,
+            'genotype_simulation_iterations': genotype_simulation_iterations,
+            'read_stats_cache_dir': read_stats_cache_dir,
+        }
+
+        if not os.path.exists(self.gramtools_build_dir):
+            raise Error('Error! gramtools_build_dir=' + self.gramtools_build_dir + ' not found on disk. Cannot continue')
+        if not os.path.isdir(self.outdir_root):
+            raise Error('Error! outdir_root=' + self.outdir_root + ' not found on disk. Cannot continue')
+        if not allow_remote and not AdjudicationServer._is_loopback(self.host):
+            raise Error('Error! host=' + self.host + ' is not a loopback address. The server has no authentication, and clients can choose where output is written. Use allow_remote to listen on it anyway')
+
+        self.jobs = {}
+        self.last_job_id = 0
+        self.jobs_lock = threading.Lock()
+        self.pool = None
+        self.httpd = None
+
+
+    @classmethod
+    def _is_loopback(cls, host):
+        '''Returns True iff all the addresses that host resolves to are
+        loopback addresses'''
+        try:
+            addresses = {x[4][0].split('%')[0] for x in socket.getaddrinfo(host, None)}
+        except socket.gaierror:
+            return False
+        return len(addresses) > 0 and all([ipaddress.ip_address(x).is_loopback for x in addresses])
+
+
+    def _evict_finished_jobs(self):
+        '''Removes finished and failed jobs that are older than the TTL, and
+        then the oldest ones until there are at most max_finished_jobs.
+        Must be called with jobs_lock held'''
+        done = sorted([x for x in self.jobs.values() if x['status'] != 'queued'], key=lambda x: x['finished_time'])
+        expire_time = time.time() - self.finished_job_ttl
+        to_remove = [x for x in done if x['finished_time'] < expire_time]
+        keep = done[len(to_remove):]
+        if len(keep) > self.max_finished_jobs:
+            to_remove.extend(keep[:len(keep) - self.max_finished_jobs])
+        for job in to_remove:
+            del self.jobs[job['id']]
+
+
+    def _job_finished(self, job_id, result):
+        error_message, metrics = result
+        with self.jobs_lock:
+            job = self.jobs[job_id]
+            job['metrics'] = metrics
+            job['finished_time'] = time.time()
+            if error_message is None:
+                job['status'] = 'finished'
+                job['final_vcf'] = os.path.join(job['outdir'], 'final.vcf')
+            else:
+                job['status'] = 'failed'
+                job['error'] = error_message
+            self._evict_finished_jobs()
+        logging.info('Job ' + str(job_id) + ' ' + job['status'])
+
+
+    def _job_crashed(self, job_id, exception):
+        self._job_finished(job_id, (str(exception), {}))
+
+
+    def _check_job_request(self, job_request):
+        '''Returns tuple (outdir, sample_name, reads files, adjudicator kwargs)
+        from the job request dict. Raises Error if the request is bad'''
+        if type(job_request) is not dict:
+            raise Error('Job request must be a JSON object')
+        unknown_keys = set(job_request).difference({'outdir', 'reads', 'sample_name', 'max_read_length', 'read_error_rate'})
+        if len(unknown_keys) > 0:
+            raise Error('Unknown key(s) in job request: ' + ','.join(sorted(unknown_keys)))
+        if 'outdir' not in job_request or 'reads' not in job_request:
+            raise Error('Job request must have outdir and reads')
+
+        reads_files = job_request['reads'] if type(job_request['reads']) is list else [job_request['reads']]
+        if len(reads_files) == 0:
+            raise Error('No reads files in job request')
+        for reads_file in reads_files:
+            if not os.path.exists(reads_file):
+                raise Error('Reads file not found: ' + reads_file)
+
+        kwargs = dict(self.adjudicator_kwargs)
+        for key in 'sample_name', 'max_read_length', 'read_error_rate':
+            kwargs[key] = job_request.get(key, None)
+        return self._resolve_outdir(job_request['outdir']), [os.path.abspath(x) for x in reads_files], kwargs
+
+
+    def _resolve_outdir(self, outdir):
+        '''Returns absolute path of job output directory outdir, which is
+        relative to outdir_root. Raises Error if it is not inside
+        outdir_root (after resolving symlinks), or is inside the gramtools
+        build directory'''
+        if type(outdir) is not str or outdir == '':
+            raise Error('outdir must be a non-empty string')
+        if '..' in outdir.split(os.sep):
+            raise Error('outdir must not contain ".."')
+        resolved = os.path.realpath(os.path.join(self.outdir_root, outdir))
+        if resolved == self.outdir_root or os.path.commonpath([self.outdir_root, resolved]) != self.outdir_root:
+            raise Error('outdir must be inside the server output root directory ' + self.outdir_root)
+        build_dir = os.path.realpath(self.gramtools_build_dir)
+        if os.path.commonpath([build_dir, resolved]) == build_dir or os.path.commonpath([build_dir, resolved]) == resolved:
+            raise Error('outdir must not contain, or be inside, the gramtools build directory')
+        return resolved
+
+
+    def submit_job(self, job_request):
+        '''Adds a job to the worker pool. Returns the job dict'''
+        outdir, reads_files, kwargs = self._check_job_request(job_request)
+
+        with self.jobs_lock:
+            self._evict_finished_jobs()
+            active = [x for x in self.jobs.values() if x['status'] == 'queued']
+            if len(active) >= self.max_queued_jobs:
+                raise Error('Too many queued jobs (' + str(len(active)) + '). Try again later')
+            if outdir in {x['outdir'] for x in active}:
+                raise Error('A queued job is already using output directory ' + outdir)
+
+            self.last_job_id += 1
+            job_id = str(self.last_job_id)
+            self.jobs[job_id] = {
+                'id': job_id,
+                'outdir': outdir,
+                'reads': reads_files,
+                'status': 'queued',
+                'final_vcf': None,
+                'error': None,
+                'metrics': None,
+                'finished_time': None,
+            }
+            job = dict(self.jobs[job_id])
+
+        adjudicator_args = (outdir, self.ref_fasta, reads_files, [self.vcf_file])
+        self.pool.apply_async(
+            _run_job,
+            (adjudicator_args, kwargs),
+            callback=lambda result: self._job_finished(job_id, result),
+            error_callback=lambda e: self._job_crashed(job_id, e),
+        )
+        logging.info('Job ' + job_id + ' queued. Output directory: ' + outdir)
+        return job
+
+
+    def get_job(self, job_id):
+        with self.jobs_lock:
+            return dict(self.jobs[job_id]) if job_id in self.jobs else None
+
+
+    def status(self):
+        with self.jobs_lock:
+            counts = {x: 0 for x in ('queued', 'finished', 'failed')}
+            for job in self.jobs.values():
+                counts[job['status']] += 1
+        return {'gramtools_build_dir': self.gramtools_build_dir, 'outdir_root': self.outdir_root, 'threads': self.threads, 'jobs': counts}
+
+
+    def start(self):
+        '''Loads the build, and starts the worker pool and HTTP server (without
+        serving requests yet). Sets self.port to the real port, which is
+        useful if port 0 was used'''
+        dependencies.check_and_report_dependencies(programs=['gramtools'])
+        logging.info('Dependencies look OK')
+
+        if os.path.exists(os.path.join(self.gramtools_build_dir, 'data.pickle')):
+            split_chunker = vcf_chunker.VcfChunker(self.gramtools_build_dir)
+        else:
+            split_chunker = None
+
+        self.pool = multiprocessing.Pool(self.threads, initializer=batch_adjudicator._init_worker, initargs=(split_chunker,))
+        self.httpd = ThreadingHTTPServer((self.host, self.port), _RequestHandler)
+        self.httpd.adjudication_server = self
+        self.port = self.httpd.server_address[1]
+        logging.info('minos serve listening on http://' + self.host + ':' + str(self.port))
+
+
+    def stop(self):
+        '''Stops the HTTP server, and waits for queued jobs to finish'''
+        self.httpd.server_close()
+        self.pool.close()
+        self.pool.join()
+
+
+    def run(self):
+        self.start()
+        try:
+            self.httpd.serve_forever()
+        except KeyboardInterrupt:
+            logging.info('Stopping minos serve. Waiting for queued jobs to finish')
+        finally:
+            self.stop()
@@ -1,13 +1,20 @@
+import bisect
+import contextlib
 import json
 import logging
+import multiprocessing.pool
 import os
+import queue
 import shutil
 import statistics
 import sys
+import time
+
+import pysam
 
 from cluster_vcf_records import vcf_clusterer, vcf_file_read
 
-from minos import bam_read_extract, dependencies, genotype_confidence_simulator, gramtools, plots, utils, vcf_chunker
+from minos import bam_read_extract, dependencies, genotype_confidence_simulator, gramtools, pileup_genotyper, plots, unmapped_reads_splitter, utils, vcf_chunker
 
 class Error (Exception): pass
 
@@ -29,6 +36,23 @@ class Adjudicator:
         total_splits=None,
         clean=True,
         genotype_simulation_iterations=10000,
+        filter_unmapped_reads=False,
+        unmapped_reads_cache_dir=None,
+        target_ram_per_split=None,
+        gramtools_ram_model=None,
+        read_stats_cache_dir=None,
+        check_dependencies=True,
+        split_chunker=None,
+        read_extract_threads=1,
+        split_threads=1,
+        regions=None,
+        pileup_isolated_snps=False,
+        genotyped_record_callback=None,
+        write_vcf_files=True,
+        mean_depth=None,
+        depth_variance=None,
+        split_cost=None,
+        slice_reference=False,
     ):
         self.ref_fasta = os.path.abspath(ref_fasta)
         self.reads_files = [os.path.abspath(x) for x in reads_files]
@@ -42,6 +66,7 @@ class Adjudicator:
         self.clustered_vcf = os.path.join(self.outdir, 'gramtools.in.vcf')
         self.unfiltered_vcf_file = os.path.join(self.outdir, 'debug.calls_with_zero_cov_alleles.vcf')
         self.final_vcf = os.path.join(self.outdir, 'final.vcf')
+        self.partial_final_vcf = os.path.join(self.outdir, 'final.partial.vcf')
         self.plots_prefix = os.path.join(self.outdir, 'final.vcf.plots')
 
         if gramtools_build_dir is None:
@@ -66,12 +91,55 @@ class Adjudicator:
         self.variants_per_split = variants_per_split
         self.alleles_per_split = alleles_per_split
         self.total_splits = total_splits
+        self.target_ram_per_split = target_ram_per_split
+        self.gramtools_ram_model = gramtools_ram_model
+        self.read_stats_cache_dir = None if read_stats_cache_dir is None else os.path.abspath(read_stats_cache_dir)
+        self.check_dependencies = check_dependencies
+        self.split_chunker = split_chunker
+        self.read_extract_threads = read_extract_threads
+        self.split_threads = split_threads
+        self.split_cost = split_cost
+        self.slice_reference = slice_reference
 
         if (self.total_splits is not None or self.variants_per_split is not None or self.alleles_per_split is not None) and len(self.reads_files) != 1:
             raise Error('Error! If using splitting, must input one reads file (which is assumed to be a sorted indexed BAM file)')
+        if self.split_cost is not None and self.total_splits is None:
+            raise Error('Error! split_cost can only be used with total_splits')
+        if self.split_threads < 1:
+            raise Error('Error! split_threads must be at least 1. Got: ' + str(self.split_threads))
+
+        self.pileup_isolated_snps = pileup_isolated_snps
+        self.genotyped_record_callback = genotyped_record_callback
+        self.write_vcf_files = write_vcf_files
+        if not self.write_vcf_files and self.genotyped_record_callback is None:
+            raise Error('Error! write_vcf_files=False can only be used with genotyped_record_callback, otherwise there would be no output')
+        self.isolated_snps_vcf = os.path.join(self.outdir, 'pileup.in.vcf')
+        self.pileup_unfiltered_vcf = os.path.join(self.outdir, 'pileup.debug.calls_with_zero_cov_alleles.vcf')
+        self.pileup_final_vcf = os.path.join(self.outdir, 'pileup.final.vcf')
+        if self.pileup_isolated_snps:
+            if self.user_supplied_gramtools_build_dir:
+                raise Error('Error! Cannot use pileup_isolated_snps with gramtools_build_dir, because the gramtools graph already has the isolated SNPs')
+            if len(self.reads_files) != 1:
+                raise Error('Error! If using pileup_isolated_snps, must input one reads file (which is assumed to be a sorted indexed BAM file)')
+
+        self.regions = regions
+        self.regions_reads_file = os.path.join(self.outdir, 'regions.reads.bam')
+        if self.regions is not None:
+            if len(self.regions) == 0:
+                raise Error('Error! regions used, but no regions given')
+            if self.user_supplied_gramtools_build_dir:
+                raise Error('Error! Cannot use regions with gramtools_build_dir, because the gramtools graph has already been made')
+            if len(self.reads_files) != 1:
+                raise Error('Error! If using regions, must input one reads file (which is assumed to be a sorted indexed BAM file)')
 
         self.clean = clean
         self.genotype_simulation_iterations = genotype_simulation_iterations
+        self.mean_depth = mean_depth
+        self.depth_variance = depth_variance
+        if (self.mean_depth is None) != (self.depth_variance is None):
+            raise Error('Error! Must use both or neither of mean_depth and depth_variance')
+        self.filter_unmapped_reads = filter_unmapped_reads
+        self.unmapped_reads_cache_dir = None if unmapped_reads_cache_dir is None else os.path.abspath(unmapped_reads_cache_dir)
 
 
     @classmethod
@@ -96,6 +164,166 @@ class Adjudicator:
             return input_kmer_size
 
 
+    @classmethod
+    def _should_split_vcf(cls, clustered_vcf, split_options_used, target_ram_per_split, gramtools_ram_model=None):
+        '''Returns True iff gramtools should be run on clustered_vcf split into
+        chunks. This is the case if split_options_used is True, or
+        target_ram_per_split is not None and the estimated RAM for the unsplit
+        VCF file exceeds it. RAM is estimated using gramtools_ram_model (see
+        vcf_chunker.estimate_gramtools_ram()). Also used by cost_estimator'''
+        if split_options_used:
+            return True
+        elif target_ram_per_split is None:
+            return False
+
+        total_variants, total_alleles = vcf_chunker.VcfChunker._total_variants_and_alleles_in_vcf_file(clustered_vcf)
+        estimated_ram = vcf_chunker.estimate_gramtools_ram(total_alleles, ram_model=gramtools_ram_model)
+        logging.info(f'Clustered VCF file has {total_variants} variants and {total_alleles} alleles. Estimated RAM for gramtools without splitting: {estimated_ram:.2f}GB. Target RAM: {target_ram_per_split}GB')
+        return estimated_ram > target_ram_per_split
+
+
+    def _use_split_vcf(self):
+        '''Returns True iff gramtools should be run on the VCF file split into chunks.
+        This is the case if any of the splitting options were used, or the
+        build directory is already split, or regions were used, or
+        target_ram_per_split was used and the estimated RAM for the unsplit
+        VCF file exceeds it'''
+        split_options_used = self.regions is not None or self.split_chunker is not None or self.total_splits is not None or self.variants_per_split is not None or self.alleles_per_split is not None or os.path.exists(os.path.join(self.split_input_dir, 'data.pickle'))
+        target_ram_per_split = None if self.user_supplied_gramtools_build_dir else self.target_ram_per_split
+        if not Adjudicator._should_split_vcf(self.clustered_vcf, split_options_used, target_ram_per_split, gramtools_ram_model=self.gramtools_ram_model):
+            return False
+        elif split_options_used:
+            return True
+        elif len(self.reads_files) != 1:
+            raise Error('Error! Estimated RAM exceeds target_ram_per_split, so need to split the VCF file. This needs one reads file (which is assumed to be a sorted indexed BAM file), but got ' + str(len(self.reads_files)))
+        else:
+            logging.info('Estimated RAM exceeds target, so splitting VCF file')
+            return True
+
+
+    @classmethod
+    def _filter_vcf_file_by_regions(cls, infile, outfile, regions):
+        '''Writes the header and records from VCF file infile that overlap
+        the regions to outfile. regions must be a dict of chrom -> sorted list of
+        non-overlapping (start, end), 0-based inclusive, as made by
+        utils.merge_regions(). Returns number of records written'''
+        region_starts = {chrom: [x[0] for x in coords] for chrom, coords in regions.items()}
+        records_written = 0
+        with open(infile) as f_in, open(outfile, 'w') as f_out:
+            for line in f_in:
+                if not line.startswith('#'):
+                    fields = line.split('\t', maxsplit=4)
+                    if fields[0] not in regions:
+                        continue
+                    start = int(fields[1]) - 1
+                    end = start + len(fields[3]) - 1
+                    i = bisect.bisect_right(region_starts[fields[0]], end) - 1
+                    if i < 0 or regions[fields[0]][i][1] < start:
+                        continue
+                    records_written += 1
+                print(line, end='', file=f_out)
+        return records_written
+
+
+    def _restrict_inputs_to_regions(self):
+        '''Replaces the input VCF files with copies that only have the records
+        in self.regions, and the reads files with one BAM file of the reads
+        in self.regions plus flanks of length max_read_length'''
+        vcf_regions = utils.merge_regions(self.regions)
+        filtered_vcf_files = []
+        for i, vcf_file in enumerate(self.vcf_files):
+            filtered_vcf = os.path.join(self.outdir, 'regions.' + str(i) + '.vcf')
+            records_written = Adjudicator._filter_vcf_file_by_regions(vcf_file, filtered_vcf, vcf_regions)
+            logging.info('Kept ' + str(records_written) + ' records in regions from VCF file ' + vcf_file)
+            filtered_vcf_files.append(filtered_vcf)
+        self.vcf_files = filtered_vcf_files
+
+        reads_regions = utils.merge_regions(self.regions, flank=self.max_read_length)
+        extractor = bam_read_extract.BamReadExtractor(self.reads_files[0], threads=self.read_extract_threads)
+        reads_written = extractor.get_regions(reads_regions, self.regions_reads_file)
+        extractor.close()
+        pysam.index(self.regions_reads_file)
+        logging.info('Extracted ' + str(reads_written) + ' reads in regions (plus flanks of ' + str(self.max_read_length) + 'bp) from ' + self.reads_files[0] + ' to ' + self.regions_reads_file)
+        self.reads_files = [self.regions_reads_file]
+
+
+    def _clean_regions_files(self):
+        for filename in self.vcf_files + [self.regions_reads_file, self.regions_reads_file + '.bai']:
+            if os.path.exists(filename):
+                os.unlink(filename)
+
+
+    def _depth_to_use(self, mean_depth, depth_variance):
+        '''Returns tuple (mean depth, depth variance) to use for genotyping the
+        gramtools output. This is the given depth measured at the sites,
+        unless self.mean_depth and self.depth_variance were given, for
+        example when only a few sites are genotyped, which would give a
+        poor estimate of the depth'''
+        if self.mean_depth is None:
+            return mean_depth, depth_variance
+        logging.info('Using given mean depth ' + str(self.mean_depth) + ' and variance ' + str(self.depth_variance) + ', instead of mean depth ' + str(mean_depth) + ' and variance ' + str(depth_variance) + ' at the sites')
+        return self.mean_depth, self.depth_variance
+
+
+    def _record_callback(self, mean_depth, depth_variance, source):
+        '''Returns function to give to the VCF writers, which calls
+        self.genotyped_record_callback with each genotyped record, plus the
+        depth and source of the genotype call. Returns None if there is
+        no callback'''
+        if self.genotyped_record_callback is None:
+            return None
+        return lambda record: self.genotyped_record_callback(record, mean_depth, depth_variance, source)
+
+
+    @classmethod
+    def _ref_names_from_fasta(cls, fasta_file):
+        names = []
+        with open(fasta_file) as f:
+            for line in f:
+                if line.startswith('>'):
+                    names.append(line[1:].split()[0])
+        return names
+
+
+    def _genotype_isolated_snps(self, gramtools_was_run):
+        '''Genotypes the isolated SNPs using a pileup of the reads, and merges them
+        with the gramtools calls (if gramtools_was_run) into the final VCF files.
+        The INFO column of every record says how it was genotyped.
+        If self.write_vcf_files is False, the SNPs are only given to the
+        genotyped record callback'''
+        logging.info('Genotyping isolated SNPs using pileup of reads file ' + self.reads_files[0])
+        mean_depth, depth_variance = pileup_genotyper.write_vcf_genotyped_from_pileup(
+            self.isolated_snps_vcf,
+            self.reads_files[0],
+            self.read_error_rate,
+            self.pileup_unfiltered_vcf if self.write_vcf_files else None,
+            self.pileup_final_vcf if self.write_vcf_files else None,
+            self.gramtools_kmer_size,
+            sample_name=self.sample_name,
+            max_read_length=self.max_read_length,
+            record_callback=None if self.genotyped_record_callback is None else lambda record, mean_depth, depth_variance: self.genotyped_record_callback(record, mean_depth, depth_variance, 'pileup'),
+        )
+        if not self.write_vcf_files:
+            if self.clean:
+                os.unlink(self.isolated_snps_vcf)
+            return
+
+        logging.info(f'Adding GT_CONF_PERCENTLE to pileup VCF file {self.pileup_final_vcf}, using mean depth {mean_depth}, depth variance {depth_variance}, error rate {self.read_error_rate}, and {self.genotype_simulation_iterations} simulation iterations')
+        Adjudicator._add_gt_conf_percentile_to_vcf_file(self.pileup_final_vcf, mean_depth, depth_variance, self.read_error_rate, self.genotype_simulation_iterations)
+
+        ref_names = Adjudicator._ref_names_from_fasta(self.ref_fasta)
+        for gramtools_vcf, pileup_vcf in (self.final_vcf, self.pileup_final_vcf), (self.unfiltered_vcf_file, self.pileup_unfiltered_vcf):
+            files_and_sources = [(gramtools_vcf, 'gramtools')] if gramtools_was_run else []
+            files_and_sources.append((pileup_vcf, 'pileup'))
+            tmp_vcf = gramtools_vcf + '.tmp'
+            pileup_genotyper.merge_vcf_files_with_source(files_and_sources, tmp_vcf, ref_names)
+            os.rename(tmp_vcf, gramtools_vcf)
+
+        if self.clean:
+            for filename in self.isolated_snps_vcf, self.pileup_final_vcf, self.pileup_unfiltered_vcf:
+                os.unlink(filename)
+
+
     def run(self):
         if os.path.exists(self.outdir) and self.overwrite_outdir:
             shutil.rmtree(self.outdir)
@@ -110,19 +338,35 @@ class Adjudicator:
         formatter = logging.Formatter('[minos %(asctime)s %(levelname)s] %(message)s', datefmt='%d-%m-%Y %H:%M:%S')
         fh.setFormatter(formatter)
         log.addHandler(fh)
+
+        # Remove the log file handler at the end, so that it does not leak
+        # into later runs in the same process (eg minos serve)
+        try:
+            self._run()
+        finally:
+            log.removeHandler(fh)
+            fh.close()
+
+
+    def _run(self):
         logging.info('Command run: ' + ' '.join(sys.argv))
-        dependencies.check_and_report_dependencies(programs=['gramtools'])
-        logging.info('Dependencies look OK')
+        if self.check_dependencies:
+            dependencies.check_and_report_dependencies(programs=['gramtools'])
+            logging.info('Dependencies look OK')
 
         if self.read_error_rate is None or self.max_read_length is None:
-            logging.info('One or both of read_error_rate and max_read_length not known. Estimate from first 10,000 reads...')
-            estimated_read_length, estimated_read_error_rate = utils.estimate_max_read_length_and_read_error_rate_from_qual_scores(self.reads_files[0])
+            logging.info('One or both of read_error_rate and max_read_length not known. Estimate from a sample of 10,000 reads...')
+            estimated_read_length, estimated_read_error_rate = utils.estimate_read_length_and_error_rate_sampled(self.reads_files[0], threads=self.read_extract_threads, cache_dir=self.read_stats_cache_dir)
             logging.info('Estimated max_read_length=' + str(estimated_read_length) + ' and read_error_rate=' + str(estimated_read_error_rate))
 
         self.read_error_rate = estimated_read_error_rate if self.read_error_rate is None else self.read_error_rate
         self.max_read_length = estimated_read_length if self.max_read_length is None else self.max_read_length
         logging.info('Using max_read_length=' + str(self.max_read_length) + ' and read_error_rate=' + str(self.read_error_rate))
 
+        if self.regions is not None:
+            logging.info('Restricting input VCF file(s) and reads to ' + str(len(self.regions)) + ' region(s)')
+            self._restrict_inputs_to_regions()
+
         if self.user_supplied_gramtools_build_dir:
             logging.info('User supplied gramtools build dir. Assuming VCF already clustered, so skipping clustering')
             assert len(self.vcf_files) == 1
@@ -146,20 +390,46 @@ class Adjudicator:
             raise Error(error_message)
 
 
-        if self.total_splits is not None or self.variants_per_split is not None or self.alleles_per_split is not None or os.path.exists(os.path.join(self.split_input_dir, 'data.pickle')):
+        if self.pileup_isolated_snps:
+            gramtools_vcf = os.path.join(self.outdir, 'gramtools.in.not_isolated_snps.vcf')
+            total_snps, total_others = pileup_genotyper.split_isolated_snps(self.clustered_vcf, self.isolated_snps_vcf, gramtools_vcf, self.max_read_length)
+            logging.info('Found ' + str(total_snps) + ' isolated SNPs, which will be genotyped using a pileup. ' + str(total_others) + ' records will be genotyped using gramtools')
+            self.clustered_vcf = gramtools_vcf
+            run_gramtools = total_others > 0
+        else:
+            run_gramtools = True
+
+        if not run_gramtools:
+            logging.info('No records need gramtools, so not running gramtools')
+        elif self._use_split_vcf():
             self._run_gramtools_with_split_vcf()
         else:
             self._run_gramtools_not_split_vcf()
 
-        logging.info('Making plots from final.vcf')
-        plots.plots_from_minos_vcf(self.final_vcf, self.plots_prefix)
+        if self.pileup_isolated_snps and total_snps > 0:
+            self._genotype_isolated_snps(run_gramtools)
+        elif self.pileup_isolated_snps and self.clean:
+            os.unlink(self.isolated_snps_vcf)
+
+        if self.clean and self.regions is not None:
+            self._clean_regions_files()
+
+        if self.write_vcf_files:
+            logging.info('Making plots from final.vcf')
+            plots.plots_from_minos_vcf(self.final_vcf, self.plots_prefix)
 
         logging.info('All done! Thank you for using minos :)')
 
 
     @classmethod
-    def _add_gt_conf_percentile_to_vcf_file(cls, vcf_file, mean_depth, depth_variance, error_rate, iterations):
-        '''Overwrites vcf_file, with new version that has GT_CONF_PERCENTILE added'''
+    def _add_gt_conf_percentile_to_vcf_file(cls, vcf_file, mean_depth, depth_variance, error_rate, iterations, outfile=None):
+        '''Overwrites vcf_file, with new version that has GT_CONF_PERCENTILE added.
+        If outfile is given, the new version is written to outfile instead,
+        leaving vcf_file unchanged.
+        The new version is written to a temporary file, which is renamed to
+        vcf_file (or outfile) at the end, so that it is never seen part-written'''
+        if outfile is None:
+            outfile = vcf_file
         simulations = genotype_confidence_simulator.GenotypeConfidenceSimulator(mean_depth, depth_variance, error_rate, allele_length=1, iterations=iterations)
         simulations.run_simulations()
         vcf_header, vcf_lines = vcf_file_read.vcf_file_to_list(vcf_file)
@@ -171,7 +441,8 @@ class Adjudicator:
 
         vcf_header.insert(i+1, r'''##FORMAT=<ID=GT_CONF_PERCENTILE,Number=1,Type=Float,Description="Percentile of GT_CONF"''')
 
-        with open(vcf_file, 'w') as f:
+        tmp_file = outfile + '.tmp.gt_conf_percentile'
+        with open(tmp_file, 'w') as f:
             print(*vcf_header, sep='\n', file=f)
 
             for vcf_record in vcf_lines:
@@ -182,6 +453,8 @@ class Adjudicator:
 
                 print(vcf_record, file=f)
 
+        os.rename(tmp_file, outfile)
+
 
     def _run_gramtools_not_split_vcf(self):
         self.gramtools_kmer_size = Adjudicator._get_gramtools_kmer_size(self.gramtools_build_dir, self.gramtools_kmer_size)
@@ -197,28 +470,32 @@ class Adjudicator:
 
         logging.info('Loading gramtools quasimap output files ' + self.gramtools_quasimap_dir)
         mean_depth, depth_variance, vcf_header, vcf_records, allele_coverage, allele_groups = gramtools.load_gramtools_vcf_and_allele_coverage_files(self.perl_generated_vcf, self.gramtools_quasimap_dir)
+        mean_depth, depth_variance = self._depth_to_use(mean_depth, depth_variance)
         logging.info('Finished loading gramtools files')
         if self.sample_name is None:
             sample_name = vcf_file_read.get_sample_name_from_vcf_header_lines(vcf_header)
         else:
             sample_name = self.sample_name
         assert sample_name is not None
-        logging.info('Writing VCf output file ' + self.final_vcf)
+        if self.write_vcf_files:
+            logging.info('Writing VCf output file ' + self.final_vcf)
         gramtools.write_vcf_annotated_using_coverage_from_gramtools(
             mean_depth,
             vcf_records,
             allele_coverage,
             allele_groups,
             self.read_error_rate,
-            self.unfiltered_vcf_file,
+            self.unfiltered_vcf_file if self.write_vcf_files else None,
             self.gramtools_kmer_size,
             sample_name=sample_name,
             max_read_length=self.max_read_length,
-            filtered_outfile=self.final_vcf
+            filtered_outfile=self.final_vcf if self.write_vcf_files else None,
+            record_callback=self._record_callback(mean_depth, depth_variance, 'gramtools'),
         )
 
-        logging.info(f'Adding GT_CONF_PERCENTLE to final VCF file {self.final_vcf}, using mean depth {mean_depth}, depth variance {depth_variance}, error rate {self.read_error_rate}, and {self.genotype_simulation_iterations} simulation iterations')
-        Adjudicator._add_gt_conf_percentile_to_vcf_file(self.final_vcf, mean_depth, depth_variance, self.read_error_rate, self.genotype_simulation_iterations)
+        if self.write_vcf_files:
+            logging.info(f'Adding GT_CONF_PERCENTLE to final VCF file {self.final_vcf}, using mean depth {mean_depth}, depth variance {depth_variance}, error rate {self.read_error_rate}, and {self.genotype_simulation_iterations} simulation iterations')
+            Adjudicator._add_gt_conf_percentile_to_vcf_file(self.final_vcf, mean_depth, depth_variance, self.read_error_rate, self.genotype_simulation_iterations)
 
         if self.clean:
             os.rename(os.path.join(self.gramtools_quasimap_dir, 'report.json'), os.path.join(self.outdir, 'gramtools.quasimap.report.json'))
@@ -229,19 +506,126 @@ class Adjudicator:
                 shutil.rmtree(self.gramtools_build_dir)
 
 
-    def _run_gramtools_with_split_vcf(self):
-        logging.info('Splitting VCF files into chunks (if not already done)')
-        chunker = vcf_chunker.VcfChunker(
+    def _genotype_split(self, split_file, unmapped_reads_file, read_extractor):
+        '''Runs gramtools and genotypes the variants in one split VCF file.
+        Only the records in the split's use range are genotyped and written
+        to the output files, not the flanking records.
+        Returns tuple: (mean depth, depth variance, filtered VCF file, unfiltered VCF file).
+        The VCF filenames are None if self.write_vcf_files is False'''
+        logging.info('===== Start analysing variants in VCF split file ' + split_file.filename + ' =====')
+        split_reads_file = os.path.join(self.split_output_dir, 'split.' + str(split_file.file_number) + '.reads.bam')
+        read_extractor.get_region(
+            split_file.chrom,
+            split_file.chrom_start,
+            split_file.chrom_end,
+            split_reads_file,
+        )
+
+        gramtools_quasimap_dir = os.path.join(self.split_output_dir, 'split.' + str(split_file.file_number) + '.gramtools.quasimap')
+        start_time = time.time()
+        build_report, quasimap_report = gramtools.run_gramtools(
+            split_file.gramtools_build_dir,
+            gramtools_quasimap_dir,
+            split_file.filename,
+            self.ref_fasta if split_file.ref_fasta is None else split_file.ref_fasta,
+            [unmapped_reads_file, split_reads_file],
+            self.max_read_length,
+            kmer_size=self.gramtools_kmer_size,
+        )
+        quasimap_seconds = time.time() - start_time
+
+        logging.info('Loading split gramtools quasimap output files ' + gramtools_quasimap_dir)
+        perl_generated_vcf = os.path.join(split_file.gramtools_build_dir, 'perl_generated_vcf')
+        mean_depth, depth_variance, vcf_header, vcf_records, allele_coverage, allele_groups = gramtools.load_gramtools_vcf_and_allele_coverage_files(perl_generated_vcf, gramtools_quasimap_dir)
+        mean_depth, depth_variance = self._depth_to_use(mean_depth, depth_variance)
+        vcf_chunker.VcfChunker.shift_split_vcf_records_to_ref(split_file, vcf_records)
+        logging.info('Finished loading gramtools files')
+        gramtools.add_minos_stats_to_report(os.path.join(gramtools_quasimap_dir, 'report.json'), {
+            'step': 'quasimap',
+            'wall_clock_seconds': round(quasimap_seconds, 2),
+            'total_variants': len(vcf_records),
+            'total_alleles': sum([1 + len(x.ALT) for x in vcf_records]),
+            'reads_bytes': sum([os.path.getsize(x) for x in (unmapped_reads_file, split_reads_file)]),
+        })
+        if self.sample_name is None:
+            sample_name = vcf_file_read.get_sample_name_from_vcf_header_lines(vcf_header)
+        else:
+            sample_name = self.sample_name
+        assert sample_name is not None
+        if self.write_vcf_files:
+            split_vcf_out = os.path.join(self.split_output_dir, 'split.' + str(split_file.file_number) + '.out.vcf')
+            unfiltered_vcf_out = os.path.join(self.split_output_dir, 'split.' + str(split_file.file_number) + '.out.debug.calls_with_zero_cov_alleles.vcf')
+            logging.info('Writing VCf output file ' + split_vcf_out + ' for split VCF file ' + split_file.filename)
+        else:
+            split_vcf_out = unfiltered_vcf_out = None
+        gramtools.write_vcf_annotated_using_coverage_from_gramtools(
+            mean_depth,
+            vcf_records,
+            allele_coverage,
+            allele_groups,
+            self.read_error_rate,
+            unfiltered_vcf_out,
+            self.gramtools_kmer_size,
+            sample_name=sample_name,
+            max_read_length=self.max_read_length,
+            filtered_outfile=split_vcf_out,
+            use_start_index=split_file.use_start_index - split_file.file_start_index,
+            use_end_index=split_file.use_end_index - split_file.file_start_index,
+            record_callback=self._record_callback(mean_depth, depth_variance, 'gramtools'),
+        )
+
+        if self.clean:
+            logging.info('Cleaning gramtools files from split VCF file ' + split_file.filename)
+            if not self.user_supplied_gramtools_build_dir:
+                os.rename(os.path.join(split_file.gramtools_build_dir, 'build_report.json'), split_file.gramtools_build_dir + '.report.json')
+                shutil.rmtree(split_file.gramtools_build_dir)
+                os.unlink(split_file.filename)
+
+            os.rename(os.path.join(gramtools_quasimap_dir, 'report.json'), gramtools_quasimap_dir + '.report.json')
+            shutil.rmtree(gramtools_quasimap_dir)
+            os.unlink(split_reads_file)
+
+        logging.info('===== Finish analysing variants in VCF split file ' + split_file.filename + ' =====')
+        return mean_depth, depth_variance, split_vcf_out, unfiltered_vcf_out
+
+
+    def _make_vcf_chunker(self):
+        '''Returns VcfChunker for splitting self.clustered_vcf. If regions
+        are used, the VCF is always split, so that gramtools build is run on
+        slices of the reference around the regions, instead of on the
+        whole reference. There is one split per region (or group of regions
+        that are within max_read_length of each other), unless
+        the splitting options make more'''
+        variants_per_split = self.variants_per_split
+        if self.regions is not None and [self.total_splits, variants_per_split, self.alleles_per_split, self.target_ram_per_split].count(None) == 4:
+            variants_per_split = max(1, vcf_chunker.VcfChunker._total_variants_and_alleles_in_vcf_file(self.clustered_vcf)[0])
+
+        return vcf_chunker.VcfChunker(
             self.split_input_dir,
             vcf_infile=self.clustered_vcf,
             ref_fasta=self.ref_fasta,
-            variants_per_split=self.variants_per_split,
+            variants_per_split=variants_per_split,
             alleles_per_split=self.alleles_per_split,
             max_read_length=self.max_read_length,
             total_splits=self.total_splits,
             flank_length=self.max_read_length,
             gramtools_kmer_size=self.gramtools_kmer_size,
+            target_ram_per_split=self.target_ram_per_split if self.total_splits is None else None,
+            gramtools_ram_model=self.gramtools_ram_model,
+            split_cost=self.split_cost,
+            reads_file=self.reads_files[0],
+            slice_reference=self.slice_reference or self.regions is not None,
+            split_at_gaps=self.regions is not None,
         )
+
+
+    def _run_gramtools_with_split_vcf(self):
+        if self.split_chunker is not None:
+            logging.info('Using already loaded split VCF files from ' + self.split_chunker.outdir)
+            chunker = self.split_chunker
+        else:
+            logging.info('Splitting VCF files into chunks (if not already done)')
+            chunker = self._make_vcf_chunker()
         chunker.make_split_files()
         self.gramtools_kmer_size = chunker.gramtools_kmer_size
 
@@ -251,95 +635,80 @@ class Adjudicator:
         except:
             raise Error('Error making output split directory ' + self.split_output_dir)
 
-        unmapped_reads_file = os.path.join(self.split_output_dir, 'unmapped_reads.bam')
-        bam_read_extract.get_unmapped_reads(self.reads_files[0], unmapped_reads_file)
-        split_vcf_outfiles = {}
-        split_vcf_outfiles_unfiltered = {}
+        # Each split that is genotyped at the same time needs its own reads
+        # file handle, because pysam file objects are not thread safe
+        read_extractors = queue.Queue()
+        for i in range(self.split_threads):
+            read_extractors.put(bam_read_extract.BamReadExtractor(self.reads_files[0], threads=self.read_extract_threads))
+
+        if self.filter_unmapped_reads:
+            if self.unmapped_reads_cache_dir is None:
+                unmapped_reads_dir = os.path.join(self.split_output_dir, 'unmapped_reads')
+            else:
+                unmapped_reads_dir = self.unmapped_reads_cache_dir
+            logging.info('Assigning unmapped reads to splits using kmers. Output directory: ' + unmapped_reads_dir)
+            splitter = unmapped_reads_splitter.UnmappedReadsSplitter(
+                self.reads_files[0],
+                self.ref_fasta,
+                [x for file_list in chunker.vcf_split_files.values() for x in file_list],
+                unmapped_reads_dir,
+            )
+            splitter.run()
+        else:
+            unmapped_reads_file = os.path.join(self.split_output_dir, 'unmapped_reads.bam')
+            read_extractor = read_extractors.get()
+            read_extractor.get_unmapped_reads(unmapped_reads_file)
+            read_extractors.put(read_extractor)
+
+        def genotype_split(split_file):
+            read_extractor = read_extractors.get()
+            try:
+                split_unmapped_reads_file = splitter.split_reads_files[split_file.file_number] if self.filter_unmapped_reads else unmapped_reads_file
+                return split_file.file_number, self._genotype_split(split_file, split_unmapped_reads_file, read_extractor)
+            finally:
+                read_extractors.put(read_extractor)
+
+        # Records are appended to final.partial.vcf as each split is finished.
+        # Splits run in parallel can finish in any order, in which case the
+        # merger holds them until the earlier splits are done. final.vcf is
+        # only made at the end, from final.partial.vcf plus GT_CONF_PERCENTILE
+        # (which needs the depth from all the splits), so that final.vcf is
+        # never seen part-written
+        if self.write_vcf_files:
+            logging.info('Merging split VCF output files into one output file ' + self.partial_final_vcf + ' as each split is finished')
+        logging.info('Genotyping ' + str(self.split_threads) + ' split(s) at a time')
         mean_depths = []
         depth_variances = []
+        split_files = [x for file_list in chunker.vcf_split_files.values() for x in file_list]
 
-        for ref_name, split_file_list in chunker.vcf_split_files.items():
-            split_vcf_outfiles[ref_name] = []
-            split_vcf_outfiles_unfiltered[ref_name] = []
-            for split_file in split_file_list:
-                logging.info('===== Start analysing variants in VCF split file ' + split_file.filename + ' =====')
-                split_reads_file = os.path.join(self.split_output_dir, 'split.' + str(split_file.file_number) + '.reads.bam')
-                bam_read_extract.get_region(
-                    self.reads_files[0],
-                    split_file.chrom,
-                    split_file.chrom_start,
-                    split_file.chrom_end,
-                    split_reads_file,
-                )
-
-                gramtools_quasimap_dir = os.path.join(self.split_output_dir, 'split.' + str(split_file.file_number) + '.gramtools.quasimap')
-
-                build_report, quasimap_report = gramtools.run_gramtools(
-                    split_file.gramtools_build_dir,
-                    gramtools_quasimap_dir,
-                    split_file.filename,
-                    self.ref_fasta,
-                    [unmapped_reads_file, split_reads_file],
-                    self.max_read_length,
-                    kmer_size=self.gramtools_kmer_size,
-                )
-
-                logging.info('Loading split gramtools quasimap output files ' + gramtools_quasimap_dir)
-                perl_generated_vcf = os.path.join(split_file.gramtools_build_dir, 'perl_generated_vcf')
-                mean_depth, depth_variance, vcf_header, vcf_records, allele_coverage, allele_groups = gramtools.load_gramtools_vcf_and_allele_coverage_files(perl_generated_vcf, gramtools_quasimap_dir)
+        with contextlib.ExitStack() as stack:
+            if self.write_vcf_files:
+                mergers = [stack.enter_context(vcf_chunker.IncrementalSplitMerger(chunker, x, delete_merged=self.clean, flanks_removed=True)) for x in (self.partial_final_vcf, self.unfiltered_vcf_file)]
+            else:
+                mergers = []
+            pool = stack.enter_context(multiprocessing.pool.ThreadPool(max(1, min(self.split_threads, len(split_files)))))
+
+            for file_number, (mean_depth, depth_variance, *split_vcf_outs) in pool.imap_unordered(genotype_split, split_files):
                 mean_depths.append(mean_depth)
                 depth_variances.append(depth_variance)
-                logging.info('Finished loading gramtools files')
-                if self.sample_name is None:
-                    sample_name = vcf_file_read.get_sample_name_from_vcf_header_lines(vcf_header)
-                else:
-                    sample_name = self.sample_name
-                assert sample_name is not None
-                split_vcf_out = os.path.join(self.split_output_dir, 'split.' + str(split_file.file_number) + '.out.vcf')
-                unfiltered_vcf_out = os.path.join(self.split_output_dir, 'split.' + str(split_file.file_number) + '.out.debug.calls_with_zero_cov_alleles.vcf')
-                logging.info('Writing VCf output file ' + split_vcf_out + ' for split VCF file ' + split_file.filename)
-                gramtools.write_vcf_annotated_using_coverage_from_gramtools(
-                    mean_depth,
-                    vcf_records,
-                    allele_coverage,
-                    allele_groups,
-                    self.read_error_rate,
-                    unfiltered_vcf_out,
-                    self.gramtools_kmer_size,
-                    sample_name=sample_name,
-                    max_read_length=self.max_read_length,
-                    filtered_outfile=split_vcf_out,
-                )
-                split_vcf_outfiles[ref_name].append(split_vcf_out)
-                split_vcf_outfiles_unfiltered[ref_name].append(unfiltered_vcf_out)
-
-                if self.clean:
-                    logging.info('Cleaning gramtools files from split VCF file ' + split_file.filename)
-                    if not self.user_supplied_gramtools_build_dir:
-                        os.rename(os.path.join(split_file.gramtools_build_dir, 'build_report.json'), split_file.gramtools_build_dir + '.report.json')
-                        shutil.rmtree(split_file.gramtools_build_dir)
-                        os.unlink(split_file.filename)
-
-                    os.rename(os.path.join(gramtools_quasimap_dir, 'report.json'), gramtools_quasimap_dir + '.report.json')
-                    shutil.rmtree(gramtools_quasimap_dir)
-                    os.unlink(split_reads_file)
-
-                logging.info('===== Finish analysing variants in VCF split file ' + split_file.filename + ' =====')
-
-        logging.info('Merging VCF files into one output file ' + self.final_vcf)
-        chunker.merge_files(split_vcf_outfiles, self.final_vcf)
-        chunker.merge_files(split_vcf_outfiles_unfiltered, self.unfiltered_vcf_file)
-
-        mean_depth = statistics.mean(mean_depths)
-        depth_variance = statistics.mean(depth_variances)
-        logging.info(f'Adding GT_CONF_PERCENTLE to final VCF file {self.final_vcf}, using mean depth {mean_depth}, depth variance {depth_variance}, error rate {self.read_error_rate}, and {self.genotype_simulation_iterations} simulation iterations')
-        Adjudicator._add_gt_conf_percentile_to_vcf_file(self.final_vcf, mean_depth, depth_variance, self.read_error_rate, self.genotype_simulation_iterations)
+                for merger, split_vcf_out in zip(mergers, split_vcf_outs):
+                    merger.add(file_number, split_vcf_out)
+
+            while not read_extractors.empty():
+                read_extractors.get().close()
+            for merger in mergers:
+                merger.finish()
+
+        if self.write_vcf_files:
+            mean_depth = statistics.mean(mean_depths)
+            depth_variance = statistics.mean(depth_variances)
+            logging.info(f'Adding GT_CONF_PERCENTLE to final VCF file {self.final_vcf}, using mean depth {mean_depth}, depth variance {depth_variance}, error rate {self.read_error_rate}, and {self.genotype_simulation_iterations} simulation iterations')
+            Adjudicator._add_gt_conf_percentile_to_vcf_file(self.partial_final_vcf, mean_depth, depth_variance, self.read_error_rate, self.genotype_simulation_iterations, outfile=self.final_vcf)
+            os.unlink(self.partial_final_vcf)
 
         if self.clean:
-            logging.info('Deleting temp split VCF files')
-            for d in split_vcf_outfiles, split_vcf_outfiles_unfiltered:
-                for file_list in d.values():
-                    for filename in file_list:
-                        os.unlink(filename)
-            os.unlink(unmapped_reads_file)
+            if not self.filter_unmapped_reads:
+                os.unlink(unmapped_reads_file)
+            elif self.unmapped_reads_cache_dir is None:
+                shutil.rmtree(unmapped_reads_dir)
 
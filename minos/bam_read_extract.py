@@ -19,3 +19,78 @@ def get_region(infile, ref_name, start, end, outfile):
     region = ref_name + ':' + str(start + 1) + '-' + str(end + 1)
     pysam.view('-b', '-F', '0x4', '-o', outfile, infile, region, catch_stdout=False)
 
+
+
+class BamReadExtractor:
+    '''Extracts reads from a sorted indexed BAM file, keeping the input file
+    (and its index) open between calls, instead of reopening it every time.
+    Output files are meant to be temporary, so are written as uncompressed
+    (level 0) BAM by default. threads is the number of threads used by
+    pysam/htslib for BGZF decompression of the input file.
+    Call close() when finished'''
+    def __init__(self, infile, threads=1, compression_level=0):
+        self.infile = infile
+        self.threads = threads
+        self.compression_level = compression_level
+        self.samfile = pysam.AlignmentFile(self.infile, 'rb', threads=self.threads)
+
+
+    def _open_outfile(self, outfile):
+        return pysam.AlignmentFile(outfile, 'wb' + str(self.compression_level), template=self.samfile)
+
+
+    def get_unmapped_reads(self, outfile):
+        '''Writes BAM file of unmapped reads, including unmapped reads that
+        are placed next to their mapped mate. This uses samtools (the same as
+        get_unmapped_reads() outside this class), because it would be slow
+        to look at every read in the file in Python'''
+        if self.compression_level == 0:
+            output_options = ['-u']
+        else:
+            output_options = ['-b', '--output-fmt-option', 'level=' + str(self.compression_level)]
+        pysam.view(*output_options, '-f', '0x4', '-@', str(self.threads), '-o', outfile, self.infile, catch_stdout=False)
+
+
+    def get_region(self, ref_name, start, end, outfile):
+        '''Writes BAM file of the mapped reads that overlap the given region.
+        start and end are 0-based inclusive. Returns number of reads written'''
+        reads_written = 0
+        with self._open_outfile(outfile) as f_out:
+            for read in self.samfile.fetch(ref_name, start, end + 1):
+                if not read.is_unmapped:
+                    f_out.write(read)
+                    reads_written += 1
+        return reads_written
+
+
+    def get_regions(self, regions, outfile):
+        '''Writes BAM file of the reads that overlap any of the regions. regions
+        must be a dict of chrom -> sorted list of non-overlapping (start, end),
+        0-based inclusive, for example as made by utils.merge_regions().
+        Each read is written once, even if it overlaps more than one region.
+        Unmapped reads are only included if they are placed in a region
+        (ie their mate is mapped there). Output is sorted in the same order as
+        the input file. Returns number of reads written'''
+        reads_written = 0
+        ref_order = {x: i for i, x in enumerate(self.samfile.references)}
+        with self._open_outfile(outfile) as f_out:
+            for chrom in sorted([x for x in regions if x in ref_order], key=lambda x: ref_order[x]):
+                previous_end = -1
+                written_near_end = set()
+                for start, end in regions[chrom]:
+                    written_this_region = set()
+                    for read in self.samfile.fetch(chrom, start, end + 1):
+                        key = (read.query_name, read.flag, read.reference_start)
+                        if read.reference_start <= previous_end and key in written_near_end:
+                            continue
+                        f_out.write(read)
+                        reads_written += 1
+                        if read.reference_end is None or read.reference_end > end:
+                            written_this_region.add(key)
+                    previous_end = end
+                    written_near_end = written_this_region
+        return reads_written
+
+
+    def close(self):
+        self.samfile.close()
@@ -0,0 +1,146 @@
+import logging
+import multiprocessing
+import os
+
+from cluster_vcf_records import vcf_file_read
+
+from minos import adjudicator, dependencies, vcf_chunker
+
+class Error (Exception): pass
+
+
+# Per-build state that is loaded once by BatchAdjudicator, and then
+# given to each worker process by _init_worker()
+_shared_split_chunker = None
+
+
+def _init_worker(split_chunker):
+    global _shared_split_chunker
+    _shared_split_chunker = split_chunker
+
+
+def _run_one_sample(adjudicator_args, adjudicator_kwargs):
+    '''Runs the adjudicator on one sample. Returns tuple (outdir, error message).
+    Error message is None if it ran successfully'''
+    outdir = adjudicator_args[0]
+    try:
+        adj = adjudicator.Adjudicator(*adjudicator_args, split_chunker=_shared_split_chunker, check_dependencies=False, **adjudicator_kwargs)
+        adj.run()
+    except Exception as e:
+        logging.error('Error running minos on sample with output directory ' + outdir + ': ' + str(e))
+        return outdir, str(e)
+
+    return outdir, None
+
+
+class BatchAdjudicator:
+    '''Runs the adjudicator on many samples against one gramtools build
+    directory, in one process. The dependency check and loading of the split
+    VCF metadata are only done once, and shared by all samples.
+    Each sample is run in a separate worker process (using threads workers),
+    and gets its own output directory. sample_depths is an optional dict of
+    output directory -> (mean depth, depth variance), to use for genotyping
+    those samples instead of the depth measured at the sites'''
+    def __init__(self,
+        samples_tsv,
+        gramtools_build_dir,
+        ref_fasta,
+        vcf_file,
+        threads=1,
+        max_read_length=None,
+        read_error_rate=None,
+        overwrite_outdirs=False,
+        clean=True,
+        genotype_simulation_iterations=10000,
+        read_stats_cache_dir=None,
+        sample_depths=None,
+    ):
+        self.samples_tsv = os.path.abspath(samples_tsv)
+        self.gramtools_build_dir = os.path.abspath(gramtools_build_dir)
+        self.ref_fasta = os.path.abspath(ref_fasta)
+        self.vcf_file = os.path.abspath(vcf_file)
+        self.threads = threads
+        self.max_read_length = max_read_length
+        self.read_error_rate = read_error_rate
+        self.overwrite_outdirs = overwrite_outdirs
+        self.clean = clean
+        self.genotype_simulation_iterations = genotype_simulation_iterations
+        self.read_stats_cache_dir = read_stats_cache_dir
+        self.sample_depths = {} if sample_depths is None else {os.path.abspath(k): v for k, v in sample_depths.items()}
+
+        if not os.path.exists(self.gramtools_build_dir):
+            raise Error('Error! gramtools_build_dir=' + self.gramtools_build_dir + ' not found on disk. Cannot continue')
+
+
+    @classmethod
+    def _load_samples_tsv(cls, infile):
+        '''Returns list of tuples (outdir, sample name, list of reads files).
+        Each line of the file is: outdir, sample name, reads file(s),
+        tab-separated. Sample name of "." means use the name from the VCF file'''
+        samples = []
+        outdirs = set()
+        with open(infile) as f:
+            for line in f:
+                if line.strip() == '' or line.startswith('#'):
+                    continue
+
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) < 3:
+                    raise Error('Bad line in samples TSV file. Need at least 3 columns: ' + line.rstrip())
+
+                outdir, sample_name, *reads_files = fields
+                for reads_file in reads_files:
+                    if not os.path.exists(reads_file):
+                        raise Error('Reads file not found: ' + reads_file)
+
+                outdir = os.path.abspath(outdir)
+                if outdir in outdirs:
+                    raise Error('Output directory found more than once in samples TSV file: ' + outdir)
+                outdirs.add(outdir)
+                samples.append((outdir, None if sample_name == '.' else sample_name, [os.path.abspath(x) for x in reads_files]))
+
+        return samples
+
+
+    def run(self):
+        samples = BatchAdjudicator._load_samples_tsv(self.samples_tsv)
+        logging.info('Loaded ' + str(len(samples)) + ' samples from file ' + self.samples_tsv)
+        dependencies.check_and_report_dependencies(programs=['gramtools'])
+        logging.info('Dependencies look OK')
+
+        if not vcf_file_read.vcf_file_has_at_least_one_record(self.vcf_file):
+            raise Error('No VCF records in ' + self.vcf_file + '. Cannot continue')
+
+        if os.path.exists(os.path.join(self.gramtools_build_dir, 'data.pickle')):
+            split_chunker = vcf_chunker.VcfChunker(self.gramtools_build_dir)
+        else:
+            split_chunker = None
+
+        adjudicator_kwargs = {
+            'max_read_length': self.max_read_length,
+            'read_error_rate': self.read_error_rate,
+            'overwrite_outdir': self.overwrite_outdirs,
+            'gramtools_build_dir': self.gramtools_build_dir,
+            'gramtools_kmer_size': None,
+            'clean': self.clean,
+            'genotype_simulation_iterations': self.genotype_simulation_iterations,
+            'read_stats_cache_dir': self.read_stats_cache_dir,
+        }
+        pool_args = []
+        for outdir, sample_name, reads_files in samples:
+            kwargs = dict(adjudicator_kwargs, sample_name=sample_name)
+            if outdir in self.sample_depths:
+                kwargs['mean_depth'], kwargs['depth_variance'] = self.sample_depths[outdir]
+            pool_args.append(((outdir, self.ref_fasta, reads_files, [self.vcf_file]), kwargs))
+
+        pool = multiprocessing.Pool(self.threads, initializer=_init_worker, initargs=(split_chunker,))
+        results = pool.starmap(_run_one_sample, pool_args, chunksize=1)
+        pool.close()
+        pool.join()
+
+        failed = [(outdir, message) for outdir, message in results if message is not None]
+        logging.info('Finished running ' + str(len(samples)) + ' samples. Failed: ' + str(len(failed)))
+        if len(failed) > 0:
+            for outdir, message in failed:
+                logging.error('Failed sample: ' + outdir + '. Error: ' + message)
+            raise Error(str(len(failed)) + ' sample(s) failed. See log for details')
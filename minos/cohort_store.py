@@ -0,0 +1,388 @@
+import itertools
+import json
+import logging
+import os
+import socket
+
+import numpy as np
+
+from minos import gramtools
+
+class Error (Exception): pass
+
+
+format_fields = ['DP', 'GT', 'COV', 'GT_CONF']
+missing_int = -1
+haploid_gt = -2 # second allele of a GT that only has one allele
+
+
+def _vcf_record_lines(vcf_file, header_lines=None):
+    '''Yields tuple (split line, line) for each record in vcf_file. If
+    header_lines is a list, the ## header lines are appended to it'''
+    with open(vcf_file) as f:
+        for line in f:
+            if not line.startswith('#'):
+                yield line.rstrip('\n').split('\t'), line
+            elif header_lines is not None and line.startswith('##'):
+                header_lines.append(line.rstrip('\n'))
+
+
+def _number_of_alleles(alt):
+    return 1 if alt == '.' else 1 + alt.count(',') + 1
+
+
+def _parse_gt(gt_string):
+    '''Returns tuple of two allele indexes from a GT string.
+    Missing alleles are missing_int. If only one allele, the second
+    allele is haploid_gt'''
+    alleles = gt_string.replace('|', '/').split('/')
+    if len(alleles) > 2:
+        raise Error('Only haploid or diploid genotypes allowed. Got: ' + gt_string)
+    alleles = [missing_int if x == '.' else int(x) for x in alleles]
+    if len(alleles) == 1:
+        alleles.append(haploid_gt)
+    return alleles
+
+
+def _gt_to_string(alleles):
+    return '/'.join(['.' if x == missing_int else str(x) for x in alleles if x != haploid_gt])
+
+
+def _cov_to_string(cov):
+    '''Returns COV string from the list of per-allele values. Missing values
+    at the end are not written, so that a COV with fewer values than
+    alleles (or ".") is written the same as it was in the input VCF'''
+    cov = list(cov)
+    while len(cov) > 0 and cov[-1] == missing_int:
+        cov.pop()
+    return '.' if len(cov) == 0 else ','.join([str(x) for x in cov])
+
+
+def create_store(outdir, sites_vcf, sample_names):
+    '''Makes a new store in directory outdir, with one site per record of
+    sites_vcf and one column per sample in sample_names. All values are set
+    to missing. sites_vcf can be a per-sample minos output VCF, because only
+    the first 8 columns are used. The records must be sorted by position
+    within each CHROM, and each CHROM must be in one block of records.
+    Returns a CohortStore, opened for adding samples'''
+    if len(set(sample_names)) != len(sample_names):
+        raise Error('Sample names must be unique')
+    os.mkdir(outdir)
+    header_lines = []
+    with open(sites_vcf) as f:
+        for line in f:
+            if line.startswith('##'):
+                header_lines.append(line.rstrip('\n'))
+            else:
+                break
+
+    with open(os.path.join(outdir, 'header.txt'), 'w') as f:
+        print(*header_lines, sep='\n', file=f)
+
+    chrom_names = []
+    chrom_indexes = []
+    positions = []
+    allele_offsets = [0]
+    max_alleles = 1
+    with open(os.path.join(outdir, 'sites.tsv'), 'w') as f:
+        for fields, line in _vcf_record_lines(sites_vcf):
+            pos = int(fields[1])
+            if len(chrom_names) == 0 or fields[0] != chrom_names[-1]:
+                if fields[0] in chrom_names:
+                    raise Error('Records for ' + fields[0] + ' are not in one block in VCF file ' + sites_vcf)
+                chrom_names.append(fields[0])
+            elif pos < positions[-1]:
+                raise Error('VCF file not sorted. ' + fields[0] + ':' + str(pos) + ' is after position ' + str(positions[-1]) + '. File: ' + sites_vcf)
+            chrom_indexes.append(len(chrom_names) - 1)
+            positions.append(pos)
+            number_of_alleles = _number_of_alleles(fields[4])
+            allele_offsets.append(allele_offsets[-1] + number_of_alleles)
+            max_alleles = max(max_alleles, number_of_alleles)
+            print(*fields[:8], sep='\t', file=f)
+
+    np.save(os.path.join(outdir, 'chrom.npy'), np.array(chrom_indexes, dtype=np.int32))
+    np.save(os.path.join(outdir, 'pos.npy'), np.array(positions, dtype=np.int64))
+    np.save(os.path.join(outdir, 'allele_offsets.npy'), np.array(allele_offsets, dtype=np.int64))
+    samples = len(sample_names)
+    arrays = [
+        ('gt', np.int16, (samples, len(positions), 2), missing_int),
+        ('dp', np.int32, (samples, len(positions)), missing_int),
+        ('cov', np.int32, (samples, allele_offsets[-1]), missing_int),
+        ('gt_conf', np.float64, (samples, len(positions)), np.nan),
+        ('samples_added', np.bool_, (samples,), False),
+    ]
+    for name, dtype, array_shape, fill_value in arrays:
+        array = np.lib.format.open_memmap(os.path.join(outdir, name + '.npy'), mode='w+', dtype=dtype, shape=array_shape)
+        array[:] = fill_value
+        array.flush()
+        del array
+
+    with open(os.path.join(outdir, 'metadata.json'), 'w') as f:
+        json.dump({
+            'samples': sample_names,
+            'chroms': chrom_names,
+            'number_of_sites': len(positions),
+            'max_alleles': max_alleles,
+            'total_alleles': allele_offsets[-1],
+        }, f, indent=2)
+
+    logging.info('Made cohort store ' + outdir + ' with ' + str(len(positions)) + ' sites and ' + str(len(sample_names)) + ' samples')
+    return CohortStore(outdir, mode='r+')
+
+
+class CohortStore:
+    '''Genotype calls for a cohort of samples, stored in memory-mapped
+    numpy arrays. Each array has one row per sample, so that the values
+    of one sample are next to each other on disk. The arrays are:
+      gt: int16, shape (samples, sites, 2). Allele indexes of the genotype.
+          Missing allele = -1. Second allele of a haploid call = -2
+      dp: int32, shape (samples, sites). -1 if missing
+      cov: int32, shape (samples, total alleles). Per-allele coverage, -1
+           if missing. The alleles of site i are in columns
+           allele_offsets[i] to allele_offsets[i + 1] - 1
+      gt_conf: float64, shape (samples, sites). nan if missing
+    The sites are in the file sites.tsv (first 8 columns of the VCF),
+    with the CHROM and POS also in numpy arrays for fast lookup.
+    The first sample that is added also saves the header lines and first 8
+    columns of its VCF file, in sample_header.txt and sample_sites.tsv.
+    These are what minos outputs (eg INFO is KMER=...), which can be
+    different from the input sites VCF, and are used by to_vcf() so that
+    its output is the same as merging the per-sample VCF files.
+    Use mode='r+' to add samples, which can be done from more than one
+    process at the same time (even on different machines, if the store is
+    on a shared filesystem), as long as they add different samples'''
+    def __init__(self, directory, mode='r'):
+        if mode not in {'r', 'r+'}:
+            raise Error('mode must be "r" or "r+". Got: ' + str(mode))
+        self.directory = os.path.abspath(directory)
+        self.mode = mode
+        with open(os.path.join(self.directory, 'metadata.json')) as f:
+            metadata = json.load(f)
+        self.sample_names = metadata['samples']
+        self.chrom_names = metadata['chroms']
+        self.number_of_sites = metadata['number_of_sites']
+        self.max_alleles = metadata['max_alleles']
+        self.total_alleles = metadata['total_alleles']
+        self.sample_name_to_index = {x: i for i, x in enumerate(self.sample_names)}
+        self.chrom_name_to_index = {x: i for i, x in enumerate(self.chrom_names)}
+        self.chrom = np.load(os.path.join(self.directory, 'chrom.npy'))
+        self.pos = np.load(os.path.join(self.directory, 'pos.npy'))
+        self.allele_offsets = np.load(os.path.join(self.directory, 'allele_offsets.npy'))
+        # Samples are added by writing to the files, not to these memory
+        # maps. See _write_sample_row()
+        for name in 'gt', 'dp', 'cov', 'gt_conf', 'samples_added':
+            setattr(self, name, np.load(os.path.join(self.directory, name + '.npy'), mmap_mode='r'))
+
+
+    def _write_sample_row(self, name, sample, values):
+        '''Writes values to the row of sample in the array name. The bytes
+        are written straight to the .npy file, instead of using the memory
+        map, so that nothing outside the sample's row is written. This means
+        different processes can add different samples at the same time'''
+        array = getattr(self, name)
+        values = np.asarray(values, dtype=array.dtype)
+        assert values.shape == array.shape[1:]
+        with open(os.path.join(self.directory, name + '.npy'), 'r+b') as f:
+            f.seek(array.offset + sample * values.nbytes)
+            f.write(values.tobytes())
+
+
+    def add_sample_vcf(self, sample_name, vcf_file):
+        '''Fills in the values of sample sample_name from the single-sample
+        minos VCF file vcf_file, which must have the same sites as the store,
+        in the same order. The file is read one line at a time, and the
+        values are written to the store at the end'''
+        if self.mode != 'r+':
+            raise Error('Cannot add sample to cohort store ' + self.directory + ' because it was not opened with mode "r+"')
+        if sample_name not in self.sample_name_to_index:
+            raise Error('Sample "' + sample_name + '" not in cohort store ' + self.directory)
+        sample = self.sample_name_to_index[sample_name]
+        sample_sites_file = os.path.join(self.directory, 'sample_sites.tsv')
+        sample_header_file = os.path.join(self.directory, 'sample_header.txt')
+        if os.path.exists(sample_sites_file):
+            f_sample_sites = None
+            header_lines = None
+        else:
+            # Other processes could be adding samples at the same time. They
+            # would all write the same file, so just use whichever is last
+            tmp_suffix = '.tmp.' + socket.gethostname() + '.' + str(os.getpid())
+            f_sample_sites = open(sample_sites_file + tmp_suffix, 'w')
+            header_lines = []
+
+        gt = np.full((self.number_of_sites, 2), missing_int, dtype=np.int16)
+        dp = np.full(self.number_of_sites, missing_int, dtype=np.int32)
+        cov = np.full(self.total_alleles, missing_int, dtype=np.int32)
+        gt_conf = np.full(self.number_of_sites, np.nan, dtype=np.float64)
+
+        try:
+            with open(os.path.join(self.directory, 'sites.tsv')) as f_sites:
+                for site, (record, site_line) in enumerate(itertools.zip_longest(_vcf_record_lines(vcf_file, header_lines=header_lines), f_sites)):
+                    if record is None or site_line is None:
+                        raise Error('Different number of records in VCF file ' + vcf_file + ' and cohort store ' + self.directory)
+                    self._add_sample_vcf_record(vcf_file, site, record[0], site_line, gt, dp, cov, gt_conf)
+                    if f_sample_sites is not None:
+                        print(*record[0][:8], sep='\t', file=f_sample_sites)
+        except:
+            if f_sample_sites is not None:
+                f_sample_sites.close()
+                os.unlink(sample_sites_file + tmp_suffix)
+            raise
+
+        self._write_sample_row('gt', sample, gt)
+        self._write_sample_row('dp', sample, dp)
+        self._write_sample_row('cov', sample, cov)
+        self._write_sample_row('gt_conf', sample, gt_conf)
+        # Only mark the sample as added after all its values are written
+        self._write_sample_row('samples_added', sample, True)
+
+        if f_sample_sites is not None:
+            f_sample_sites.close()
+            with open(sample_header_file + tmp_suffix, 'w') as f:
+                print(*header_lines, sep='\n', file=f)
+            # The header is renamed first, because the sites file existing
+            # means that both files are there
+            os.rename(sample_header_file + tmp_suffix, sample_header_file)
+            os.rename(sample_sites_file + tmp_suffix, sample_sites_file)
+
+        logging.info('Added sample ' + sample_name + ' to cohort store from VCF file ' + vcf_file)
+
+
+    def _add_sample_vcf_record(self, vcf_file, site, fields, site_line, gt, dp, cov, gt_conf):
+        '''Puts the values of one record (split into fields) of the VCF file
+        of a sample into the arrays gt, dp, cov, gt_conf. Missing values
+        are kept as they are in the VCF, eg GT "." or "./."'''
+        site_fields = site_line.rstrip('\n').split('\t')
+        if fields[:2] != site_fields[:2] or fields[3:5] != site_fields[3:5]:
+            raise Error('Mismatch in CHROM/POS/REF/ALT at record ' + str(site + 1) + ' of VCF file ' + vcf_file + ' and cohort store ' + self.directory)
+        if len(fields) < 10:
+            raise Error('No sample column at record ' + str(site + 1) + ' of VCF file ' + vcf_file)
+
+        values = dict(zip(fields[8].split(':'), fields[9].split(':')))
+        if 'GT' in values:
+            gt[site] = _parse_gt(values['GT'])
+        if values.get('DP', '.') != '.':
+            dp[site] = int(values['DP'])
+        if values.get('COV', '.') != '.':
+            site_cov = [int(x) for x in values['COV'].split(',')]
+            start, end = self.allele_offsets[site], self.allele_offsets[site + 1]
+            if len(site_cov) > end - start:
+                raise Error('More COV values than alleles at record ' + str(site + 1) + ' of VCF file ' + vcf_file)
+            cov[start:start + len(site_cov)] = site_cov
+        if values.get('GT_CONF', '.') != '.':
+            gt_conf[site] = float(values['GT_CONF'])
+
+
+    def site_slice(self, chrom, start=None, end=None):
+        '''Returns slice of the site indexes on chrom with start <= POS <= end
+        (1-based, same as the VCF). start/end of None means no limit'''
+        if chrom not in self.chrom_name_to_index:
+            raise Error('CHROM "' + chrom + '" not in cohort store ' + self.directory)
+        chrom_index = self.chrom_name_to_index[chrom]
+        chrom_start = int(np.searchsorted(self.chrom, chrom_index, side='left'))
+        chrom_end = int(np.searchsorted(self.chrom, chrom_index, side='right'))
+        positions = self.pos[chrom_start:chrom_end]
+        first = 0 if start is None else int(np.searchsorted(positions, start, side='left'))
+        last = len(positions) if end is None else int(np.searchsorted(positions, end, side='right'))
+        return slice(chrom_start + first, chrom_start + last)
+
+
+    def sample_indexes(self, samples=None):
+        '''Returns list of indexes of the sample names in samples.
+        samples=None means all samples'''
+        if samples is None:
+            return list(range(len(self.sample_names)))
+        try:
+            return [self.sample_name_to_index[x] for x in samples]
+        except KeyError as e:
+            raise Error('Sample ' + str(e) + ' not in cohort store ' + self.directory)
+
+
+    def _sites_range(self, sites):
+        '''Returns tuple (start, end) of the site indexes in the slice sites
+        (or all sites if sites is None)'''
+        if sites is None:
+            return 0, self.number_of_sites
+        start, end, step = sites.indices(self.number_of_sites)
+        if step != 1:
+            raise Error('Slice of sites must have step 1')
+        return start, max(start, end)
+
+
+    def _padded_cov(self, start, end, sample_indexes):
+        '''Returns numpy array of COV values of sites start to end - 1, shape
+        (sites, samples, max alleles). Alleles that a site does not have are -1'''
+        offsets = self.allele_offsets[start:end + 1] - self.allele_offsets[start]
+        counts = np.diff(offsets)
+        flat = self.cov[sample_indexes, self.allele_offsets[start]:self.allele_offsets[end]]
+        padded = np.full((end - start, len(sample_indexes), self.max_alleles), missing_int, dtype=np.int32)
+        site_indexes = np.repeat(np.arange(end - start), counts)
+        allele_indexes = np.arange(offsets[-1]) - np.repeat(offsets[:-1], counts)
+        padded[site_indexes, :, allele_indexes] = flat.T
+        return padded
+
+
+    def get(self, field, sites=None, samples=None):
+        '''Returns numpy array of the values of field (one of gt, dp, cov,
+        gt_conf) for the sites (a slice, eg from site_slice(), or None for all
+        sites) and list of sample names samples (None for all samples).
+        The first two dimensions of the array are (sites, samples). cov
+        is padded with -1 to max_alleles values per site'''
+        if field not in {'gt', 'dp', 'cov', 'gt_conf'}:
+            raise Error('Field must be one of gt, dp, cov, gt_conf. Got: ' + str(field))
+        start, end = self._sites_range(sites)
+        sample_indexes = self.sample_indexes(samples)
+        if field == 'cov':
+            return self._padded_cov(start, end, sample_indexes)
+        return np.swapaxes(getattr(self, field)[sample_indexes, start:end], 0, 1)
+
+
+    @classmethod
+    def _sample_column(cls, gt, dp, cov, gt_conf):
+        return ':'.join([
+            '.' if dp == missing_int else str(dp),
+            _gt_to_string(gt),
+            _cov_to_string(cov),
+            '.' if np.isnan(gt_conf) else str(gt_conf),
+        ])
+
+
+    def to_vcf(self, outfile, sites=None, samples=None, chunk_size=10000):
+        '''Writes a multi-sample VCF file of the sites (a slice, eg from
+        site_slice(), or None for all sites) and the samples (None means all
+        samples), with the FORMAT column DP:GT:COV:GT_CONF. Samples that have
+        not been added yet get "." in every record. The header and first 8
+        columns are the same as in the per-sample VCF files (if any samples
+        have been added), and the minos FORMAT header lines are added if
+        they are not already there. The arrays are read chunk_size sites at a time'''
+        start, end = self._sites_range(sites)
+        sample_indexes = self.sample_indexes(samples)
+        added = [bool(self.samples_added[i]) for i in sample_indexes]
+        if os.path.exists(os.path.join(self.directory, 'sample_sites.tsv')):
+            header_file = os.path.join(self.directory, 'sample_header.txt')
+            sites_file = os.path.join(self.directory, 'sample_sites.tsv')
+        else:
+            header_file = os.path.join(self.directory, 'header.txt')
+            sites_file = os.path.join(self.directory, 'sites.tsv')
+        with open(header_file) as f:
+            header_lines = [x.rstrip('\n') for x in f if x.strip() != '']
+        for line in gramtools.output_vcf_format_header_lines:
+            if line.split(',', maxsplit=1)[0] not in [x.split(',', maxsplit=1)[0] for x in header_lines]:
+                header_lines.append(line)
+
+        with open(sites_file) as f_sites, open(outfile, 'w') as f:
+            print(*header_lines, sep='\n', file=f)
+            print('#CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO', 'FORMAT', *[self.sample_names[i] for i in sample_indexes], sep='\t', file=f)
+            for i in range(start):
+                f_sites.readline()
+
+            for chunk_start in range(start, end, chunk_size):
+                chunk_end = min(chunk_start + chunk_size, end)
+                gt = self.get('gt', slice(chunk_start, chunk_end), samples).tolist()
+                dp = self.get('dp', slice(chunk_start, chunk_end), samples).tolist()
+                cov = self.get('cov', slice(chunk_start, chunk_end), samples).tolist()
+                gt_conf = self.get('gt_conf', slice(chunk_start, chunk_end), samples).tolist()
+                for i in range(chunk_end - chunk_start):
+                    site_fields = f_sites.readline().rstrip('\n').split('\t')
+                    number_of_alleles = _number_of_alleles(site_fields[4])
+                    columns = [CohortStore._sample_column(gt[i][j], dp[i][j], cov[i][j][:number_of_alleles], gt_conf[i][j]) if added[j] else '.' for j in range(len(sample_indexes))]
+                    print(*site_fields, ':'.join(format_fields), *columns, sep='\t', file=f)
@@ -0,0 +1,388 @@
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pyfastaq
+import pysam
+
+from cluster_vcf_records import vcf_clusterer
+
+from minos import adjudicator, unmapped_reads_splitter, vcf_chunker
+
+class Error (Exception): pass
+
+
+# Default cost model, used when there are no (or not enough) previous
+# gramtools reports to calibrate from. build (seconds) and build_ram (GB)
+# are tuples (intercept, coefficient), applied to the number of alleles.
+# quasimap (seconds) is a tuple (intercept, coefficient of alleles,
+# coefficient of reads file size in bytes)
+default_cost_model = {
+    'build': (10.0, 0.002),
+    'build_ram': vcf_chunker.default_gramtools_ram_model,
+    'quasimap': (5.0, 0.001, 0.0000001),
+}
+
+# Extra bytes added to each VCF record by genotyping
+# (FORMAT and sample columns)
+output_bytes_per_record = 100
+
+estimate_columns = [
+    'split',
+    'chrom',
+    'start',
+    'end',
+    'variants',
+    'alleles',
+    'build_seconds',
+    'build_ram_gb',
+    'reads_bytes',
+    'quasimap_seconds',
+    'output_bytes',
+]
+
+
+def _fit_line(xs, ys, default):
+    '''Returns tuple (intercept, coefficient) of straight line fitted to the
+    points xs, ys. If there are not enough distinct xs to fit a line, then
+    the intercept from default is kept and only the coefficient is fitted.
+    Values are not allowed to be negative'''
+    if len(xs) == 0:
+        return default
+    elif len(set(xs)) == 1:
+        if xs[0] == 0:
+            return default
+        intercept = default[0]
+        coefficient = (np.mean(ys) - intercept) / xs[0]
+    else:
+        coefficient, intercept = np.polyfit(np.array(xs, dtype=float), np.array(ys, dtype=float), 1)
+    return max(0.0, float(intercept)), max(0.0, float(coefficient))
+
+
+def _fit_plane(points, default):
+    '''Returns tuple (intercept, coefficient1, coefficient2) of plane fitted
+    to points = list of (x1, x2, y). If x1 and x2 do not vary enough to fit
+    a plane, then coefficient2 is kept from default and a line is fitted to
+    x1 using _fit_line(). Values are not allowed to be negative'''
+    if len(points) >= 3:
+        xs = np.array([[1, x[0], x[1]] for x in points], dtype=float)
+        if np.linalg.matrix_rank(xs) == 3:
+            fit = np.linalg.lstsq(xs, np.array([x[2] for x in points], dtype=float), rcond=None)[0]
+            return tuple([max(0.0, float(x)) for x in fit])
+
+    intercept, coefficient = _fit_line([x[0] for x in points], [x[2] - default[2] * x[1] for x in points], default[:2])
+    return intercept, coefficient, default[2]
+
+
+def load_stats_from_reports(dirs):
+    '''Returns dict of cost model name -> list of tuples, gathered from
+    gramtools JSON report files found anywhere in the given directories.
+    The tuples are (total alleles, wall clock seconds) for build,
+    (total alleles, peak RAM in GB) for build_ram, and (total alleles,
+    reads bytes, wall clock seconds) for quasimap. Only reports that were
+    annotated by minos (ie that have the key "minos_stats") are used'''
+    stats = {x: [] for x in default_cost_model}
+    for directory in dirs:
+        for root, dirnames, filenames in os.walk(directory):
+            for filename in filenames:
+                if not filename.endswith('.json'):
+                    continue
+                try:
+                    with open(os.path.join(root, filename)) as f:
+                        report = json.load(f)
+                except:
+                    continue
+
+                minos_stats = report.get('minos_stats', None) if type(report) is dict else None
+                if minos_stats is None:
+                    continue
+                elif minos_stats.get('step', None) == 'build':
+                    stats['build'].append((minos_stats['total_alleles'], minos_stats['wall_clock_seconds']))
+                    if 'peak_ram_gb' in minos_stats:
+                        stats['build_ram'].append((minos_stats['total_alleles'], minos_stats['peak_ram_gb']))
+                elif minos_stats.get('step', None) == 'quasimap':
+                    stats['quasimap'].append((minos_stats['total_alleles'], minos_stats.get('reads_bytes', 0), minos_stats['wall_clock_seconds']))
+
+    return stats
+
+
+def calibrate_cost_model(dirs):
+    '''Returns cost model (in the same form as default_cost_model), fitted
+    to the gramtools reports found in the given directories'''
+    stats = load_stats_from_reports(dirs)
+    cost_model = {}
+    for step, units in ('build', 'seconds'), ('build_ram', 'GB'):
+        cost_model[step] = _fit_line([x[0] for x in stats[step]], [x[1] for x in stats[step]], default_cost_model[step])
+        if step == 'build_ram' and cost_model[step][1] <= 0:
+            logging.warning('Fitted GB per allele of build_ram is not more than zero, so it cannot be used to choose split sizes. Using default model')
+            cost_model[step] = default_cost_model[step]
+        logging.info('Cost model for ' + step + ' calibrated from ' + str(len(stats[step])) + ' report(s): ' + units + ' = ' + str(round(cost_model[step][0], 4)) + ' + ' + str(cost_model[step][1]) + ' * alleles')
+    cost_model['quasimap'] = _fit_plane(stats['quasimap'], default_cost_model['quasimap'])
+    logging.info('Cost model for quasimap calibrated from ' + str(len(stats['quasimap'])) + ' report(s): seconds = ' + str(round(cost_model['quasimap'][0], 4)) + ' + ' + str(cost_model['quasimap'][1]) + ' * alleles + ' + str(cost_model['quasimap'][2]) + ' * reads_bytes')
+    return cost_model
+
+
+def gramtools_ram_model_from_options(model_string=None, calibration_dirs=None):
+    '''Returns the model of gramtools RAM to use (tuple (intercept in GB,
+    GB per allele), see vcf_chunker.estimate_gramtools_ram()), or None
+    meaning use vcf_chunker.default_gramtools_ram_model.
+    model_string is of the form "intercept,GB per allele", and is used if
+    given. Otherwise the "build_ram" model is fitted to the gramtools
+    reports in calibration_dirs, if any have the peak RAM'''
+    if model_string is not None:
+        try:
+            model = tuple([float(x) for x in model_string.split(',')])
+        except ValueError:
+            model = None
+        if model is None or len(model) != 2 or model[0] < 0 or model[1] <= 0:
+            raise Error('gramtools RAM model must be of the form "intercept,GB per allele", where intercept is at least zero and GB per allele is more than zero. Got: ' + model_string)
+        return model
+    elif calibration_dirs is None or len(calibration_dirs) == 0:
+        return None
+
+    build_ram_stats = load_stats_from_reports(calibration_dirs)['build_ram']
+    model = _fit_line([x[0] for x in build_ram_stats], [x[1] for x in build_ram_stats], default_cost_model['build_ram'])
+    if len(build_ram_stats) == 0 or model[1] <= 0:
+        logging.warning('Could not calibrate gramtools RAM model from ' + str(len(build_ram_stats)) + ' report(s) with peak RAM. Using default model ' + str(vcf_chunker.default_gramtools_ram_model))
+        return None
+    logging.info('gramtools RAM model calibrated from ' + str(len(build_ram_stats)) + ' report(s): GB = ' + str(round(model[0], 4)) + ' + ' + str(model[1]) + ' * alleles')
+    return model
+
+
+class CostEstimator:
+    '''Predicts the time and RAM that adjudicate would need on a VCF file,
+    without running gramtools. Clusters the VCF file(s) (unless
+    vcf_is_clustered is True), makes the same split plan as VcfChunker, and
+    writes a TSV file of predicted build time, build RAM, quasimap time and
+    output size for each split, plus a total line.
+    If calibration_dirs are given, the cost model is fitted to the gramtools
+    reports in those directories from previous minos runs. The build_ram
+    model (or gramtools_ram_model, if given) is also used to decide whether
+    and how to split, in the same way as adjudicate.
+    If reads_files are given, their size is used to predict quasimap time.
+    Each split gets the reads that adjudicate would give it: the mapped
+    reads in its region (the mapped part of the reads files, shared in
+    proportion to the length of the region including flanks), plus the
+    unmapped reads. If unmapped_reads_dir has per-split unmapped reads files
+    made by adjudicate --filter_unmapped_reads for the same reads and splits,
+    then their sizes are used. Otherwise each split gets all the unmapped
+    reads. The size of a sorted indexed BAM file is shared between mapped
+    and unmapped reads using the read counts in its index. Any other reads
+    file is assumed to be all mapped reads. The reads bytes used are in the
+    output TSV file. If no reads_files, the part of quasimap time that
+    depends on the reads is not included'''
+    def __init__(self,
+        outfile,
+        ref_fasta,
+        vcf_files,
+        vcf_is_clustered=False,
+        max_alleles_per_cluster=5000,
+        total_splits=None,
+        variants_per_split=None,
+        alleles_per_split=None,
+        target_ram_per_split=None,
+        max_read_length=200,
+        calibration_dirs=None,
+        reads_files=None,
+        gramtools_ram_model=None,
+        unmapped_reads_dir=None,
+    ):
+        self.outfile = os.path.abspath(outfile)
+        self.ref_fasta = os.path.abspath(ref_fasta)
+        self.vcf_files = [os.path.abspath(x) for x in vcf_files]
+        self.vcf_is_clustered = vcf_is_clustered
+        self.max_alleles_per_cluster = max_alleles_per_cluster
+        self.total_splits = total_splits
+        self.variants_per_split = variants_per_split
+        self.alleles_per_split = alleles_per_split
+        self.target_ram_per_split = target_ram_per_split
+        self.max_read_length = max_read_length
+        self.calibration_dirs = [] if calibration_dirs is None else calibration_dirs
+        self.gramtools_ram_model = None if gramtools_ram_model is None else tuple(gramtools_ram_model)
+        self.reads_files = [] if reads_files is None else [os.path.abspath(x) for x in reads_files]
+        self.reads_bytes = sum([os.path.getsize(x) for x in self.reads_files])
+        self.unmapped_reads_dir = None if unmapped_reads_dir is None else os.path.abspath(unmapped_reads_dir)
+
+        if self.vcf_is_clustered and len(self.vcf_files) != 1:
+            raise Error('Error! If the VCF is already clustered, must input exactly one VCF file. Got ' + str(len(self.vcf_files)))
+
+
+    @classmethod
+    def _vcf_file_stats(cls, vcf_file, use_start_index=None, use_end_index=None):
+        '''Returns tuple (variants, alleles, bytes) for the records in the VCF
+        file in the given (0-based, inclusive) use range. All records are
+        used by default'''
+        variants = 0
+        alleles = 0
+        total_bytes = 0
+        i = -1
+        with open(vcf_file) as f:
+            for line in f:
+                if line.startswith('#'):
+                    continue
+                i += 1
+                if (use_start_index is not None and i < use_start_index) or (use_end_index is not None and i > use_end_index):
+                    continue
+                variants += 1
+                alleles += 2 + line.split('\t', maxsplit=5)[4].count(',')
+                total_bytes += len(line)
+        return variants, alleles, total_bytes
+
+
+    @classmethod
+    def _estimate_row(cls, name, chrom, start, end, vcf_file, use_start_index, use_end_index, reads_bytes, cost_model):
+        '''Returns dict of estimates for one VCF file, where the graph is made
+        from all the records in the file, but only the records in the use range
+        are genotyped and output. reads_bytes is the size of the reads
+        mapped to the graph'''
+        graph_variants, graph_alleles, graph_bytes = CostEstimator._vcf_file_stats(vcf_file)
+        used_variants, used_alleles, used_bytes = CostEstimator._vcf_file_stats(vcf_file, use_start_index=use_start_index, use_end_index=use_end_index)
+        return {
+            'split': name,
+            'chrom': chrom,
+            'start': start,
+            'end': end,
+            'variants': used_variants,
+            'alleles': used_alleles,
+            'build_seconds': cost_model['build'][0] + cost_model['build'][1] * graph_alleles,
+            'build_ram_gb': cost_model['build_ram'][0] + cost_model['build_ram'][1] * graph_alleles,
+            'reads_bytes': int(round(reads_bytes)),
+            'quasimap_seconds': cost_model['quasimap'][0] + cost_model['quasimap'][1] * graph_alleles + cost_model['quasimap'][2] * reads_bytes,
+            'output_bytes': used_bytes + output_bytes_per_record * used_variants,
+        }
+
+
+    @classmethod
+    def _mapped_and_unmapped_bytes(cls, reads_files):
+        '''Returns tuple (bytes of mapped reads, bytes of unmapped reads) in
+        reads_files. The size of a sorted indexed BAM/CRAM file is shared
+        between mapped and unmapped reads in proportion to their counts in
+        the index. Any other file is counted as all mapped reads'''
+        mapped_bytes = 0
+        unmapped_bytes = 0
+        for filename in reads_files:
+            file_bytes = os.path.getsize(filename)
+            mapped = unmapped = 0
+            try:
+                with pysam.AlignmentFile(filename) as f:
+                    if f.has_index():
+                        mapped, unmapped = f.mapped, f.unmapped
+            except (ValueError, OSError):
+                pass
+
+            if mapped + unmapped == 0:
+                mapped_bytes += file_bytes
+            else:
+                mapped_bytes += file_bytes * mapped / (mapped + unmapped)
+                unmapped_bytes += file_bytes * unmapped / (mapped + unmapped)
+        return mapped_bytes, unmapped_bytes
+
+
+    def _split_unmapped_reads_bytes(self, split_files, unmapped_bytes):
+        '''Returns dict of split file number -> bytes of unmapped reads that
+        adjudicate would give to the split'''
+        if self.unmapped_reads_dir is not None and len(self.reads_files) > 0:
+            splitter = unmapped_reads_splitter.UnmappedReadsSplitter(self.reads_files[0], self.ref_fasta, split_files, self.unmapped_reads_dir)
+            if splitter._load_cached_files():
+                logging.info('Quasimap reads: using sizes of per-split unmapped reads files in ' + self.unmapped_reads_dir)
+                return {x.file_number: os.path.getsize(splitter.split_reads_files[x.file_number]) for x in split_files}
+            logging.info('Quasimap reads: no per-split unmapped reads files in ' + self.unmapped_reads_dir + ' that match the reads and splits')
+
+        logging.info('Quasimap reads: assuming each split gets all the unmapped reads (' + str(int(unmapped_bytes)) + ' bytes)')
+        return {x.file_number: unmapped_bytes for x in split_files}
+
+
+    def _make_estimates(self, tmp_dir, cost_model):
+        if self.vcf_is_clustered:
+            clustered_vcf = self.vcf_files[0]
+        else:
+            clustered_vcf = os.path.join(tmp_dir, 'gramtools.in.vcf')
+            logging.info('Clustering VCF file(s)')
+            clusterer = vcf_clusterer.VcfClusterer(
+                self.vcf_files,
+                self.ref_fasta,
+                clustered_vcf,
+                max_distance_between_variants=1,
+                max_alleles_per_cluster=self.max_alleles_per_cluster,
+            )
+            clusterer.run()
+
+        split_options_used = self.total_splits is not None or self.variants_per_split is not None or self.alleles_per_split is not None
+        if not adjudicator.Adjudicator._should_split_vcf(clustered_vcf, split_options_used, self.target_ram_per_split, gramtools_ram_model=cost_model['build_ram']):
+            logging.info('VCF file would not be split')
+            return [CostEstimator._estimate_row('all', '.', '.', '.', clustered_vcf, None, None, self.reads_bytes, cost_model)]
+
+        chunker = vcf_chunker.VcfChunker(
+            os.path.join(tmp_dir, 'split'),
+            vcf_infile=clustered_vcf,
+            ref_fasta=self.ref_fasta,
+            variants_per_split=self.variants_per_split,
+            alleles_per_split=self.alleles_per_split,
+            max_read_length=self.max_read_length,
+            total_splits=self.total_splits,
+            flank_length=self.max_read_length,
+            target_ram_per_split=self.target_ram_per_split if self.total_splits is None else None,
+            gramtools_ram_model=cost_model['build_ram'],
+        )
+        chunker.make_split_vcf_files()
+        logging.info('VCF file would be split into ' + str(chunker.total_split_files) + ' chunks')
+        split_files = [x for file_list in chunker.vcf_split_files.values() for x in file_list]
+        genome_length = sum([len(x) for x in pyfastaq.sequences.file_reader(self.ref_fasta)])
+        mapped_bytes, unmapped_bytes = CostEstimator._mapped_and_unmapped_bytes(self.reads_files)
+        logging.info('Quasimap reads: sharing ' + str(int(mapped_bytes)) + ' bytes of mapped reads between splits in proportion to the length of each split region (including flanks), out of genome length ' + str(genome_length))
+        split_unmapped_bytes = self._split_unmapped_reads_bytes(split_files, unmapped_bytes)
+        rows = []
+        for split_file in split_files:
+            region_length = split_file.chrom_end - split_file.chrom_start + 1
+            rows.append(CostEstimator._estimate_row(
+                split_file.file_number,
+                split_file.chrom,
+                split_file.chrom_start + 1,
+                split_file.chrom_end + 1,
+                split_file.filename,
+                split_file.use_start_index - split_file.file_start_index,
+                split_file.use_end_index - split_file.file_start_index,
+                mapped_bytes * region_length / max(1, genome_length) + split_unmapped_bytes[split_file.file_number],
+                cost_model,
+            ))
+        return rows
+
+
+    @classmethod
+    def _total_row(cls, rows):
+        total = {x: '.' for x in estimate_columns}
+        total['split'] = 'total'
+        for key in 'variants', 'alleles', 'build_seconds', 'reads_bytes', 'quasimap_seconds', 'output_bytes':
+            total[key] = sum([x[key] for x in rows])
+        total['build_ram_gb'] = max([x['build_ram_gb'] for x in rows])
+        return total
+
+
+    def run(self):
+        if len(self.calibration_dirs) > 0:
+            cost_model = calibrate_cost_model(self.calibration_dirs)
+        else:
+            cost_model = default_cost_model
+        if self.gramtools_ram_model is not None:
+            cost_model = dict(cost_model, build_ram=self.gramtools_ram_model)
+
+        tmp_dir = tempfile.mkdtemp(prefix='tmp.minos_estimate.', dir=os.path.dirname(self.outfile))
+        try:
+            rows = self._make_estimates(tmp_dir, cost_model)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        rows.append(CostEstimator._total_row(rows))
+        with open(self.outfile, 'w') as f:
+            print(*estimate_columns, sep='\t', file=f)
+            for row in rows:
+                print(*[round(row[x], 2) if type(row[x]) is float else row[x] for x in estimate_columns], sep='\t', file=f)
+
+        total = rows[-1]
+        logging.info('Predicted total build time (seconds): ' + str(round(total['build_seconds'], 2)))
+        logging.info('Predicted peak build RAM (GB): ' + str(round(total['build_ram_gb'], 2)))
+        logging.info('Predicted total quasimap time per sample (seconds): ' + str(round(total['quasimap_seconds'], 2)))
+        logging.info('Predicted output VCF size per sample (bytes): ' + str(total['output_bytes']))
@@ -74,6 +74,17 @@ def run_gramtools_build(outdir, vcf_file, ref_file, max_read_length, kmer_size=1
     logging.info('Build report file looks good from gramtools build: ' + build_report)
 
 
+def add_minos_stats_to_report(report_file, stats):
+    '''Adds the dict stats to the gramtools JSON report file, under the
+    key "minos_stats". These are used to calibrate the cost model
+    in cost_estimator'''
+    with open(report_file) as f:
+        report = json.load(f)
+    report['minos_stats'] = stats
+    with open(report_file, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+
 def run_gramtools(build_dir, quasimap_dir, vcf_file, ref_file, reads, max_read_length, kmer_size=10, seed=42):
     '''If build_dir does not exist, runs runs gramtools build and quasimap.
     Otherwise, just runs quasimap. quasimap output is in new
@@ -230,20 +241,22 @@ def update_vcf_record_using_gramtools_allele_depths(vcf_record, allele_combinati
     return filtered_record
 
 
-def write_vcf_annotated_using_coverage_from_gramtools(mean_depth, vcf_records, all_allele_coverage, allele_groups, read_error_rate, outfile, kmer_size, sample_name='SAMPLE', max_read_length=None, filtered_outfile=None):
-    '''mean_depth, vcf_records, all_allele_coverage, allele_groups should be those
-    returned by load_gramtools_vcf_and_allele_coverage_files().
-    Writes a new VCF that has allele counts for all the ALTs'''
-    assert len(vcf_records) == len(all_allele_coverage)
+# FORMAT header lines of the VCF files output by minos
+output_vcf_format_header_lines = [
+    '##FORMAT=<ID=COV,Number=R,Type=Integer,Description="Number of reads on ref and alt alleles">',
+    '##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">',
+    '##FORMAT=<ID=DP,Number=1,Type=Integer,Description="total kmer depth from gramtools",Source="minos">',
+    '##FORMAT=<ID=GT_CONF,Number=1,Type=Float,Description="Genotype confidence. Difference in log likelihood of most likely and next most likely genotype">',
+]
+
 
+def make_output_vcf_header_lines(sample_name, max_read_length=None):
+    '''Returns list of header lines for VCF files output by minos'''
     header_lines = [
         '##fileformat=VCFv4.2',
         '##source=minos, version ' + minos_version,
         '##fileDate=' + str(datetime.date.today()),
-        '##FORMAT=<ID=COV,Number=R,Type=Integer,Description="Number of reads on ref and alt alleles">',
-        '##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">',
-        '##FORMAT=<ID=DP,Number=1,Type=Integer,Description="total kmer depth from gramtools",Source="minos">',
-        '##FORMAT=<ID=GT_CONF,Number=1,Type=Float,Description="Genotype confidence. Difference in log likelihood of most likely and next most likely genotype">',
+        *output_vcf_format_header_lines,
         '##INFO=<ID=KMER,Number=1,Type=Integer,Description="Kmer size at which variant was discovered (kmer-size used by gramtools build)">',
     ]
 
@@ -251,23 +264,48 @@ def write_vcf_annotated_using_coverage_from_gramtools(mean_depth, vcf_records, a
         header_lines.append('##minos_max_read_length=' + str(max_read_length))
 
     header_lines.append('\t'.join(['#CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO', 'FORMAT', sample_name]))
+    return header_lines
 
-    if filtered_outfile is not None:
-        f_filter = open(filtered_outfile, 'w')
-        print(*header_lines, sep='\n', file=f_filter)
 
-    with open(outfile, 'w') as f:
-        print(*header_lines, sep='\n', file=f)
-
-        for i in range(len(vcf_records)):
-            logging.debug('Genotyping: ' + str(vcf_records[i]))
-            filtered_record = update_vcf_record_using_gramtools_allele_depths(vcf_records[i], all_allele_coverage[i][0], all_allele_coverage[i][1], allele_groups, mean_depth, read_error_rate, kmer_size)
+def write_vcf_annotated_using_coverage_from_gramtools(mean_depth, vcf_records, all_allele_coverage, allele_groups, read_error_rate, outfile, kmer_size, sample_name='SAMPLE', max_read_length=None, filtered_outfile=None, use_start_index=None, use_end_index=None, record_callback=None):
+    '''mean_depth, vcf_records, all_allele_coverage, allele_groups should be those
+    returned by load_gramtools_vcf_and_allele_coverage_files().
+    Writes a new VCF that has allele counts for all the ALTs.
+    If use_start_index and/or use_end_index are given, then only the
+    records in that range (0-based, inclusive) are genotyped and written.
+    This is used to skip the flanking records of split VCF files.
+    If record_callback is given, it is called on each filtered
+    record as soon as it is genotyped. outfile can be None (and
+    filtered_outfile is optional), for example if the caller only
+    wants the records given to record_callback'''
+    assert len(vcf_records) == len(all_allele_coverage)
+    use_start_index = 0 if use_start_index is None else use_start_index
+    use_end_index = len(vcf_records) - 1 if use_end_index is None else use_end_index
+    assert 0 <= use_start_index and use_end_index < len(vcf_records)
+
+    header_lines = make_output_vcf_header_lines(sample_name, max_read_length=max_read_length)
+    out_files = []
+    for filename in outfile, filtered_outfile:
+        if filename is None:
+            out_files.append(None)
+        else:
+            out_files.append(open(filename, 'w'))
+            print(*header_lines, sep='\n', file=out_files[-1])
+    f, f_filter = out_files
+
+    for i in range(use_start_index, use_end_index + 1):
+        logging.debug('Genotyping: ' + str(vcf_records[i]))
+        filtered_record = update_vcf_record_using_gramtools_allele_depths(vcf_records[i], all_allele_coverage[i][0], all_allele_coverage[i][1], allele_groups, mean_depth, read_error_rate, kmer_size)
+        if f is not None:
             print(vcf_records[i], file=f)
-            if filtered_outfile is not None:
-                print(filtered_record, file=f_filter)
-
-    if filtered_outfile is not None:
-        f_filter.close()
+        if f_filter is not None:
+            print(filtered_record, file=f_filter)
+        if record_callback is not None:
+            record_callback(filtered_record)
+
+    for f_out in out_files:
+        if f_out is not None:
+            f_out.close()
 
 
 def load_allele_files(allele_base_counts_file, grouped_allele_counts_file):
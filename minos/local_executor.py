@@ -0,0 +1,132 @@
+import logging
+import multiprocessing
+import os
+import queue
+import resource
+import traceback
+
+class Error (Exception): pass
+
+
+def total_ram_gb():
+    '''Returns the total RAM of this machine in GB'''
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1024**3
+
+
+def _set_ram_limit(ram_gb):
+    '''Limits the address space of this process (and of processes it starts
+    later) to ram_gb GB. Cannot go above the existing hard limit'''
+    soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+    limit = int(ram_gb * 1024**3)
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+    resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+
+
+def _run_task(task_id, function, args, results_queue, ram_limit_gb=None):
+    '''Runs function(*args) in a child process. Puts tuple
+    (task id, error message, return value) into results_queue.
+    Error message is None if the function ran successfully.
+    If ram_limit_gb is given, the address space of the process is
+    limited to that many GB before running the function'''
+    try:
+        if ram_limit_gb is not None:
+            _set_ram_limit(ram_limit_gb)
+        result = function(*args)
+    except Exception:
+        results_queue.put((task_id, traceback.format_exc(), None))
+    else:
+        results_queue.put((task_id, None, result))
+
+
+class LocalExecutor:
+    '''Runs stages of tasks on this machine, as an alternative to nextflow.
+    Each task is a Python function run in its own process (so that tasks
+    can make their own process pools, eg gramtools build on split VCF files).
+    Each task asks for an amount of RAM in GB and a number of CPUs. A task is
+    only started if the total RAM and CPUs of running tasks stay within
+    max_ram and threads, except that a task always starts if nothing else is
+    running. A task that fails is retried, up to max_attempts times in total,
+    asking for its RAM multiplied by the attempt number (in the same way as
+    the nextflow pipeline).
+    By default, the RAM of a task is only a reservation used for scheduling:
+    nothing stops a task using more. If enforce_ram is True, then the
+    address space of the task's process is limited to its RAM, using
+    RLIMIT_AS. The limit applies to each process of the task separately
+    (including programs it runs, like gramtools), and counts virtual memory,
+    which can be more than the resident memory reported by nextflow'''
+    def __init__(self, threads=1, max_ram=None, max_attempts=3, enforce_ram=False):
+        self.threads = threads
+        self.max_ram = total_ram_gb() if max_ram is None else max_ram
+        self.max_attempts = max_attempts
+        self.enforce_ram = enforce_ram
+        if self.threads < 1:
+            raise Error('threads must be at least 1. Got ' + str(self.threads))
+        if self.max_attempts < 1:
+            raise Error('max_attempts must be at least 1. Got ' + str(self.max_attempts))
+
+
+    def _can_start(self, ram, cpus, running):
+        if len(running) == 0:
+            return True
+        used_ram = sum([x['ram'] for x in running.values()])
+        used_cpus = sum([x['cpus'] for x in running.values()])
+        return used_ram + ram <= self.max_ram and used_cpus + cpus <= self.threads
+
+
+    def run_stage(self, stage_name, tasks):
+        '''Runs all the tasks of one stage. tasks = list of tuples
+        (function, tuple of args, RAM in GB, number of CPUs).
+        Returns list of the return values of the tasks, in the same order
+        as tasks. Raises Error if any task still failed after max_attempts'''
+        logging.info('Start stage ' + stage_name + '. Tasks: ' + str(len(tasks)))
+        results_queue = multiprocessing.Queue()
+        to_run = [(i, 1) for i in range(len(tasks))] # (task index, attempt number)
+        running = {} # task index -> dict of process, ram, cpus, attempt
+        results = [None] * len(tasks)
+        failed = {} # task index -> error message
+
+        while len(to_run) > 0 or len(running) > 0:
+            while len(to_run) > 0:
+                task_index, attempt = to_run[0]
+                function, args, ram, cpus = tasks[task_index]
+                ram = min(ram * attempt, self.max_ram)
+                cpus = min(cpus, self.threads)
+                if not self._can_start(ram, cpus, running):
+                    break
+                to_run.pop(0)
+                process = multiprocessing.Process(target=_run_task, args=(task_index, function, args, results_queue, ram if self.enforce_ram else None))
+                process.start()
+                running[task_index] = {'process': process, 'ram': ram, 'cpus': cpus, 'attempt': attempt}
+                logging.info('Stage ' + stage_name + ': started task ' + str(task_index) + ' (attempt ' + str(attempt) + ', RAM ' + str(round(ram, 2)) + 'GB, CPUs ' + str(cpus) + ')')
+
+            try:
+                task_index, error_message, result = results_queue.get(timeout=1)
+            except queue.Empty:
+                # Catch processes that died without putting anything in the
+                # queue, eg killed by the OS for using too much RAM
+                dead = [i for i, x in running.items() if not x['process'].is_alive() and x['process'].exitcode != 0]
+                if len(dead) == 0:
+                    continue
+                task_index = dead[0]
+                error_message = 'Process exited with code ' + str(running[task_index]['process'].exitcode)
+                result = None
+
+            task = running.pop(task_index)
+            task['process'].join()
+            if error_message is None:
+                results[task_index] = result
+                logging.info('Stage ' + stage_name + ': finished task ' + str(task_index))
+            elif task['attempt'] < self.max_attempts:
+                logging.warning('Stage ' + stage_name + ': task ' + str(task_index) + ' failed on attempt ' + str(task['attempt']) + '. Retrying. Error: ' + error_message)
+                to_run.append((task_index, task['attempt'] + 1))
+            else:
+                logging.error('Stage ' + stage_name + ': task ' + str(task_index) + ' failed on attempt ' + str(task['attempt']) + '. Error: ' + error_message)
+                failed[task_index] = error_message
+
+        results_queue.close()
+        if len(failed) > 0:
+            raise Error('Stage ' + stage_name + ': ' + str(len(failed)) + ' task(s) failed after ' + str(self.max_attempts) + ' attempts. See log for details')
+
+        logging.info('Finish stage ' + stage_name)
+        return results
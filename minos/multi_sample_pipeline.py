@@ -1,10 +1,18 @@
+import bisect
+import contextlib
+import heapq
+import itertools
+import json
 import logging
+import multiprocessing.pool
 import os
 import shutil
+import statistics
+import tempfile
 
-from cluster_vcf_records import vcf_file_read
+from cluster_vcf_records import vcf_clusterer, vcf_file_read, vcf_record
 
-from minos import dependencies, utils, vcf_file_split_deletions
+from minos import batch_adjudicator, cohort_store, dependencies, gramtools, local_executor, resource_predictor, utils, vcf_chunker, vcf_file_split_deletions, vcf_tree_merge
 
 class Error (Exception): pass
 
@@ -31,6 +39,19 @@ class MultiSamplePipeline:
         nf_ram_gramtools_build_small=12,
         nf_ram_minos_small_vars=5,
         nf_ram_merge_small_vars=4,
+        nf_ram_pre_cluster_merge_group=2,
+        nf_ram_pre_cluster_merge=8,
+        minos_batch_size=1,
+        minos_batch_threads=1,
+        cohort_store=False,
+        executor='nextflow',
+        threads=1,
+        local_max_ram=None,
+        local_enforce_ram=False,
+        update=False,
+        pre_cluster_merge_group_size=100,
+        predict_ram=False,
+        ram_calibration_dirs=None,
     ):
         self.ref_fasta = os.path.abspath(ref_fasta)
         if not os.path.exists(self.ref_fasta):
@@ -66,11 +87,48 @@ class MultiSamplePipeline:
         self.nf_ram_gramtools_build_small = nf_ram_gramtools_build_small
         self.nf_ram_minos_small_vars = nf_ram_minos_small_vars
         self.nf_ram_merge_small_vars = nf_ram_merge_small_vars
+        self.nf_ram_pre_cluster_merge_group = nf_ram_pre_cluster_merge_group
+        self.nf_ram_pre_cluster_merge = nf_ram_pre_cluster_merge
+        self.minos_batch_size = minos_batch_size
+        self.minos_batch_threads = minos_batch_threads
+        self.cohort_store = cohort_store
+        self.cohort_store_dir = os.path.join(self.output_dir, 'cohort_store')
+        self.executor = executor
+        self.threads = threads
+        self.local_max_ram = local_max_ram
+        self.local_enforce_ram = local_enforce_ram
+        self.local_work_dir = os.path.join(self.output_dir, 'local.work')
+        self.local_samples_json = os.path.join(self.local_work_dir, 'samples.json')
+        self.update = update
+        self.pre_cluster_merge_group_size = pre_cluster_merge_group_size
+        if self.pre_cluster_merge_group_size < 2:
+            raise Error('pre_cluster_merge_group_size must be at least 2. Got: ' + str(self.pre_cluster_merge_group_size))
+        if ram_calibration_dirs is not None and len(ram_calibration_dirs) > 0:
+            self.ram_model = resource_predictor.calibrate_ram_model(ram_calibration_dirs)
+        elif predict_ram:
+            self.ram_model = resource_predictor.default_ram_model
+        else:
+            self.ram_model = resource_predictor.fixed_ram_model(
+                self.nf_ram_cluster_small_vars,
+                self.nf_ram_gramtools_build_small,
+                self.nf_ram_minos_small_vars,
+                pre_cluster_merge_group_ram=self.nf_ram_pre_cluster_merge_group,
+                pre_cluster_merge_ram=self.nf_ram_pre_cluster_merge,
+            )
+        self.nextflow_ram_model_json = os.path.join(self.output_dir, 'nextflow.ram_model.json')
+        self.nextflow_trace_config = os.path.join(self.output_dir, 'nextflow.trace.config')
+        if self.executor not in {'nextflow', 'local'}:
+            raise Error('Executor must be "nextflow" or "local". Got: ' + str(self.executor))
+        if self.update and self.executor != 'local':
+            raise Error('Update mode can only be used with the local executor')
 
 
 
     @classmethod
-    def _load_input_data_tsv(cls, infile):
+    def _load_input_data_tsv(cls, infile, threads=16):
+        '''Returns list of tuples (VCF filename, list of reads filenames).
+        The files are checked to exist using a pool of threads, because on
+        network filesystems checking thousands of files one at a time is slow'''
         logging.info('Start reading file ' + infile)
         data = []
         with open(infile) as f:
@@ -80,56 +138,162 @@ class MultiSamplePipeline:
                 except:
                     raise Error('Bad line in input TSV file: ' + line.rstrip())
 
-                if not(os.path.exists(vcf_file)):
-                    raise Error('VCF file not found: ' + vcf_file)
-                for reads_file in reads_files:
-                    if not(os.path.exists(reads_file)):
-                        raise Error('Reads file not found: ' + reads_file)
+                data.append((vcf_file, reads_files))
 
-                data.append((os.path.abspath(vcf_file), [os.path.abspath(x) for x in reads_files]))
+        to_check = [('VCF', x[0]) for x in data]
+        for vcf_file, reads_files in data:
+            to_check.extend([('Reads', x) for x in reads_files])
+        with multiprocessing.pool.ThreadPool(max(1, min(threads, len(to_check)))) as pool:
+            exists = pool.map(os.path.exists, [x[1] for x in to_check])
+        for (file_type, filename), file_exists in zip(to_check, exists):
+            if not file_exists:
+                raise Error(file_type + ' file not found: ' + filename)
 
+        data = [(os.path.abspath(x[0]), [os.path.abspath(y) for y in x[1]]) for x in data]
         logging.info('Finish reading file ' + infile + '. Loaded ' + str(len(data)) + ' samples')
         return data
 
 
     @classmethod
-    def _merge_vcf_files(cls, infiles_list, outfile):
-        '''Reimplementation of bcftools merge. Load all files into
-        memory, then write output. bcftools opens all files at the same
-        time, which doesn't work for lots of files'''
-        vcf_file_data_list_per_sample = []
+    def _merge_vcf_files_batch(cls, infiles_list, outfile):
+        '''Merges the VCF files infiles_list, which must all have the same
+        records in the same order (but can have any number of samples each),
+        into one VCF file. All the input files are opened at the same time,
+        and read one line from each at a time, so memory use does not depend
+        on the number of records'''
         sample_names = []
         header_lines = []
-        common_first_column_data = []
-        first_file = True
-
-        for filename in infiles_list:
-            new_data = []
 
-            with open(filename) as f_vcf:
+        with contextlib.ExitStack() as stack:
+            file_handles = [stack.enter_context(open(x)) for x in infiles_list]
+            for i, f_vcf in enumerate(file_handles):
                 for vcf_line in f_vcf:
-                    if vcf_line.startswith('#'):
-                        if first_file and vcf_line.startswith('##'):
-                            header_lines.append(vcf_line.rstrip())
-                        elif vcf_line.startswith('#CHROM'):
-                            fields = vcf_line.rstrip().split('\t')
-                            assert len(fields) == 10
-                            sample_names.append(fields[-1])
-                    else:
-                        first_columns, last_column = vcf_line.rstrip().rsplit('\t', maxsplit=1)
-                        new_data.append(last_column)
-                        if first_file:
-                            common_first_column_data.append(first_columns)
+                    if vcf_line.startswith('#CHROM'):
+                        fields = vcf_line.rstrip().split('\t')
+                        if len(fields) < 10:
+                            raise Error('No sample columns in #CHROM line of VCF file ' + infiles_list[i])
+                        sample_names.extend(fields[9:])
+                        break
+                    elif i == 0 and vcf_line.startswith('##'):
+                        header_lines.append(vcf_line.rstrip())
+                else:
+                    raise Error('No #CHROM line found in VCF file ' + infiles_list[i])
+
+            with open(outfile, 'w') as f:
+                print(*header_lines, sep='\n', file=f)
+                print('#CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO', 'FORMAT', *sample_names, sep='\t', file=f)
+                for line_number, vcf_lines in enumerate(itertools.zip_longest(*file_handles), start=1):
+                    if None in vcf_lines:
+                        raise Error('VCF files have different numbers of records. Cannot merge. Files: ' + ' '.join([infiles_list[i] for i, x in enumerate(vcf_lines) if x is None]))
+                    fields_list = [x.rstrip().split('\t', maxsplit=9) for x in vcf_lines]
+                    first_fields = fields_list[0]
+                    for i, fields in enumerate(fields_list):
+                        if fields[:2] != first_fields[:2] or fields[3:5] != first_fields[3:5]:
+                            raise Error('Mismatch in CHROM/POS/REF/ALT at record ' + str(line_number) + ' of VCF files ' + infiles_list[0] + ' and ' + infiles_list[i] + '. Cannot merge')
+                    print(*first_fields[:9], *[x[9] for x in fields_list], sep='\t', file=f)
 
-            vcf_file_data_list_per_sample.append(new_data)
-            first_file = False
 
-        with open(outfile, 'w') as f:
-            print(*header_lines, sep='\n', file=f)
-            print('#CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO', 'FORMAT', *sample_names, sep='\t', file=f)
-            for i, common_first_data in enumerate(common_first_column_data):
-                sample_data_cols = [vcf_file_data_list_per_sample[j][i] for j in range(len(vcf_file_data_list_per_sample))]
-                print(common_first_data, *sample_data_cols, sep='\t', file=f)
+    @classmethod
+    def _merge_vcf_files(cls, infiles_list, outfile, max_open_files=500):
+        '''Reimplementation of bcftools merge. The files are read one line at
+        a time, so memory use does not grow with the number of samples or
+        records. bcftools opens all files at the same time, which doesn't
+        work for lots of files. If there are more than max_open_files input
+        files, then they are merged in passes: each pass merges batches of
+        max_open_files files into temporary multi-sample files, until there are
+        few enough files to merge into outfile'''
+        assert max_open_files > 1
+        outfile = os.path.abspath(outfile)
+        tmp_dir = None
+        merge_pass = 0
+
+        try:
+            while len(infiles_list) > max_open_files:
+                if tmp_dir is None:
+                    tmp_dir = tempfile.mkdtemp(prefix=os.path.basename(outfile) + '.tmp.merge.', dir=os.path.dirname(outfile))
+                merge_pass += 1
+                merged_files = []
+                for i in range(0, len(infiles_list), max_open_files):
+                    merged_files.append(os.path.join(tmp_dir, 'pass.' + str(merge_pass) + '.' + str(len(merged_files)) + '.vcf'))
+                    MultiSamplePipeline._merge_vcf_files_batch(infiles_list[i:i + max_open_files], merged_files[-1])
+                logging.info('Merge pass ' + str(merge_pass) + ': merged ' + str(len(infiles_list)) + ' VCF files into ' + str(len(merged_files)) + ' files')
+                if merge_pass > 1:
+                    for filename in infiles_list:
+                        os.unlink(filename)
+                infiles_list = merged_files
+
+            MultiSamplePipeline._merge_vcf_files_batch(infiles_list, outfile)
+        finally:
+            if tmp_dir is not None:
+                shutil.rmtree(tmp_dir)
+
+
+    @classmethod
+    def _create_cohort_store(cls, sites_vcf, sample_names_file, outdir):
+        '''Makes an empty cohort_store.CohortStore in outdir, with the sites
+        in sites_vcf (the clustered VCF file that minos is run on), and the
+        samples in sample_names_file (one name per line). Any existing outdir
+        is replaced. The samples are added later, as each minos run finishes'''
+        with open(sample_names_file) as f:
+            sample_names = [x.rstrip('\n') for x in f if x.strip() != '']
+        if os.path.exists(outdir):
+            shutil.rmtree(outdir)
+        cohort_store.create_store(outdir, sites_vcf, sample_names)
+
+
+    @classmethod
+    def _add_samples_to_cohort_store(cls, store_dir, sample_names, vcf_files):
+        store = cohort_store.CohortStore(store_dir, mode='r+')
+        for sample_name, vcf_file in zip(sample_names, vcf_files):
+            store.add_sample_vcf(sample_name, vcf_file)
+
+
+    @classmethod
+    def _add_batch_to_cohort_store(cls, store_dir, batch_tsv):
+        '''Adds the samples of one minos adjudicate_batch run to the cohort
+        store. batch_tsv is the samples file of the batch'''
+        sample_names = []
+        vcf_files = []
+        for outdir, sample_name, reads_files in batch_adjudicator.BatchAdjudicator._load_samples_tsv(batch_tsv):
+            vcf_files.append(os.path.join(outdir, 'debug.calls_with_zero_cov_alleles.vcf'))
+            sample_names.append(vcf_file_read.get_sample_name_from_vcf_file(vcf_files[-1]) if sample_name is None else sample_name)
+        MultiSamplePipeline._add_samples_to_cohort_store(store_dir, sample_names, vcf_files)
+
+
+    @classmethod
+    def _filter_vcf_record_for_clustering(cls, vcf_record):
+        '''Returns vcf_record, changed to only have the called alleles,
+        or None if the record should not be used for clustering'''
+        if vcf_record.FILTER == 'MISMAPPED_UNPLACEABLE':
+            return None
+        if vcf_record.FORMAT is None or 'GT' not in vcf_record.FORMAT:
+            logging.warning('No GT in vcf record:' + str(vcf_record))
+            return None
+
+        genotype = vcf_record.FORMAT['GT']
+        genotypes = genotype.split('/')
+
+        called_alleles = set(genotypes)
+        if called_alleles == {'0'} or '.' in called_alleles:
+            return None
+
+        genotypes = sorted([int(x) for x in genotypes])
+
+        if len(called_alleles) == 1:
+            assert 0 not in genotypes
+            vcf_record.set_format_key_value('GT', '1/1')
+            vcf_record.ALT = [vcf_record.ALT[int(genotypes[0]) - 1]]
+        else:
+            assert len(called_alleles) == 2
+            vcf_record.set_format_key_value('GT', '0/1')
+            if 0 in genotypes:
+                vcf_record.set_format_key_value('GT', '0/1')
+                vcf_record.ALT = [vcf_record.ALT[genotypes[1] - 1]]
+            else:
+                vcf_record.set_format_key_value('GT', '1/2')
+                vcf_record.ALT = [vcf_record.ALT[genotypes[0] - 1], vcf_record.ALT[genotypes[1] - 1]]
+
+        return vcf_record
 
 
     @classmethod
@@ -139,36 +303,113 @@ class MultiSamplePipeline:
             print(*header_lines, sep='\n', file=f)
             for ref_name in vcf_records:
                 for vcf_record in vcf_records[ref_name]:
-                    if vcf_record.FILTER == 'MISMAPPED_UNPLACEABLE':
-                        continue
-                    if vcf_record.FORMAT is None or 'GT' not in vcf_record.FORMAT:
-                        logging.warning('No GT in vcf record:' + str(vcf_record))
-                        continue
+                    vcf_record = MultiSamplePipeline._filter_vcf_record_for_clustering(vcf_record)
+                    if vcf_record is not None:
+                        print(vcf_record, file=f)
 
-                    genotype = vcf_record.FORMAT['GT']
-                    genotypes = genotype.split('/')
 
-                    called_alleles = set(genotypes)
-                    if called_alleles == {'0'} or '.' in called_alleles:
-                        continue
+    @classmethod
+    def _filtered_vcf_records_from_sorted_lines(cls, lines):
+        '''Yields the records from the iterable of VCF record lines that pass
+        _filter_vcf_record_for_clustering, in the same order as
+        _filter_input_file_for_clustering writes them. The lines must be
+        sorted (each CHROM in one block, sorted by POS). Removing useless start
+        nucleotides can move a record after the next ones, so records
+        are held in a heap until no later line can come before them.
+        Raises Error if the lines are not sorted'''
+        held = [] # heap of (POS, line number, record)
+        chroms_done = set()
+        chrom = None
+        previous_pos = None
+
+        for line_number, line in enumerate(lines):
+            record = vcf_record.VcfRecord(line)
+            if record.CHROM != chrom:
+                if record.CHROM in chroms_done:
+                    raise Error('VCF records not sorted. ' + record.CHROM + ' found in more than one block')
+                while len(held) > 0:
+                    yield heapq.heappop(held)[2]
+                if chrom is not None:
+                    chroms_done.add(chrom)
+                chrom = record.CHROM
+            elif record.POS < previous_pos:
+                raise Error('VCF records not sorted. ' + record.CHROM + ':' + str(record.POS + 1) + ' is after position ' + str(previous_pos + 1))
+            previous_pos = record.POS
+
+            # Every record from here on has POS >= this record's original POS
+            while len(held) > 0 and held[0][0] <= record.POS:
+                yield heapq.heappop(held)[2]
+
+            record.remove_asterisk_alts()
+            if len(record.ALT) < 1:
+                continue
+            record.remove_useless_start_nucleotides()
+            record = MultiSamplePipeline._filter_vcf_record_for_clustering(record)
+            if record is not None:
+                heapq.heappush(held, (record.POS, line_number, record))
+
+        while len(held) > 0:
+            yield heapq.heappop(held)[2]
 
-                    genotypes = sorted([int(x) for x in genotypes])
 
-                    if len(called_alleles) == 1:
-                        assert 0 not in genotypes
-                        vcf_record.set_format_key_value('GT', '1/1')
-                        vcf_record.ALT = [vcf_record.ALT[int(genotypes[0]) - 1]]
+    @classmethod
+    def _write_small_and_big_vars(cls, filtered_records, header_lines, out_small_vars, out_big_vars, min_large_ref_length):
+        '''Splits each record in filtered_records into SNPs where possible
+        (same as vcf_file_split_deletions.VcfFileSplitDeletions), writing
+        records with REF shorter than min_large_ref_length to out_small_vars,
+        and the rest to out_big_vars'''
+        with open(out_small_vars, 'w') as f_small, open(out_big_vars, 'w') as f_big:
+            print(*header_lines, sep='\n', file=f_small)
+            print(*header_lines, sep='\n', file=f_big)
+            for filtered_record in filtered_records:
+                for record in filtered_record.split_into_snps():
+                    if len(record.REF) < min_large_ref_length:
+                        print(record, file=f_small)
                     else:
-                        assert len(called_alleles) == 2
-                        vcf_record.set_format_key_value('GT', '0/1')
-                        if 0 in genotypes:
-                            vcf_record.set_format_key_value('GT', '0/1')
-                            vcf_record.ALT = [vcf_record.ALT[genotypes[1] - 1]]
-                        else:
-                            vcf_record.set_format_key_value('GT', '1/2')
-                            vcf_record.ALT = [vcf_record.ALT[genotypes[0] - 1], vcf_record.ALT[genotypes[1] - 1]]
+                        print(record, file=f_big)
 
-                    print(vcf_record, file=f)
+
+    @classmethod
+    def _process_input_vcf_file(cls, infile, out_small_vars, out_big_vars, out_sample_name, min_large_ref_length):
+        '''Makes the same output files as running _filter_input_file_for_clustering
+        and then _nextflow_helper_process_input_vcf_file, but in one pass
+        through infile that is streamed instead of loaded into memory.
+        If infile is not sorted, falls back to loading the whole file.
+        Returns the max read length from the header, or None if not found'''
+        header_lines = []
+        with vcf_file_read.open_vcf_file_for_reading(infile) as f:
+            for line in f:
+                if line.startswith('#'):
+                    header_lines.append(line.rstrip())
+                else:
+                    break
+            else:
+                line = None
+
+            first_line = [] if line is None else [line]
+            try:
+                filtered_records = MultiSamplePipeline._filtered_vcf_records_from_sorted_lines(itertools.chain(first_line, f))
+                MultiSamplePipeline._write_small_and_big_vars(filtered_records, header_lines, out_small_vars, out_big_vars, min_large_ref_length)
+                is_sorted = True
+            except Error as e:
+                logging.info(str(e) + '. Loading all of file ' + infile + ' to sort it')
+                is_sorted = False
+
+        if not is_sorted:
+            header_lines, vcf_records = vcf_file_read.vcf_file_to_dict(infile, sort=True, homozygous_only=False, remove_asterisk_alts=True, remove_useless_start_nucleotides=True)
+            filtered_records = (MultiSamplePipeline._filter_vcf_record_for_clustering(x) for x in itertools.chain.from_iterable(vcf_records.values()))
+            MultiSamplePipeline._write_small_and_big_vars((x for x in filtered_records if x is not None), header_lines, out_small_vars, out_big_vars, min_large_ref_length)
+
+        sample_name = vcf_file_read.get_sample_name_from_vcf_header_lines(header_lines)
+        assert sample_name is not None
+        with open(out_sample_name, 'w') as f:
+            print(sample_name, file=f)
+
+        max_read_length = None
+        for line in header_lines:
+            if line.startswith('##minos_max_read_length='):
+                max_read_length = int(line.rstrip().split('=')[1])
+        return max_read_length
 
 
     @classmethod
@@ -192,11 +433,19 @@ class MultiSamplePipeline:
 
 
     @classmethod
-    def _write_nextflow_data_tsv(cls, data, outfile):
+    def _reads_files_bytes(cls, data, threads=16):
+        '''Returns list of the total size in bytes of the reads files of
+        each sample in data (made by _load_input_data_tsv())'''
+        with multiprocessing.pool.ThreadPool(max(1, min(threads, len(data)))) as pool:
+            return pool.map(lambda x: sum([os.path.getsize(y) for y in x[1]]), data)
+
+
+    @classmethod
+    def _write_nextflow_data_tsv(cls, data, reads_bytes, outfile):
         with open(outfile, 'w') as f:
-            print('sample_id', 'vcf_file', 'reads_files', sep='\t', file=f)
-            for i, (vcf_file, reads_files) in enumerate(data):
-                print(i, vcf_file, ' '.join(reads_files), sep='\t', file=f)
+            print('sample_id', 'vcf_file', 'reads_files', 'reads_bytes', sep='\t', file=f)
+            for i, ((vcf_file, reads_files), total_bytes) in enumerate(zip(data, reads_bytes)):
+                print(i, vcf_file, ' '.join(reads_files), total_bytes, sep='\t', file=f)
 
 
     @classmethod
@@ -210,16 +459,17 @@ params.gramtools_kmer_size = 0
 params.gramtools_build_threads = 1
 params.final_outdir = ""
 params.testing = false
-params.cluster_small_vars_ram = 2
-params.gramtools_build_small_vars_ram = 12
-params.minos_small_vars_ram = 5
-params.pre_cluster_small_vars_merge_ram = 8
+params.minos_batch_size = 1
+params.minos_batch_threads = 1
 params.pre_cluster_small_vars_merge_threads = 10
+params.pre_cluster_merge_group_size = 100
 params.merge_small_vars_ram = 4
 params.variants_per_split = 0
 params.alleles_per_split = 0
 params.total_splits = 0
 params.max_alleles_per_cluster = 5000
+params.cohort_store = false
+params.ram_model_json = ""
 
 
 if (params.testing) {
@@ -251,6 +501,50 @@ if (!final_outdir.exists()) {
     exit 1, "Output directory not found: ${params.final_outdir} -- aborting"
 }
 
+if (!file(params.ram_model_json).exists()) {
+    exit 1, "RAM model JSON file not found: ${params.ram_model_json} -- aborting"
+}
+
+ram_model = new groovy.json.JsonSlurper().parseText(file(params.ram_model_json).text)
+
+// Returns the memory of a task of the given stage, predicted by the RAM model
+// from minos.resource_predictor. metrics_string is name=value pairs separated
+// by spaces. This is the same as resource_predictor.predict_ram_gb(), multiplied
+// by the attempt number
+def predicted_memory(stage, metrics_string, attempt) {
+    def metrics = [:]
+    metrics_string.trim().split(/\s+/).each{ def fields = it.split('='); metrics[fields[0]] = fields[1].toDouble() }
+    def model = ram_model.stages[stage]
+    double ram_gb = model.intercept
+    model.coefficients.each{ name, coefficient -> ram_gb += coefficient * metrics.get(name, 0) }
+    ram_gb = Math.max(ram_gb, (double) ram_model.min_ram_gb)
+    if (model.scale != null) {
+        ram_gb *= metrics.get(model.scale, 1)
+    }
+    return 1.MB * (long) Math.ceil(1024 * ram_gb * attempt)
+}
+
+// Metrics of one minos task: the metrics of the clustered VCF file, plus the
+// size of the reads files of the biggest sample, and the number of samples
+// run at the same time
+def minos_metrics(clustered_metrics_file, batch) {
+    def reads_gb = (batch.collect{ it[3].toLong() }.max() / 1073741824).toDouble().round(3)
+    return clustered_metrics_file.text.trim() + " reads_gb=${reads_gb} samples=${Math.min(batch.size(), params.minos_batch_threads)}"
+}
+
+// Metrics of a merge task: the total size in GB of its input files, and the
+// number of merges it runs at the same time
+def merge_metrics(file_list, threads) {
+    def input_gb = (file_list.collect{ file(it).size() }.sum() / 1073741824).toDouble().round(3)
+    return "input_gb=${input_gb} threads=${threads}"
+}
+
+// Returns s in single quotes, for use in a shell command. Any single
+// quotes in s are escaped
+def shell_quote(s) {
+    return "'" + s.toString().replace("'", "'\\''") + "'"
+}
+
 split_tsv = Channel.from(data_in_tsv).splitCsv(header: true, sep:'\t')
 
 
@@ -268,12 +562,8 @@ process process_input_vcf_file {
     """
     #!/usr/bin/env python3
     from minos import multi_sample_pipeline
-    multi_sample_pipeline.MultiSamplePipeline._filter_input_file_for_clustering(
+    max_read_length = multi_sample_pipeline.MultiSamplePipeline._process_input_vcf_file(
         "${tsv_fields.vcf_file}",
-        'filtered.vcf'
-    )
-    max_read_length = multi_sample_pipeline.MultiSamplePipeline._nextflow_helper_process_input_vcf_file(
-        'filtered.vcf',
         "small_vars.${tsv_fields['sample_id']}.vcf",
         "big_vars.${tsv_fields['sample_id']}.vcf",
         "sample_name.${tsv_fields['sample_id']}",
@@ -287,64 +577,107 @@ process process_input_vcf_file {
 }
 
 
+// The small variant VCF files are merged in a tree. First, groups of
+// params.pre_cluster_merge_group_size files are merged in parallel.
+// Then the merged files are merged into one file. The memory of both
+// processes is predicted from the size of their input files
+process_input_vcf_file_out_small.buffer(size: params.pre_cluster_merge_group_size, remainder: true).set{ pre_cluster_small_vars_merge_groups }
+
+
+process pre_cluster_small_vars_merge_group {
+    errorStrategy {task.attempt < 3 ? 'retry' : 'terminate'}
+    memory {params.testing ? '0.5 GB' : predicted_memory('pre_cluster_small_vars_merge_group', merge_metrics(file_list, 1), task.attempt)}
+    maxRetries 3
+    tag {merge_metrics(file_list, 1)}
+
+    input:
+    val(file_list) from pre_cluster_small_vars_merge_groups
+
+    output:
+    file('pre_cluster_small_vars_merge_group.vcf') into pre_cluster_small_vars_merge_group_out
+
+    """
+    #!/usr/bin/env python3
+    from minos import vcf_tree_merge
+    file_list = ["${file_list.join('", "')}"]
+    vcf_tree_merge.merge_vcf_files_group(file_list, "${ref_fasta}", "pre_cluster_small_vars_merge_group.vcf")
+    """
+}
+
+
 process pre_cluster_small_vars_merge {
     errorStrategy {task.attempt < 3 ? 'retry' : 'terminate'}
-    memory {params.testing ? '0.5 GB' : 1.GB * params.pre_cluster_small_vars_merge_ram * task.attempt}
+    memory {params.testing ? '0.5 GB' : predicted_memory('pre_cluster_small_vars_merge', merge_metrics(file_list, params.pre_cluster_small_vars_merge_threads), task.attempt)}
     maxRetries 3
     cpus {params.testing? 2 : params.pre_cluster_small_vars_merge_threads}
+    tag {merge_metrics(file_list, params.pre_cluster_small_vars_merge_threads)}
 
     input:
-    val(file_list) from process_input_vcf_file_out_small.collect()
+    val(file_list) from pre_cluster_small_vars_merge_group_out.collect()
 
     output:
     file('pre_cluster_small_vars_merge.vcf') into pre_cluster_small_vars_merge_out
+    file('pre_cluster_small_vars_merge.metrics') into pre_cluster_small_vars_merge_metrics
 
     """
     #!/usr/bin/env python3
-    from cluster_vcf_records import vcf_merge
-    import pyfastaq
-    ref_seqs = dict()
-    pyfastaq.tasks.file_to_dict("${ref_fasta}", ref_seqs)
-
+    from minos import resource_predictor, vcf_tree_merge
     file_list = ["${file_list.join('", "')}"]
-
-    vcf_merge.merge_vcf_files(file_list, ref_seqs, "pre_cluster_small_vars_merge.vcf", threads=${params.pre_cluster_small_vars_merge_threads})
+    vcf_tree_merge.merge_vcf_files(file_list, "${ref_fasta}", "pre_cluster_small_vars_merge.vcf", group_size=${params.pre_cluster_merge_group_size}, threads=${params.testing ? 2 : params.pre_cluster_small_vars_merge_threads}, inputs_are_merged=True)
+    resource_predictor.write_vcf_metrics_file("pre_cluster_small_vars_merge.vcf", "pre_cluster_small_vars_merge.metrics")
     """
 
 }
 
+// The memory of the cluster, gramtools build and minos processes is predicted
+// from metrics of their input files. The metrics are put in the tag of each
+// task, so that they are in the trace file with the memory and peak RSS
 process cluster_small_vars_vcf {
     errorStrategy {task.attempt < 3 ? 'retry' : 'terminate'}
-    memory {params.testing ? '0.5 GB' : 1.GB * params.cluster_small_vars_ram * task.attempt}
+    memory {params.testing ? '0.5 GB' : predicted_memory('cluster_small_vars_vcf', metrics_file.text, task.attempt)}
     maxRetries 3
+    tag {metrics_file.text.trim()}
 
     input:
     file('pre_cluster_small_vars_merge.vcf') from pre_cluster_small_vars_merge_out
+    val(metrics_file) from pre_cluster_small_vars_merge_metrics
 
     output:
-    file('small_vars_clustered.vcf') into cluster_small_vars_vcf_out
+    file('small_vars_clustered.vcf') into cluster_small_vars_vcf_out, cluster_small_vars_vcf_for_cohort_store
+    file('small_vars_clustered.metrics') into cluster_small_vars_vcf_metrics
 
     """
     #!/usr/bin/env python3
     from cluster_vcf_records import vcf_clusterer
+    from minos import resource_predictor
     clusterer = vcf_clusterer.VcfClusterer(["pre_cluster_small_vars_merge.vcf"], "${ref_fasta}", "small_vars_clustered.vcf", max_alleles_per_cluster=${params.max_alleles_per_cluster})
     clusterer.run()
+    resource_predictor.write_vcf_metrics_file(
+        "small_vars_clustered.vcf",
+        "small_vars_clustered.metrics",
+        threads=${params.gramtools_build_threads},
+        variants_per_split=${params.variants_per_split} if ${params.variants_per_split} > 0 else None,
+        alleles_per_split=${params.alleles_per_split} if ${params.alleles_per_split} > 0 else None,
+        total_splits=${params.total_splits} if ${params.total_splits} > 0 else None,
+    )
     """
 }
 
 
 process gramtools_build_small_vars {
     errorStrategy {task.attempt < 3 ? 'retry' : 'terminate'}
-    memory {params.testing ? '0.5 GB' : 1.GB * params.gramtools_build_small_vars_ram * task.attempt}
+    memory {params.testing ? '0.5 GB' : predicted_memory('gramtools_build_small_vars', metrics_file.text, task.attempt)}
     maxRetries 3
     cpus params.gramtools_build_threads
+    tag {metrics_file.text.trim()}
 
     input:
     file('small_vars_clustered.vcf') from cluster_small_vars_vcf_out
+    val(metrics_file) from cluster_small_vars_vcf_metrics
     val(max_read_length) from max_read_lengths.max()
 
     output:
-    set(file('small_vars_clustered.vcf'), file('small_vars_clustered.gramtools.build')) into gramtools_build_small_vars_out
+    set(file('small_vars_clustered.vcf'), file('small_vars_clustered.gramtools.build'), val(metrics_file)) into gramtools_build_small_vars_out
 
     """
     #!/usr/bin/env python3
@@ -392,23 +725,63 @@ process gramtools_build_small_vars {
 }
 
 
+minos_all_small_vars_tsv_in.into{ minos_all_small_vars_tsv_in_batches; minos_all_small_vars_tsv_in_cohort_store }
+
+
+// If params.cohort_store, the (empty) cohort store is made in the final
+// output directory before minos is run. Each minos task then adds its
+// samples to the store as soon as they are genotyped. Outputs the store
+// directory, or "" if there is no cohort store
+process create_cohort_store {
+    memory '1 GB'
+
+    input:
+    file('small_vars_clustered.vcf') from cluster_small_vars_vcf_for_cohort_store
+    val(samples) from minos_all_small_vars_tsv_in_cohort_store.map{ tsv_fields, sample_name_file -> [tsv_fields['sample_id'].toInteger(), sample_name_file.text.trim()] }.toSortedList({ a, b -> a[0] <=> b[0] })
+
+    output:
+    val(cohort_store_dir) into create_cohort_store_out
+
+    script:
+    cohort_store_dir = params.cohort_store ? final_outdir.resolve('cohort_store').toString() : ''
+    if (params.cohort_store)
+        """
+        printf '%s\n' ${samples.collect{ shell_quote(it[1]) }.join(' ')} > sample_names.txt
+        python3 -c 'import sys; from minos import multi_sample_pipeline; multi_sample_pipeline.MultiSamplePipeline._create_cohort_store(*sys.argv[1:])' small_vars_clustered.vcf sample_names.txt ${shell_quote(cohort_store_dir)}
+        """
+    else
+        """
+        echo "No cohort store"
+        """
+}
+
+
+// Samples are run in batches of params.minos_batch_size samples, using
+// one run of minos adjudicate_batch per batch
+minos_all_small_vars_tsv_in_batches.map{ tsv_fields, sample_name_file -> [tsv_fields['sample_id'], sample_name_file.text.trim(), tsv_fields['reads_files'], tsv_fields['reads_bytes']] }.buffer(size: params.minos_batch_size, remainder: true).set{ minos_all_small_vars_batches }
+
 
 process minos_all_small_vars {
     errorStrategy {task.attempt < 3 ? 'retry' : 'terminate'}
-    memory {params.testing ? '0.5 GB' : 1.GB * params.minos_small_vars_ram * task.attempt}
+    memory {params.testing ? '0.5 GB' : predicted_memory('minos_all_small_vars', minos_metrics(clustered_metrics_file, batch), task.attempt)}
     maxRetries 3
+    cpus params.minos_batch_threads
+    tag {minos_metrics(clustered_metrics_file, batch)}
 
     input:
-    set(file('small_vars_clustered.vcf'), file('small_vars_clustered.gramtools.build')) from gramtools_build_small_vars_out
-    set(val(tsv_fields), file("sample_name.${tsv_fields['sample_id']}")) from minos_all_small_vars_tsv_in
+    set(file('small_vars_clustered.vcf'), file('small_vars_clustered.gramtools.build'), val(clustered_metrics_file)) from gramtools_build_small_vars_out
+    val(batch) from minos_all_small_vars_batches
+    val(cohort_store_dir) from create_cohort_store_out.first()
 
     output:
-    file("small_vars.minos.${tsv_fields['sample_id']}") into minos_all_small_vars_out
+    file("small_vars.minos.*") into minos_all_small_vars_out
 
+    script:
+    add_to_cohort_store = cohort_store_dir == '' ? '' : "python3 -c 'import sys; from minos import multi_sample_pipeline; multi_sample_pipeline.MultiSamplePipeline._add_batch_to_cohort_store(*sys.argv[1:])' ${shell_quote(cohort_store_dir)} batch.tsv"
     """
-    sample_name=\$(cat sample_name.${tsv_fields['sample_id']})
-    minos_outdir=small_vars.minos.${tsv_fields['sample_id']}
-    minos adjudicate --sample_name \$sample_name --gramtools_build_dir "small_vars_clustered.gramtools.build" --reads ${tsv_fields['reads_files'].replaceAll(/ /, " --reads ")} \$minos_outdir ${ref_fasta} "small_vars_clustered.vcf"
+    printf '%s\n' ${batch.collect{ shell_quote(["small_vars.minos." + it[0], it[1], it[2].replaceAll(/ /, "\t")].join("\t")) }.join(' ')} > batch.tsv
+    minos adjudicate_batch --threads ${params.minos_batch_threads} --gramtools_build_dir "small_vars_clustered.gramtools.build" batch.tsv ${ref_fasta} "small_vars_clustered.vcf"
+    ${add_to_cohort_store}
     """
 }
 
@@ -456,16 +829,585 @@ process merge_small_vars_vcfs {
 
     def _prepare_nextflow_input_files(self):
         input_data = MultiSamplePipeline._load_input_data_tsv(self.input_data_tsv)
-        MultiSamplePipeline._write_nextflow_data_tsv(input_data, self.nextflow_input_tsv)
+        reads_bytes = MultiSamplePipeline._reads_files_bytes(input_data)
+        MultiSamplePipeline._write_nextflow_data_tsv(input_data, reads_bytes, self.nextflow_input_tsv)
+        resource_predictor.write_nextflow_model_json(self.ram_model, self.nextflow_ram_model_json)
+        resource_predictor.write_nextflow_trace_config(self.nextflow_trace_config)
+
+
+    @classmethod
+    def _local_process_input_vcf_file(cls, vcf_file, sample_id, work_dir, min_large_ref_length):
+        '''Same as the nextflow process process_input_vcf_file. Returns tuple
+        (small variants VCF file, sample name, max read length)'''
+        small_vars_vcf = os.path.join(work_dir, 'small_vars.' + str(sample_id) + '.vcf')
+        big_vars_vcf = os.path.join(work_dir, 'big_vars.' + str(sample_id) + '.vcf')
+        sample_name_file = os.path.join(work_dir, 'sample_name.' + str(sample_id))
+        max_read_length = MultiSamplePipeline._process_input_vcf_file(vcf_file, small_vars_vcf, big_vars_vcf, sample_name_file, min_large_ref_length)
+        with open(sample_name_file) as f:
+            sample_name = f.read().rstrip()
+        return small_vars_vcf, sample_name, max_read_length
+
+
+    def _local_pre_cluster_merge(self, executor, vcf_files, outfile):
+        '''Same as the nextflow processes pre_cluster_small_vars_merge_group
+        and pre_cluster_small_vars_merge: groups of files are merged in
+        parallel, then the merged files are merged'''
+        group_files = []
+        tasks = []
+        for i in range(0, len(vcf_files), self.pre_cluster_merge_group_size):
+            group = vcf_files[i:i + self.pre_cluster_merge_group_size]
+            group_files.append(outfile + '.group.' + str(len(group_files)) + '.vcf')
+            ram = resource_predictor.predict_ram_gb(self.ram_model, 'pre_cluster_small_vars_merge_group', {'input_gb': resource_predictor.files_gb(group), 'threads': 1})
+            tasks.append((vcf_tree_merge.merge_vcf_files_group, (group, self.ref_fasta, group_files[-1]), ram, 1))
+        executor.run_stage('pre_cluster_small_vars_merge_group', tasks)
+        ram = resource_predictor.predict_ram_gb(self.ram_model, 'pre_cluster_small_vars_merge', {'input_gb': resource_predictor.files_gb(group_files), 'threads': self.threads})
+        executor.run_stage('pre_cluster_small_vars_merge', [
+            (vcf_tree_merge.merge_vcf_files, (group_files, self.ref_fasta, outfile, self.pre_cluster_merge_group_size, self.threads, True), ram, self.threads),
+        ])
+        for filename in group_files:
+            os.unlink(filename)
+
+
+    @classmethod
+    def _local_cluster(cls, infile, ref_fasta, outfile, max_alleles_per_cluster):
+        clusterer = vcf_clusterer.VcfClusterer([infile], ref_fasta, outfile, max_alleles_per_cluster=max_alleles_per_cluster)
+        clusterer.run()
+
+
+    @classmethod
+    def _local_gramtools_build(cls, build_dir, vcf_file, ref_fasta, max_read_length, kmer_size, threads, variants_per_split, alleles_per_split, total_splits):
+        '''Same as the nextflow process gramtools_build_small_vars'''
+        if os.path.exists(build_dir):
+            shutil.rmtree(build_dir)
+
+        if total_splits is None and variants_per_split is None and alleles_per_split is None:
+            gramtools.run_gramtools_build(build_dir, vcf_file, ref_fasta, max_read_length, kmer_size=kmer_size)
+        else:
+            chunker = vcf_chunker.VcfChunker(
+                build_dir,
+                vcf_infile=vcf_file,
+                ref_fasta=ref_fasta,
+                variants_per_split=variants_per_split,
+                alleles_per_split=alleles_per_split,
+                max_read_length=max_read_length,
+                total_splits=total_splits,
+                flank_length=max_read_length,
+                gramtools_kmer_size=kmer_size,
+                threads=threads,
+            )
+            chunker.make_split_files()
+
+
+    @classmethod
+    def _local_minos_batch(cls, batch_tsv, build_dir, ref_fasta, vcf_file, threads, cohort_store_dir=None, depth_vcfs=None):
+        '''Runs minos on the samples in batch_tsv. depth_vcfs is an optional
+        dict of output directory -> minos VCF file. Those samples are
+        genotyped using the depth from the VCF file (see _depth_from_minos_vcf())'''
+        if depth_vcfs is None:
+            sample_depths = None
+        else:
+            sample_depths = {k: MultiSamplePipeline._depth_from_minos_vcf(v) for k, v in depth_vcfs.items()}
+        adjudicator = batch_adjudicator.BatchAdjudicator(batch_tsv, build_dir, ref_fasta, vcf_file, threads=threads, overwrite_outdirs=True, sample_depths=sample_depths)
+        adjudicator.run()
+        if cohort_store_dir is not None:
+            MultiSamplePipeline._add_batch_to_cohort_store(cohort_store_dir, batch_tsv)
+
+
+    @classmethod
+    def _vcf_record_keys_and_lines(cls, vcf_file):
+        '''Yields tuples ((CHROM, POS, REF, ALT), line) for each record in vcf_file'''
+        with open(vcf_file) as f:
+            for line in f:
+                if not line.startswith('#'):
+                    fields = line.split('\t', maxsplit=5)
+                    yield (fields[0], fields[1], fields[3], fields[4]), line
+
+
+    @classmethod
+    def _depth_from_minos_vcf(cls, vcf_file):
+        '''Returns tuple (mean depth, depth variance) of the DP of the records
+        in vcf_file, which should be a debug.calls_with_zero_cov_alleles.vcf
+        made by minos. DP is the depth that minos measures at each site,
+        so this is the depth of the sample at all the sites'''
+        depths = []
+        with open(vcf_file) as f:
+            for line in f:
+                if line.startswith('#'):
+                    continue
+                fields = line.rstrip('\n').split('\t')
+                format_dict = dict(zip(fields[8].split(':'), fields[9].split(':')))
+                if format_dict.get('DP', '.') != '.':
+                    depths.append(int(format_dict['DP']))
+
+        if len(depths) == 0:
+            raise Error('No DP values found in VCF file ' + vcf_file + '. Cannot get depth')
+        variance = 1.000 if len(depths) == 1 else round(statistics.variance(depths), 3)
+        return round(statistics.mean(depths), 3), variance
+
+
+    @classmethod
+    def _write_changed_vcf_records(cls, old_vcf, new_vcf, outfile, flank_length=0):
+        '''Writes the records of new_vcf that are not in old_vcf (with the same
+        CHROM, POS, REF and ALT) to outfile, with the header of new_vcf. The
+        records of new_vcf within flank_length of a changed record are also
+        written, in the same way as the flanking records of split VCF files,
+        so that a graph made from outfile has the same sequence around the
+        changed records as the graph made from new_vcf.
+        Returns tuple (number of changed records, number of flanking records)'''
+        old_keys = set(x[0] for x in MultiSamplePipeline._vcf_record_keys_and_lines(old_vcf))
+        records = [] # tuples (chrom, start, end, is changed, line)
+        header_lines = []
+        with open(new_vcf) as f_in:
+            for line in f_in:
+                if line.startswith('#'):
+                    header_lines.append(line)
+                    continue
+                fields = line.split('\t', maxsplit=5)
+                start = int(fields[1]) - 1
+                records.append((fields[0], start, start + len(fields[3]) - 1, (fields[0], fields[1], fields[3], fields[4]) not in old_keys, line))
+
+        # Changed records, extended by flank_length either side, merged
+        # into one sorted list of (start, end) per chrom
+        changed_regions = utils.merge_regions([x[:3] for x in records if x[3]], flank=flank_length)
+        changed_starts = {chrom: [x[0] for x in regions] for chrom, regions in changed_regions.items()}
+        changed_written = 0
+        flanks_written = 0
+
+        with open(outfile, 'w') as f_out:
+            for line in header_lines:
+                f_out.write(line)
+            for chrom, start, end, is_changed, line in records:
+                if is_changed:
+                    changed_written += 1
+                elif chrom in changed_regions:
+                    i = bisect.bisect_right(changed_starts[chrom], end) - 1
+                    if i < 0 or changed_regions[chrom][i][1] < start:
+                        continue
+                    flanks_written += 1
+                else:
+                    continue
+                f_out.write(line)
+
+        return changed_written, flanks_written
+
+
+    @classmethod
+    def _vcf_record_keys_and_line_pairs(cls, vcf_file, final_vcf=None):
+        '''Yields tuples ((CHROM, POS, REF, ALT), lines) for each record in
+        vcf_file, where lines is a tuple of the line from vcf_file, and the
+        line from final_vcf if given. final_vcf must have one record per
+        record of vcf_file, in the same order, like the final.vcf made by
+        minos with debug.calls_with_zero_cov_alleles.vcf'''
+        if final_vcf is None:
+            for key, line in MultiSamplePipeline._vcf_record_keys_and_lines(vcf_file):
+                yield key, (line,)
+            return
+
+        final_records = MultiSamplePipeline._vcf_record_keys_and_lines(final_vcf)
+        for record, final_record in itertools.zip_longest(MultiSamplePipeline._vcf_record_keys_and_lines(vcf_file), final_records):
+            if record is None or final_record is None:
+                raise Error('Different number of records in VCF files ' + vcf_file + ' and ' + final_vcf)
+            yield record[0], (record[1], final_record[1])
+
+
+    @classmethod
+    def _write_vcf_header(cls, vcf_file, f_out):
+        '''Writes the header lines of vcf_file to the open file handle f_out'''
+        with open(vcf_file) as f_in:
+            for line in f_in:
+                if not line.startswith('#'):
+                    break
+                f_out.write(line)
+
+
+    @classmethod
+    def _update_minos_vcf(cls, template_vcf, old_vcf, changed_vcf, outfile, old_final_vcf=None, changed_final_vcf=None, final_outfile=None):
+        '''Makes the updated minos VCF file of a sample that was in the cohort
+        before the update, so that it has the same records as template_vcf (a
+        minos VCF file of a new sample). Records are taken from old_vcf if
+        there, otherwise from changed_vcf (the sample genotyped at the
+        new/changed sites, plus their flanking sites, which are ignored
+        here). Records of old_vcf that are not in template_vcf are sites
+        that were removed by re-clustering. changed_vcf can be None,
+        meaning no sites changed. If final_outfile is given, the updated
+        final.vcf is also written to final_outfile, taking the records
+        from old_final_vcf and changed_final_vcf, which are the final.vcf
+        files made with old_vcf and changed_vcf'''
+        if final_outfile is None:
+            old_final_vcf = changed_final_vcf = None
+        elif old_final_vcf is None or (changed_vcf is not None and changed_final_vcf is None):
+            raise Error('Cannot update final VCF file ' + final_outfile + ' without the final VCF files from before')
+
+        changed_lines = {}
+        if changed_vcf is not None:
+            old_keys = set(x[0] for x in MultiSamplePipeline._vcf_record_keys_and_lines(old_vcf))
+            for key, lines in MultiSamplePipeline._vcf_record_keys_and_line_pairs(changed_vcf, changed_final_vcf):
+                if key not in old_keys:
+                    changed_lines[key] = lines
+
+        old_records = MultiSamplePipeline._vcf_record_keys_and_line_pairs(old_vcf, old_final_vcf)
+        with contextlib.ExitStack() as stack:
+            f_outs = [stack.enter_context(open(outfile, 'w'))]
+            MultiSamplePipeline._write_vcf_header(old_vcf, f_outs[0])
+            if final_outfile is not None:
+                f_outs.append(stack.enter_context(open(final_outfile, 'w')))
+                MultiSamplePipeline._write_vcf_header(old_final_vcf, f_outs[1])
+
+            for key, line in MultiSamplePipeline._vcf_record_keys_and_lines(template_vcf):
+                if key in changed_lines:
+                    lines = changed_lines[key]
+                else:
+                    for old_key, lines in old_records:
+                        if old_key == key:
+                            break
+                    else:
+                        raise Error('Record ' + ' '.join(key) + ' not found in VCF files ' + old_vcf + ' or ' + str(changed_vcf) + '. Cannot update')
+
+                for f_out, line in zip(f_outs, lines):
+                    f_out.write(line)
+
+
+    @classmethod
+    def _local_update_old_sample(cls, template_vcf, minos_dir, changed_minos_dir, cohort_store_dir=None, sample_name=None):
+        '''Writes the updated debug.calls_with_zero_cov_alleles.vcf and
+        final.vcf of a sample from before the update to their side files
+        (see _update_side_file()). changed_minos_dir is the minos output
+        directory of the sample genotyped at only the new/changed sites, or
+        None if no sites changed'''
+        minos_vcf = os.path.join(minos_dir, 'debug.calls_with_zero_cov_alleles.vcf')
+        final_vcf = os.path.join(minos_dir, 'final.vcf')
+        if changed_minos_dir is None:
+            changed_vcf = changed_final_vcf = None
+        else:
+            changed_vcf = os.path.join(changed_minos_dir, 'debug.calls_with_zero_cov_alleles.vcf')
+            changed_final_vcf = os.path.join(changed_minos_dir, 'final.vcf')
+        updated_vcf = MultiSamplePipeline._update_side_file(minos_vcf)
+        MultiSamplePipeline._update_minos_vcf(template_vcf, minos_vcf, changed_vcf, updated_vcf, old_final_vcf=final_vcf, changed_final_vcf=changed_final_vcf, final_outfile=MultiSamplePipeline._update_side_file(final_vcf))
+        if cohort_store_dir is not None:
+            MultiSamplePipeline._add_samples_to_cohort_store(cohort_store_dir, [sample_name], [updated_vcf])
+
+
+    @classmethod
+    def _local_update_gramtools_build(cls, build_dir, new_build_dir, vcf_file, threads):
+        '''Makes new_build_dir, which is a copy of the split build_dir
+        updated to use vcf_file. build_dir is not changed. Files are hard
+        linked instead of copied where possible. This is safe because
+        VcfChunker deletes the files of a split before it remakes them'''
+        try:
+            shutil.copytree(build_dir, new_build_dir, symlinks=True, copy_function=os.link)
+        except OSError:
+            logging.info('Could not hard link files of ' + build_dir + '. Copying them instead')
+            if os.path.exists(new_build_dir):
+                shutil.rmtree(new_build_dir)
+            shutil.copytree(build_dir, new_build_dir, symlinks=True)
+        chunker = vcf_chunker.VcfChunker(new_build_dir, threads=threads)
+        chunker.update_split_files(vcf_file)
+
+
+    def _clustered_vcf_metrics(self, vcf_file):
+        return resource_predictor.vcf_metrics(vcf_file, threads=self.gramtools_build_threads, variants_per_split=self.variants_per_split, alleles_per_split=self.alleles_per_split, total_splits=self.total_splits)
+
+
+    def _local_minos_stage(self, executor, stage_name, samples, build_dir, vcf_file, cohort_store_dir=None, depth_vcfs=None):
+        '''samples = list of tuples (outdir, sample name, reads files).
+        Runs minos on the samples in batches of minos_batch_size. If
+        cohort_store_dir is given, each batch adds its samples to that
+        cohort store as soon as it finishes. depth_vcfs is an optional dict of
+        outdir -> minos VCF file, to use the depth from (see _local_minos_batch())'''
+        vcf_metrics = self._clustered_vcf_metrics(vcf_file)
+        tasks = []
+        for batch_start in range(0, len(samples), self.minos_batch_size):
+            batch = samples[batch_start:batch_start + self.minos_batch_size]
+            batch_tsv = os.path.join(self.local_work_dir, stage_name + '.batch.' + str(len(tasks)) + '.tsv')
+            with open(batch_tsv, 'w') as f:
+                for outdir, sample_name, reads_files in batch:
+                    print(outdir, sample_name, *reads_files, sep='\t', file=f)
+            metrics = dict(vcf_metrics, reads_gb=max([resource_predictor.files_gb(x[2]) for x in batch]), samples=min(len(batch), self.minos_batch_threads))
+            ram = resource_predictor.predict_ram_gb(self.ram_model, 'minos_all_small_vars', metrics)
+            batch_depth_vcfs = None if depth_vcfs is None else {x[0]: depth_vcfs[x[0]] for x in batch}
+            tasks.append((MultiSamplePipeline._local_minos_batch, (batch_tsv, build_dir, self.ref_fasta, vcf_file, self.minos_batch_threads, cohort_store_dir, batch_depth_vcfs), ram, self.minos_batch_threads))
+        executor.run_stage(stage_name, tasks)
+
+
+    def _save_local_samples_json(self, max_read_length, samples, pending_renames=None):
+        '''Saves what is needed to add samples later in update mode.
+        pending_renames = list of tuples (side file, file), meaning that an
+        update has made all of its files, and each side file needs renaming
+        to replace the file (see _run_local_update())'''
+        state = {'max_read_length': max_read_length, 'samples': samples}
+        if pending_renames is not None:
+            state['pending_renames'] = pending_renames
+        tmp_json = self.local_samples_json + '.tmp'
+        with open(tmp_json, 'w') as f:
+            json.dump(state, f, indent=2)
+        os.rename(tmp_json, self.local_samples_json)
+
+
+    @classmethod
+    def _update_side_file(cls, filename):
+        '''Returns the name of the side file (or directory) that an update
+        writes instead of changing filename. The side file replaces
+        filename when the update has finished'''
+        root, extension = os.path.splitext(filename)
+        if extension == '.vcf':
+            return root + '.update.vcf'
+        return filename + '.update'
+
+
+    @classmethod
+    def _delete_file_or_dir(cls, filename):
+        if os.path.isdir(filename) and not os.path.islink(filename):
+            shutil.rmtree(filename)
+        elif os.path.lexists(filename):
+            os.unlink(filename)
+
+
+    @classmethod
+    def _finish_pending_renames(cls, pending_renames):
+        '''pending_renames = list of tuples (side file, file). Replaces each
+        file with its side file. A side file that does not exist is assumed
+        to be renamed already, so that this can be run again if it was
+        interrupted'''
+        for side_file, filename in pending_renames:
+            if os.path.exists(side_file):
+                MultiSamplePipeline._delete_file_or_dir(filename)
+                os.rename(side_file, filename)
+
+
+    def _local_update_files(self, samples):
+        '''samples = list of dicts, as saved in samples.json. Returns list
+        of the files and directories that an update replaces with side files'''
+        files = [
+            os.path.join(self.local_work_dir, 'pre_cluster_small_vars_merge.vcf'),
+            os.path.join(self.local_work_dir, 'small_vars_clustered.vcf'),
+            os.path.join(self.local_work_dir, 'small_vars_clustered.gramtools.build'),
+            self.cohort_store_dir,
+            os.path.join(self.output_dir, 'combined_calls.vcf'),
+        ]
+        for x in samples:
+            files.append(os.path.join(x['minos_dir'], 'debug.calls_with_zero_cov_alleles.vcf'))
+            files.append(os.path.join(x['minos_dir'], 'final.vcf'))
+        return files
+
+
+    def _local_update_scratch_files(self, samples):
+        '''samples = list of dicts, as saved in samples.json. Returns list
+        of the files and directories that an update only uses while
+        it is running'''
+        files = [
+            os.path.join(self.local_work_dir, 'small_vars_clustered.changed.vcf'),
+            os.path.join(self.local_work_dir, 'small_vars_clustered.changed.gramtools.build'),
+        ]
+        return files + [x['minos_dir'] + '.changed' for x in samples]
+
+
+    def _local_merge_outputs(self, executor, minos_vcfs, outfile):
+        '''Merges the minos VCF files minos_vcfs into outfile (combined_calls.vcf)'''
+        executor.run_stage('merge_small_vars_vcfs', [
+            (MultiSamplePipeline._merge_vcf_files, (minos_vcfs, outfile), self.nf_ram_merge_small_vars, 1),
+        ])
+
+
+    def _local_create_cohort_store(self, outdir, sites_vcf, sample_names):
+        '''Makes an empty cohort store in outdir if the cohort store was
+        asked for, ready for samples to be added as minos finishes on
+        them. Returns outdir, or None if no cohort store wanted'''
+        if not self.cohort_store:
+            return None
+        sample_names_file = os.path.join(self.local_work_dir, 'cohort_store.sample_names.txt')
+        with open(sample_names_file, 'w') as f:
+            print(*sample_names, sep='\n', file=f)
+        MultiSamplePipeline._create_cohort_store(sites_vcf, sample_names_file, outdir)
+        os.unlink(sample_names_file)
+        return outdir
+
+
+    def _process_input_vcf_files_stage(self, executor, input_data, first_sample_id):
+        '''Returns list of dicts, one per sample, to be saved in samples.json,
+        and the max read length found in the VCF files (0 if none found)'''
+        results = executor.run_stage('process_input_vcf_file', [
+            (MultiSamplePipeline._local_process_input_vcf_file, (vcf_file, first_sample_id + i, self.local_work_dir, self.min_large_ref_length), 0.5, 1)
+            for i, (vcf_file, reads_files) in enumerate(input_data)
+        ])
+        samples = []
+        for i, ((vcf_file, reads_files), (small_vars_vcf, sample_name, max_read_length)) in enumerate(zip(input_data, results)):
+            samples.append({
+                'vcf_file': vcf_file,
+                'reads_files': reads_files,
+                'sample_name': sample_name,
+                'small_vars_vcf': small_vars_vcf,
+                'minos_dir': os.path.join(self.local_work_dir, 'small_vars.minos.' + str(first_sample_id + i)),
+            })
+        return samples, max([0 if x[2] is None else x[2] for x in results])
+
+
+    def _run_local(self):
+        '''Runs the same stages as the nextflow pipeline, but using
+        local_executor.LocalExecutor instead of nextflow'''
+        input_data = MultiSamplePipeline._load_input_data_tsv(self.input_data_tsv)
+        if self.no_run:
+            print('Loaded input data. --no_run used, so not running')
+            return
+
+        os.mkdir(self.local_work_dir)
+        executor = local_executor.LocalExecutor(threads=self.threads, max_ram=self.local_max_ram, enforce_ram=self.local_enforce_ram)
+        samples, max_read_length = self._process_input_vcf_files_stage(executor, input_data, 0)
+        if self.gramtools_max_read_length != 0:
+            max_read_length = self.gramtools_max_read_length
+        if max_read_length == 0:
+            raise Error('Error! max read length could not be inferred from input VCF files. Must use option gramtools_max_read_length')
+
+        pre_cluster_vcf = os.path.join(self.local_work_dir, 'pre_cluster_small_vars_merge.vcf')
+        self._local_pre_cluster_merge(executor, [x['small_vars_vcf'] for x in samples], pre_cluster_vcf)
+
+        clustered_vcf = os.path.join(self.local_work_dir, 'small_vars_clustered.vcf')
+        cluster_ram = resource_predictor.predict_ram_gb(self.ram_model, 'cluster_small_vars_vcf', resource_predictor.vcf_metrics(pre_cluster_vcf))
+        executor.run_stage('cluster_small_vars_vcf', [
+            (MultiSamplePipeline._local_cluster, (pre_cluster_vcf, self.ref_fasta, clustered_vcf, self.max_alleles_per_cluster), cluster_ram, 1),
+        ])
+
+        build_dir = os.path.join(self.local_work_dir, 'small_vars_clustered.gramtools.build')
+        build_ram = resource_predictor.predict_ram_gb(self.ram_model, 'gramtools_build_small_vars', self._clustered_vcf_metrics(clustered_vcf))
+        executor.run_stage('gramtools_build_small_vars', [
+            (MultiSamplePipeline._local_gramtools_build, (build_dir, clustered_vcf, self.ref_fasta, max_read_length, self.gramtools_kmer_size, self.gramtools_build_threads, self.variants_per_split, self.alleles_per_split, self.total_splits), build_ram, self.gramtools_build_threads),
+        ])
+
+        store_dir = self._local_create_cohort_store(self.cohort_store_dir, clustered_vcf, [x['sample_name'] for x in samples])
+        self._local_minos_stage(executor, 'minos_all_small_vars', [(x['minos_dir'], x['sample_name'], x['reads_files']) for x in samples], build_dir, clustered_vcf, cohort_store_dir=store_dir)
+        self._save_local_samples_json(max_read_length, samples)
+        self._local_merge_outputs(executor, [os.path.join(x['minos_dir'], 'debug.calls_with_zero_cov_alleles.vcf') for x in samples], os.path.join(self.output_dir, 'combined_calls.vcf'))
+
+        if self.clean:
+            logging.info('Delete local work directory ' + self.local_work_dir)
+            shutil.rmtree(self.local_work_dir)
+
+
+    def _run_local_update(self):
+        '''Adds new samples to the output of a previous run of the local
+        executor that was run without cleaning. Only the new samples are
+        genotyped at all sites. The samples from before are only genotyped
+        at the sites that are new or changed after re-clustering, using a
+        graph of just those sites plus the sites in their flanks (so that the
+        graph has the same sequence around the changed sites). They are
+        genotyped using their depth from before at all sites, instead of
+        the depth at only those sites. If the VCF was split, only the splits
+        that changed are rebuilt.
+        The output from before is not changed until the end: every file
+        that changes is written to a side file (see _update_side_file()).
+        When they are all made, the list of side files is saved in
+        samples.json, together with the new samples. That is the point where
+        the update is done. Then the side files are renamed to replace the
+        old files. If an update is interrupted, the next update finishes the
+        renaming if samples.json has the list of side files, otherwise it
+        deletes the side files and starts again'''
+        if not os.path.exists(self.local_samples_json):
+            raise Error('Cannot update. File not found: ' + self.local_samples_json + '. Need the output directory of a previous run with the local executor, that was not cleaned')
+        with open(self.local_samples_json) as f:
+            state = json.load(f)
+        old_samples = state['samples']
+        max_read_length = state['max_read_length']
+
+        if 'pending_renames' in state:
+            logging.info('Previous update was interrupted after making all its files. Finishing it')
+            MultiSamplePipeline._finish_pending_renames(state['pending_renames'])
+            self._save_local_samples_json(max_read_length, old_samples)
+        for filename in [MultiSamplePipeline._update_side_file(x) for x in self._local_update_files(old_samples)] + self._local_update_scratch_files(old_samples):
+            if os.path.lexists(filename):
+                logging.info('Deleting ' + filename + ', which is left over from an interrupted update')
+                MultiSamplePipeline._delete_file_or_dir(filename)
+
+        input_data = MultiSamplePipeline._load_input_data_tsv(self.input_data_tsv)
+        input_vcfs = set([x[0] for x in input_data])
+        missing = [x['vcf_file'] for x in old_samples if x['vcf_file'] not in input_vcfs]
+        if len(missing) > 0:
+            raise Error('Cannot update. Samples cannot be removed, but these VCF files are not in the input file: ' + ' '.join(missing))
+        old_vcfs = set([x['vcf_file'] for x in old_samples])
+        new_data = [x for x in input_data if x[0] not in old_vcfs]
+        logging.info('Update mode. Samples from before: ' + str(len(old_samples)) + '. New samples: ' + str(len(new_data)))
+        if len(new_data) == 0:
+            logging.info('No new samples. Nothing to do')
+            return
+        if self.no_run:
+            print('Loaded input data. --no_run used, so not running')
+            return
+
+        executor = local_executor.LocalExecutor(threads=self.threads, max_ram=self.local_max_ram, enforce_ram=self.local_enforce_ram)
+        new_samples, new_max_read_length = self._process_input_vcf_files_stage(executor, new_data, len(old_samples))
+        if new_max_read_length > max_read_length:
+            logging.warning('Max read length of new samples is ' + str(new_max_read_length) + ', which is more than the ' + str(max_read_length) + ' used to make the graph. Using ' + str(max_read_length))
+
+        pre_cluster_vcf, clustered_vcf, build_dir, store_dir, combined_vcf = self._local_update_files([])
+        new_pre_cluster_vcf = MultiSamplePipeline._update_side_file(pre_cluster_vcf)
+        self._local_pre_cluster_merge(executor, [pre_cluster_vcf] + [x['small_vars_vcf'] for x in new_samples], new_pre_cluster_vcf)
+
+        new_clustered_vcf = MultiSamplePipeline._update_side_file(clustered_vcf)
+        cluster_ram = resource_predictor.predict_ram_gb(self.ram_model, 'cluster_small_vars_vcf', resource_predictor.vcf_metrics(new_pre_cluster_vcf))
+        executor.run_stage('cluster_small_vars_vcf', [
+            (MultiSamplePipeline._local_cluster, (new_pre_cluster_vcf, self.ref_fasta, new_clustered_vcf, self.max_alleles_per_cluster), cluster_ram, 1),
+        ])
+        changed_vcf, changed_build_dir = self._local_update_scratch_files([])
+        changed_sites, flank_sites = MultiSamplePipeline._write_changed_vcf_records(clustered_vcf, new_clustered_vcf, changed_vcf, flank_length=max_read_length)
+        logging.info('New or changed sites after re-clustering: ' + str(changed_sites) + '. Unchanged sites in their flanks, also put in the graph of changed sites: ' + str(flank_sites))
+
+        new_build_dir = MultiSamplePipeline._update_side_file(build_dir)
+        build_args = (self.ref_fasta, max_read_length, self.gramtools_kmer_size, self.gramtools_build_threads, self.variants_per_split, self.alleles_per_split, self.total_splits)
+        build_ram = resource_predictor.predict_ram_gb(self.ram_model, 'gramtools_build_small_vars', self._clustered_vcf_metrics(new_clustered_vcf))
+        if self.total_splits is None and self.variants_per_split is None and self.alleles_per_split is None:
+            build_tasks = [(MultiSamplePipeline._local_gramtools_build, (new_build_dir, new_clustered_vcf) + build_args, build_ram, self.gramtools_build_threads)]
+        else:
+            build_tasks = [(MultiSamplePipeline._local_update_gramtools_build, (build_dir, new_build_dir, new_clustered_vcf, self.gramtools_build_threads), build_ram, self.gramtools_build_threads)]
+        if changed_sites > 0:
+            changed_build_ram = resource_predictor.predict_ram_gb(self.ram_model, 'gramtools_build_small_vars', self._clustered_vcf_metrics(changed_vcf))
+            build_tasks.append((MultiSamplePipeline._local_gramtools_build, (changed_build_dir, changed_vcf) + build_args, changed_build_ram, self.gramtools_build_threads))
+        executor.run_stage('gramtools_build_small_vars', build_tasks)
+
+        samples = old_samples + new_samples
+        new_store_dir = self._local_create_cohort_store(MultiSamplePipeline._update_side_file(store_dir), new_clustered_vcf, [x['sample_name'] for x in samples])
+        self._local_minos_stage(executor, 'minos_new_samples', [(x['minos_dir'], x['sample_name'], x['reads_files']) for x in new_samples], new_build_dir, new_clustered_vcf, cohort_store_dir=new_store_dir)
+        if changed_sites > 0:
+            self._local_minos_stage(executor, 'minos_old_samples_changed_sites', [(x['minos_dir'] + '.changed', x['sample_name'], x['reads_files']) for x in old_samples], changed_build_dir, changed_vcf,
+                depth_vcfs={x['minos_dir'] + '.changed': os.path.join(x['minos_dir'], 'debug.calls_with_zero_cov_alleles.vcf') for x in old_samples})
+
+        template_vcf = os.path.join(new_samples[0]['minos_dir'], 'debug.calls_with_zero_cov_alleles.vcf')
+        executor.run_stage('update_old_samples', [
+            (MultiSamplePipeline._local_update_old_sample, (template_vcf, x['minos_dir'], x['minos_dir'] + '.changed' if changed_sites > 0 else None, new_store_dir, x['sample_name']), 0.5, 1)
+            for x in old_samples
+        ])
+        minos_vcfs = [os.path.join(x['minos_dir'], 'debug.calls_with_zero_cov_alleles.vcf') for x in samples]
+        self._local_merge_outputs(executor, [MultiSamplePipeline._update_side_file(x) for x in minos_vcfs[:len(old_samples)]] + minos_vcfs[len(old_samples):], MultiSamplePipeline._update_side_file(combined_vcf))
+
+        pending_renames = [(MultiSamplePipeline._update_side_file(x), x) for x in self._local_update_files(old_samples)]
+        self._save_local_samples_json(max_read_length, samples, pending_renames=pending_renames)
+        MultiSamplePipeline._finish_pending_renames(pending_renames)
+        self._save_local_samples_json(max_read_length, samples)
+        for filename in self._local_update_scratch_files(old_samples):
+            MultiSamplePipeline._delete_file_or_dir(filename)
+
+        if self.clean:
+            logging.info('Delete local work directory ' + self.local_work_dir)
+            shutil.rmtree(self.local_work_dir)
 
 
     def run(self):
-        self._make_output_dir()
-        fh = logging.FileHandler(self.log_file, mode='w')
+        if self.update:
+            if not os.path.exists(self.output_dir):
+                raise Error('Cannot update. Output directory not found: ' + self.output_dir)
+        else:
+            self._make_output_dir()
+        fh = logging.FileHandler(self.log_file, mode='a' if self.update else 'w')
         log = logging.getLogger()
         formatter = logging.Formatter('[minos %(asctime)s %(levelname)s] %(message)s', datefmt='%d-%m-%Y %H:%M:%S')
         fh.setFormatter(formatter)
         log.addHandler(fh)
+
+        if self.executor == 'local':
+            dependencies.check_and_report_dependencies(programs=['gramtools'])
+            if self.update:
+                self._run_local_update()
+            else:
+                self._run_local()
+            return
+
         dependencies.check_and_report_dependencies(programs=['nextflow'])
 
         self._prepare_nextflow_input_files()
@@ -481,6 +1423,7 @@ process merge_small_vars_vcfs {
             '-work-dir', self.nextflow_work_dir,
             '-with-dag', 'nextflow.out.dag.pdf',
             '-with-trace', 'nextflow.out.trace.txt',
+            '-c', self.nextflow_trace_config,
         ]
 
         if self.nextflow_config_file is not None:
@@ -494,16 +1437,19 @@ process merge_small_vars_vcfs {
             '--min_large_ref_length', str(self.min_large_ref_length),
             '--final_outdir', self.output_dir,
             '--gramtools_max_read_length', str(self.gramtools_max_read_length),
-            '--cluster_small_vars_ram', str(self.nf_ram_cluster_small_vars),
-            '--gramtools_build_small_vars_ram', str(self.nf_ram_gramtools_build_small),
             '--gramtools_kmer_size', str(self.gramtools_kmer_size),
             '--gramtools_build_threads', str(self.gramtools_build_threads),
-            '--minos_small_vars_ram', str(self.nf_ram_minos_small_vars),
             '--merge_small_vars_ram', str(self.nf_ram_merge_small_vars),
+            '--minos_batch_size', str(self.minos_batch_size),
+            '--minos_batch_threads', str(self.minos_batch_threads),
+            '--pre_cluster_merge_group_size', str(self.pre_cluster_merge_group_size),
+            '--ram_model_json', self.nextflow_ram_model_json,
         ]
 
         if self.testing:
             nextflow_command.append('--testing')
+        if self.cohort_store:
+            nextflow_command.append('--cohort_store')
 
 
         if self.variants_per_split is not None:
@@ -530,6 +1476,12 @@ process merge_small_vars_vcfs {
 
             logging.info('cd ' + original_dir)
 
+        if os.path.exists('nextflow.out.trace.txt'):
+            try:
+                resource_predictor.report_nextflow_trace('nextflow.out.trace.txt', resource_predictor.predictions_filename)
+            except resource_predictor.Error as e:
+                logging.warning('Could not report RAM predictions: ' + str(e))
+
         if self.clean:
             logging.info('Delete nextflow work directory ' + self.nextflow_work_dir)
             shutil.rmtree(self.nextflow_work_dir)
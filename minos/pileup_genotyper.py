@@ -0,0 +1,165 @@
+import heapq
+import logging
+import statistics
+
+import pysam
+
+from cluster_vcf_records import vcf_file_read
+
+from minos import gramtools
+
+class Error (Exception): pass
+
+
+def _is_biallelic_snp(fields):
+    return len(fields[3]) == 1 and len(fields[4]) == 1 and fields[3] in 'ACGT' and fields[4] in 'ACGT' and fields[3] != fields[4]
+
+
+def split_isolated_snps(infile, snps_outfile, others_outfile, min_distance):
+    '''Splits the (sorted) VCF file infile into two VCF files. snps_outfile gets
+    the biallelic SNPs where the nearest other variant is more than
+    min_distance away. others_outfile gets all other records.
+    Both output files get the header of infile.
+    Returns tuple (number of isolated SNPs, number of other records)'''
+    counts = [0, 0]
+    previous_chrom = None
+    previous_end = None
+    pending = None # (line, fields, is SNP, isolated from previous variant)
+
+    with open(infile) as f_in, open(snps_outfile, 'w') as f_snps, open(others_outfile, 'w') as f_others:
+        def write_pending(isolated_from_next):
+            line, fields, is_snp, isolated_from_previous = pending
+            if is_snp and isolated_from_previous and isolated_from_next:
+                print(line, end='', file=f_snps)
+                counts[0] += 1
+            else:
+                print(line, end='', file=f_others)
+                counts[1] += 1
+
+        for line in f_in:
+            if line.startswith('#'):
+                print(line, end='', file=f_snps)
+                print(line, end='', file=f_others)
+                continue
+
+            fields = line.split('\t', maxsplit=5)
+            start = int(fields[1]) - 1
+            end = start + len(fields[3]) - 1
+            same_chrom = fields[0] == previous_chrom
+            if pending is not None:
+                write_pending(not same_chrom or start - previous_end > min_distance)
+
+            isolated_from_previous = not same_chrom or start - previous_end > min_distance
+            pending = (line, fields, _is_biallelic_snp(fields), isolated_from_previous)
+            if same_chrom:
+                previous_end = max(end, previous_end)
+            else:
+                previous_chrom = fields[0]
+                previous_end = end
+
+        if pending is not None:
+            write_pending(True)
+
+    return tuple(counts)
+
+
+def allele_coverage_from_pileup(samfile, vcf_record):
+    '''Returns tuple (ref depth, alt depth) at the biallelic SNP vcf_record,
+    from the open pysam AlignmentFile samfile'''
+    base_counts = samfile.count_coverage(vcf_record.CHROM, vcf_record.POS, vcf_record.POS + 1, quality_threshold=0)
+    bases = 'ACGT'
+    return base_counts[bases.index(vcf_record.REF)][0], base_counts[bases.index(vcf_record.ALT[0])][0]
+
+
+def write_vcf_genotyped_from_pileup(vcf_file, reads_file, read_error_rate, outfile, filtered_outfile, kmer_size, sample_name=None, max_read_length=None, record_callback=None):
+    '''Genotypes the biallelic SNPs in vcf_file using the allele depths from
+    a pileup of the sorted indexed BAM file reads_file, with the same
+    likelihood model as used for gramtools output. Writes the same output
+    files as gramtools.write_vcf_annotated_using_coverage_from_gramtools().
+    The mean depth used by the genotyper is the mean depth of the SNPs.
+    If record_callback is given, it is called as soon as each record is
+    genotyped, with arguments (filtered record, mean depth, depth variance).
+    outfile and/or filtered_outfile can be None, in which case that file
+    is not written. Returns tuple (mean depth, depth variance)'''
+    vcf_header, vcf_records = vcf_file_read.vcf_file_to_list(vcf_file)
+    if sample_name is None:
+        sample_name = vcf_file_read.get_sample_name_from_vcf_header_lines(vcf_header)
+    samfile = pysam.AlignmentFile(reads_file, 'rb')
+    depths = [allele_coverage_from_pileup(samfile, x) for x in vcf_records]
+    samfile.close()
+    coverages = [x[0] + x[1] for x in depths]
+    mean_depth = round(statistics.mean(coverages), 3) if len(coverages) > 0 else 0
+    variance = round(statistics.variance(coverages), 3) if len(coverages) > 1 else 1.000
+    logging.info('Got allele depths from pileup of ' + str(len(vcf_records)) + ' isolated SNPs. Mean depth ' + str(mean_depth) + ', variance ' + str(variance))
+    allele_groups = {'0': {0}, '1': {1}}
+    header_lines = gramtools.make_output_vcf_header_lines(sample_name, max_read_length=max_read_length)
+
+    out_files = []
+    for filename in outfile, filtered_outfile:
+        if filename is None:
+            out_files.append(None)
+        else:
+            out_files.append(open(filename, 'w'))
+            print(*header_lines, sep='\n', file=out_files[-1])
+    f, f_filter = out_files
+
+    for vcf_record, (ref_depth, alt_depth) in zip(vcf_records, depths):
+        allele_combination_cov = {k: v for k, v in (('0', ref_depth), ('1', alt_depth)) if v > 0}
+        filtered_record = gramtools.update_vcf_record_using_gramtools_allele_depths(vcf_record, allele_combination_cov, [[ref_depth], [alt_depth]], allele_groups, mean_depth, read_error_rate, kmer_size)
+        vcf_record.INFO = {}
+        filtered_record.INFO = {}
+        if f is not None:
+            print(vcf_record, file=f)
+        if f_filter is not None:
+            print(filtered_record, file=f_filter)
+        if record_callback is not None:
+            record_callback(filtered_record, mean_depth, variance)
+
+    for f_out in out_files:
+        if f_out is not None:
+            f_out.close()
+
+    return mean_depth, variance
+
+
+def _vcf_records_with_source(vcf_file, source, ref_order):
+    '''Yields tuples (sort key, line) of the records in vcf_file,
+    with SOURCE=source added to the INFO column of each line'''
+    with open(vcf_file) as f:
+        for line in f:
+            if line.startswith('#'):
+                continue
+            fields = line.rstrip('\n').split('\t')
+            if fields[7] == '.':
+                fields[7] = 'SOURCE=' + source
+            else:
+                fields[7] += ';SOURCE=' + source
+            if fields[0] not in ref_order:
+                raise Error('Sequence name ' + fields[0] + ' from VCF file ' + vcf_file + ' not found in reference')
+            yield (ref_order[fields[0]], int(fields[1])), '\t'.join(fields)
+
+
+def merge_vcf_files_with_source(files_and_sources, outfile, ref_names):
+    '''files_and_sources = list of tuples (VCF filename, source name). Each
+    VCF file must be sorted in the order of the reference sequence names
+    ref_names, then by position. Writes one sorted VCF file, with the header
+    of the first file, where the INFO column of each record has SOURCE
+    set to the name of the file it came from'''
+    ref_order = {name: i for i, name in enumerate(ref_names)}
+    header_lines = []
+    with open(files_and_sources[0][0]) as f:
+        for line in f:
+            if not line.startswith('#'):
+                break
+            header_lines.append(line.rstrip('\n'))
+
+    for i, line in enumerate(header_lines):
+        if line.startswith('#CHROM') or line.startswith('##INFO'):
+            break
+    header_lines.insert(i, '##INFO=<ID=SOURCE,Number=1,Type=String,Description="How the variant was genotyped: gramtools=from gramtools allele coverage, pileup=from pileup of reads at an isolated SNP">')
+    iterators = [_vcf_records_with_source(filename, source, ref_order) for filename, source in files_and_sources]
+
+    with open(outfile, 'w') as f:
+        print(*header_lines, sep='\n', file=f)
+        for sort_key, line in heapq.merge(*iterators, key=lambda x: x[0]):
+            print(line, file=f)
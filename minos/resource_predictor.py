@@ -0,0 +1,316 @@
+import json
+import logging
+import math
+import os
+import re
+
+import numpy as np
+
+from minos import vcf_chunker
+
+class Error (Exception): pass
+
+
+# Model of the peak RAM (in GB) of each stage of multi_sample_pipeline that
+# has its RAM predicted. RAM = intercept + sum of (coefficient * metric).
+# If scale is not None, that is multiplied by the metric called scale (the
+# number of things run at the same time by the task).
+# Metrics are:
+#   variants, alleles: number of records, and of alleles (REF plus ALTs),
+#       in the input VCF file of the stage
+#   split_alleles: alleles in one split of the clustered VCF file, or all
+#       alleles if the VCF is not split. This is what gramtools has in memory
+#   builds: number of gramtools builds of splits run at the same time
+#   reads_gb: size in GB of the reads files of the biggest sample in the task
+#   samples: number of samples run at the same time in one minos task
+#   input_gb: total size in GB of the input VCF files of a merge task
+#   threads: number of merges run at the same time by a merge task
+# The numbers here are not fitted to measurements (the gramtools stages use
+# vcf_chunker.default_gramtools_ram_model). They are a fallback, for when
+# there is no model from calibrate_ram_model() of previous runs
+default_ram_model = {
+    'cluster_small_vars_vcf': {
+        'intercept': 1.0,
+        'coefficients': {'variants': 0.000002, 'alleles': 0.000001},
+        'scale': None,
+    },
+    'gramtools_build_small_vars': {
+        'intercept': vcf_chunker.default_gramtools_ram_model[0],
+        'coefficients': {'split_alleles': vcf_chunker.default_gramtools_ram_model[1]},
+        'scale': 'builds',
+    },
+    'minos_all_small_vars': {
+        'intercept': vcf_chunker.default_gramtools_ram_model[0] + 0.5,
+        'coefficients': {'split_alleles': vcf_chunker.default_gramtools_ram_model[1], 'reads_gb': 0.25},
+        'scale': 'samples',
+    },
+    # Input files that vcf_tree_merge cannot stream (because they are not
+    # sorted) are loaded into memory, which takes a few times their size.
+    # This allows for all inputs being loaded
+    'pre_cluster_small_vars_merge_group': {
+        'intercept': 0.5,
+        'coefficients': {'input_gb': 5.0},
+        'scale': None,
+    },
+    # The inputs were made by the merge_group stage, so are streamed
+    'pre_cluster_small_vars_merge': {
+        'intercept': 0.5,
+        'coefficients': {},
+        'scale': 'threads',
+    },
+}
+
+# No task is predicted to need less than this (GB)
+min_ram_gb = 0.5
+
+# A calibrated model is multiplied by this, so that most tasks are
+# predicted to need a little more RAM than they used before
+calibration_margin = 1.25
+
+predictions_filename = 'ram_predictions.tsv'
+
+prediction_columns = [
+    'stage',
+    'task',
+    'attempt',
+    'status',
+    'predicted_ram_gb',
+    'peak_rss_gb',
+    'metrics',
+]
+
+# Fields needed in the nextflow trace file. These are the nextflow defaults,
+# plus attempt and memory
+nextflow_trace_fields = 'task_id,hash,native_id,name,status,exit,submit,duration,realtime,%cpu,peak_rss,peak_vmem,rchar,wchar,attempt,memory'
+
+
+def fixed_ram_model(cluster_ram, gramtools_build_ram, minos_ram, pre_cluster_merge_group_ram=2, pre_cluster_merge_ram=8):
+    '''Returns RAM model that does not depend on input metrics, the same as
+    the original fixed RAM settings of multi_sample_pipeline. minos_ram is per
+    sample run at the same time'''
+    return {
+        'cluster_small_vars_vcf': {'intercept': cluster_ram, 'coefficients': {}, 'scale': None},
+        'gramtools_build_small_vars': {'intercept': gramtools_build_ram, 'coefficients': {}, 'scale': None},
+        'minos_all_small_vars': {'intercept': minos_ram, 'coefficients': {}, 'scale': 'samples'},
+        'pre_cluster_small_vars_merge_group': {'intercept': pre_cluster_merge_group_ram, 'coefficients': {}, 'scale': None},
+        'pre_cluster_small_vars_merge': {'intercept': pre_cluster_merge_ram, 'coefficients': {}, 'scale': None},
+    }
+
+
+def predict_ram_gb(model, stage, metrics):
+    '''Returns predicted RAM in GB of a task of the given stage.
+    metrics = dict of metric name -> value'''
+    stage_model = model[stage]
+    ram = stage_model['intercept'] + sum([coefficient * metrics.get(name, 0) for name, coefficient in stage_model['coefficients'].items()])
+    ram = max(ram, min_ram_gb)
+    if stage_model['scale'] is not None:
+        ram *= metrics.get(stage_model['scale'], 1)
+    return ram
+
+
+def metrics_to_string(metrics):
+    return ' '.join([name + '=' + str(metrics[name]) for name in sorted(metrics)])
+
+
+def metrics_from_string(metrics_string):
+    metrics = {}
+    for name_and_value in metrics_string.split():
+        try:
+            name, value = name_and_value.split('=')
+            metrics[name] = float(value)
+        except:
+            raise Error('Cannot get metric from "' + name_and_value + '"')
+    return metrics
+
+
+def files_gb(filenames):
+    '''Returns total size in GB of the files'''
+    return sum([os.path.getsize(x) for x in filenames]) / 1024**3
+
+
+def vcf_metrics(vcf_file, threads=1, variants_per_split=None, alleles_per_split=None, total_splits=None):
+    '''Returns dict of metrics of a VCF file: variants, alleles,
+    split_alleles, builds. The split options are the same as for
+    vcf_chunker.VcfChunker. The splits are not made, so split_alleles is
+    the mean alleles per split'''
+    variants = 0
+    alleles = 0
+    with open(vcf_file) as f:
+        for line in f:
+            if not line.startswith('#'):
+                alt = line.split('\t', maxsplit=5)[4]
+                variants += 1
+                alleles += 1 if alt == '.' else 1 + len(alt.split(','))
+
+    if alleles_per_split is not None:
+        splits = math.ceil(alleles / alleles_per_split)
+    elif variants_per_split is not None:
+        splits = math.ceil(variants / variants_per_split)
+    elif total_splits is not None:
+        splits = total_splits
+    else:
+        splits = 1
+    splits = max(1, splits)
+
+    return {
+        'variants': variants,
+        'alleles': alleles,
+        'split_alleles': math.ceil(alleles / splits),
+        'builds': min(threads, splits),
+    }
+
+
+def write_vcf_metrics_file(vcf_file, outfile, threads=1, variants_per_split=None, alleles_per_split=None, total_splits=None):
+    '''Writes the metrics from vcf_metrics() to a file, in one line of name=value pairs'''
+    metrics = vcf_metrics(vcf_file, threads=threads, variants_per_split=variants_per_split, alleles_per_split=alleles_per_split, total_splits=total_splits)
+    with open(outfile, 'w') as f:
+        print(metrics_to_string(metrics), file=f)
+
+
+def write_nextflow_model_json(model, outfile):
+    '''Writes the model to a JSON file, to be used by the nextflow pipeline'''
+    with open(outfile, 'w') as f:
+        json.dump({'min_ram_gb': min_ram_gb, 'stages': model}, f, indent=2, sort_keys=True)
+
+
+def write_nextflow_trace_config(outfile):
+    '''Writes nextflow config file, that makes the trace file have the
+    fields needed by load_nextflow_trace()'''
+    with open(outfile, 'w') as f:
+        print('trace {', "    fields = '" + nextflow_trace_fields + "'", '}', sep='\n', file=f)
+
+
+def _memory_to_gb(memory):
+    '''Returns memory from the nextflow trace file in GB (eg "1.5 GB" -> 1.5),
+    or None if it is unknown ("-")'''
+    units = {'B': 0, 'KB': 1, 'MB': 2, 'GB': 3, 'TB': 4, 'PB': 5}
+    match = re.match(r'^([0-9.]+)\s*([KMGTP]?B)?$', memory.strip())
+    if match is None:
+        return None
+    unit = 'B' if match.group(2) is None else match.group(2)
+    return float(match.group(1)) * 1024**units[unit] / 1024**3
+
+
+def load_nextflow_trace(trace_file, stages=None):
+    '''Returns list of dicts, one per task (attempt) in the nextflow trace
+    file of a stage in stages (default: all stages in default_ram_model),
+    with the keys in prediction_columns. The task metrics are in the tag of
+    each task'''
+    if stages is None:
+        stages = set(default_ram_model.keys())
+    rows = []
+
+    with open(trace_file) as f:
+        header = f.readline().rstrip('\n').split('\t')
+        missing = {'name', 'status', 'attempt', 'memory', 'peak_rss'}.difference(header)
+        if len(missing) > 0:
+            raise Error('Column(s) ' + ','.join(sorted(missing)) + ' not found in nextflow trace file ' + trace_file)
+
+        for line in f:
+            fields = dict(zip(header, line.rstrip('\n').split('\t')))
+            match = re.match(r'^(\S+) \((.*)\)$', fields['name'])
+            if match is None or match.group(1) not in stages:
+                continue
+            attempt = int(fields['attempt'])
+            memory = _memory_to_gb(fields['memory'])
+            rows.append({
+                'stage': match.group(1),
+                'task': fields['name'],
+                'attempt': attempt,
+                'status': fields['status'],
+                'predicted_ram_gb': None if memory is None else memory / attempt,
+                'peak_rss_gb': _memory_to_gb(fields['peak_rss']),
+                'metrics': match.group(2),
+            })
+
+    return rows
+
+
+def write_predictions_tsv(rows, outfile):
+    with open(outfile, 'w') as f:
+        print(*prediction_columns, sep='\t', file=f)
+        for row in rows:
+            print(*['.' if row[x] is None else row[x] for x in prediction_columns], sep='\t', file=f)
+
+
+def load_predictions_tsv(infile):
+    rows = []
+    with open(infile) as f:
+        header = f.readline().rstrip('\n').split('\t')
+        if header != prediction_columns:
+            raise Error('Unexpected header line in RAM predictions file ' + infile)
+        for line in f:
+            row = dict(zip(header, line.rstrip('\n').split('\t')))
+            row['attempt'] = int(row['attempt'])
+            for key in 'predicted_ram_gb', 'peak_rss_gb':
+                row[key] = None if row[key] == '.' else float(row[key])
+            rows.append(row)
+    return rows
+
+
+def report_nextflow_trace(trace_file, outfile):
+    '''Writes predicted and actual (peak RSS) RAM of each task in the nextflow
+    trace file to the TSV file outfile, and logs a summary of each stage.
+    The TSV file can be used by calibrate_ram_model()'''
+    rows = load_nextflow_trace(trace_file)
+    write_predictions_tsv(rows, outfile)
+    for stage in sorted(set([x['stage'] for x in rows])):
+        stage_rows = [x for x in rows if x['stage'] == stage]
+        retried = len([x for x in stage_rows if x['attempt'] > 1])
+        measured = [x for x in stage_rows if x['status'] == 'COMPLETED' and x['predicted_ram_gb'] is not None and x['peak_rss_gb'] is not None]
+        message = 'RAM prediction for ' + stage + '. Tasks: ' + str(len(stage_rows)) + '. Retries: ' + str(retried)
+        if len(measured) > 0:
+            message += '. Mean predicted GB: ' + str(round(np.mean([x['predicted_ram_gb'] for x in measured]), 2)) \
+                + '. Mean peak RSS GB: ' + str(round(np.mean([x['peak_rss_gb'] for x in measured]), 2)) \
+                + '. Max peak RSS / predicted: ' + str(round(max([x['peak_rss_gb'] / x['predicted_ram_gb'] for x in measured]), 2))
+        logging.info(message)
+    logging.info('Predicted and actual RAM of each task written to ' + outfile)
+    return rows
+
+
+def _fit_stage(rows, stage_model):
+    '''Returns model of one stage, in the same form as stage_model, fitted to
+    the completed tasks in rows (made by load_predictions_tsv()). The same
+    metrics as stage_model are used. If there is not enough data to fit,
+    stage_model is returned'''
+    names = sorted(stage_model['coefficients'].keys())
+    xs = []
+    ys = []
+    for row in rows:
+        if row['status'] != 'COMPLETED' or row['peak_rss_gb'] is None:
+            continue
+        metrics = metrics_from_string(row['metrics'])
+        scale = 1 if stage_model['scale'] is None else metrics.get(stage_model['scale'], 1)
+        xs.append([1] + [metrics.get(x, 0) for x in names])
+        ys.append(row['peak_rss_gb'] / max(scale, 1))
+
+    if len(xs) <= len(names) or np.linalg.matrix_rank(np.array(xs, dtype=float)) < len(names) + 1:
+        return stage_model
+
+    fit = np.linalg.lstsq(np.array(xs, dtype=float), np.array(ys, dtype=float), rcond=None)[0]
+    return {
+        'intercept': calibration_margin * max(0.0, float(fit[0])),
+        'coefficients': {name: calibration_margin * max(0.0, float(x)) for name, x in zip(names, fit[1:])},
+        'scale': stage_model['scale'],
+    }
+
+
+def calibrate_ram_model(dirs):
+    '''Returns RAM model (in the same form as default_ram_model), fitted to
+    the peak RSS of tasks in the RAM prediction files (written by
+    report_nextflow_trace()) found anywhere in the given directories'''
+    rows = []
+    for directory in dirs:
+        for root, dirnames, filenames in os.walk(directory):
+            if predictions_filename in filenames:
+                rows.extend(load_predictions_tsv(os.path.join(root, predictions_filename)))
+
+    model = {}
+    for stage, stage_model in default_ram_model.items():
+        stage_rows = [x for x in rows if x['stage'] == stage]
+        model[stage] = _fit_stage(stage_rows, stage_model)
+        if model[stage] is stage_model:
+            logging.info('RAM model for ' + stage + ': not enough data from ' + str(len(stage_rows)) + ' task(s). Using default model')
+        else:
+            logging.info('RAM model for ' + stage + ' calibrated from ' + str(len(stage_rows)) + ' task(s): GB = ' + str(round(model[stage]['intercept'], 4)) + ' + ' + ' + '.join([str(model[stage]['coefficients'][x]) + ' * ' + x for x in sorted(model[stage]['coefficients'])]))
+    return model
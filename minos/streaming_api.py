@@ -0,0 +1,131 @@
+from collections import namedtuple
+import os
+import queue
+import shutil
+import tempfile
+import threading
+
+from minos import adjudicator
+
+class Error (Exception): pass
+
+
+genotyped_site_attributes = [
+    'chrom',
+    'pos',
+    'ref',
+    'alts',
+    'gt',
+    'cov',
+    'gt_conf',
+    'source',
+    'vcf_record',
+]
+GenotypedSite = namedtuple('GenotypedSite', genotyped_site_attributes)
+
+
+class _Cancelled (Exception): pass
+
+
+def adjudicate_iter(ref_fasta, reads_files, vcf_files, outdir=None, queue_size=1000, **adjudicator_kwargs):
+    '''Runs the adjudicator, yielding a GenotypedSite for each site as soon as
+    it is genotyped, instead of having to read final.vcf at the end.
+    Sites are yielded in the order they are genotyped, which is the same
+    order as final.vcf, except that isolated SNPs from pileup_isolated_snps
+    come last, and that splits genotyped in parallel (split_threads > 1)
+    are yielded in the order they finish. Only sites that are written to final.vcf are yielded.
+    GT_CONF_PERCENTILE is not given. It is the percentile of GT_CONF among
+    GT_CONFs simulated from the mean depth and variance of the whole run
+    (of all the splits, if the VCF is split), which is only known after the
+    last site has been genotyped. Giving it would mean holding every site
+    until the end. It is added to final.vcf, so use outdir if it is needed.
+    At most queue_size sites are held waiting for the consumer, after which
+    the adjudicator waits. If the generator is closed early, the adjudicator
+    is stopped at the next genotyped site (leaving outdir unfinished).
+    If outdir is None, the adjudicator is run with write_vcf_files=False,
+    so the sites are only yielded and no VCF output files are made. Other
+    files (eg gramtools files) are written to a temporary directory, which
+    is deleted at the end. Otherwise the usual output files are
+    kept in outdir. adjudicator_kwargs are passed to Adjudicator'''
+    if 'genotyped_record_callback' in adjudicator_kwargs:
+        raise Error('Cannot use genotyped_record_callback with adjudicate_iter')
+
+    if outdir is None:
+        tmp_dir = tempfile.mkdtemp(prefix='tmp.minos.adjudicate_iter.')
+        run_outdir = os.path.join(tmp_dir, 'out')
+        adjudicator_kwargs.setdefault('write_vcf_files', False)
+    else:
+        tmp_dir = None
+        run_outdir = outdir
+
+    sites = queue.Queue(maxsize=queue_size)
+    finished = object()
+    stop = threading.Event()
+
+    # This is run by the adjudicator thread. Waits for space in the queue,
+    # unless the consumer has gone away, in which case raises _Cancelled
+    # to stop the adjudicator
+    def put(item):
+        while not stop.is_set():
+            try:
+                sites.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+        raise _Cancelled()
+
+    def add_site(vcf_record, mean_depth, depth_variance, source):
+        put(GenotypedSite(
+            vcf_record.CHROM,
+            vcf_record.POS + 1,
+            vcf_record.REF,
+            vcf_record.ALT,
+            vcf_record.FORMAT.get('GT', None),
+            [int(x) for x in vcf_record.FORMAT['COV'].split(',')] if 'COV' in vcf_record.FORMAT else None,
+            float(vcf_record.FORMAT['GT_CONF']) if 'GT_CONF' in vcf_record.FORMAT else None,
+            source,
+            vcf_record,
+        ))
+
+    try:
+        adj = adjudicator.Adjudicator(
+            run_outdir,
+            ref_fasta,
+            reads_files,
+            vcf_files,
+            genotyped_record_callback=add_site,
+            **adjudicator_kwargs
+        )
+    except:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
+        raise
+
+    def run_adjudicator():
+        try:
+            adj.run()
+            put(finished)
+        except _Cancelled:
+            pass
+        except Exception as e:
+            try:
+                put(e)
+            except _Cancelled:
+                pass
+
+    thread = threading.Thread(target=run_adjudicator, daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            site = sites.get()
+            if site is finished:
+                break
+            elif isinstance(site, Exception):
+                raise site
+            yield site
+    finally:
+        stop.set()
+        thread.join()
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
@@ -1,11 +1,15 @@
 __all__ = [
     'adjudicate',
+    'adjudicate_batch',
     'check_with_ref',
     'check_snps',
     'check_recall',
     'cluster_vcfs',
+    'cohort_store_export',
+    'estimate',
     'make_split_gramtools_build',
     'multi_sample_pipeline',
+    'serve',
     'versions',
 ]
 
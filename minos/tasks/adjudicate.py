@@ -1,6 +1,13 @@
-from minos import adjudicator
+from minos import adjudicator, cost_estimator, utils
 
 def run(options):
+    if options.regions is None and options.regions_bed is None:
+        regions = None
+    else:
+        regions = [] if options.regions is None else [utils.parse_region_string(x) for x in options.regions]
+        if options.regions_bed is not None:
+            regions.extend(utils.load_regions_bed_file(options.regions_bed))
+
     adj = adjudicator.Adjudicator(
         options.outdir,
         options.ref_fasta,
@@ -17,6 +24,17 @@ def run(options):
         total_splits=options.total_splits,
         clean=not options.debug,
         gramtools_kmer_size=options.gramtools_kmer_size,
+        filter_unmapped_reads=options.filter_unmapped_reads,
+        unmapped_reads_cache_dir=options.unmapped_reads_cache_dir,
+        target_ram_per_split=options.target_ram_per_split,
+        gramtools_ram_model=cost_estimator.gramtools_ram_model_from_options(options.gramtools_ram_model, options.gramtools_ram_calibration_dir),
+        read_stats_cache_dir=options.read_stats_cache_dir,
+        read_extract_threads=options.read_extract_threads,
+        split_threads=options.split_threads,
+        regions=regions,
+        pileup_isolated_snps=options.pileup_isolated_snps,
+        split_cost=options.split_cost,
+        slice_reference=options.slice_reference,
     )
     adj.run()
 
@@ -0,0 +1,16 @@
+from minos import batch_adjudicator
+
+def run(options):
+    batch = batch_adjudicator.BatchAdjudicator(
+        options.samples_tsv,
+        options.gramtools_build_dir,
+        options.ref_fasta,
+        options.vcf_file,
+        threads=options.threads,
+        max_read_length=options.max_read_length,
+        read_error_rate=options.read_error_rate,
+        overwrite_outdirs=options.force,
+        clean=not options.debug,
+        read_stats_cache_dir=options.read_stats_cache_dir,
+    )
+    batch.run()
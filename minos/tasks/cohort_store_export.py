@@ -0,0 +1,16 @@
+from minos import cohort_store
+
+def run(options):
+    store = cohort_store.CohortStore(options.store_dir)
+    if options.region is None:
+        sites = None
+    else:
+        chrom, _, coords = options.region.partition(':')
+        if coords == '':
+            sites = store.site_slice(chrom)
+        else:
+            start, end = coords.split('-')
+            sites = store.site_slice(chrom, start=int(start), end=int(end))
+
+    samples = None if options.samples is None else options.samples.split(',')
+    store.to_vcf(options.outfile, sites=sites, samples=samples)
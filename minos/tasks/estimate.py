@@ -0,0 +1,20 @@
+from minos import cost_estimator
+
+def run(options):
+    estimator = cost_estimator.CostEstimator(
+        options.outfile,
+        options.ref_fasta,
+        options.vcf_files,
+        vcf_is_clustered=options.vcf_is_clustered,
+        max_alleles_per_cluster=options.max_alleles_per_cluster,
+        total_splits=options.total_splits,
+        variants_per_split=options.variants_per_split,
+        alleles_per_split=options.alleles_per_split,
+        target_ram_per_split=options.target_ram_per_split,
+        max_read_length=options.max_read_length,
+        calibration_dirs=options.calibration_dir,
+        reads_files=options.reads_file,
+        gramtools_ram_model=cost_estimator.gramtools_ram_model_from_options(options.gramtools_ram_model),
+        unmapped_reads_dir=options.unmapped_reads_cache_dir,
+    )
+    estimator.run()
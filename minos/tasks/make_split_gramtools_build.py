@@ -1,6 +1,15 @@
-from minos import vcf_chunker
+import os
+
+from minos import cost_estimator, vcf_chunker
 
 def run(options):
+    if options.update:
+        if not os.path.exists(options.outdir):
+            raise vcf_chunker.Error('Output directory ' + options.outdir + ' not found. --update needs an existing directory')
+        chunker = vcf_chunker.VcfChunker(options.outdir, threads=options.threads)
+        chunker.update_split_files(options.vcf_file)
+        return
+
     chunker = vcf_chunker.VcfChunker(
         options.outdir,
         vcf_infile=options.vcf_file,
@@ -12,6 +21,11 @@ def run(options):
         flank_length=options.max_read_length,
         gramtools_kmer_size=options.gramtools_kmer_size,
         threads=options.threads,
+        target_ram_per_split=options.target_ram_per_split,
+        gramtools_ram_model=cost_estimator.gramtools_ram_model_from_options(options.gramtools_ram_model, options.gramtools_ram_calibration_dir),
+        split_cost=options.split_cost,
+        reads_file=options.split_cost_reads,
+        slice_reference=options.slice_reference,
     )
     chunker.make_split_files()
 
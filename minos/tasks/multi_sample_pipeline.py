@@ -22,6 +22,19 @@ def run(options):
         nf_ram_gramtools_build_small=options.nf_ram_gramtools_build_small,
         nf_ram_minos_small_vars=options.nf_ram_minos_small_vars,
         nf_ram_merge_small_vars=options.nf_ram_merge_small_vars,
+        nf_ram_pre_cluster_merge_group=options.nf_ram_pre_cluster_merge_group,
+        nf_ram_pre_cluster_merge=options.nf_ram_pre_cluster_merge,
+        minos_batch_size=options.minos_batch_size,
+        minos_batch_threads=options.minos_batch_threads,
+        cohort_store=options.cohort_store,
+        executor=options.executor,
+        threads=options.threads,
+        local_max_ram=options.local_max_ram,
+        local_enforce_ram=options.local_enforce_ram,
+        update=options.update,
+        pre_cluster_merge_group_size=options.pre_cluster_merge_group_size,
+        predict_ram=options.predict_ram,
+        ram_calibration_dirs=options.ram_calibration_dir,
         testing=options.testing,
     )
     pipeline.run()
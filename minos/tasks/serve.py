@@ -0,0 +1,20 @@
+from minos import adjudication_server
+
+def run(options):
+    server = adjudication_server.AdjudicationServer(
+        options.gramtools_build_dir,
+        options.ref_fasta,
+        options.vcf_file,
+        outdir_root=options.outdir_root,
+        host=options.host,
+        port=options.port,
+        allow_remote=options.allow_remote,
+        threads=options.threads,
+        max_queued_jobs=options.max_queued_jobs,
+        max_finished_jobs=options.max_finished_jobs,
+        finished_job_ttl=options.finished_job_ttl,
+        overwrite_outdirs=options.force,
+        clean=not options.debug,
+        read_stats_cache_dir=options.read_stats_cache_dir,
+    )
+    server.run()
@@ -0,0 +1,138 @@
+from http.server import ThreadingHTTPServer
+import json
+import os
+import shutil
+import threading
+import unittest
+import urllib.error
+import urllib.request
+
+from minos import adjudication_server
+
+modules_dir = os.path.dirname(os.path.abspath(adjudication_server.__file__))
+data_dir = os.path.join(modules_dir, 'tests', 'data', 'adjudicator')
+
+
+def make_server(build_dir):
+    if os.path.exists(build_dir):
+        shutil.rmtree(build_dir)
+    os.mkdir(build_dir)
+    ref_fasta = os.path.join(data_dir, 'run.ref.fa')
+    vcf_file = os.path.join(data_dir, 'run.calls.1.vcf')
+    return adjudication_server.AdjudicationServer(build_dir, ref_fasta, vcf_file, max_queued_jobs=1)
+
+
+class TestAdjudicationServer(unittest.TestCase):
+    def test_init(self):
+        '''test __init__ and _is_loopback'''
+        self.assertTrue(adjudication_server.AdjudicationServer._is_loopback('127.0.0.1'))
+        self.assertTrue(adjudication_server.AdjudicationServer._is_loopback('localhost'))
+        self.assertFalse(adjudication_server.AdjudicationServer._is_loopback('0.0.0.0'))
+        build_dir = 'tmp.adjudication_server.init.build'
+        make_server(build_dir)
+        ref_fasta = os.path.join(data_dir, 'run.ref.fa')
+        vcf_file = os.path.join(data_dir, 'run.calls.1.vcf')
+        with self.assertRaises(adjudication_server.Error):
+            adjudication_server.AdjudicationServer(build_dir, ref_fasta, vcf_file, host='0.0.0.0')
+        server = adjudication_server.AdjudicationServer(build_dir, ref_fasta, vcf_file, host='0.0.0.0', allow_remote=True)
+        self.assertEqual('0.0.0.0', server.host)
+        with self.assertRaises(adjudication_server.Error):
+            adjudication_server.AdjudicationServer(build_dir, ref_fasta, vcf_file, outdir_root='does_not_exist')
+        shutil.rmtree(build_dir)
+
+
+    def test_check_job_request(self):
+        '''test _check_job_request'''
+        build_dir = 'tmp.adjudication_server.check_job_request.build'
+        server = make_server(build_dir)
+        reads_file = os.path.join(data_dir, 'run.bwa.bam')
+        outdir, reads_files, kwargs = server._check_job_request({'outdir': 'out', 'reads': [reads_file], 'sample_name': 'sample1'})
+        self.assertEqual(os.path.join(os.path.realpath('.'), 'out'), outdir)
+        self.assertEqual([reads_file], reads_files)
+        self.assertEqual('sample1', kwargs['sample_name'])
+        self.assertEqual(None, kwargs['max_read_length'])
+        self.assertEqual(server.gramtools_build_dir, kwargs['gramtools_build_dir'])
+
+        bad_requests = [
+            [],
+            {'reads': [reads_file]},
+            {'outdir': 'out'},
+            {'outdir': 'out', 'reads': []},
+            {'outdir': 'out', 'reads': ['does_not_exist.bam']},
+            {'outdir': 'out', 'reads': [reads_file], 'unknown_key': 42},
+        ]
+        for job_request in bad_requests:
+            with self.assertRaises(adjudication_server.Error):
+                server._check_job_request(job_request)
+
+        symlink = 'tmp.adjudication_server.check_job_request.link'
+        if os.path.lexists(symlink):
+            os.unlink(symlink)
+        os.symlink('/', symlink)
+        bad_outdirs = [42, '', '.', '../out', 'out/../../out', '/tmp', build_dir, os.path.join(build_dir, 'out'), os.path.join(symlink, 'tmp')]
+        for bad_outdir in bad_outdirs:
+            with self.assertRaises(adjudication_server.Error):
+                server._check_job_request({'outdir': bad_outdir, 'reads': [reads_file]})
+        os.unlink(symlink)
+        shutil.rmtree(build_dir)
+
+
+    def test_job_status(self):
+        '''test _job_finished, get_job, status'''
+        build_dir = 'tmp.adjudication_server.job_status.build'
+        server = make_server(build_dir)
+        for job_id in '1', '2', '3':
+            server.jobs[job_id] = {'id': job_id, 'outdir': 'out.' + job_id, 'status': 'queued', 'final_vcf': None, 'error': None, 'metrics': None}
+        server._job_finished('1', (None, {'wall_clock_seconds': 1.0}))
+        server._job_crashed('2', Exception('oops'))
+        self.assertEqual({'queued': 1, 'finished': 1, 'failed': 1}, server.status()['jobs'])
+        self.assertEqual(os.path.join('out.1', 'final.vcf'), server.get_job('1')['final_vcf'])
+        self.assertEqual({'wall_clock_seconds': 1.0}, server.get_job('1')['metrics'])
+        self.assertEqual('oops', server.get_job('2')['error'])
+        self.assertEqual(None, server.get_job('4'))
+
+        # Only one queued job allowed
+        with self.assertRaises(adjudication_server.Error):
+            server.submit_job({'outdir': 'out.4', 'reads': [os.path.join(data_dir, 'run.bwa.bam')]})
+
+        server.max_finished_jobs = 1
+        server._job_finished('3', (None, {}))
+        self.assertEqual(None, server.get_job('1'))
+        self.assertEqual(None, server.get_job('2'))
+        self.assertEqual('finished', server.get_job('3')['status'])
+        server.finished_job_ttl = -1
+        with server.jobs_lock:
+            server._evict_finished_jobs()
+        self.assertEqual({}, server.jobs)
+        shutil.rmtree(build_dir)
+
+
+    def test_request_handler(self):
+        '''test _RequestHandler'''
+        build_dir = 'tmp.adjudication_server.request_handler.build'
+        server = make_server(build_dir)
+        server.jobs['1'] = {'id': '1', 'outdir': 'out.1', 'status': 'finished', 'final_vcf': 'out.1/final.vcf', 'error': None, 'metrics': {}}
+        httpd = ThreadingHTTPServer(('127.0.0.1', 0), adjudication_server._RequestHandler)
+        httpd.adjudication_server = server
+        thread = threading.Thread(target=httpd.serve_forever)
+        thread.start()
+        url = 'http://127.0.0.1:' + str(httpd.server_address[1])
+
+        with urllib.request.urlopen(url + '/status') as response:
+            self.assertEqual({'queued': 0, 'finished': 1, 'failed': 0}, json.load(response)['jobs'])
+        with urllib.request.urlopen(url + '/jobs/1') as response:
+            self.assertEqual('out.1/final.vcf', json.load(response)['final_vcf'])
+
+        with self.assertRaises(urllib.error.HTTPError) as context:
+            urllib.request.urlopen(url + '/jobs/2')
+        self.assertEqual(404, context.exception.code)
+
+        for data in b'not json', json.dumps({'outdir': 'out.2'}).encode():
+            with self.assertRaises(urllib.error.HTTPError) as context:
+                urllib.request.urlopen(urllib.request.Request(url + '/jobs', data=data, method='POST'))
+            self.assertEqual(400, context.exception.code)
+
+        httpd.shutdown()
+        httpd.server_close()
+        thread.join()
+        shutil.rmtree(build_dir)
@@ -1,9 +1,14 @@
 import filecmp
+import logging
 import shutil
 import os
 import unittest
 
-from minos import adjudicator
+import pyfastaq
+
+from cluster_vcf_records import vcf_file_read
+
+from minos import adjudicator, utils, vcf_chunker
 
 modules_dir = os.path.dirname(os.path.abspath(adjudicator.__file__))
 data_dir = os.path.join(modules_dir, 'tests', 'data', 'adjudicator')
@@ -18,6 +23,117 @@ class TestAdjudicator(unittest.TestCase):
         self.assertEqual(10, adjudicator.Adjudicator._get_gramtools_kmer_size(None, None))
 
 
+    def test_init_write_vcf_files_needs_callback(self):
+        '''test write_vcf_files=False is only allowed with genotyped_record_callback'''
+        ref_fasta = os.path.join(data_dir, 'run.ref.fa')
+        reads_file = os.path.join(data_dir, 'run.bwa.bam')
+        vcf_files = [os.path.join(data_dir, 'run.calls.1.vcf')]
+        with self.assertRaises(adjudicator.Error):
+            adjudicator.Adjudicator('tmp.adjudicator.out', ref_fasta, [reads_file], vcf_files, write_vcf_files=False)
+        adj = adjudicator.Adjudicator('tmp.adjudicator.out', ref_fasta, [reads_file], vcf_files, write_vcf_files=False, genotyped_record_callback=lambda *args: None)
+        self.assertFalse(adj.write_vcf_files)
+
+
+    def test_depth_to_use(self):
+        '''test mean_depth and depth_variance options, and _depth_to_use'''
+        ref_fasta = os.path.join(data_dir, 'run.ref.fa')
+        reads_file = os.path.join(data_dir, 'run.bwa.bam')
+        vcf_files = [os.path.join(data_dir, 'run.calls.1.vcf')]
+        with self.assertRaises(adjudicator.Error):
+            adjudicator.Adjudicator('tmp.adjudicator.out', ref_fasta, [reads_file], vcf_files, mean_depth=10)
+        with self.assertRaises(adjudicator.Error):
+            adjudicator.Adjudicator('tmp.adjudicator.out', ref_fasta, [reads_file], vcf_files, depth_variance=10)
+        adj = adjudicator.Adjudicator('tmp.adjudicator.out', ref_fasta, [reads_file], vcf_files)
+        self.assertEqual((2, 3), adj._depth_to_use(2, 3))
+        adj = adjudicator.Adjudicator('tmp.adjudicator.out', ref_fasta, [reads_file], vcf_files, mean_depth=20, depth_variance=30)
+        self.assertEqual((20, 30), adj._depth_to_use(2, 3))
+
+
+    def test_use_split_vcf(self):
+        '''test _use_split_vcf'''
+        ref_fasta = os.path.join(data_dir, 'run.ref.fa')
+        reads_file = os.path.join(data_dir, 'run.bwa.bam')
+        vcf_file = os.path.join(data_dir, 'run.calls.1.vcf')
+        outdir = 'tmp.adjudicator.use_split_vcf'
+        adj = adjudicator.Adjudicator(outdir, ref_fasta, [reads_file], [vcf_file])
+        self.assertFalse(adj._use_split_vcf())
+        adj = adjudicator.Adjudicator(outdir, ref_fasta, [reads_file], [vcf_file], variants_per_split=3)
+        self.assertTrue(adj._use_split_vcf())
+
+        adj = adjudicator.Adjudicator(outdir, ref_fasta, [reads_file], [vcf_file], target_ram_per_split=1000)
+        adj.clustered_vcf = vcf_file
+        self.assertFalse(adj._use_split_vcf())
+        adj = adjudicator.Adjudicator(outdir, ref_fasta, [reads_file], [vcf_file], target_ram_per_split=0.5)
+        adj.clustered_vcf = vcf_file
+        self.assertTrue(adj._use_split_vcf())
+        adj = adjudicator.Adjudicator(outdir, ref_fasta, [reads_file], [vcf_file], target_ram_per_split=1000, gramtools_ram_model=(1, 100))
+        adj.clustered_vcf = vcf_file
+        self.assertTrue(adj._use_split_vcf())
+        adj = adjudicator.Adjudicator(outdir, ref_fasta, [reads_file, reads_file], [vcf_file], target_ram_per_split=0.5)
+        adj.clustered_vcf = vcf_file
+        with self.assertRaises(adjudicator.Error):
+            adj._use_split_vcf()
+
+
+    def test_make_vcf_chunker_with_regions(self):
+        '''test _make_vcf_chunker when regions are used'''
+        outdir = 'tmp.adjudicator.make_vcf_chunker_with_regions'
+        if os.path.exists(outdir):
+            shutil.rmtree(outdir)
+        os.mkdir(outdir)
+        ref_fasta = os.path.join(data_dir, 'run.ref.fa')
+        reads_file = os.path.join(data_dir, 'run.bwa.bam')
+        vcf_file = os.path.join(data_dir, 'run.calls.1.vcf')
+        regions = [('ref.1', 95, 105), ('ref.1', 695, 710)]
+        adj = adjudicator.Adjudicator(outdir, ref_fasta, [reads_file], [vcf_file], regions=regions, max_read_length=10)
+        self.assertTrue(adj._use_split_vcf())
+        adjudicator.Adjudicator._filter_vcf_file_by_regions(vcf_file, adj.clustered_vcf, utils.merge_regions(regions))
+        chunker = adj._make_vcf_chunker()
+        chunker.make_split_vcf_files()
+
+        # gramtools build should get one slice of the reference for each
+        # region, with records in the coordinates of the slice
+        ref_seqs = {}
+        pyfastaq.tasks.file_to_dict(ref_fasta, ref_seqs)
+        split_files = chunker.vcf_split_files['ref.1']
+        self.assertEqual([(89, 109), (690, 713)], [(x.chrom_start, x.chrom_end) for x in split_files])
+        expect_positions = [[10], [10, 11, 12, 13]]
+        for split_file, positions in zip(split_files, expect_positions):
+            slice_seqs = {}
+            pyfastaq.tasks.file_to_dict(split_file.ref_fasta, slice_seqs)
+            self.assertEqual({'ref.1': ref_seqs['ref.1'].seq[split_file.chrom_start:split_file.chrom_end + 1]}, {k: v.seq for k, v in slice_seqs.items()})
+            header, records = vcf_file_read.vcf_file_to_list(split_file.filename)
+            self.assertEqual(positions, [x.POS for x in records])
+            vcf_chunker.VcfChunker.shift_split_vcf_records_to_ref(split_file, records)
+            self.assertEqual([x + split_file.chrom_start for x in positions], [x.POS for x in records])
+        shutil.rmtree(outdir)
+
+
+    def test_filter_vcf_file_by_regions(self):
+        '''test _filter_vcf_file_by_regions'''
+        tmp_in = 'tmp.adjudicator.filter_vcf_file_by_regions.in.vcf'
+        tmp_out = 'tmp.adjudicator.filter_vcf_file_by_regions.out.vcf'
+        header = ['##fileformat=VCFv4.2', '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO']
+        records = [
+            'ref1\t5\t.\tA\tG\t.\tPASS\t.',
+            'ref1\t8\t.\tACGT\tA\t.\tPASS\t.',
+            'ref1\t20\t.\tA\tG\t.\tPASS\t.',
+            'ref1\t30\t.\tA\tG\t.\tPASS\t.',
+            'ref2\t5\t.\tA\tG\t.\tPASS\t.',
+            'ref3\t5\t.\tA\tG\t.\tPASS\t.',
+        ]
+        with open(tmp_in, 'w') as f:
+            print(*header, *records, sep='\n', file=f)
+
+        regions = {'ref1': [(9, 12), (29, 40)], 'ref2': [(0, 100)]}
+        self.assertEqual(3, adjudicator.Adjudicator._filter_vcf_file_by_regions(tmp_in, tmp_out, regions))
+        with open(tmp_out) as f:
+            got = [x.rstrip() for x in f]
+        self.assertEqual(header + [records[1], records[3], records[4]], got)
+        os.unlink(tmp_in)
+        os.unlink(tmp_out)
+
+
     def test_run(self):
         '''test run'''
         # We're just testing that it doesn't crash.
@@ -35,7 +151,18 @@ class TestAdjudicator(unittest.TestCase):
         self.assertTrue(os.path.exists(outdir))
         self.assertTrue(os.path.exists(adj.log_file))
         self.assertTrue(os.path.exists(adj.final_vcf))
+        self.assertFalse(os.path.exists(adj.partial_final_vcf))
         self.assertTrue(os.path.exists(adj.clustered_vcf))
+        vcf_header, expect_records = vcf_file_read.vcf_file_to_list(adj.final_vcf)
+
+        # Run again, genotyping splits in parallel, which can finish
+        # in any order. Should get the same records in the same order
+        shutil.rmtree(outdir)
+        adj = adjudicator.Adjudicator(outdir, ref_fasta, [reads_file], vcf_files, variants_per_split=3, split_threads=3, clean=False, gramtools_kmer_size=5, genotype_simulation_iterations=1000)
+        adj.run()
+        self.assertFalse(os.path.exists(adj.partial_final_vcf))
+        vcf_header, got_records = vcf_file_read.vcf_file_to_list(adj.final_vcf)
+        self.assertEqual([(x.CHROM, x.POS, x.REF, x.ALT) for x in expect_records], [(x.CHROM, x.POS, x.REF, x.ALT) for x in got_records])
 
         # Clean up and then run without splitting
         shutil.rmtree(outdir)
@@ -93,8 +220,10 @@ class TestAdjudicator(unittest.TestCase):
         reads_file = os.path.join(data_dir, 'run.bwa.bam')
         vcf_files =  [os.path.join(data_dir, x) for x in ['run.calls.empty.1.vcf', 'run.calls.empty.2.vcf']]
         adj = adjudicator.Adjudicator(outdir, ref_fasta, [reads_file], vcf_files, clean=False, gramtools_kmer_size=5, genotype_simulation_iterations=1000)
+        total_log_handlers = len(logging.getLogger().handlers)
         with self.assertRaises(adjudicator.Error):
             adj.run()
+        self.assertEqual(total_log_handlers, len(logging.getLogger().handlers))
         self.assertTrue(os.path.exists(outdir))
         self.assertTrue(os.path.exists(adj.log_file))
         self.assertFalse(os.path.exists(adj.final_vcf))
@@ -119,3 +248,8 @@ class TestAdjudicator(unittest.TestCase):
         self.assertTrue(filecmp.cmp(tmp_file, expect_file, shallow=False))
         os.unlink(tmp_file)
 
+        tmp_out = 'tmp.adjudicator.add_gt_conf_percentile_to_vcf_file.out.vcf'
+        adjudicator.Adjudicator._add_gt_conf_percentile_to_vcf_file(original_file, 60, 100, error_rate, iterations=1000, outfile=tmp_out)
+        self.assertTrue(filecmp.cmp(tmp_out, expect_file, shallow=False))
+        os.unlink(tmp_out)
+
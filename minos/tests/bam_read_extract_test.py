@@ -49,3 +49,33 @@ class TestBamReadExtract(unittest.TestCase):
         self.assertTrue(read_names_match(expected_bam, tmp_out))
         os.unlink(tmp_out)
 
+
+
+    def test_bam_read_extractor(self):
+        '''test BamReadExtractor'''
+        infile = os.path.join(data_dir, 'all_reads.bam')
+        tmp_out = 'tmp.bam_read_extract.bam_read_extractor.bam'
+        extractor = bam_read_extract.BamReadExtractor(infile, threads=2)
+
+        expected_bam = os.path.join(data_dir, 'unmapped_reads.bam')
+        extractor.get_unmapped_reads(tmp_out)
+        self.assertTrue(read_names_match(expected_bam, tmp_out))
+        os.unlink(tmp_out)
+
+        # Use the same extractor for more than one region, to check
+        # the input file handle is reused properly
+        expected_bam = os.path.join(data_dir, 'region.1.60-181.bam')
+        extractor.get_region('1', 59, 180, tmp_out)
+        self.assertTrue(read_names_match(expected_bam, tmp_out))
+        os.unlink(tmp_out)
+
+        expected_bam = os.path.join(data_dir, 'region.1.61-180.bam')
+        extractor.get_region('1', 60, 179, tmp_out)
+        self.assertTrue(read_names_match(expected_bam, tmp_out))
+        os.unlink(tmp_out)
+
+        # read.0 overlaps both regions, but should only be written once
+        self.assertEqual(3, extractor.get_regions({'1': [(50, 70), (100, 190)], 'not_in_bam': [(1, 10)]}, tmp_out))
+        self.assertEqual(['read.5', 'read.0', 'read.1'], bam_read_extract.get_read_names(tmp_out))
+        os.unlink(tmp_out)
+        extractor.close()
@@ -0,0 +1,72 @@
+import os
+import shutil
+import unittest
+
+from minos import batch_adjudicator, vcf_chunker
+
+modules_dir = os.path.dirname(os.path.abspath(batch_adjudicator.__file__))
+data_dir = os.path.join(modules_dir, 'tests', 'data', 'adjudicator')
+
+class TestBatchAdjudicator(unittest.TestCase):
+    def test_load_samples_tsv(self):
+        '''test _load_samples_tsv'''
+        tmp_tsv = 'tmp.batch_adjudicator.load_samples_tsv.tsv'
+        reads_file = os.path.join(data_dir, 'run.bwa.bam')
+        with open(tmp_tsv, 'w') as f:
+            print('out1', 'sample1', reads_file, sep='\t', file=f)
+            print('out2', '.', reads_file, reads_file, sep='\t', file=f)
+
+        expect = [
+            (os.path.abspath('out1'), 'sample1', [reads_file]),
+            (os.path.abspath('out2'), None, [reads_file, reads_file]),
+        ]
+        self.assertEqual(expect, batch_adjudicator.BatchAdjudicator._load_samples_tsv(tmp_tsv))
+
+        with open(tmp_tsv, 'a') as f:
+            print('out1', 'sample3', reads_file, sep='\t', file=f)
+        with self.assertRaises(batch_adjudicator.Error):
+            batch_adjudicator.BatchAdjudicator._load_samples_tsv(tmp_tsv)
+
+        with open(tmp_tsv, 'w') as f:
+            print('out1', 'sample1', 'does_not_exist.bam', sep='\t', file=f)
+        with self.assertRaises(batch_adjudicator.Error):
+            batch_adjudicator.BatchAdjudicator._load_samples_tsv(tmp_tsv)
+
+        with open(tmp_tsv, 'w') as f:
+            print('out1', 'sample1', sep='\t', file=f)
+        with self.assertRaises(batch_adjudicator.Error):
+            batch_adjudicator.BatchAdjudicator._load_samples_tsv(tmp_tsv)
+
+        os.unlink(tmp_tsv)
+
+
+    def test_run(self):
+        '''test run'''
+        # Just testing that it doesn't crash, and each sample
+        # gets its own final VCF file
+        tmp_prefix = 'tmp.batch_adjudicator.run'
+        build_dir = tmp_prefix + '.build'
+        samples_tsv = tmp_prefix + '.samples.tsv'
+        outdirs = [tmp_prefix + '.out.' + str(i) for i in (1, 2)]
+        for d in [build_dir] + outdirs:
+            if os.path.exists(d):
+                shutil.rmtree(d)
+
+        ref_fasta = os.path.join(data_dir, 'run.ref.fa')
+        reads_file = os.path.join(data_dir, 'run.bwa.bam')
+        vcf_file = os.path.join(data_dir, 'run.calls.1.vcf')
+        chunker = vcf_chunker.VcfChunker(build_dir, vcf_infile=vcf_file, ref_fasta=ref_fasta, variants_per_split=3, flank_length=100, gramtools_kmer_size=5)
+        chunker.make_split_files()
+
+        with open(samples_tsv, 'w') as f:
+            print(outdirs[0], 'sample1', reads_file, sep='\t', file=f)
+            print(outdirs[1], 'sample2', reads_file, sep='\t', file=f)
+
+        batch = batch_adjudicator.BatchAdjudicator(samples_tsv, build_dir, ref_fasta, vcf_file, threads=2, genotype_simulation_iterations=1000)
+        batch.run()
+        for outdir in outdirs:
+            self.assertTrue(os.path.exists(os.path.join(outdir, 'final.vcf')))
+            shutil.rmtree(outdir)
+
+        shutil.rmtree(build_dir)
+        os.unlink(samples_tsv)
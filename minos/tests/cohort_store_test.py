@@ -0,0 +1,116 @@
+import filecmp
+import os
+import shutil
+import unittest
+
+import numpy as np
+
+from minos import cohort_store, multi_sample_pipeline
+
+modules_dir = os.path.dirname(os.path.abspath(cohort_store.__file__))
+data_dir = os.path.join(modules_dir, 'tests', 'data', 'cohort_store')
+
+
+class TestCohortStore(unittest.TestCase):
+    def test_parse_gt_and_gt_to_string(self):
+        '''test _parse_gt and _gt_to_string'''
+        tests = [
+            ('0/1', [0, 1]),
+            ('2|2', [2, 2]),
+            ('./.', [-1, -1]),
+            ('1', [1, -2]),
+        ]
+        for gt_string, expected in tests:
+            self.assertEqual(expected, cohort_store._parse_gt(gt_string))
+        self.assertEqual('0/1', cohort_store._gt_to_string([0, 1]))
+        self.assertEqual('./.', cohort_store._gt_to_string([-1, -1]))
+        self.assertEqual('1', cohort_store._gt_to_string([1, -2]))
+        with self.assertRaises(cohort_store.Error):
+            cohort_store._parse_gt('0/1/1')
+
+
+    def test_store(self):
+        '''test create_store, add_sample_vcf, get, site_slice, to_vcf'''
+        store_dir = 'tmp.cohort_store.store'
+        if os.path.exists(store_dir):
+            shutil.rmtree(store_dir)
+        vcf1 = os.path.join(data_dir, 'add_sample_vcf.1.vcf')
+        vcf2 = os.path.join(data_dir, 'add_sample_vcf.2.vcf')
+        store = cohort_store.create_store(store_dir, vcf1, ['sample1', 'sample2'])
+        self.assertEqual(4, store.number_of_sites)
+        self.assertEqual(3, store.max_alleles)
+        self.assertEqual(np.int16, store.gt.dtype)
+        self.assertEqual((2, 4, 2), store.gt.shape)
+        self.assertEqual((2, 9), store.cov.shape)
+        np.testing.assert_array_equal(np.array([0, 2, 5, 7, 9]), store.allele_offsets)
+        store.add_sample_vcf('sample2', vcf2)
+        with self.assertRaises(cohort_store.Error):
+            store.add_sample_vcf('sample3', vcf2)
+        with self.assertRaises(cohort_store.Error):
+            store.add_sample_vcf('sample1', os.path.join(data_dir, 'add_sample_vcf.mismatch.vcf'))
+
+        # Only sample2 added so far
+        tmp_vcf = 'tmp.cohort_store.store.vcf'
+        store = cohort_store.CohortStore(store_dir)
+        with self.assertRaises(cohort_store.Error):
+            store.add_sample_vcf('sample1', vcf1)
+        np.testing.assert_array_equal(np.array([False, True]), store.samples_added)
+        store.to_vcf(tmp_vcf, sites=store.site_slice('ref1', start=15, end=30))
+        with open(tmp_vcf) as f:
+            got_records = [x.rstrip('\n').split('\t')[-2:] for x in f if not x.startswith('#')]
+        self.assertEqual([['.', '19:2/2:0,0,19:198.0'], ['.', '0:./.:0,0:0.0']], got_records)
+
+        store = cohort_store.CohortStore(store_dir, mode='r+')
+        store.add_sample_vcf('sample1', vcf1)
+        store = cohort_store.CohortStore(store_dir)
+        self.assertEqual(slice(0, 3), store.site_slice('ref1'))
+        self.assertEqual(slice(1, 2), store.site_slice('ref1', start=11, end=29))
+        self.assertEqual(slice(4, 4), store.site_slice('ref2', start=6))
+        with self.assertRaises(cohort_store.Error):
+            store.site_slice('ref3')
+        np.testing.assert_array_equal(np.array([[[1, 1]], [[1, 1]]]), store.get('gt', sites=slice(1, 3), samples=['sample1']))
+        np.testing.assert_array_equal(np.array([[17, 19], [26, 0]]), store.get('dp', sites=slice(1, 3)))
+        np.testing.assert_array_equal(np.array([[0, 10, -1]]), store.get('cov', sites=slice(0, 1), samples=['sample2'])[0])
+        self.assertEqual((4, 2, 3), store.get('cov').shape)
+        self.assertEqual(335.16, store.get('gt_conf', samples=['sample1'])[3][0])
+        with self.assertRaises(cohort_store.Error):
+            store.get('GT')
+
+        store.to_vcf(tmp_vcf)
+        self.assertTrue(filecmp.cmp(os.path.join(data_dir, 'to_vcf.all.expect.vcf'), tmp_vcf, shallow=False))
+        shutil.rmtree(store_dir)
+        os.unlink(tmp_vcf)
+
+
+    def test_to_vcf_same_as_merged_vcf_files(self):
+        '''test to_vcf makes the same file as merging the per-sample VCF files'''
+        store_dir = 'tmp.cohort_store.to_vcf_same_as_merged'
+        if os.path.exists(store_dir):
+            shutil.rmtree(store_dir)
+        # The sites VCF is like the clustered VCF that minos is run on,
+        # which has different INFO etc to the minos output
+        sites_vcf = os.path.join(data_dir, 'to_vcf.sites.vcf')
+        vcf_files = [os.path.join(data_dir, 'add_sample_vcf.' + x + '.vcf') for x in ('1', 'missing')]
+        store = cohort_store.create_store(store_dir, sites_vcf, ['sample1', 'sample3'])
+
+        # Before any samples are added, the minos FORMAT lines are added to
+        # the header of the sites VCF
+        tmp_vcf = 'tmp.cohort_store.to_vcf_same_as_merged.vcf'
+        store.to_vcf(tmp_vcf)
+        with open(tmp_vcf) as f:
+            header_lines = [x.rstrip('\n') for x in f if x.startswith('##')]
+        self.assertEqual(['##fileformat=VCFv4.2', '##source=cluster_vcf_records'], header_lines[:2])
+        self.assertEqual(multi_sample_pipeline.gramtools.output_vcf_format_header_lines, header_lines[2:])
+
+        store.add_sample_vcf('sample1', vcf_files[0])
+        store.add_sample_vcf('sample3', vcf_files[1])
+        # GT "." and "./." are stored differently, so are written as they were
+        self.assertEqual([[-1, -2], [-1, -1], [1, -2], [1, 1]], store.get('gt', samples=['sample3'])[:, 0].tolist())
+        store.to_vcf(tmp_vcf)
+        tmp_merged = 'tmp.cohort_store.to_vcf_same_as_merged.merged.vcf'
+        multi_sample_pipeline.MultiSamplePipeline._merge_vcf_files(vcf_files, tmp_merged)
+        self.assertTrue(filecmp.cmp(tmp_merged, tmp_vcf, shallow=False))
+        self.assertEqual([], [x for x in os.listdir(store_dir) if '.tmp.' in x])
+        shutil.rmtree(store_dir)
+        os.unlink(tmp_vcf)
+        os.unlink(tmp_merged)
@@ -0,0 +1,191 @@
+import json
+import os
+import shutil
+import unittest
+
+import pysam
+
+from minos import cost_estimator, unmapped_reads_splitter, vcf_chunker
+
+modules_dir = os.path.dirname(os.path.abspath(cost_estimator.__file__))
+data_dir = os.path.join(modules_dir, 'tests', 'data', 'cost_estimator')
+
+
+def load_estimates_tsv(infile):
+    with open(infile) as f:
+        lines = [x.rstrip('\n').split('\t') for x in f]
+    return [dict(zip(lines[0], x)) for x in lines[1:]]
+
+
+class TestCostEstimator(unittest.TestCase):
+    def test_fit_line(self):
+        '''test _fit_line'''
+        default = (10.0, 1.0)
+        self.assertEqual(default, cost_estimator._fit_line([], [], default))
+        self.assertEqual(default, cost_estimator._fit_line([0], [5], default))
+        self.assertEqual((10.0, 2.0), cost_estimator._fit_line([5, 5], [19, 21], default))
+        self.assertEqual((10.0, 0.0), cost_estimator._fit_line([5], [1], default))
+        intercept, coefficient = cost_estimator._fit_line([1, 2, 3], [5, 7, 9], default)
+        self.assertAlmostEqual(3, intercept)
+        self.assertAlmostEqual(2, coefficient)
+
+
+    def test_fit_plane(self):
+        '''test _fit_plane'''
+        default = (10.0, 1.0, 0.5)
+        self.assertEqual(default, cost_estimator._fit_plane([], default))
+        self.assertEqual((10.0, 2.0, 0.5), cost_estimator._fit_plane([(5, 2, 20), (5, 2, 22)], default))
+        got = cost_estimator._fit_plane([(1, 10, 6), (2, 10, 8), (1, 20, 9), (3, 30, 16)], default)
+        expected = (1, 2, 0.3)
+        for i in range(3):
+            self.assertAlmostEqual(expected[i], got[i])
+
+
+    def test_calibrate_cost_model(self):
+        '''test calibrate_cost_model'''
+        tmp_dir = 'tmp.cost_estimator.calibrate_cost_model'
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.mkdir(tmp_dir)
+        os.mkdir(os.path.join(tmp_dir, 'split.0.gramtools_build'))
+        reports = {
+            os.path.join(tmp_dir, 'split.0.gramtools_build', 'build_report.json'): {'minos_stats': {'step': 'build', 'wall_clock_seconds': 12, 'total_alleles': 100}},
+            os.path.join(tmp_dir, 'split.1.gramtools_build.report.json'): {'minos_stats': {'step': 'build', 'wall_clock_seconds': 22, 'total_alleles': 200, 'peak_ram_gb': 1.5}},
+            os.path.join(tmp_dir, 'split.2.gramtools_build.report.json'): {'minos_stats': {'step': 'build', 'wall_clock_seconds': 32, 'total_alleles': 300, 'peak_ram_gb': 2.5}},
+            os.path.join(tmp_dir, 'split.0.gramtools.quasimap.report.json'): {'minos_stats': {'step': 'quasimap', 'wall_clock_seconds': 15, 'total_alleles': 100}},
+            os.path.join(tmp_dir, 'not_minos.json'): {'step': 'build', 'wall_clock_seconds': 1000, 'total_alleles': 1},
+        }
+        for filename, report in reports.items():
+            with open(filename, 'w') as f:
+                json.dump(report, f)
+
+        got = cost_estimator.calibrate_cost_model([tmp_dir])
+        self.assertAlmostEqual(2, got['build'][0])
+        self.assertAlmostEqual(0.1, got['build'][1])
+        self.assertEqual(cost_estimator.default_cost_model['quasimap'][0], got['quasimap'][0])
+        self.assertAlmostEqual(0.1, got['quasimap'][1])
+        self.assertEqual(cost_estimator.default_cost_model['quasimap'][2], got['quasimap'][2])
+        self.assertAlmostEqual(0, got['build_ram'][0])
+        self.assertAlmostEqual(0.01, got['build_ram'][1])
+
+        reports = {
+            os.path.join(tmp_dir, 'split.1.gramtools.quasimap.report.json'): {'minos_stats': {'step': 'quasimap', 'wall_clock_seconds': 21, 'total_alleles': 100, 'reads_bytes': 1000}},
+            os.path.join(tmp_dir, 'split.2.gramtools.quasimap.report.json'): {'minos_stats': {'step': 'quasimap', 'wall_clock_seconds': 28, 'total_alleles': 200, 'reads_bytes': 500}},
+        }
+        for filename, report in reports.items():
+            with open(filename, 'w') as f:
+                json.dump(report, f)
+        # 5 + 0.1 * alleles + 0.006 * reads_bytes
+        got = cost_estimator.calibrate_cost_model([tmp_dir])
+        expected = (5, 0.1, 0.006)
+        for i in range(3):
+            self.assertAlmostEqual(expected[i], got['quasimap'][i])
+
+        got = cost_estimator.gramtools_ram_model_from_options(calibration_dirs=[tmp_dir])
+        self.assertAlmostEqual(0, got[0])
+        self.assertAlmostEqual(0.01, got[1])
+        shutil.rmtree(tmp_dir)
+
+
+    def test_gramtools_ram_model_from_options(self):
+        '''test gramtools_ram_model_from_options'''
+        self.assertEqual(None, cost_estimator.gramtools_ram_model_from_options())
+        self.assertEqual((1.5, 0.001), cost_estimator.gramtools_ram_model_from_options('1.5,0.001', calibration_dirs=['not_used']))
+        for bad in '1', '1,2,3', 'x,1', '1,0', '-1,1':
+            with self.assertRaises(cost_estimator.Error):
+                cost_estimator.gramtools_ram_model_from_options(bad)
+
+        tmp_dir = 'tmp.cost_estimator.gramtools_ram_model_from_options'
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.mkdir(tmp_dir)
+        self.assertEqual(None, cost_estimator.gramtools_ram_model_from_options(calibration_dirs=[tmp_dir]))
+        shutil.rmtree(tmp_dir)
+
+
+    def test_run(self):
+        '''test run'''
+        ref_fasta = os.path.join(data_dir, 'ref.fa')
+        vcf_file = os.path.join(data_dir, 'in.vcf')
+        tmp_out = 'tmp.cost_estimator.run.tsv'
+
+        estimator = cost_estimator.CostEstimator(tmp_out, ref_fasta, [vcf_file], vcf_is_clustered=True)
+        estimator.run()
+        got = load_estimates_tsv(tmp_out)
+        self.assertEqual(['all', 'total'], [x['split'] for x in got])
+        self.assertEqual('7', got[0]['variants'])
+        self.assertEqual('14', got[0]['alleles'])
+        self.assertEqual(got[0]['build_seconds'], got[1]['build_seconds'])
+        quasimap_seconds_no_reads = float(got[0]['quasimap_seconds'])
+
+        estimator = cost_estimator.CostEstimator(tmp_out, ref_fasta, [vcf_file], vcf_is_clustered=True, reads_files=[vcf_file, vcf_file])
+        estimator.run()
+        got = load_estimates_tsv(tmp_out)
+        expected = quasimap_seconds_no_reads + 2 * os.path.getsize(vcf_file) * cost_estimator.default_cost_model['quasimap'][2]
+        self.assertAlmostEqual(expected, float(got[0]['quasimap_seconds']), places=3)
+
+        estimator = cost_estimator.CostEstimator(tmp_out, ref_fasta, [vcf_file], vcf_is_clustered=True, variants_per_split=2, max_read_length=3)
+        estimator.run()
+        got = load_estimates_tsv(tmp_out)
+        self.assertEqual(['0', '1', '2', '3', 'total'], [x['split'] for x in got])
+        self.assertEqual(['ref1', 'ref1', 'ref1', 'ref2'], [x['chrom'] for x in got[:-1]])
+        self.assertEqual(['2', '2', '2', '1', '7'], [x['variants'] for x in got])
+        self.assertEqual(['4', '4', '4', '2', '14'], [x['alleles'] for x in got])
+        self.assertEqual(sum([int(x['output_bytes']) for x in got[:-1]]), int(got[-1]['output_bytes']))
+        self.assertEqual([], [x for x in os.listdir('.') if x.startswith('tmp.minos_estimate.')])
+        os.unlink(tmp_out)
+
+
+    def test_run_split_reads_bytes(self):
+        '''test run splits reads bytes by region length plus unmapped reads'''
+        ref_fasta = os.path.join(data_dir, 'ref.fa')
+        vcf_file = os.path.join(data_dir, 'in.vcf')
+        tmp_sam = 'tmp.cost_estimator.run_split_reads_bytes.sam'
+        tmp_bam = 'tmp.cost_estimator.run_split_reads_bytes.bam'
+        tmp_out = 'tmp.cost_estimator.run_split_reads_bytes.tsv'
+        with open(tmp_sam, 'w') as f:
+            print('@HD\tVN:1.6\tSO:coordinate', file=f)
+            print('@SQ\tSN:ref1\tLN:38', file=f)
+            print('@SQ\tSN:ref2\tLN:52', file=f)
+            print(1, 0, 'ref1', 1, 60, '4M', '*', 0, 0, 'GCTA', 'IIII', sep='\t', file=f)
+            print(2, 0, 'ref2', 1, 60, '4M', '*', 0, 0, 'CTAT', 'IIII', sep='\t', file=f)
+            print(3, 4, '*', 0, 0, '*', '*', 0, 0, 'ACGT', 'IIII', sep='\t', file=f)
+            print(4, 4, '*', 0, 0, '*', '*', 0, 0, 'ACGT', 'IIII', sep='\t', file=f)
+        pysam.sort('-o', tmp_bam, tmp_sam, catch_stdout=False)
+        pysam.index(tmp_bam)
+        bam_bytes = os.path.getsize(tmp_bam)
+        self.assertEqual((bam_bytes / 2, bam_bytes / 2), cost_estimator.CostEstimator._mapped_and_unmapped_bytes([tmp_bam]))
+        self.assertEqual((os.path.getsize(vcf_file), 0), cost_estimator.CostEstimator._mapped_and_unmapped_bytes([vcf_file]))
+
+        estimator = cost_estimator.CostEstimator(tmp_out, ref_fasta, [vcf_file], vcf_is_clustered=True, variants_per_split=2, max_read_length=3, reads_files=[tmp_bam])
+        estimator.run()
+        got = load_estimates_tsv(tmp_out)
+        for row in got[:-1]:
+            region_length = int(row['end']) - int(row['start']) + 1
+            self.assertEqual(int(round(bam_bytes / 2 * region_length / 90 + bam_bytes / 2)), int(row['reads_bytes']))
+        self.assertEqual(sum([int(x['reads_bytes']) for x in got[:-1]]), int(got[-1]['reads_bytes']))
+
+        # Make per-split unmapped reads files for the same splits. Their
+        # sizes should be used instead of all the unmapped reads
+        tmp_split_dir = 'tmp.cost_estimator.run_split_reads_bytes.split'
+        tmp_unmapped_dir = 'tmp.cost_estimator.run_split_reads_bytes.unmapped'
+        for d in tmp_split_dir, tmp_unmapped_dir:
+            if os.path.exists(d):
+                shutil.rmtree(d)
+        chunker = vcf_chunker.VcfChunker(tmp_split_dir, vcf_infile=vcf_file, ref_fasta=ref_fasta, variants_per_split=2, max_read_length=3, flank_length=3)
+        chunker.make_split_vcf_files()
+        split_files = [x for file_list in chunker.vcf_split_files.values() for x in file_list]
+        splitter = unmapped_reads_splitter.UnmappedReadsSplitter(tmp_bam, ref_fasta, split_files, tmp_unmapped_dir)
+        splitter.run()
+        estimator = cost_estimator.CostEstimator(tmp_out, ref_fasta, [vcf_file], vcf_is_clustered=True, variants_per_split=2, max_read_length=3, reads_files=[tmp_bam], unmapped_reads_dir=tmp_unmapped_dir)
+        estimator.run()
+        got = load_estimates_tsv(tmp_out)
+        for row, split_file in zip(got[:-1], split_files):
+            region_length = int(row['end']) - int(row['start']) + 1
+            unmapped_bytes = os.path.getsize(splitter.split_reads_files[split_file.file_number])
+            self.assertEqual(int(round(bam_bytes / 2 * region_length / 90 + unmapped_bytes)), int(row['reads_bytes']))
+
+        shutil.rmtree(tmp_split_dir)
+        shutil.rmtree(tmp_unmapped_dir)
+        for filename in tmp_sam, tmp_bam, tmp_bam + '.bai', tmp_out:
+            os.unlink(filename)
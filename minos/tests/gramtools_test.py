@@ -213,6 +213,16 @@ class TestGramtools(unittest.TestCase):
         os.unlink(tmp_outfile)
         os.unlink(tmp_outfile_filtered)
 
+        # Only genotype and write the middle record
+        mean_depth, depth_variance, vcf_header, vcf_records, allele_coverage, allele_groups  = gramtools.load_gramtools_vcf_and_allele_coverage_files(vcf_file_in, quasimap_dir)
+        gramtools.write_vcf_annotated_using_coverage_from_gramtools(mean_depth, vcf_records, allele_coverage, allele_groups, error_rate, tmp_outfile, kmer_size, sample_name='sample_42', max_read_length=200, filtered_outfile=tmp_outfile_filtered, use_start_index=1, use_end_index=1)
+        for expected, got in ((expected_vcf, tmp_outfile), (expected_vcf_filtered, tmp_outfile_filtered)):
+            expected_header, expected_vcf_records = vcf_file_read.vcf_file_to_list(expected)
+            got_header, got_vcf_records = vcf_file_read.vcf_file_to_list(got)
+            self.assertEqual(expected_vcf_records[1:2], got_vcf_records)
+        os.unlink(tmp_outfile)
+        os.unlink(tmp_outfile_filtered)
+
 
     def test_load_allele_files(self):
         '''test load_allele_files'''
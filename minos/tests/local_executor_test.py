@@ -0,0 +1,65 @@
+import os
+import resource
+import unittest
+
+from minos import local_executor
+
+
+def add_numbers(x, y):
+    return x + y
+
+
+def fail_unless_file_exists(filename):
+    if not os.path.exists(filename):
+        with open(filename, 'w'):
+            pass
+        raise Exception('File not found: ' + filename)
+    return 'ok'
+
+
+def always_fail():
+    raise Exception('Oops')
+
+
+def get_ram_limit():
+    return resource.getrlimit(resource.RLIMIT_AS)[0]
+
+
+class TestLocalExecutor(unittest.TestCase):
+    def test_can_start(self):
+        '''test _can_start'''
+        executor = local_executor.LocalExecutor(threads=2, max_ram=10)
+        self.assertTrue(executor._can_start(20, 4, {}))
+        running = {0: {'ram': 6, 'cpus': 1}}
+        self.assertTrue(executor._can_start(4, 1, running))
+        self.assertFalse(executor._can_start(5, 1, running))
+        self.assertFalse(executor._can_start(1, 2, running))
+
+
+    def test_run_stage(self):
+        '''test run_stage'''
+        executor = local_executor.LocalExecutor(threads=2, max_ram=2)
+        tasks = [(add_numbers, (i, 1), 1, 1) for i in range(5)]
+        self.assertEqual([1, 2, 3, 4, 5], executor.run_stage('test', tasks))
+
+
+    def test_run_stage_retry(self):
+        '''test run_stage retries failed tasks'''
+        flag_file = 'tmp.local_executor.run_stage_retry.flag'
+        if os.path.exists(flag_file):
+            os.unlink(flag_file)
+        executor = local_executor.LocalExecutor(threads=1, max_ram=1)
+        self.assertEqual(['ok'], executor.run_stage('test', [(fail_unless_file_exists, (flag_file,), 1, 1)]))
+        os.unlink(flag_file)
+
+        executor = local_executor.LocalExecutor(threads=1, max_ram=1, max_attempts=2)
+        with self.assertRaises(local_executor.Error):
+            executor.run_stage('test', [(always_fail, (), 1, 1), (add_numbers, (1, 2), 1, 1)])
+
+
+    def test_run_stage_enforce_ram(self):
+        '''test run_stage with enforce_ram'''
+        executor = local_executor.LocalExecutor(threads=1, max_ram=4, enforce_ram=True)
+        self.assertEqual([3 * 1024**3], executor.run_stage('test', [(get_ram_limit, (), 3, 1)]))
+        executor = local_executor.LocalExecutor(threads=1, max_ram=4)
+        self.assertEqual([get_ram_limit()], executor.run_stage('test', [(get_ram_limit, (), 3, 1)]))
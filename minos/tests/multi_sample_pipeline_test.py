@@ -5,7 +5,7 @@ import unittest
 
 from cluster_vcf_records import vcf_file_read
 
-from minos import multi_sample_pipeline
+from minos import cohort_store, multi_sample_pipeline
 
 modules_dir = os.path.dirname(os.path.abspath(multi_sample_pipeline.__file__))
 data_dir = os.path.join(modules_dir, 'tests', 'data', 'multi_sample_pipeline')
@@ -66,6 +66,164 @@ class TestMultiSamplePipeline(unittest.TestCase):
         self.assertTrue(filecmp.cmp(expected, tmp_out, shallow=False))
         os.unlink(tmp_out)
 
+        # Merging in passes should give the same output, and clean up its
+        # temporary files
+        multi_sample_pipeline.MultiSamplePipeline._merge_vcf_files(file_list, tmp_out, max_open_files=2)
+        self.assertTrue(filecmp.cmp(expected, tmp_out, shallow=False))
+        os.unlink(tmp_out)
+        self.assertEqual([], [x for x in os.listdir() if x.startswith(tmp_out)])
+
+        tmp_bad_vcf = 'tmp.merge_vcf_files.bad.vcf'
+        with open(file_list[0]) as f_in, open(tmp_bad_vcf, 'w') as f_out:
+            lines = f_in.readlines()
+            print(*lines[:-1], sep='', end='', file=f_out)
+        with self.assertRaises(multi_sample_pipeline.Error):
+            multi_sample_pipeline.MultiSamplePipeline._merge_vcf_files(file_list + [tmp_bad_vcf], tmp_out)
+        with self.assertRaises(multi_sample_pipeline.Error):
+            multi_sample_pipeline.MultiSamplePipeline._merge_vcf_files(file_list + [tmp_bad_vcf], tmp_out, max_open_files=2)
+        self.assertEqual([], [x for x in os.listdir() if x.startswith(tmp_out + '.tmp.merge.')])
+
+        with open(tmp_bad_vcf, 'w') as f_out:
+            fields = lines[-1].split('\t')
+            fields[4] = 'X'
+            print(*lines[:-1], sep='', end='', file=f_out)
+            print(*fields, sep='\t', end='', file=f_out)
+        with self.assertRaises(multi_sample_pipeline.Error):
+            multi_sample_pipeline.MultiSamplePipeline._merge_vcf_files(file_list + [tmp_bad_vcf], tmp_out)
+        os.unlink(tmp_bad_vcf)
+        os.unlink(tmp_out)
+
+
+    def test_create_and_add_batch_to_cohort_store(self):
+        '''test _create_cohort_store and _add_batch_to_cohort_store'''
+        cohort_store_data_dir = os.path.join(modules_dir, 'tests', 'data', 'cohort_store')
+        tmp_prefix = 'tmp.multi_sample_pipeline.cohort_store'
+        store_dir = tmp_prefix + '.store'
+        sample_names_file = tmp_prefix + '.names'
+        batch_tsv = tmp_prefix + '.batch.tsv'
+        reads_file = os.path.join(data_dir, 'run.reads.1.1.fq')
+        with open(sample_names_file, 'w') as f:
+            print('sample1', 'sample2', sep='\n', file=f)
+        os.mkdir(store_dir)
+        multi_sample_pipeline.MultiSamplePipeline._create_cohort_store(os.path.join(cohort_store_data_dir, 'add_sample_vcf.1.vcf'), sample_names_file, store_dir)
+        self.assertEqual([False, False], list(cohort_store.CohortStore(store_dir).samples_added))
+
+        with open(batch_tsv, 'w') as f:
+            for i in (1, 2):
+                minos_dir = tmp_prefix + '.minos.' + str(i)
+                if os.path.exists(minos_dir):
+                    shutil.rmtree(minos_dir)
+                os.mkdir(minos_dir)
+                shutil.copy(os.path.join(cohort_store_data_dir, 'add_sample_vcf.' + str(i) + '.vcf'), os.path.join(minos_dir, 'debug.calls_with_zero_cov_alleles.vcf'))
+                print(minos_dir, 'sample' + str(i) if i == 1 else '.', reads_file, sep='\t', file=f)
+        multi_sample_pipeline.MultiSamplePipeline._add_batch_to_cohort_store(store_dir, batch_tsv)
+        tmp_vcf = tmp_prefix + '.vcf'
+        cohort_store.CohortStore(store_dir).to_vcf(tmp_vcf)
+        self.assertTrue(filecmp.cmp(os.path.join(cohort_store_data_dir, 'to_vcf.all.expect.vcf'), tmp_vcf, shallow=False))
+        shutil.rmtree(store_dir)
+        for i in (1, 2):
+            shutil.rmtree(tmp_prefix + '.minos.' + str(i))
+        for filename in tmp_vcf, sample_names_file, batch_tsv:
+            os.unlink(filename)
+
+
+    def test_write_changed_vcf_records(self):
+        '''test _write_changed_vcf_records'''
+        old_vcf = os.path.join(data_dir, 'update_minos_vcf.old_clustered.vcf')
+        new_vcf = os.path.join(data_dir, 'update_minos_vcf.new_clustered.vcf')
+        tmp_out = 'tmp.write_changed_vcf_records.vcf'
+        self.assertEqual((2, 0), multi_sample_pipeline.MultiSamplePipeline._write_changed_vcf_records(old_vcf, new_vcf, tmp_out))
+        self.assertTrue(filecmp.cmp(os.path.join(data_dir, 'update_minos_vcf.changed.vcf'), tmp_out, shallow=False))
+        self.assertEqual((2, 0), multi_sample_pipeline.MultiSamplePipeline._write_changed_vcf_records(old_vcf, new_vcf, tmp_out, flank_length=9))
+        self.assertTrue(filecmp.cmp(os.path.join(data_dir, 'update_minos_vcf.changed.vcf'), tmp_out, shallow=False))
+        self.assertEqual((2, 1), multi_sample_pipeline.MultiSamplePipeline._write_changed_vcf_records(old_vcf, new_vcf, tmp_out, flank_length=10))
+        self.assertTrue(filecmp.cmp(os.path.join(data_dir, 'update_minos_vcf.changed.flank10.vcf'), tmp_out, shallow=False))
+        os.unlink(tmp_out)
+
+
+    def test_depth_from_minos_vcf(self):
+        '''test _depth_from_minos_vcf'''
+        tmp_vcf = 'tmp.depth_from_minos_vcf.vcf'
+        header = '##fileformat=VCFv4.2\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tsample\n'
+        with open(tmp_vcf, 'w') as f:
+            print(header, end='', file=f)
+            print('ref1\t1\t.\tA\tG\t.\t.\t.\tGT:DP\t0/0:2', file=f)
+            print('ref1\t2\t.\tA\tG\t.\t.\t.\tDP:GT\t4:0/0', file=f)
+            print('ref1\t3\t.\tA\tG\t.\t.\t.\tGT:DP\t./.:.', file=f)
+            print('ref1\t4\t.\tA\tG\t.\t.\t.\tGT:DP\t1/1:6', file=f)
+        self.assertEqual((4, 4), multi_sample_pipeline.MultiSamplePipeline._depth_from_minos_vcf(tmp_vcf))
+
+        with open(tmp_vcf, 'w') as f:
+            print(header, end='', file=f)
+            print('ref1\t1\t.\tA\tG\t.\t.\t.\tGT:DP\t0/0:5', file=f)
+        self.assertEqual((5, 1), multi_sample_pipeline.MultiSamplePipeline._depth_from_minos_vcf(tmp_vcf))
+
+        with open(tmp_vcf, 'w') as f:
+            print(header, end='', file=f)
+        with self.assertRaises(multi_sample_pipeline.Error):
+            multi_sample_pipeline.MultiSamplePipeline._depth_from_minos_vcf(tmp_vcf)
+        os.unlink(tmp_vcf)
+
+
+    def test_update_minos_vcf(self):
+        '''test _update_minos_vcf'''
+        template_vcf = os.path.join(data_dir, 'update_minos_vcf.template.vcf')
+        old_vcf = os.path.join(data_dir, 'update_minos_vcf.old_sample.vcf')
+        changed_vcf = os.path.join(data_dir, 'update_minos_vcf.old_sample.changed.vcf')
+        tmp_out = 'tmp.update_minos_vcf.vcf'
+        multi_sample_pipeline.MultiSamplePipeline._update_minos_vcf(template_vcf, old_vcf, changed_vcf, tmp_out)
+        self.assertTrue(filecmp.cmp(os.path.join(data_dir, 'update_minos_vcf.expect.vcf'), tmp_out, shallow=False))
+
+        with self.assertRaises(multi_sample_pipeline.Error):
+            multi_sample_pipeline.MultiSamplePipeline._update_minos_vcf(template_vcf, old_vcf, None, tmp_out)
+
+        old_final_vcf = os.path.join(data_dir, 'update_minos_vcf.old_sample.final.vcf')
+        changed_final_vcf = os.path.join(data_dir, 'update_minos_vcf.old_sample.changed.final.vcf')
+        tmp_final_out = 'tmp.update_minos_vcf.final.vcf'
+        multi_sample_pipeline.MultiSamplePipeline._update_minos_vcf(template_vcf, old_vcf, changed_vcf, tmp_out, old_final_vcf=old_final_vcf, changed_final_vcf=changed_final_vcf, final_outfile=tmp_final_out)
+        self.assertTrue(filecmp.cmp(os.path.join(data_dir, 'update_minos_vcf.expect.vcf'), tmp_out, shallow=False))
+        self.assertTrue(filecmp.cmp(os.path.join(data_dir, 'update_minos_vcf.expect.final.vcf'), tmp_final_out, shallow=False))
+
+        with self.assertRaises(multi_sample_pipeline.Error):
+            multi_sample_pipeline.MultiSamplePipeline._update_minos_vcf(template_vcf, old_vcf, changed_vcf, tmp_out, old_final_vcf=changed_final_vcf, changed_final_vcf=changed_final_vcf, final_outfile=tmp_final_out)
+        os.unlink(tmp_out)
+        os.unlink(tmp_final_out)
+
+
+    def test_update_side_file_and_finish_pending_renames(self):
+        '''test _update_side_file and _finish_pending_renames'''
+        self.assertEqual('dir/foo.update.vcf', multi_sample_pipeline.MultiSamplePipeline._update_side_file('dir/foo.vcf'))
+        self.assertEqual('dir/foo.update', multi_sample_pipeline.MultiSamplePipeline._update_side_file('dir/foo'))
+
+        tmp_dir = 'tmp.multi_sample_pipeline.finish_pending_renames'
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.mkdir(tmp_dir)
+        tmp_file = os.path.join(tmp_dir, 'file.vcf')
+        tmp_subdir = os.path.join(tmp_dir, 'dir')
+        pending_renames = [(multi_sample_pipeline.MultiSamplePipeline._update_side_file(x), x) for x in (tmp_file, tmp_subdir)]
+        for filename in tmp_file, pending_renames[0][0]:
+            with open(filename, 'w') as f:
+                print(filename, file=f)
+        for dirname in tmp_subdir, pending_renames[1][0]:
+            os.mkdir(dirname)
+            with open(os.path.join(dirname, 'file'), 'w') as f:
+                print(dirname, file=f)
+
+        # Rename the file, to check that running again after being
+        # interrupted part way through works
+        os.unlink(tmp_file)
+        os.rename(pending_renames[0][0], tmp_file)
+        multi_sample_pipeline.MultiSamplePipeline._finish_pending_renames(pending_renames)
+        self.assertEqual(['dir', 'file.vcf'], sorted(os.listdir(tmp_dir)))
+        with open(tmp_file) as f:
+            self.assertEqual(pending_renames[0][0] + '\n', f.read())
+        with open(os.path.join(tmp_subdir, 'file')) as f:
+            self.assertEqual(pending_renames[1][0] + '\n', f.read())
+        multi_sample_pipeline.MultiSamplePipeline._finish_pending_renames(pending_renames)
+        self.assertEqual(['dir', 'file.vcf'], sorted(os.listdir(tmp_dir)))
+        shutil.rmtree(tmp_dir)
+
 
     def test_filter_input_file_for_clustering(self):
         infile = os.path.join(data_dir, 'filter_input_file_for_clustering.in.vcf')
@@ -95,6 +253,41 @@ class TestMultiSamplePipeline(unittest.TestCase):
         os.unlink(out_sample)
 
 
+    def test_process_input_vcf_file(self):
+        '''test _process_input_vcf_file'''
+        # Should be the same as running _filter_input_file_for_clustering
+        # then _nextflow_helper_process_input_vcf_file
+        tmp_prefix = 'tmp.process_input_vcf_file'
+        tmp_filtered = tmp_prefix + '.filtered.vcf'
+        tmp_unsorted = tmp_prefix + '.unsorted.vcf'
+        infile = os.path.join(data_dir, 'process_input_vcf_file.in.vcf')
+        with open(infile) as f_in, open(tmp_unsorted, 'w') as f_out:
+            lines = f_in.readlines()
+            print(*lines[:3], *lines[-2:], *lines[3:-2], sep='', end='', file=f_out)
+
+        infiles = [
+            os.path.join(data_dir, 'filter_input_file_for_clustering.in.vcf'),
+            os.path.join(data_dir, 'nextflow_helper_process_input_vcf_file.in.vcf'),
+            infile,
+            tmp_unsorted,
+        ]
+        for infile in infiles:
+            multi_sample_pipeline.MultiSamplePipeline._filter_input_file_for_clustering(infile, tmp_filtered)
+            expect_read_length = multi_sample_pipeline.MultiSamplePipeline._nextflow_helper_process_input_vcf_file(tmp_filtered, tmp_prefix + '.expect.small.vcf', tmp_prefix + '.expect.big.vcf', tmp_prefix + '.expect.sample.txt', 5)
+            got_read_length = multi_sample_pipeline.MultiSamplePipeline._process_input_vcf_file(infile, tmp_prefix + '.got.small.vcf', tmp_prefix + '.got.big.vcf', tmp_prefix + '.got.sample.txt', 5)
+            self.assertEqual(expect_read_length, got_read_length)
+            for suffix in 'small.vcf', 'big.vcf', 'sample.txt':
+                self.assertTrue(filecmp.cmp(tmp_prefix + '.expect.' + suffix, tmp_prefix + '.got.' + suffix, shallow=False))
+
+        with open(tmp_prefix + '.got.small.vcf') as f:
+            got_positions = [x.split('\t')[1] for x in f if not x.startswith('#')]
+        self.assertEqual(['5', '11', '13', '12', '20', '23'], got_positions)
+
+        for filename in os.listdir():
+            if filename.startswith(tmp_prefix):
+                os.unlink(filename)
+
+
     def test_write_nextflow_data_tsv(self):
         '''test _write_nextflow_data_tsv'''
         outfile = 'tmp.multi_sample_pipeline_test_write_nextflow_data_tsv'
@@ -104,7 +297,7 @@ class TestMultiSamplePipeline(unittest.TestCase):
             ('vcf2', ['reads2.1', 'reads2.2']),
         ]
 
-        multi_sample_pipeline.MultiSamplePipeline._write_nextflow_data_tsv(data, outfile)
+        multi_sample_pipeline.MultiSamplePipeline._write_nextflow_data_tsv(data, [42, 100], outfile)
         self.assertTrue(filecmp.cmp(expected_file, outfile, shallow=False))
         os.unlink(outfile)
 
@@ -131,6 +324,8 @@ class TestMultiSamplePipeline(unittest.TestCase):
         pipeline._prepare_nextflow_input_files()
         self.assertTrue(os.path.exists(outdir))
         self.assertTrue(os.path.exists(pipeline.nextflow_input_tsv))
+        self.assertTrue(os.path.exists(pipeline.nextflow_ram_model_json))
+        self.assertTrue(os.path.exists(pipeline.nextflow_trace_config))
         shutil.rmtree(outdir)
         os.unlink(ref_fasta)
         os.unlink(data_tsv)
@@ -171,6 +366,36 @@ class TestMultiSamplePipeline(unittest.TestCase):
         os.unlink(input_tsv)
 
 
+    def test_run_local_executor(self):
+        '''test run using the local executor'''
+        input_tsv = 'tmp.multi_sample_pipeline.run_local.in.tsv'
+        ref_fasta = os.path.join(data_dir, 'run.ref.0.fa')
+        with open(input_tsv, 'w') as f:
+            for i in '1', '2':
+                reads1 = os.path.join(data_dir, 'run.reads.' + i + '.1.fq')
+                reads2 = os.path.join(data_dir, 'run.reads.' + i + '.2.fq')
+                vcf = os.path.join(data_dir, 'run.calls.' + i + '.vcf')
+                print(vcf, reads1, reads2, sep='\t', file=f)
+
+        outdir = 'tmp.multi_sample_pipeline.run_local.out'
+        if os.path.exists(outdir):
+            shutil.rmtree(outdir)
+
+        pipeline = multi_sample_pipeline.MultiSamplePipeline(ref_fasta, input_tsv, outdir, min_large_ref_length=10, executor='local', threads=2, local_max_ram=2)
+        pipeline.run()
+
+        expected_vcf = os.path.join(data_dir, 'run.out.vcf')
+        expected_header, expected_lines = vcf_file_read.vcf_file_to_list(expected_vcf)
+        got_vcf = os.path.join(outdir, 'combined_calls.vcf')
+        self.assertTrue(os.path.exists(got_vcf))
+        self.assertFalse(os.path.exists(pipeline.local_work_dir))
+        got_header, got_lines = vcf_file_read.vcf_file_to_list(got_vcf)
+        self.assertEqual(expected_lines, got_lines)
+
+        shutil.rmtree(outdir)
+        os.unlink(input_tsv)
+
+
     def test_run_with_small_var_vcf_chunking_vars_per_split(self):
         '''test run with chunking small variatn VCF file using variants_per_split option'''
         input_tsv = 'tmp.multi_sample_pipeline.run.in.tsv'
@@ -0,0 +1,110 @@
+import os
+import unittest
+
+import pysam
+
+from cluster_vcf_records import vcf_file_read
+
+from minos import pileup_genotyper
+
+modules_dir = os.path.dirname(os.path.abspath(pileup_genotyper.__file__))
+data_dir = os.path.join(modules_dir, 'tests', 'data', 'pileup_genotyper')
+adjudicator_data_dir = os.path.join(modules_dir, 'tests', 'data', 'adjudicator')
+
+vcf_header = ['##fileformat=VCFv4.2', '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tsample']
+
+
+def write_vcf(filename, records):
+    with open(filename, 'w') as f:
+        print(*vcf_header, *records, sep='\n', file=f)
+
+
+def load_records(filename):
+    with open(filename) as f:
+        return [x.rstrip() for x in f if not x.startswith('#')]
+
+
+class TestPileupGenotyper(unittest.TestCase):
+    def test_split_isolated_snps(self):
+        '''test split_isolated_snps'''
+        tmp_in = 'tmp.pileup_genotyper.split_isolated_snps.in.vcf'
+        tmp_snps = 'tmp.pileup_genotyper.split_isolated_snps.snps.vcf'
+        tmp_others = 'tmp.pileup_genotyper.split_isolated_snps.others.vcf'
+        records = [
+            'ref1\t10\t.\tA\tG\t.\t.\t.\t.\t.',      # isolated SNP
+            'ref1\t30\t.\tA\tG\t.\t.\t.\t.\t.',      # too close to next record
+            'ref1\t35\t.\tACGTACGTAC\tA\t.\t.\t.\t.\t.', # indel
+            'ref1\t50\t.\tA\tG\t.\t.\t.\t.\t.',      # too close to end of indel
+            'ref1\t70\t.\tA\tG,T\t.\t.\t.\t.\t.',    # not biallelic
+            'ref1\t90\t.\tA\tN\t.\t.\t.\t.\t.',      # not ACGT
+            'ref1\t110\t.\tA\tG\t.\t.\t.\t.\t.',     # isolated SNP
+            'ref2\t111\t.\tA\tG\t.\t.\t.\t.\t.',     # isolated SNP, other ref
+        ]
+        write_vcf(tmp_in, records)
+        self.assertEqual((3, 5), pileup_genotyper.split_isolated_snps(tmp_in, tmp_snps, tmp_others, 10))
+        self.assertEqual([records[i] for i in (0, 6, 7)], load_records(tmp_snps))
+        self.assertEqual([records[i] for i in (1, 2, 3, 4, 5)], load_records(tmp_others))
+        for filename in tmp_snps, tmp_others:
+            with open(filename) as f:
+                self.assertEqual(vcf_header, [x.rstrip() for x in f if x.startswith('#')])
+            os.unlink(filename)
+        os.unlink(tmp_in)
+
+
+    def test_write_vcf_genotyped_from_pileup(self):
+        '''test write_vcf_genotyped_from_pileup'''
+        vcf_in = os.path.join(data_dir, 'write_vcf_genotyped_from_pileup.in.vcf')
+        reads_file = os.path.join(adjudicator_data_dir, 'run.bwa.bam')
+        samfile = pysam.AlignmentFile(reads_file, 'rb')
+        header, records = vcf_file_read.vcf_file_to_list(vcf_in)
+        self.assertEqual([(0, 7), (13, 0)], [pileup_genotyper.allele_coverage_from_pileup(samfile, x) for x in records])
+        samfile.close()
+
+        tmp_out = 'tmp.pileup_genotyper.write_vcf_genotyped_from_pileup.out.vcf'
+        tmp_filtered = 'tmp.pileup_genotyper.write_vcf_genotyped_from_pileup.out.filtered.vcf'
+        mean_depth, variance = pileup_genotyper.write_vcf_genotyped_from_pileup(vcf_in, reads_file, 0.001, tmp_out, tmp_filtered, 10, max_read_length=100)
+        self.assertEqual(10, mean_depth)
+        self.assertEqual(18, variance)
+        for filename in tmp_out, tmp_filtered:
+            header, records = vcf_file_read.vcf_file_to_list(filename)
+            self.assertEqual('##minos_max_read_length=100', header[-2])
+            self.assertTrue(header[-1].endswith('\trun.bwa.bam'))
+            self.assertEqual(['1/1', '0/0'], [x.FORMAT['GT'] for x in records])
+            self.assertEqual(['0,7', '13,0'], [x.FORMAT['COV'] for x in records])
+            self.assertEqual([{}, {}], [x.INFO for x in records])
+            os.unlink(filename)
+
+
+    def test_merge_vcf_files_with_source(self):
+        '''test merge_vcf_files_with_source'''
+        tmp_vcf1 = 'tmp.pileup_genotyper.merge_vcf_files_with_source.1.vcf'
+        tmp_vcf2 = 'tmp.pileup_genotyper.merge_vcf_files_with_source.2.vcf'
+        tmp_out = 'tmp.pileup_genotyper.merge_vcf_files_with_source.out.vcf'
+        write_vcf(tmp_vcf1, [
+            'ref2\t5\t.\tA\tG\t.\t.\tKMER=10\t.\t.',
+            'ref1\t20\t.\tA\tG\t.\t.\tKMER=10\t.\t.',
+        ])
+        write_vcf(tmp_vcf2, [
+            'ref2\t1\t.\tA\tG\t.\t.\t.\t.\t.',
+            'ref2\t10\t.\tA\tG\t.\t.\t.\t.\t.',
+            'ref1\t30\t.\tA\tG\t.\t.\t.\t.\t.',
+        ])
+        pileup_genotyper.merge_vcf_files_with_source([(tmp_vcf1, 'gramtools'), (tmp_vcf2, 'pileup')], tmp_out, ['ref2', 'ref1'])
+        expected = [
+            'ref2\t1\t.\tA\tG\t.\t.\tSOURCE=pileup\t.\t.',
+            'ref2\t5\t.\tA\tG\t.\t.\tKMER=10;SOURCE=gramtools\t.\t.',
+            'ref2\t10\t.\tA\tG\t.\t.\tSOURCE=pileup\t.\t.',
+            'ref1\t20\t.\tA\tG\t.\t.\tKMER=10;SOURCE=gramtools\t.\t.',
+            'ref1\t30\t.\tA\tG\t.\t.\tSOURCE=pileup\t.\t.',
+        ]
+        self.assertEqual(expected, load_records(tmp_out))
+        with open(tmp_out) as f:
+            header = [x.rstrip() for x in f if x.startswith('#')]
+        self.assertEqual(3, len(header))
+        self.assertTrue(header[1].startswith('##INFO=<ID=SOURCE,'))
+
+        with self.assertRaises(pileup_genotyper.Error):
+            pileup_genotyper.merge_vcf_files_with_source([(tmp_vcf1, 'gramtools')], tmp_out, ['ref1'])
+
+        for filename in tmp_vcf1, tmp_vcf2, tmp_out:
+            os.unlink(filename)
@@ -0,0 +1,143 @@
+import json
+import os
+import shutil
+import unittest
+
+from minos import resource_predictor
+
+modules_dir = os.path.dirname(os.path.abspath(resource_predictor.__file__))
+data_dir = os.path.join(modules_dir, 'tests', 'data', 'resource_predictor')
+
+
+class TestResourcePredictor(unittest.TestCase):
+    def test_predict_ram_gb(self):
+        '''test predict_ram_gb'''
+        model = {
+            'stage1': {'intercept': 1, 'coefficients': {'alleles': 0.01, 'reads_gb': 2}, 'scale': None},
+            'stage2': {'intercept': 1, 'coefficients': {'alleles': 0.01}, 'scale': 'samples'},
+        }
+        self.assertEqual(4, resource_predictor.predict_ram_gb(model, 'stage1', {'alleles': 100, 'reads_gb': 1, 'variants': 1000}))
+        self.assertEqual(1, resource_predictor.predict_ram_gb(model, 'stage1', {}))
+        self.assertEqual(6, resource_predictor.predict_ram_gb(model, 'stage2', {'alleles': 200, 'samples': 2}))
+        model['stage1']['intercept'] = 0
+        self.assertEqual(resource_predictor.min_ram_gb, resource_predictor.predict_ram_gb(model, 'stage1', {}))
+
+        model = resource_predictor.fixed_ram_model(2, 12, 5)
+        self.assertEqual(2, resource_predictor.predict_ram_gb(model, 'cluster_small_vars_vcf', {'variants': 1000}))
+        self.assertEqual(12, resource_predictor.predict_ram_gb(model, 'gramtools_build_small_vars', {'alleles': 1000, 'builds': 3}))
+        self.assertEqual(10, resource_predictor.predict_ram_gb(model, 'minos_all_small_vars', {'alleles': 1000, 'samples': 2}))
+        self.assertEqual(2, resource_predictor.predict_ram_gb(model, 'pre_cluster_small_vars_merge_group', {'input_gb': 10, 'threads': 1}))
+        self.assertEqual(8, resource_predictor.predict_ram_gb(model, 'pre_cluster_small_vars_merge', {'input_gb': 10, 'threads': 4}))
+        model = resource_predictor.fixed_ram_model(2, 12, 5, pre_cluster_merge_group_ram=3, pre_cluster_merge_ram=16)
+        self.assertEqual(3, resource_predictor.predict_ram_gb(model, 'pre_cluster_small_vars_merge_group', {'input_gb': 10, 'threads': 1}))
+        self.assertEqual(16, resource_predictor.predict_ram_gb(model, 'pre_cluster_small_vars_merge', {'input_gb': 10, 'threads': 4}))
+
+        model = resource_predictor.default_ram_model
+        self.assertEqual(5.5, resource_predictor.predict_ram_gb(model, 'pre_cluster_small_vars_merge_group', {'input_gb': 1, 'threads': 1}))
+        self.assertEqual(2, resource_predictor.predict_ram_gb(model, 'pre_cluster_small_vars_merge', {'input_gb': 1, 'threads': 4}))
+
+
+    def test_metrics_to_and_from_string(self):
+        '''test metrics_to_string and metrics_from_string'''
+        metrics = {'variants': 3, 'alleles': 7, 'reads_gb': 0.5}
+        self.assertEqual('alleles=7 reads_gb=0.5 variants=3', resource_predictor.metrics_to_string(metrics))
+        self.assertEqual(metrics, resource_predictor.metrics_from_string('alleles=7 reads_gb=0.5 variants=3\n'))
+        self.assertEqual({}, resource_predictor.metrics_from_string(''))
+        with self.assertRaises(resource_predictor.Error):
+            resource_predictor.metrics_from_string('alleles')
+
+
+    def test_vcf_metrics(self):
+        '''test vcf_metrics and write_vcf_metrics_file'''
+        vcf_file = os.path.join(data_dir, 'vcf_metrics.vcf')
+        self.assertEqual({'variants': 4, 'alleles': 8, 'split_alleles': 8, 'builds': 1}, resource_predictor.vcf_metrics(vcf_file))
+        self.assertEqual({'variants': 4, 'alleles': 8, 'split_alleles': 8, 'builds': 1}, resource_predictor.vcf_metrics(vcf_file, threads=2))
+        self.assertEqual({'variants': 4, 'alleles': 8, 'split_alleles': 3, 'builds': 2}, resource_predictor.vcf_metrics(vcf_file, threads=2, alleles_per_split=3))
+        self.assertEqual({'variants': 4, 'alleles': 8, 'split_alleles': 4, 'builds': 2}, resource_predictor.vcf_metrics(vcf_file, threads=4, variants_per_split=2))
+        self.assertEqual({'variants': 4, 'alleles': 8, 'split_alleles': 2, 'builds': 3}, resource_predictor.vcf_metrics(vcf_file, threads=3, total_splits=4))
+
+        tmp_file = 'tmp.resource_predictor.vcf_metrics'
+        resource_predictor.write_vcf_metrics_file(vcf_file, tmp_file, threads=2, variants_per_split=2)
+        with open(tmp_file) as f:
+            self.assertEqual('alleles=8 builds=2 split_alleles=4 variants=4\n', f.read())
+        os.unlink(tmp_file)
+
+
+    def test_write_nextflow_model_json(self):
+        '''test write_nextflow_model_json'''
+        tmp_file = 'tmp.resource_predictor.write_nextflow_model_json.json'
+        resource_predictor.write_nextflow_model_json(resource_predictor.default_ram_model, tmp_file)
+        with open(tmp_file) as f:
+            got = json.load(f)
+        self.assertEqual({'min_ram_gb': resource_predictor.min_ram_gb, 'stages': resource_predictor.default_ram_model}, got)
+        os.unlink(tmp_file)
+
+
+    def test_memory_to_gb(self):
+        '''test _memory_to_gb'''
+        self.assertEqual(None, resource_predictor._memory_to_gb('-'))
+        self.assertEqual(1.5, resource_predictor._memory_to_gb('1.5 GB'))
+        self.assertEqual(0.5, resource_predictor._memory_to_gb('512 MB'))
+        self.assertEqual(2048, resource_predictor._memory_to_gb('2 TB'))
+        self.assertEqual(1, resource_predictor._memory_to_gb(str(1024**3)))
+
+
+    def test_report_nextflow_trace(self):
+        '''test load_nextflow_trace and report_nextflow_trace'''
+        trace_file = os.path.join(data_dir, 'nextflow.trace.txt')
+        tmp_file = 'tmp.resource_predictor.report_nextflow_trace.tsv'
+        got = resource_predictor.report_nextflow_trace(trace_file, tmp_file)
+        expected = [
+            {'stage': 'cluster_small_vars_vcf', 'task': 'cluster_small_vars_vcf (alleles=14 builds=1 split_alleles=14 variants=7)', 'attempt': 1, 'status': 'COMPLETED', 'predicted_ram_gb': 2, 'peak_rss_gb': 1.5, 'metrics': 'alleles=14 builds=1 split_alleles=14 variants=7'},
+            {'stage': 'minos_all_small_vars', 'task': 'minos_all_small_vars (alleles=14 reads_gb=0.5 samples=2)', 'attempt': 1, 'status': 'FAILED', 'predicted_ram_gb': 4, 'peak_rss_gb': None, 'metrics': 'alleles=14 reads_gb=0.5 samples=2'},
+            {'stage': 'minos_all_small_vars', 'task': 'minos_all_small_vars (alleles=14 reads_gb=0.5 samples=2)', 'attempt': 2, 'status': 'COMPLETED', 'predicted_ram_gb': 4, 'peak_rss_gb': 5, 'metrics': 'alleles=14 reads_gb=0.5 samples=2'},
+        ]
+        self.assertEqual(expected, got)
+        self.assertEqual(expected, resource_predictor.load_predictions_tsv(tmp_file))
+        os.unlink(tmp_file)
+
+        with open(tmp_file, 'w') as f:
+            print('task_id', 'name', 'status', sep='\t', file=f)
+        with self.assertRaises(resource_predictor.Error):
+            resource_predictor.load_nextflow_trace(tmp_file)
+        os.unlink(tmp_file)
+
+
+    def test_calibrate_ram_model(self):
+        '''test calibrate_ram_model'''
+        tmp_dir = 'tmp.resource_predictor.calibrate_ram_model'
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.mkdir(tmp_dir)
+        os.mkdir(os.path.join(tmp_dir, 'run1'))
+        os.mkdir(os.path.join(tmp_dir, 'run2'))
+        # cluster: GB = 1 + 0.1 * variants + 0.05 * alleles
+        # minos: GB = samples * (0.5 + 0.001 * split_alleles + reads_gb)
+        rows1 = [
+            {'stage': 'cluster_small_vars_vcf', 'task': 'c1', 'attempt': 1, 'status': 'COMPLETED', 'predicted_ram_gb': 8, 'peak_rss_gb': 3, 'metrics': 'alleles=20 variants=10'},
+            {'stage': 'cluster_small_vars_vcf', 'task': 'c2', 'attempt': 1, 'status': 'COMPLETED', 'predicted_ram_gb': 8, 'peak_rss_gb': 4.5, 'metrics': 'alleles=30 variants=20'},
+            {'stage': 'cluster_small_vars_vcf', 'task': 'c3', 'attempt': 1, 'status': 'FAILED', 'predicted_ram_gb': 1, 'peak_rss_gb': None, 'metrics': 'alleles=40 variants=10'},
+            {'stage': 'gramtools_build_small_vars', 'task': 'g1', 'attempt': 1, 'status': 'COMPLETED', 'predicted_ram_gb': 8, 'peak_rss_gb': 1, 'metrics': 'builds=1 split_alleles=10'},
+            {'stage': 'minos_all_small_vars', 'task': 'm1', 'attempt': 1, 'status': 'COMPLETED', 'predicted_ram_gb': 8, 'peak_rss_gb': 5, 'metrics': 'reads_gb=1 samples=2 split_alleles=1000'},
+        ]
+        rows2 = [
+            {'stage': 'cluster_small_vars_vcf', 'task': 'c4', 'attempt': 2, 'status': 'COMPLETED', 'predicted_ram_gb': 2, 'peak_rss_gb': 4, 'metrics': 'alleles=40 variants=10'},
+            {'stage': 'cluster_small_vars_vcf', 'task': 'c5', 'attempt': 1, 'status': 'COMPLETED', 'predicted_ram_gb': 8, 'peak_rss_gb': 4.5, 'metrics': 'alleles=10 variants=30'},
+            {'stage': 'minos_all_small_vars', 'task': 'm2', 'attempt': 1, 'status': 'COMPLETED', 'predicted_ram_gb': 8, 'peak_rss_gb': 3.5, 'metrics': 'reads_gb=1 samples=1 split_alleles=2000'},
+            {'stage': 'minos_all_small_vars', 'task': 'm3', 'attempt': 1, 'status': 'COMPLETED', 'predicted_ram_gb': 8, 'peak_rss_gb': 4.5, 'metrics': 'reads_gb=3 samples=1 split_alleles=1000'},
+        ]
+        resource_predictor.write_predictions_tsv(rows1, os.path.join(tmp_dir, 'run1', resource_predictor.predictions_filename))
+        resource_predictor.write_predictions_tsv(rows2, os.path.join(tmp_dir, 'run2', resource_predictor.predictions_filename))
+
+        got = resource_predictor.calibrate_ram_model([tmp_dir])
+        margin = resource_predictor.calibration_margin
+        self.assertEqual(resource_predictor.default_ram_model['gramtools_build_small_vars'], got['gramtools_build_small_vars'])
+        self.assertAlmostEqual(margin * 1, got['cluster_small_vars_vcf']['intercept'])
+        self.assertAlmostEqual(margin * 0.1, got['cluster_small_vars_vcf']['coefficients']['variants'])
+        self.assertAlmostEqual(margin * 0.05, got['cluster_small_vars_vcf']['coefficients']['alleles'])
+        self.assertEqual(None, got['cluster_small_vars_vcf']['scale'])
+        self.assertAlmostEqual(margin * 0.5, got['minos_all_small_vars']['intercept'])
+        self.assertAlmostEqual(margin * 0.001, got['minos_all_small_vars']['coefficients']['split_alleles'])
+        self.assertAlmostEqual(margin * 1, got['minos_all_small_vars']['coefficients']['reads_gb'])
+        self.assertEqual('samples', got['minos_all_small_vars']['scale'])
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,47 @@
+import os
+import shutil
+import unittest
+
+import minos
+from minos import adjudicator, streaming_api
+
+modules_dir = os.path.dirname(os.path.abspath(streaming_api.__file__))
+data_dir = os.path.join(modules_dir, 'tests', 'data', 'streaming_api')
+adjudicator_data_dir = os.path.join(modules_dir, 'tests', 'data', 'adjudicator')
+
+
+class TestStreamingApi(unittest.TestCase):
+    def test_adjudicate_iter(self):
+        '''test adjudicate_iter'''
+        # Both variants are isolated SNPs, so this does not need gramtools
+        ref_fasta = os.path.join(adjudicator_data_dir, 'run.ref.fa')
+        reads_file = os.path.join(adjudicator_data_dir, 'run.bwa.bam')
+        vcf_file = os.path.join(data_dir, 'in.vcf')
+        kwargs = {'max_read_length': 100, 'read_error_rate': 0.001, 'pileup_isolated_snps': True, 'check_dependencies': False, 'genotype_simulation_iterations': 1000}
+        got = list(minos.adjudicate_iter(ref_fasta, [reads_file], [vcf_file], **kwargs))
+        self.assertEqual([('ref.1', 100, 'G', ['T'], '1/1', [0, 7], 'pileup'), ('ref.1', 900, 'T', ['G'], '0/0', [13, 0], 'pileup')], [(x.chrom, x.pos, x.ref, x.alts, x.gt, x.cov, x.source) for x in got])
+
+        outdir = 'tmp.streaming_api.adjudicate_iter'
+        if os.path.exists(outdir):
+            shutil.rmtree(outdir)
+        got_with_outdir = list(streaming_api.adjudicate_iter(ref_fasta, [reads_file], [vcf_file], outdir=outdir, **kwargs))
+        self.assertEqual(got, got_with_outdir)
+        self.assertTrue(os.path.exists(os.path.join(outdir, 'final.vcf')))
+        shutil.rmtree(outdir)
+
+        # Same sites when the VCF files are not written
+        got_no_vcf_files = list(streaming_api.adjudicate_iter(ref_fasta, [reads_file], [vcf_file], outdir=outdir, write_vcf_files=False, **kwargs))
+        self.assertEqual(got, got_no_vcf_files)
+        for filename in 'final.vcf', 'debug.calls_with_zero_cov_alleles.vcf', 'pileup.final.vcf', 'pileup.in.vcf':
+            self.assertFalse(os.path.exists(os.path.join(outdir, filename)))
+        shutil.rmtree(outdir)
+
+        # Closing the generator early stops the adjudicator
+        sites = streaming_api.adjudicate_iter(ref_fasta, [reads_file], [vcf_file], outdir=outdir, queue_size=1, **kwargs)
+        self.assertEqual(got[0], next(sites))
+        sites.close()
+        self.assertFalse(os.path.exists(os.path.join(outdir, 'final.vcf')))
+        shutil.rmtree(outdir)
+
+        with self.assertRaises(adjudicator.Error):
+            list(streaming_api.adjudicate_iter(ref_fasta, [reads_file], [os.path.join(data_dir, 'empty.vcf')], **kwargs))
@@ -0,0 +1,112 @@
+import os
+import shutil
+import unittest
+
+import numpy as np
+
+from minos import bam_read_extract, unmapped_reads_splitter, vcf_chunker
+
+modules_dir = os.path.dirname(os.path.abspath(unmapped_reads_splitter.__file__))
+data_dir = os.path.join(modules_dir, 'tests', 'data', 'unmapped_reads_splitter')
+
+
+def make_split_files():
+    return [
+        vcf_chunker.SplitFile(os.path.join(data_dir, 'split.0.in.vcf'), 0, 'ref', 0, 99, 0, 0, 0, 0, 'split.0.gramtools_build'),
+        vcf_chunker.SplitFile(os.path.join(data_dir, 'split.1.in.vcf'), 1, 'ref', 200, 299, 0, 0, 0, 0, 'split.1.gramtools_build'),
+    ]
+
+
+class TestUnmappedReadsSplitter(unittest.TestCase):
+    def test_canonical_kmers(self):
+        '''test _canonical_kmers'''
+        # Kmers are 2-bit packed, A=0, C=1, G=2, T=3. eg ACGT = 0b00011011 = 27
+        for seq, expect_kmers, expect_positions in [
+            ('ACG', [], []),
+            ('ACGT', [27], [0]),
+            ('GTTT', [1], [0]),
+            ('aaacc', [1, 5], [0, 1]),
+            ('NAACCN', [5], [1]),
+            ('AANAACC', [5], [3]),
+        ]:
+            got_kmers, got_positions = unmapped_reads_splitter._canonical_kmers(seq, 4)
+            self.assertEqual(expect_kmers, got_kmers.tolist())
+            self.assertEqual(expect_positions, got_positions.tolist())
+
+
+    def test_split_numbers_for_seqs(self):
+        '''test _split_numbers_for_seqs'''
+        kmer_index = (np.array([1, 5, 5, 27], dtype=np.uint64), np.array([0, 1, 2, 1]))
+        seqs = ['GTTT', 'AANAACC', 'GGGG', 'ACGTN']
+        expect = [{0}, {1, 2}, set(), {1}]
+        self.assertEqual(expect, unmapped_reads_splitter.UnmappedReadsSplitter._split_numbers_for_seqs(seqs, kmer_index, 4))
+
+
+    def test_run(self):
+        '''test run'''
+        tmp_dir = 'tmp.unmapped_reads_splitter.run'
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        reads_file = os.path.join(data_dir, 'reads.sam')
+        ref_fasta = os.path.join(data_dir, 'ref.fa')
+        splitter = unmapped_reads_splitter.UnmappedReadsSplitter(reads_file, ref_fasta, make_split_files(), tmp_dir)
+        splitter.run()
+        self.assertEqual({0, 1}, set(splitter.split_reads_files.keys()))
+        # read.0 matches the reference in split 0, but not near the variant,
+        # so is not used. read.2 has the ALT of the split 0 variant, read.1 is
+        # the reverse complement of the split 1 variant, and read.4 has half
+        # of each
+        self.assertEqual(['read.2', 'read.4'], bam_read_extract.get_read_names(splitter.split_reads_files[0]))
+        self.assertEqual(['read.1', 'read.4'], bam_read_extract.get_read_names(splitter.split_reads_files[1]))
+        self.assertTrue(os.path.exists(splitter.manifest_file))
+        self.assertFalse(os.path.exists(os.path.join(tmp_dir, 'unmapped_reads.bam')))
+
+        # Rerunning should reuse the files that are already there
+        splitter = unmapped_reads_splitter.UnmappedReadsSplitter(reads_file, ref_fasta, make_split_files(), tmp_dir)
+        self.assertTrue(splitter._load_cached_files())
+        self.assertEqual(['read.2', 'read.4'], bam_read_extract.get_read_names(splitter.split_reads_files[0]))
+
+        # ... but not if the kmer length is changed
+        splitter = unmapped_reads_splitter.UnmappedReadsSplitter(reads_file, ref_fasta, make_split_files(), tmp_dir, kmer_length=20)
+        self.assertFalse(splitter._load_cached_files())
+        shutil.rmtree(tmp_dir)
+
+        # Reads are k-merised in batches. Should get the same
+        # output whatever the batch size
+        splitter = unmapped_reads_splitter.UnmappedReadsSplitter(reads_file, ref_fasta, make_split_files(), tmp_dir, batch_size=1)
+        splitter.run()
+        self.assertEqual(['read.2', 'read.4'], bam_read_extract.get_read_names(splitter.split_reads_files[0]))
+        self.assertEqual(['read.1', 'read.4'], bam_read_extract.get_read_names(splitter.split_reads_files[1]))
+        shutil.rmtree(tmp_dir)
+
+        with self.assertRaises(unmapped_reads_splitter.Error):
+            unmapped_reads_splitter.UnmappedReadsSplitter(reads_file, ref_fasta, make_split_files(), tmp_dir, kmer_length=33)
+
+
+    def test_run_with_sliced_reference(self):
+        '''test run on splits from VcfChunker with slice_reference'''
+        reads_file = os.path.join(data_dir, 'reads.sam')
+        ref_fasta = os.path.join(data_dir, 'ref.fa')
+        vcf_file = os.path.join(data_dir, 'run_sliced_reference.in.vcf')
+        got = {}
+
+        for slice_reference in True, False:
+            chunker_dir = 'tmp.unmapped_reads_splitter.run_sliced_reference.' + str(slice_reference) + '.chunker'
+            tmp_dir = 'tmp.unmapped_reads_splitter.run_sliced_reference.' + str(slice_reference)
+            for dirname in chunker_dir, tmp_dir:
+                if os.path.exists(dirname):
+                    shutil.rmtree(dirname)
+            chunker = vcf_chunker.VcfChunker(chunker_dir, vcf_infile=vcf_file, ref_fasta=ref_fasta, variants_per_split=1, flank_length=1, gramtools_kmer_size=5, max_read_length=50, slice_reference=slice_reference)
+            chunker.make_split_vcf_files()
+            split_files = chunker.vcf_split_files['ref']
+            self.assertEqual(2, len(split_files))
+            self.assertEqual(slice_reference, split_files[1].ref_fasta is not None)
+            self.assertTrue(split_files[1].chrom_start > 0)
+            splitter = unmapped_reads_splitter.UnmappedReadsSplitter(reads_file, ref_fasta, split_files, tmp_dir)
+            splitter.run()
+            got[slice_reference] = [bam_read_extract.get_read_names(splitter.split_reads_files[x.file_number]) for x in split_files]
+            shutil.rmtree(chunker_dir)
+            shutil.rmtree(tmp_dir)
+
+        self.assertEqual(got[False], got[True])
+        self.assertIn('read.2', got[True][0])
@@ -1,75 +1,160 @@
+import json
 import os
+import shutil
 import unittest
 
+import pysam
+
 from minos import utils
 
 modules_dir = os.path.dirname(os.path.abspath(utils.__file__))
 data_dir = os.path.join(modules_dir, 'tests', 'data', 'utils')
 
 class TestUtils(unittest.TestCase):
-    def test_estimate_max_read_length_and_read_error_rate_from_qual_scores_fastq_file(self):
-        '''test estimate_max_read_length_and_read_error_rate_from_qual_scores fastq file'''
-        tmp_file = 'tmp.estimate_max_read_length_and_read_error_rate_from_qual_scores.fq'
+    def test_sample_regions_from_bam_header(self):
+        '''test _sample_regions_from_bam_header'''
+        self.assertEqual([], utils._sample_regions_from_bam_header([], [], 10))
+        expect = [('ref1', 25), ('ref1', 75), ('ref2', 25), ('ref2', 75)]
+        self.assertEqual(expect, utils._sample_regions_from_bam_header(['ref1', 'ref2'], [100, 100], 4))
+        expect = [('ref1', 0)]
+        self.assertEqual(expect, utils._sample_regions_from_bam_header(['ref1'], [1], 3))
+
+
+    def test_estimate_read_length_and_error_rate_sampled_fastq_file(self):
+        '''test estimate_read_length_and_error_rate_sampled fastq file'''
+        tmp_file = 'tmp.estimate_read_length_and_error_rate_sampled.fq'
         with open(tmp_file, 'w') as f:
             print('@1', 'ACGT', '+', 'IIHH', sep='\n', file=f)
             print('@2', 'ACGTAG', '+', 'IHGGFF', sep='\n', file=f)
 
-        got_length, got_qual = utils.estimate_max_read_length_and_read_error_rate_from_qual_scores(tmp_file, number_of_reads=1)
-        expect_qual = pow(10, -39.5 / 10)
-        self.assertAlmostEqual(expect_qual, got_qual)
+        got_length, got_qual = utils.estimate_read_length_and_error_rate_sampled(tmp_file, number_of_reads=1)
+        self.assertAlmostEqual(pow(10, -39.5 / 10), got_qual)
         self.assertEqual(4, got_length)
-        got_length, got_qual = utils.estimate_max_read_length_and_read_error_rate_from_qual_scores(tmp_file, number_of_reads=2)
-        expect_qual = pow(10, -38.7 / 10)
-        self.assertAlmostEqual(expect_qual, got_qual)
+        got_length, got_qual = utils.estimate_read_length_and_error_rate_sampled(tmp_file, number_of_reads=2)
+        self.assertAlmostEqual(pow(10, -38.7 / 10), got_qual)
         self.assertEqual(6, got_length)
         os.unlink(tmp_file)
 
 
-    def test_estimate_max_read_length_and_read_error_rate_from_qual_scores_sam_file(self):
-        '''test estimate_max_read_length_and_read_error_rate_from_qual_scores sam file'''
-        tmp_file = 'tmp.estimate_max_read_length_and_read_error_rate_from_qual_scores.sam'
+    def test_estimate_read_length_and_error_rate_sampled_sam_file(self):
+        '''test estimate_read_length_and_error_rate_sampled sam file'''
+        tmp_file = 'tmp.estimate_read_length_and_error_rate_sampled.sam'
         with open(tmp_file, 'w') as f:
             print('@SQ\tSN:ref\tLN:1000', file=f)
             print(1, 0, 'ref', 42, 43, '4M', '*', 0, 0, 'ACGT', 'IIHH', sep='\t', file=f)
             print(2, 0, 'ref', 42, 43, '4M', '*', 0, 0, 'ACGT', 'GGFF', sep='\t', file=f)
 
-        got_length, got_qual = utils.estimate_max_read_length_and_read_error_rate_from_qual_scores(tmp_file, number_of_reads=1)
-        expect_qual = pow(10, -39.5 / 10)
-        self.assertAlmostEqual(expect_qual, got_qual)
+        got_length, got_qual = utils.estimate_read_length_and_error_rate_sampled(tmp_file, number_of_reads=1)
+        self.assertAlmostEqual(pow(10, -39.5 / 10), got_qual)
         self.assertEqual(4, got_length)
-        got_length, got_qual = utils.estimate_max_read_length_and_read_error_rate_from_qual_scores(tmp_file, number_of_reads=2)
-        expect_qual = pow(10, -38.5 / 10)
-        self.assertAlmostEqual(expect_qual, got_qual)
+        got_length, got_qual = utils.estimate_read_length_and_error_rate_sampled(tmp_file, number_of_reads=2)
+        self.assertAlmostEqual(pow(10, -38.5 / 10), got_qual)
         self.assertEqual(4, got_length)
         os.unlink(tmp_file)
 
 
-    def test_estimate_max_read_length_and_read_error_rate_from_qual_scores_sam_file_no_quals(self):
-        '''test estimate_max_read_length_and_read_error_rate_from_qual_scores sam file with no quals'''
-        tmp_file = 'tmp.estimate_max_read_length_and_read_error_rate_from_qual_scores.sam'
+    def test_estimate_read_length_and_error_rate_sampled_sam_file_no_quals(self):
+        '''test estimate_read_length_and_error_rate_sampled sam file with no quals'''
+        tmp_file = 'tmp.estimate_read_length_and_error_rate_sampled.sam'
         with open(tmp_file, 'w') as f:
             print('@SQ\tSN:ref\tLN:1000', file=f)
             print(1, 0, 'ref', 42, 43, '4M', '*', 0, 0, 'ACGT', '*', sep='\t', file=f)
             print(2, 0, 'ref', 42, 43, '5M', '*', 0, 0, 'ACGTA', '*', sep='\t', file=f)
 
-        got_length, got_qual = utils.estimate_max_read_length_and_read_error_rate_from_qual_scores(tmp_file, number_of_reads=1)
+        got_length, got_qual = utils.estimate_read_length_and_error_rate_sampled(tmp_file, number_of_reads=1)
         self.assertEqual(None, got_qual)
         self.assertEqual(4, got_length)
-        got_length, got_qual = utils.estimate_max_read_length_and_read_error_rate_from_qual_scores(tmp_file, number_of_reads=2)
+        got_length, got_qual = utils.estimate_read_length_and_error_rate_sampled(tmp_file, number_of_reads=2)
         self.assertEqual(None, got_qual)
         self.assertEqual(5, got_length)
         os.unlink(tmp_file)
 
 
-    def test_estimate_max_read_length_and_read_error_rate_from_qual_scores_fasta_file(self):
-        '''test estimate_max_read_length_and_read_error_rate_from_qual_scores fasta file'''
-        tmp_file = 'tmp.estimate_max_read_length_and_read_error_rate_from_qual_scores.fa'
+    def test_estimate_read_length_and_error_rate_sampled_fasta_file(self):
+        '''test estimate_read_length_and_error_rate_sampled fasta file'''
+        tmp_file = 'tmp.estimate_read_length_and_error_rate_sampled.fa'
         with open(tmp_file, 'w') as f:
             print('>1', 'ACGT', sep='\n', file=f)
             print('>2', 'ACGT', sep='\n', file=f)
 
-        got_length, got_qual = utils.estimate_max_read_length_and_read_error_rate_from_qual_scores(tmp_file)
+        got_length, got_qual = utils.estimate_read_length_and_error_rate_sampled(tmp_file)
         self.assertEqual(None, got_qual)
         self.assertEqual(4, got_length)
         os.unlink(tmp_file)
 
+
+    def test_estimate_read_length_and_error_rate_sampled_bam_file(self):
+        '''test estimate_read_length_and_error_rate_sampled sorted indexed bam file'''
+        tmp_sam = 'tmp.estimate_read_length_and_error_rate_sampled.sam'
+        tmp_bam = 'tmp.estimate_read_length_and_error_rate_sampled.bam'
+        cache_dir = 'tmp.estimate_read_length_and_error_rate_sampled.cache'
+        if os.path.exists(cache_dir):
+            shutil.rmtree(cache_dir)
+        with open(tmp_sam, 'w') as f:
+            print('@HD\tVN:1.6\tSO:coordinate', file=f)
+            print('@SQ\tSN:ref1\tLN:1000', file=f)
+            print('@SQ\tSN:ref2\tLN:1000', file=f)
+            # The first 2 reads would be used if not sampling across the genome
+            print(1, 0, 'ref1', 1, 60, '4M', '*', 0, 0, 'ACGT', 'IIII', sep='\t', file=f)
+            print(2, 0, 'ref1', 2, 60, '4M', '*', 0, 0, 'ACGT', 'IIII', sep='\t', file=f)
+            print(3, 0, 'ref2', 600, 60, '6M', '*', 0, 0, 'ACGTAC', '555555', sep='\t', file=f)
+            print(4, 256, 'ref2', 600, 60, '8M', '*', 0, 0, 'ACGTACGT', '++++++++', sep='\t', file=f)
+
+        pysam.sort('-o', tmp_bam, tmp_sam, catch_stdout=False)
+        pysam.index(tmp_bam)
+        got_length, got_qual = utils.estimate_read_length_and_error_rate_sampled(tmp_bam, number_of_reads=2, number_of_regions=2, threads=2, cache_dir=cache_dir)
+        self.assertAlmostEqual(pow(10, -20 / 10), got_qual)
+        self.assertEqual(6, got_length)
+        cache_file = utils._read_stats_cache_file(cache_dir, tmp_bam)
+        self.assertTrue(os.path.exists(cache_file))
+        self.assertFalse(os.path.exists(tmp_bam + '.minos_read_stats.json'))
+
+        # Check the cached values are used, by changing them
+        with open(cache_file) as f:
+            cache_data = json.load(f)
+        cache_data['max_read_length'] = 42
+        with open(cache_file, 'w') as f:
+            json.dump(cache_data, f)
+        got_length, got_qual = utils.estimate_read_length_and_error_rate_sampled(tmp_bam, number_of_reads=2, number_of_regions=2, cache_dir=cache_dir)
+        self.assertEqual(42, got_length)
+        got_length, got_qual = utils.estimate_read_length_and_error_rate_sampled(tmp_bam, number_of_reads=2, number_of_regions=3, cache_dir=cache_dir)
+        self.assertNotEqual(42, got_length)
+
+        for filename in (tmp_sam, tmp_bam, tmp_bam + '.bai'):
+            os.unlink(filename)
+        shutil.rmtree(cache_dir)
+
+
+    def test_parse_region_string(self):
+        '''test parse_region_string'''
+        self.assertEqual(('chr1', 0, 9), utils.parse_region_string('chr1:1-10'))
+        self.assertEqual(('chr1', 999, 1999), utils.parse_region_string('chr1:1,000-2,000'))
+        self.assertEqual(('HLA:A', 4, 4), utils.parse_region_string('HLA:A:5-5'))
+        for bad_region in ['chr1', 'chr1:10', 'chr1:0-10', 'chr1:10-9', ':1-10', 'chr1:a-b']:
+            with self.assertRaises(utils.Error):
+                utils.parse_region_string(bad_region)
+
+
+    def test_load_regions_bed_file(self):
+        '''test load_regions_bed_file'''
+        tmp_bed = 'tmp.utils.load_regions_bed_file.bed'
+        with open(tmp_bed, 'w') as f:
+            print('track name=test', file=f)
+            print('chr1', 0, 10, sep='\t', file=f)
+            print('chr2', 41, 42, 'name', sep='\t', file=f)
+        self.assertEqual([('chr1', 0, 9), ('chr2', 41, 41)], utils.load_regions_bed_file(tmp_bed))
+
+        with open(tmp_bed, 'w') as f:
+            print('chr1', 10, 10, sep='\t', file=f)
+        with self.assertRaises(utils.Error):
+            utils.load_regions_bed_file(tmp_bed)
+        os.unlink(tmp_bed)
+
+
+    def test_merge_regions(self):
+        '''test merge_regions'''
+        regions = [('chr2', 5, 6), ('chr1', 20, 30), ('chr1', 1, 10), ('chr1', 11, 12), ('chr1', 25, 40)]
+        expected = {'chr1': [(1, 12), (20, 40)], 'chr2': [(5, 6)]}
+        self.assertEqual(expected, utils.merge_regions(regions))
+        expected = {'chr1': [(0, 45)], 'chr2': [(0, 11)]}
+        self.assertEqual(expected, utils.merge_regions(regions, flank=5))
@@ -4,6 +4,8 @@ import os
 import unittest
 
 import cluster_vcf_records
+import pyfastaq
+import pysam
 
 from minos import vcf_chunker
 
@@ -27,6 +29,85 @@ class TestVcfChunker(unittest.TestCase):
         self.assertEqual(expect_alleles, got_alleles)
 
 
+    def test_total_variants_and_alleles_in_vcf_file(self):
+        '''test _total_variants_and_alleles_in_vcf_file'''
+        infile = os.path.join(data_dir, 'make_split_files.in.vcf')
+        self.assertEqual((7, 14), vcf_chunker.VcfChunker._total_variants_and_alleles_in_vcf_file(infile))
+        tmp_gz = 'tmp.vcf_chunker.total_variants_and_alleles_in_vcf_file.vcf.gz'
+        pysam.tabix_compress(infile, tmp_gz, force=True)
+        self.assertEqual((7, 14), vcf_chunker.VcfChunker._total_variants_and_alleles_in_vcf_file(tmp_gz))
+        os.unlink(tmp_gz)
+
+
+    def test_estimate_gramtools_ram_and_max_alleles_for_ram(self):
+        '''test estimate_gramtools_ram and max_alleles_for_ram'''
+        intercept, ram_per_allele = vcf_chunker.default_gramtools_ram_model
+        self.assertEqual(intercept, vcf_chunker.estimate_gramtools_ram(0))
+        ram = vcf_chunker.estimate_gramtools_ram(1000)
+        self.assertGreater(ram, intercept)
+        self.assertEqual(1000, vcf_chunker.max_alleles_for_ram(ram + 0.5 * ram_per_allele))
+        with self.assertRaises(vcf_chunker.Error):
+            vcf_chunker.max_alleles_for_ram(intercept)
+
+        self.assertEqual(12, vcf_chunker.estimate_gramtools_ram(10, ram_model=(2, 1)))
+        self.assertEqual(10, vcf_chunker.max_alleles_for_ram(12.5, ram_model=(2, 1)))
+        with self.assertRaises(vcf_chunker.Error):
+            vcf_chunker.max_alleles_for_ram(2, ram_model=(2, 1))
+        with self.assertRaises(vcf_chunker.Error):
+            vcf_chunker.max_alleles_for_ram(3, ram_model=(2, 0))
+
+
+    def test_make_split_vcf_files_target_ram(self):
+        '''test make_split_vcf_files using target_ram_per_split'''
+        infile = os.path.join(data_dir, 'make_split_files.in.vcf')
+        ref_fa = os.path.join(data_dir, 'make_split_files.in.ref.fa')
+        tmp_out = 'tmp.vcf_chunker.make_split_vcf_files_target_ram'
+        if os.path.exists(tmp_out):
+            shutil.rmtree(tmp_out)
+
+        target_ram = vcf_chunker.estimate_gramtools_ram(4.5)
+        chunker = vcf_chunker.VcfChunker(tmp_out, vcf_infile=infile, ref_fasta=ref_fa, flank_length=1, total_splits=1, target_ram_per_split=target_ram)
+        chunker.make_split_vcf_files()
+        self.assertEqual(4, chunker.alleles_per_split)
+        use_ranges = [(x.use_start_index, x.use_end_index) for x in chunker.vcf_split_files['ref1']]
+        self.assertEqual([(0, 1), (2, 3), (4, 4), (5, 5)], use_ranges)
+        chunker2 = vcf_chunker.VcfChunker(tmp_out)
+        self.assertEqual(target_ram, chunker2.target_ram_per_split)
+        shutil.rmtree(tmp_out)
+
+        # Same again, but with a RAM model of 1GB + 1GB per allele
+        chunker = vcf_chunker.VcfChunker(tmp_out, vcf_infile=infile, ref_fasta=ref_fa, flank_length=1, total_splits=1, target_ram_per_split=5.5, gramtools_ram_model=(1, 1))
+        chunker.make_split_vcf_files()
+        self.assertEqual(4, chunker.alleles_per_split)
+        self.assertEqual(use_ranges, [(x.use_start_index, x.use_end_index) for x in chunker.vcf_split_files['ref1']])
+        self.assertEqual((1, 1), vcf_chunker.VcfChunker(tmp_out).gramtools_ram_model)
+        shutil.rmtree(tmp_out)
+
+
+    def test_split_cost_functions(self):
+        '''test split cost functions'''
+        vcf_records = {
+            'ref.1': [
+                cluster_vcf_records.vcf_record.VcfRecord('ref.1\t100\t.\tG\tT\t.\t.\t.\t.'),
+                cluster_vcf_records.vcf_record.VcfRecord('ref.1\t299\t.\tGATA\tGA,G\t.\t.\t.\t.'),
+                cluster_vcf_records.vcf_record.VcfRecord('ref.1\t501\t.\tG\tGAGTC\t.\t.\t.\t.'),
+                cluster_vcf_records.vcf_record.VcfRecord('ref.1\t701\t.\tC\tA\t.\t.\t.\t.'),
+            ],
+            'not_in_bam': [cluster_vcf_records.vcf_record.VcfRecord('not_in_bam\t1\t.\tC\tA\t.\t.\t.\t.')],
+        }
+        reads_file = os.path.join(modules_dir, 'tests', 'data', 'adjudicator', 'run.bwa.bam')
+        self.assertEqual({'ref.1': [2, 3, 2, 2], 'not_in_bam': [2]}, vcf_chunker.alleles_cost(vcf_records, None))
+        self.assertEqual({'ref.1': [2, 7, 6, 2], 'not_in_bam': [2]}, vcf_chunker.allele_lengths_cost(vcf_records, None))
+        self.assertEqual({'ref.1': [49, 49, 56.5, 56.5], 'not_in_bam': [0]}, vcf_chunker.read_counts_cost(vcf_records, reads_file, bin_size=500))
+        with self.assertRaises(vcf_chunker.Error):
+            vcf_chunker.read_counts_cost(vcf_records, None)
+
+        got = vcf_chunker.allele_lengths_and_reads_cost(vcf_records, reads_file)
+        self.assertAlmostEqual(2, sum([sum(x) for x in got.values()]))
+        self.assertAlmostEqual(2 / 19 + 0.25, got['ref.1'][0])
+        self.assertAlmostEqual(2 / 19, got['not_in_bam'][0])
+
+
     def test_chunk_end_indexes_from_vcf_record_list(self):
         '''test _chunk_end_indexes_from_vcf_record_list'''
         record_list = [
@@ -51,6 +132,11 @@ class TestVcfChunker(unittest.TestCase):
         self.assertEqual((0, 2, 2), vcf_chunker.VcfChunker._chunk_end_indexes_from_vcf_record_list(record_list, 0, 1, total_alleles=11))
         self.assertEqual((0, 3, 3), vcf_chunker.VcfChunker._chunk_end_indexes_from_vcf_record_list(record_list, 0, 1, total_alleles=12))
 
+        record_costs = [1, 10, 1, 1, 1, 1]
+        self.assertEqual((0, 0, 1), vcf_chunker.VcfChunker._chunk_end_indexes_from_vcf_record_list(record_list, 0, 1, total_cost=10, record_costs=record_costs))
+        self.assertEqual((0, 1, 2), vcf_chunker.VcfChunker._chunk_end_indexes_from_vcf_record_list(record_list, 0, 1, total_cost=11, record_costs=record_costs))
+        self.assertEqual((1, 3, 3), vcf_chunker.VcfChunker._chunk_end_indexes_from_vcf_record_list(record_list, 2, 1, total_cost=2, record_costs=record_costs))
+
         self.assertEqual((0, 0, 1), vcf_chunker.VcfChunker._chunk_end_indexes_from_vcf_record_list(record_list, 0, 1, total_sites=1))
         self.assertEqual((0, 1, 2), vcf_chunker.VcfChunker._chunk_end_indexes_from_vcf_record_list(record_list, 0, 1, total_sites=2))
         self.assertEqual((0, 2, 2), vcf_chunker.VcfChunker._chunk_end_indexes_from_vcf_record_list(record_list, 0, 1, total_sites=3))
@@ -129,6 +215,167 @@ class TestVcfChunker(unittest.TestCase):
         self.assertEqual((4, 4, 4), vcf_chunker.VcfChunker._chunk_end_indexes_from_vcf_record_list(record_list, 4, 100, total_sites=2))
 
 
+    def test_split_indexes_from_vcf_record_stream(self):
+        '''test _split_indexes_from_vcf_record_stream'''
+        record_list = [
+            cluster_vcf_records.vcf_record.VcfRecord('ref\t1\t.\tA\tG\t.\t.\t.\t.'),
+            cluster_vcf_records.vcf_record.VcfRecord('ref\t2\t.\tC\tT,A,G,TA\t.\t.\t.\t.'),
+            cluster_vcf_records.vcf_record.VcfRecord('ref\t3\t.\tT\tA,C\t.\t.\t.\t.'),
+            cluster_vcf_records.vcf_record.VcfRecord('ref\t5\t.\tAGAGTCACGTA\tG\t.\t.\t.\t.'),
+            cluster_vcf_records.vcf_record.VcfRecord('ref\t8\t.\tA\tG\t.\t.\t.\t.'),
+            cluster_vcf_records.vcf_record.VcfRecord('ref\t18\t.\tA\tG\t.\t.\t.\t.'),
+            cluster_vcf_records.vcf_record.VcfRecord('ref\t21\t.\tG\tT\t.\t.\t.\t.'),
+            cluster_vcf_records.vcf_record.VcfRecord('ref\t60\t.\tG\tT,C\t.\t.\t.\t.'),
+        ]
+        record_costs = [1, 10, 1, 1, 3, 1, 2, 1]
+
+        # Should get the same splits as repeatedly calling
+        # _chunk_end_indexes_from_vcf_record_list
+        def expected_splits(flank_length, **kwargs):
+            splits = []
+            use_start_index = 0
+            while use_start_index < len(record_list):
+                file_start_index, use_end_index, file_end_index = vcf_chunker.VcfChunker._chunk_end_indexes_from_vcf_record_list(record_list, use_start_index, flank_length, **kwargs)
+                splits.append((file_start_index, use_start_index, use_end_index, file_end_index, record_list[file_start_index:file_end_index + 1]))
+                use_start_index = use_end_index + 1
+            return splits
+
+        for flank_length in range(1, 45):
+            for total in range(1, 15):
+                for kwargs in {'total_sites': total}, {'total_alleles': total}, {'total_cost': total, 'record_costs': record_costs}:
+                    got = list(vcf_chunker.VcfChunker._split_indexes_from_vcf_record_stream(iter(record_list), flank_length, **kwargs))
+                    self.assertEqual(expected_splits(flank_length, **kwargs), got)
+
+        self.assertEqual([], list(vcf_chunker.VcfChunker._split_indexes_from_vcf_record_stream([], 1, total_sites=1)))
+
+
+    def test_vcf_header_lines_and_is_sorted(self):
+        '''test _vcf_header_lines_and_is_sorted'''
+        tmp_vcf = 'tmp.vcf_chunker.vcf_header_lines_and_is_sorted.vcf'
+        header = ['##fileformat=VCFv4.2', '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO']
+        tests = [
+            (['ref1\t1', 'ref1\t1', 'ref1\t5', 'ref2\t2'], True),
+            (['ref1\t5', 'ref1\t1'], False),
+            (['ref1\t1', 'ref2\t1', 'ref1\t5'], False),
+        ]
+        for records, expected in tests:
+            with open(tmp_vcf, 'w') as f:
+                print(*header, sep='\n', file=f)
+                for record in records:
+                    print(record + '\t.\tA\tG\t.\t.\t.', file=f)
+            self.assertEqual((header, expected), vcf_chunker.VcfChunker._vcf_header_lines_and_is_sorted(tmp_vcf))
+        os.unlink(tmp_vcf)
+
+
+    def test_make_split_vcf_files_split_cost(self):
+        '''test make_split_vcf_files using split_cost'''
+        infile = os.path.join(data_dir, 'make_split_files.in.vcf')
+        ref_fa = os.path.join(data_dir, 'make_split_files.in.ref.fa')
+        tmp_out = 'tmp.vcf_chunker.make_split_vcf_files_split_cost'
+        if os.path.exists(tmp_out):
+            shutil.rmtree(tmp_out)
+
+        with self.assertRaises(vcf_chunker.Error):
+            vcf_chunker.VcfChunker(tmp_out, vcf_infile=infile, ref_fasta=ref_fa, split_cost='not_a_cost_function')
+        with self.assertRaises(vcf_chunker.Error):
+            vcf_chunker.VcfChunker(tmp_out, vcf_infile=infile, ref_fasta=ref_fa, split_cost='alleles', alleles_per_split=2)
+
+        # Allele lengths are 2,2,2,12,2,2 (ref1) and 2 (ref2). Total 24, so
+        # 8 per split. The long deletion gets a split to itself. The last
+        # record gets its own split, same as when using alleles_per_split
+        chunker = vcf_chunker.VcfChunker(tmp_out, vcf_infile=infile, ref_fasta=ref_fa, flank_length=1, total_splits=3, split_cost='allele_lengths')
+        chunker.make_split_vcf_files()
+        use_ranges = [(x.use_start_index, x.use_end_index) for x in chunker.vcf_split_files['ref1']]
+        self.assertEqual([(0, 2), (3, 3), (4, 4), (5, 5)], use_ranges)
+        chunker2 = vcf_chunker.VcfChunker(tmp_out)
+        self.assertEqual('allele_lengths', chunker2.split_cost)
+        shutil.rmtree(tmp_out)
+
+
+    def test_make_split_vcf_files_slice_reference(self):
+        '''test make_split_vcf_files using slice_reference'''
+        infile = os.path.join(data_dir, 'make_split_files.in.vcf')
+        ref_fa = os.path.join(data_dir, 'make_split_files.in.ref.fa')
+        tmp_out = 'tmp.vcf_chunker.make_split_vcf_files_slice_reference'
+        if os.path.exists(tmp_out):
+            shutil.rmtree(tmp_out)
+
+        chunker = vcf_chunker.VcfChunker(tmp_out, vcf_infile=infile, ref_fasta=ref_fa, variants_per_split=4, flank_length=3, slice_reference=True)
+        chunker.make_split_vcf_files()
+        split_files = [x for ref_name in chunker.vcf_split_files for x in chunker.vcf_split_files[ref_name]]
+        self.assertEqual([(0, 17), (4, 23), (38, 44)], [(x.chrom_start, x.chrom_end) for x in split_files])
+        expected_refs = [
+            ('ref1', 'GCTAAGAGTCACGTAGTA'),
+            ('ref1', 'AGAGTCACGTAGTATCGCTA'),
+            ('ref2', 'GTGCGAT'),
+        ]
+        header, original_records = cluster_vcf_records.vcf_file_read.vcf_file_to_list(infile)
+
+        for split_file, (expected_name, expected_seq) in zip(split_files, expected_refs):
+            self.assertEqual(os.path.join(chunker.outdir, 'split.' + str(split_file.file_number) + '.ref.fa'), split_file.ref_fasta)
+            ref_seqs = {}
+            pyfastaq.tasks.file_to_dict(split_file.ref_fasta, ref_seqs)
+            self.assertEqual({expected_name: expected_seq}, {k: v.seq for k, v in ref_seqs.items()})
+
+            header, records = cluster_vcf_records.vcf_file_read.vcf_file_to_list(split_file.filename)
+            for record in records:
+                self.assertEqual(record.REF, expected_seq[record.POS:record.POS + len(record.REF)])
+            vcf_chunker.VcfChunker.shift_split_vcf_records_to_ref(split_file, records)
+            self.assertEqual(original_records[split_file.file_start_index + (6 if split_file.chrom == 'ref2' else 0):][:len(records)], records)
+
+        self.assertTrue(vcf_chunker.VcfChunker(tmp_out).slice_reference)
+
+        # A copy of the directory should use the files in the copy
+        tmp_copy = tmp_out + '.copy'
+        if os.path.exists(tmp_copy):
+            shutil.rmtree(tmp_copy)
+        shutil.copytree(tmp_out, tmp_copy)
+        chunker2 = vcf_chunker.VcfChunker(tmp_copy)
+        split_files2 = [x for ref_name in chunker2.vcf_split_files for x in chunker2.vcf_split_files[ref_name]]
+        self.assertEqual(len(split_files), len(split_files2))
+        for split_file, split_file2 in zip(split_files, split_files2):
+            self.assertEqual(os.path.join(chunker2.outdir, os.path.basename(split_file.filename)), split_file2.filename)
+            self.assertEqual(os.path.join(chunker2.outdir, os.path.basename(split_file.gramtools_build_dir)), split_file2.gramtools_build_dir)
+            self.assertEqual(os.path.join(chunker2.outdir, os.path.basename(split_file.ref_fasta)), split_file2.ref_fasta)
+            self.assertEqual(split_file[1:9], split_file2[1:9])
+        shutil.rmtree(tmp_copy)
+        shutil.rmtree(tmp_out)
+
+
+    def test_record_groups_separated_by_gaps(self):
+        '''test _record_groups_separated_by_gaps'''
+        records = [cluster_vcf_records.vcf_record.VcfRecord('ref\t' + str(pos + 1) + '\t.\t' + ref + '\tA\t.\tPASS\t.') for pos, ref in [(1, 'C'), (4, 'CGCGCGCGCG'), (16, 'C'), (20, 'C'), (30, 'C')]]
+        got = [(i, [x.POS for x in group]) for i, group in vcf_chunker.VcfChunker._record_groups_separated_by_gaps(records, 3)]
+        self.assertEqual([(0, [1, 4, 16]), (3, [20]), (4, [30])], got)
+        self.assertEqual([], list(vcf_chunker.VcfChunker._record_groups_separated_by_gaps([], 3)))
+
+
+    def test_make_split_vcf_files_split_at_gaps(self):
+        '''test make_split_vcf_files using split_at_gaps'''
+        infile = os.path.join(data_dir, 'make_split_files.in.vcf')
+        ref_fa = os.path.join(data_dir, 'make_split_files.in.ref.fa')
+        tmp_out = 'tmp.vcf_chunker.make_split_vcf_files_split_at_gaps'
+        if os.path.exists(tmp_out):
+            shutil.rmtree(tmp_out)
+
+        # Without split_at_gaps, this makes one split of all the ref1 records.
+        # With it, the records at 18 and 21 are too far from the others to be
+        # in their flanks, so each get their own split
+        chunker = vcf_chunker.VcfChunker(tmp_out, vcf_infile=infile, ref_fasta=ref_fa, variants_per_split=10, flank_length=2, split_at_gaps=True)
+        chunker.make_split_vcf_files()
+        split_files = chunker.vcf_split_files['ref1']
+        self.assertEqual([(0, 0, 3, 3), (4, 4, 4, 4), (5, 5, 5, 5)], [(x.file_start_index, x.use_start_index, x.use_end_index, x.file_end_index) for x in split_files])
+        self.assertEqual([(0, 16), (15, 19), (18, 22)], [(x.chrom_start, x.chrom_end) for x in split_files])
+        self.assertEqual(7, chunker.total_input_records)
+
+        header, original_records = cluster_vcf_records.vcf_file_read.vcf_file_to_list(infile)
+        for split_file in split_files:
+            header, got_records = cluster_vcf_records.vcf_file_read.vcf_file_to_list(split_file.filename)
+            self.assertEqual(original_records[split_file.file_start_index:split_file.file_end_index + 1], got_records)
+        self.assertTrue(vcf_chunker.VcfChunker(tmp_out).split_at_gaps)
+        shutil.rmtree(tmp_out)
+
+
     def test_make_split_files(self):
         '''test make_split_files'''
         infile = os.path.join(data_dir, 'make_split_files.in.vcf')
@@ -198,8 +445,99 @@ class TestVcfChunker(unittest.TestCase):
         self.assertEqual(chunker.max_read_length,chunker2.max_read_length)
         self.assertEqual(chunker.total_split_files,chunker2.total_split_files)
         self.assertEqual(chunker.vcf_split_files,chunker2.vcf_split_files)
+        self.assertEqual({0, 1, 2}, set(chunker2.build_seconds))
         shutil.rmtree(tmp_out)
 
+        # Test with two threads. Splits from every ref seq should be built
+        chunker = vcf_chunker.VcfChunker(tmp_out, vcf_infile=infile, ref_fasta=ref_fa, variants_per_split=2, flank_length=1, gramtools_kmer_size=5, threads=2)
+        chunker.make_split_files()
+        for split_file in [x for ref_name in chunker.vcf_split_files for x in chunker.vcf_split_files[ref_name]]:
+            self.assertTrue(os.path.exists(os.path.join(split_file.gramtools_build_dir, 'build_report.json')))
+        chunker2 = vcf_chunker.VcfChunker(tmp_out)
+        self.assertEqual({0, 1, 2, 3}, set(chunker2.build_seconds))
+        shutil.rmtree(tmp_out)
+
+
+    def test_update_split_vcf_files(self):
+        '''test _update_split_vcf_files'''
+        infile = os.path.join(data_dir, 'make_split_files.in.vcf')
+        ref_fa = os.path.join(data_dir, 'make_split_files.in.ref.fa')
+        tmp_out = 'tmp.vcf_chunker.update_split_vcf_files'
+        tmp_vcf = 'tmp.vcf_chunker.update_split_vcf_files.vcf'
+        if os.path.exists(tmp_out):
+            shutil.rmtree(tmp_out)
+
+        chunker = vcf_chunker.VcfChunker(tmp_out, vcf_infile=infile, ref_fasta=ref_fa, variants_per_split=2, flank_length=1)
+        chunker.make_split_vcf_files()
+        # Fake the gramtools builds, so we can check which ones get deleted
+        for ref_name in chunker.vcf_split_files:
+            for split_file in chunker.vcf_split_files[ref_name]:
+                os.mkdir(split_file.gramtools_build_dir)
+
+        # New VCF: add a record at the end of ref1, which goes in the last
+        # split of ref1. That split then has too many records, so the new
+        # record is put in a new split. Remove the ref2 record, and add a ref3 record
+        with open(infile) as f_in, open(tmp_vcf, 'w') as f_out:
+            for line in f_in:
+                if not line.startswith('ref2'):
+                    print(line, end='', file=f_out)
+            print('ref1\t30\t.\tT\tC\t.\tPASS\t.\t.\t.', file=f_out)
+            print('ref3\t10\t.\tA\tG\t.\tPASS\t.\t.\t.', file=f_out)
+
+        to_build = chunker._update_split_vcf_files(tmp_vcf)
+        self.assertEqual([(4, 'ref1'), (5, 'ref3')], [(x.file_number, x.chrom) for x in to_build])
+        self.assertEqual([0, 1, 2, 4], [x.file_number for x in chunker.vcf_split_files['ref1']])
+        self.assertEqual([(4, 5, 4, 5), (6, 6, 6, 6)], [(x.use_start_index, x.use_end_index, x.file_start_index, x.file_end_index) for x in chunker.vcf_split_files['ref1'][2:]])
+        self.assertEqual(['ref1', 'ref3'], list(chunker.vcf_split_files))
+        self.assertEqual(8, chunker.total_input_records)
+        self.assertEqual(5, chunker.total_split_files)
+        for i, build_exists in (0, True), (1, True), (2, True), (3, False), (4, False):
+            self.assertEqual(build_exists, os.path.exists(os.path.join(tmp_out, 'split.' + str(i) + '.gramtools_build')))
+        self.assertFalse(os.path.exists(os.path.join(tmp_out, 'split.3.in.vcf')))
+        header, records = cluster_vcf_records.vcf_file_read.vcf_file_to_list(os.path.join(tmp_out, 'split.4.in.vcf'))
+        self.assertEqual([30], [x.POS + 1 for x in records])
+
+        chunker2 = vcf_chunker.VcfChunker(tmp_out)
+        self.assertEqual(chunker.vcf_split_files, chunker2.vcf_split_files)
+        self.assertEqual(os.path.abspath(tmp_vcf), chunker2.vcf_infile)
+
+        # Updating again with the same file should change nothing
+        self.assertEqual([], chunker2._update_split_vcf_files(tmp_vcf))
+        self.assertEqual(chunker.vcf_split_files, chunker2.vcf_split_files)
+        shutil.rmtree(tmp_out)
+        os.unlink(tmp_vcf)
+
+
+    def test_split_use_count(self):
+        '''test _split_use_count'''
+        records = [cluster_vcf_records.vcf_record.VcfRecord('ref\t' + str(i + 1) + '\t.\tA\t' + alts + '\t.\tPASS\t.\t.\t.') for i, alts in enumerate(['C', 'C,G', 'T', 'C,G,T'])]
+        self.assertEqual(3, vcf_chunker.VcfChunker._split_use_count(records, 1, 3))
+        self.assertEqual(2, vcf_chunker.VcfChunker._split_use_count(records, 1, 3, variants_per_split=2))
+        self.assertEqual(3, vcf_chunker.VcfChunker._split_use_count(records, 1, 3, variants_per_split=4))
+        self.assertEqual(2, vcf_chunker.VcfChunker._split_use_count(records, 0, 4, alleles_per_split=5))
+        self.assertEqual(1, vcf_chunker.VcfChunker._split_use_count(records, 0, 4, alleles_per_split=4))
+        self.assertEqual(1, vcf_chunker.VcfChunker._split_use_count(records, 3, 1, alleles_per_split=1))
+        self.assertEqual(3, vcf_chunker.VcfChunker._split_use_count(records, 1, 3, alleles_per_split=100))
+
+
+    def test_run_gramtools_build_on_each_split_fails(self):
+        '''test run_gramtools_build_on_each_split when builds fail'''
+        infile = os.path.join(data_dir, 'make_split_files.in.vcf')
+        ref_fa = os.path.join(data_dir, 'make_split_files.in.ref.fa')
+        tmp_out = 'tmp.vcf_chunker.run_gramtools_build_on_each_split_fails'
+        if os.path.exists(tmp_out):
+            shutil.rmtree(tmp_out)
+
+        for threads in 1, 2:
+            chunker = vcf_chunker.VcfChunker(tmp_out, vcf_infile=infile, ref_fasta=ref_fa, variants_per_split=4, flank_length=3, gramtools_kmer_size=5, threads=threads)
+            chunker.make_split_vcf_files()
+            chunker.ref_fasta = 'does_not_exist.fa'
+            with self.assertRaises(vcf_chunker.Error) as context:
+                chunker.run_gramtools_build_on_each_split()
+            self.assertIn('failed on 3 split file(s): 0,1,2.', str(context.exception))
+            self.assertEqual({}, vcf_chunker.VcfChunker(tmp_out).build_seconds)
+            shutil.rmtree(tmp_out)
+
 
     def test_make_split_files_2(self):
         '''test make_split_files with different input from previous test'''
@@ -248,3 +586,94 @@ class TestVcfChunker(unittest.TestCase):
         os.unlink(tmp_vcf_out)
         shutil.rmtree(tmp_outdir)
 
+
+
+    def test_merge_files_without_gramtools_build(self):
+        '''test merge_files, after only making split VCF files'''
+        vcf_to_split = os.path.join(data_dir, 'merge_files.in.vcf')
+        ref_fasta = os.path.join(data_dir, 'merge_files.in.ref.fa')
+        tmp_outdir = 'tmp.vcf_chunker.merge_files_without_gramtools_build'
+        if os.path.exists(tmp_outdir):
+            shutil.rmtree(tmp_outdir)
+        chunker = vcf_chunker.VcfChunker(tmp_outdir, vcf_infile=vcf_to_split, ref_fasta=ref_fasta, variants_per_split=4, flank_length=3, gramtools_kmer_size=5)
+        chunker.make_split_vcf_files()
+        to_merge = {}
+        for ref, split_list in chunker.vcf_split_files.items():
+            to_merge[ref] = [x.filename for x in split_list]
+        tmp_vcf_out = 'tmp.vcf_chunker.merge_files_without_gramtools_build.out.vcf'
+        chunker.merge_files(to_merge, tmp_vcf_out)
+        self.assertTrue(filecmp.cmp(vcf_to_split, tmp_vcf_out, shallow=False))
+
+        # Remove a record from one of the split files, which should
+        # then make merging fail
+        split_file = chunker.vcf_split_files['ref1'][-1]
+        with open(split_file.filename) as f:
+            lines = f.readlines()
+        with open(split_file.filename, 'w') as f:
+            print(*lines[:-1], sep='', end='', file=f)
+        with self.assertRaises(vcf_chunker.Error):
+            chunker.merge_files(to_merge, tmp_vcf_out)
+
+        os.unlink(tmp_vcf_out)
+        shutil.rmtree(tmp_outdir)
+
+
+    def test_incremental_split_merger(self):
+        '''test IncrementalSplitMerger'''
+        vcf_to_split = os.path.join(data_dir, 'merge_files.in.vcf')
+        ref_fasta = os.path.join(data_dir, 'merge_files.in.ref.fa')
+        tmp_outdir = 'tmp.vcf_chunker.incremental_split_merger'
+        if os.path.exists(tmp_outdir):
+            shutil.rmtree(tmp_outdir)
+        chunker = vcf_chunker.VcfChunker(tmp_outdir, vcf_infile=vcf_to_split, ref_fasta=ref_fasta, variants_per_split=2, flank_length=3, gramtools_kmer_size=5)
+        chunker.make_split_vcf_files()
+        split_files = [x for ref in chunker.vcf_split_files for x in chunker.vcf_split_files[ref]]
+        self.assertEqual(4, len(split_files))
+        to_merge = {}
+        for split_file in split_files:
+            to_merge[split_file.file_number] = split_file.filename + '.copy'
+            shutil.copyfile(split_file.filename, to_merge[split_file.file_number])
+
+        tmp_vcf_out = 'tmp.vcf_chunker.incremental_split_merger.out.vcf'
+        merger = vcf_chunker.IncrementalSplitMerger(chunker, tmp_vcf_out)
+        merger.add(1, to_merge[1])
+        self.assertEqual(0, merger.next_index)
+        self.assertTrue(os.path.exists(to_merge[1]))
+        merger.add(0, to_merge[0])
+        self.assertEqual(2, merger.next_index)
+        self.assertFalse(os.path.exists(to_merge[0]))
+        self.assertFalse(os.path.exists(to_merge[1]))
+        merger.add(3, to_merge[3])
+        self.assertEqual(2, merger.next_index)
+        merger.add(2, to_merge[2])
+        self.assertEqual(4, merger.next_index)
+        merger.finish()
+        self.assertTrue(filecmp.cmp(vcf_to_split, tmp_vcf_out, shallow=False))
+
+        # Files that only have the records in the use range of each split
+        merger = vcf_chunker.IncrementalSplitMerger(chunker, tmp_vcf_out, flanks_removed=True)
+        for split_file in split_files:
+            header_lines, vcf_records = cluster_vcf_records.vcf_file_read.vcf_file_to_list(split_file.filename)
+            start = split_file.use_start_index - split_file.file_start_index
+            end = split_file.use_end_index - split_file.file_start_index
+            with open(to_merge[split_file.file_number], 'w') as f:
+                print(*header_lines, sep='\n', file=f)
+                print(*vcf_records[start:end + 1], sep='\n', file=f)
+            merger.add(split_file.file_number, to_merge[split_file.file_number])
+        merger.finish()
+        self.assertTrue(filecmp.cmp(vcf_to_split, tmp_vcf_out, shallow=False))
+
+        merger = vcf_chunker.IncrementalSplitMerger(chunker, tmp_vcf_out, delete_merged=False)
+        merger.add(0, split_files[0].filename)
+        self.assertTrue(os.path.exists(split_files[0].filename))
+        with self.assertRaises(vcf_chunker.Error):
+            merger.finish()
+
+        with self.assertRaises(vcf_chunker.Error):
+            with vcf_chunker.IncrementalSplitMerger(chunker, tmp_vcf_out, delete_merged=False) as merger:
+                merger.add(0, split_files[0].filename)
+                raise vcf_chunker.Error('Test error')
+        self.assertTrue(merger.f_out.closed)
+
+        os.unlink(tmp_vcf_out)
+        shutil.rmtree(tmp_outdir)
@@ -0,0 +1,116 @@
+import os
+import unittest
+
+import pyfastaq
+import pysam
+from cluster_vcf_records import vcf_merge
+
+from minos import vcf_tree_merge
+
+modules_dir = os.path.dirname(os.path.abspath(vcf_tree_merge.__file__))
+data_dir = os.path.join(modules_dir, 'tests', 'data', 'vcf_tree_merge')
+
+
+def file_to_lines(filename):
+    with open(filename) as f:
+        return f.readlines()
+
+
+class TestVcfTreeMerge(unittest.TestCase):
+    def test_lazy_ref_seqs(self):
+        '''test LazyRefSeqs'''
+        ref_fasta = os.path.join(data_dir, 'ref.fa')
+        expected = {}
+        pyfastaq.tasks.file_to_dict(ref_fasta, expected)
+        ref_seqs = vcf_tree_merge.LazyRefSeqs(ref_fasta)
+        self.assertEqual(sorted(expected), sorted(ref_seqs.offsets))
+        for name in 'ref1', 'ref2 description', 'ref3', 'ref1':
+            self.assertTrue(name in ref_seqs)
+            self.assertEqual(expected[name].seq, ref_seqs[name])
+            self.assertEqual(name, ref_seqs.cached_name)
+        self.assertFalse('ref2' in ref_seqs)
+
+
+    def test_vcf_file_chrom_blocks(self):
+        '''test _vcf_file_chrom_blocks'''
+        got = [vcf_tree_merge._vcf_file_chrom_blocks(os.path.join(data_dir, 'in.' + str(i) + '.vcf')) for i in range(1, 5)]
+        self.assertEqual([None, None], [got[0], got[3]])
+        self.assertEqual(['ref1', 'ref4'], [x[0] for x in got[1]])
+        self.assertEqual([('ref1', 105, 164), ('ref3', 74, 105)], got[2])
+
+
+    def test_stream_variants_from_vcf_file_blocks(self):
+        '''test _stream_variants_from_vcf_file_blocks'''
+        ref_seqs = vcf_tree_merge.LazyRefSeqs(os.path.join(data_dir, 'ref.fa'))
+        tmp_vcf = 'tmp.vcf_tree_merge.stream_variants.vcf'
+        # The second record moves from position 4 to 5 when normalised,
+        # which is after the third record. ref3 is before ref1 in the file
+        with open(tmp_vcf, 'w') as f:
+            print('##fileformat=VCFv4.2', file=f)
+            print('#CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO', sep='\t', file=f)
+            print('ref3', 1, '.', 'A', 'G', '.', 'PASS', '.', sep='\t', file=f)
+            print('ref1', 2, '.', 'C', 'T', '.', 'PASS', '.', sep='\t', file=f)
+            print('ref1', 4, '.', 'TACG', 'TA', '.', 'PASS', '.', sep='\t', file=f)
+            print('ref1', 5, '.', 'A', 'G', '.', 'PASS', '.', sep='\t', file=f)
+            print('ref1', 5, '.', 'ACG', 'AC', '.', 'PASS', '.', sep='\t', file=f)
+
+        for compress in False, True:
+            if compress:
+                pysam.tabix_compress(tmp_vcf, tmp_vcf + '.gz')
+                os.unlink(tmp_vcf)
+                tmp_vcf += '.gz'
+            blocks = vcf_tree_merge._vcf_file_chrom_blocks(tmp_vcf)
+            self.assertEqual(['ref1', 'ref3'], [x[0] for x in blocks])
+            expected = vcf_tree_merge._sorted_variants_from_vcf_file(tmp_vcf, ref_seqs)
+            got = list(vcf_tree_merge._stream_variants_from_vcf_file_blocks(tmp_vcf, ref_seqs, blocks))
+            self.assertEqual(expected, got)
+            self.assertEqual([('ref1', 1), ('ref1', 4), ('ref1', 4), ('ref1', 5), ('ref3', 0)], [x[:2] for x in got])
+        os.unlink(tmp_vcf)
+
+        for i in 2, 3:
+            infile = os.path.join(data_dir, 'in.' + str(i) + '.vcf')
+            expected = vcf_tree_merge._sorted_variants_from_vcf_file(infile, ref_seqs)
+            got = vcf_tree_merge._stream_variants_from_vcf_file_blocks(infile, ref_seqs, vcf_tree_merge._vcf_file_chrom_blocks(infile))
+            self.assertEqual(expected, list(got))
+
+
+    def test_merge_plan(self):
+        '''test merge_plan'''
+        self.assertEqual([1], vcf_tree_merge.merge_plan(0, 2))
+        self.assertEqual([1], vcf_tree_merge.merge_plan(2, 2))
+        self.assertEqual([2, 1], vcf_tree_merge.merge_plan(3, 2))
+        self.assertEqual([5, 3, 2, 1], vcf_tree_merge.merge_plan(9, 2))
+        self.assertEqual([2, 1], vcf_tree_merge.merge_plan(101, 100))
+
+
+    def test_merge_vcf_files(self):
+        '''test merge_vcf_files and merge_vcf_files_group'''
+        ref_fasta = os.path.join(data_dir, 'ref.fa')
+        infiles = [os.path.join(data_dir, 'in.' + str(i) + '.vcf') for i in range(1, 5)]
+        ref_seqs = {}
+        pyfastaq.tasks.file_to_dict(ref_fasta, ref_seqs)
+        tmp_expect = 'tmp.vcf_tree_merge.expect.vcf'
+        vcf_merge.merge_vcf_files(infiles, ref_seqs, tmp_expect)
+        expected = file_to_lines(tmp_expect)
+        os.unlink(tmp_expect)
+
+        tmp_out = 'tmp.vcf_tree_merge.out.vcf'
+        for group_size, threads in (2, 1), (3, 2), (100, 1):
+            vcf_tree_merge.merge_vcf_files(infiles, ref_fasta, tmp_out, group_size=group_size, threads=threads)
+            self.assertEqual(expected, file_to_lines(tmp_out))
+            os.unlink(tmp_out)
+        self.assertEqual([], [x for x in os.listdir() if x.startswith(tmp_out)])
+
+        # Temporary files should be deleted if the merge fails
+        with self.assertRaises(OSError):
+            vcf_tree_merge.merge_vcf_files(infiles + ['tmp.vcf_tree_merge.not_a_file.vcf'], ref_fasta, tmp_out, group_size=2)
+        self.assertEqual([], [x for x in os.listdir() if x.startswith(tmp_out)])
+
+        tmp_group1 = 'tmp.vcf_tree_merge.group.1.vcf'
+        tmp_group2 = 'tmp.vcf_tree_merge.group.2.vcf'
+        vcf_tree_merge.merge_vcf_files_group(infiles[:1], ref_fasta, tmp_group1)
+        vcf_tree_merge.merge_vcf_files_group(infiles[1:], ref_fasta, tmp_group2)
+        vcf_tree_merge.merge_vcf_files_group([tmp_group1, tmp_group2], ref_fasta, tmp_out, inputs_are_merged=True)
+        self.assertEqual(expected, file_to_lines(tmp_out))
+        for filename in tmp_group1, tmp_group2, tmp_out:
+            os.unlink(filename)
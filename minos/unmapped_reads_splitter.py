@@ -0,0 +1,237 @@
+import json
+import logging
+import os
+
+import numpy as np
+import pyfastaq
+import pysam
+
+from cluster_vcf_records import vcf_file_read
+
+from minos import bam_read_extract, vcf_chunker
+
+class Error (Exception): pass
+
+
+# Maps each byte to 2-bit nucleotide code A=0, C=1, G=2, T=3 (upper or
+# lower case). Anything else is 4
+nucleotide_codes = np.full(256, 4, dtype=np.uint64)
+for i, nucleotide in enumerate('ACGT'):
+    nucleotide_codes[ord(nucleotide)] = i
+    nucleotide_codes[ord(nucleotide.lower())] = i
+
+max_kmer_length = 32
+
+
+def _canonical_kmers(seq, kmer_length):
+    '''Returns tuple of numpy arrays (kmers, positions). kmers are the canonical
+    kmers (the smallest of the kmer and its reverse complement) in the
+    sequence, each 2-bit packed into one integer with the first nucleotide
+    in the highest bits, so that integer order is the same as alphabetical
+    order. positions are the 0-based start positions of the kmers in seq.
+    Kmers containing anything other than A,C,G,T are skipped'''
+    codes = nucleotide_codes[np.frombuffer(seq.encode(), dtype=np.uint8)]
+    total_kmers = len(codes) - kmer_length + 1
+    if total_kmers < 1:
+        return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64)
+
+    # Number of non-ACGT characters in the first i characters is bad_counts[i]
+    bad_counts = np.zeros(len(codes) + 1, dtype=np.int64)
+    np.cumsum(codes == 4, out=bad_counts[1:])
+    good = bad_counts[kmer_length:] == bad_counts[:total_kmers]
+
+    codes &= np.uint64(3)
+    two = np.uint64(2)
+    forward = np.zeros(total_kmers, dtype=np.uint64)
+    reverse = np.zeros(total_kmers, dtype=np.uint64)
+    for i in range(kmer_length):
+        forward = (forward << two) | codes[i:i + total_kmers]
+        reverse = (reverse << two) | (np.uint64(3) - codes[kmer_length - 1 - i:kmer_length - 1 - i + total_kmers])
+
+    positions = np.nonzero(good)[0]
+    return np.minimum(forward[positions], reverse[positions]), positions
+
+
+class UnmappedReadsSplitter:
+    '''Assigns each unmapped read from a sorted indexed BAM file to only the
+    split VCF files that share at least one kmer with the read, instead of
+    giving every split all of the unmapped reads. Kmers are taken from the
+    REF and ALT alleles of each split, with kmer_length - 1 flanking
+    reference nucleotides, because only reads that overlap an allele
+    can change the genotype calls. Kmers are 2-bit packed into integers,
+    and reads are k-merised batch_size reads at a time using numpy.
+    The per-split BAM files are kept in outdir, together with a manifest
+    file, so that a rerun on the same reads file and splits reuses them'''
+    def __init__(self, reads_file, ref_fasta, split_files, outdir, kmer_length=15, batch_size=10000):
+        if not 0 < kmer_length <= max_kmer_length:
+            raise Error('kmer_length must be in the range 1-' + str(max_kmer_length) + '. Got: ' + str(kmer_length))
+        self.reads_file = os.path.abspath(reads_file)
+        self.ref_fasta = os.path.abspath(ref_fasta)
+        self.split_files = split_files
+        self.outdir = os.path.abspath(outdir)
+        self.kmer_length = kmer_length
+        self.batch_size = batch_size
+        self.manifest_file = os.path.join(self.outdir, 'unmapped_reads.manifest.json')
+        self.split_reads_files = {} # split file number -> BAM filename
+
+
+    def _split_reads_filename(self, split_file):
+        return os.path.join(self.outdir, 'split.' + str(split_file.file_number) + '.unmapped_reads.bam')
+
+
+    def _manifest_data(self):
+        reads_stat = os.stat(self.reads_file)
+        return {
+            'reads_file': self.reads_file,
+            'reads_file_size': reads_stat.st_size,
+            'reads_file_mtime': reads_stat.st_mtime,
+            'kmer_length': self.kmer_length,
+            'kmers_from': 'alleles_and_flanks',
+            'splits': {str(x.file_number): [x.chrom, x.chrom_start, x.chrom_end, x.file_start_index, x.file_end_index] for x in self.split_files},
+        }
+
+
+    def _load_cached_files(self):
+        '''Returns True iff the manifest file exists, matches the reads file and
+        splits, and all the per-split files exist. If so, sets self.split_reads_files'''
+        if not os.path.exists(self.manifest_file):
+            return False
+
+        with open(self.manifest_file) as f:
+            manifest = json.load(f)
+
+        if manifest.get('inputs', None) != self._manifest_data():
+            logging.info('Unmapped reads manifest file ' + self.manifest_file + ' does not match current reads file and splits. Remaking per-split unmapped reads files')
+            return False
+
+        split_reads_files = {int(k): v for k, v in manifest['split_reads_files'].items()}
+        if not all([os.path.exists(x) for x in split_reads_files.values()]):
+            return False
+
+        self.split_reads_files = split_reads_files
+        return True
+
+
+    @classmethod
+    def _kmers_from_split_file(cls, split_file, ref_seq, kmer_length):
+        '''Returns numpy array of the unique canonical kmers from the REF and ALT
+        alleles in the split VCF file, each with kmer_length - 1 flanking
+        reference nucleotides either side. ref_seq is the whole
+        reference sequence, even if the reference is sliced for the split'''
+        header_lines, vcf_records = vcf_file_read.vcf_file_to_list(split_file.filename)
+        vcf_chunker.VcfChunker.shift_split_vcf_records_to_ref(split_file, vcf_records)
+        allele_seqs = []
+        for vcf_record in vcf_records:
+            left_flank = ref_seq[max(0, vcf_record.POS - kmer_length + 1):vcf_record.POS]
+            right_flank = ref_seq[vcf_record.ref_end_pos() + 1:vcf_record.ref_end_pos() + kmer_length]
+            for allele in [vcf_record.REF] + vcf_record.ALT:
+                allele_seqs.append(left_flank + allele + right_flank)
+
+        # Separating the sequences with N means no kmer spans two of them
+        kmers, positions = _canonical_kmers('N'.join(allele_seqs), kmer_length)
+        return np.unique(kmers)
+
+
+    def _make_kmer_index(self):
+        '''Returns tuple of numpy arrays (kmers, split file numbers), sorted
+        by kmer. There is one element per kmer and split that contains it'''
+        ref_seqs = {}
+        pyfastaq.tasks.file_to_dict(self.ref_fasta, ref_seqs)
+        ref_seqs = {k.split()[0]: v.seq for k, v in ref_seqs.items()}
+        kmers = []
+        split_numbers = []
+
+        for split_file in self.split_files:
+            if split_file.chrom not in ref_seqs:
+                raise Error('Sequence ' + split_file.chrom + ' from split VCF file ' + split_file.filename + ' not found in reference FASTA file ' + self.ref_fasta)
+            split_kmers = UnmappedReadsSplitter._kmers_from_split_file(split_file, ref_seqs[split_file.chrom], self.kmer_length)
+            kmers.append(split_kmers)
+            split_numbers.append(np.full(len(split_kmers), split_file.file_number, dtype=np.int64))
+
+        if len(kmers) == 0:
+            return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64)
+        kmers = np.concatenate(kmers)
+        split_numbers = np.concatenate(split_numbers)
+        order = np.argsort(kmers, kind='stable')
+        return kmers[order], split_numbers[order]
+
+
+    @classmethod
+    def _split_numbers_for_seqs(cls, seqs, kmer_index, kmer_length):
+        '''Returns list of sets of split file numbers, one set per sequence in
+        seqs, of the splits that share at least one kmer with the sequence.
+        kmer_index should be made by _make_kmer_index(). All the sequences
+        are k-merised together, which is much faster than one at a time'''
+        index_kmers, index_split_numbers = kmer_index
+        seq_starts = np.cumsum([0] + [len(x) + 1 for x in seqs[:-1]])
+        kmers, positions = _canonical_kmers('N'.join(seqs), kmer_length)
+        starts = np.searchsorted(index_kmers, kmers, side='left')
+        ends = np.searchsorted(index_kmers, kmers, side='right')
+        hits = np.nonzero(ends > starts)[0]
+        seq_indexes = np.searchsorted(seq_starts, positions[hits], side='right') - 1
+        split_numbers = [set() for x in seqs]
+        for seq_index, start, end in zip(seq_indexes, starts[hits], ends[hits]):
+            split_numbers[seq_index].update(index_split_numbers[start:end].tolist())
+        return split_numbers
+
+
+    def _write_split_reads_files(self, unmapped_reads_file, kmer_index):
+        reads_in = pysam.AlignmentFile(unmapped_reads_file, 'rb')
+        reads_out = {}
+        for split_file in self.split_files:
+            self.split_reads_files[split_file.file_number] = self._split_reads_filename(split_file)
+            reads_out[split_file.file_number] = pysam.AlignmentFile(self.split_reads_files[split_file.file_number], 'wb', template=reads_in)
+
+        total_reads = 0
+        total_assigned = 0
+        batch = []
+
+        def write_batch():
+            nonlocal total_assigned
+            for read, split_numbers in zip(batch, UnmappedReadsSplitter._split_numbers_for_seqs([x.query_sequence for x in batch], kmer_index, self.kmer_length)):
+                for split_number in split_numbers:
+                    reads_out[split_number].write(read)
+                total_assigned += len(split_numbers)
+            batch.clear()
+
+        for read in reads_in.fetch(until_eof=True):
+            total_reads += 1
+            if read.query_sequence is None:
+                continue
+            batch.append(read)
+            if len(batch) >= self.batch_size:
+                write_batch()
+
+        if len(batch) > 0:
+            write_batch()
+
+        reads_in.close()
+        for f in reads_out.values():
+            f.close()
+
+        logging.info('Assigned ' + str(total_reads) + ' unmapped reads to splits. Total reads written across all splits: ' + str(total_assigned) + ', compared to ' + str(total_reads * len(self.split_files)) + ' without kmer filtering')
+
+
+    def run(self):
+        if self._load_cached_files():
+            logging.info('Using existing per-split unmapped reads files from ' + self.outdir)
+            return
+
+        if not os.path.exists(self.outdir):
+            os.mkdir(self.outdir)
+
+        unmapped_reads_file = os.path.join(self.outdir, 'unmapped_reads.bam')
+        logging.info('Extracting unmapped reads to ' + unmapped_reads_file)
+        bam_read_extract.get_unmapped_reads(self.reads_file, unmapped_reads_file)
+        logging.info('Making kmer index of ' + str(len(self.split_files)) + ' split VCF files, using kmer length ' + str(self.kmer_length))
+        kmer_index = self._make_kmer_index()
+        logging.info('Finished making kmer index. Total kmers: ' + str(len(kmer_index[0])))
+        self._write_split_reads_files(unmapped_reads_file, kmer_index)
+        os.unlink(unmapped_reads_file)
+
+        with open(self.manifest_file, 'w') as f:
+            manifest = {
+                'inputs': self._manifest_data(),
+                'split_reads_files': {str(k): v for k, v in self.split_reads_files.items()},
+            }
+            json.dump(manifest, f, indent=2, sort_keys=True)
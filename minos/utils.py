@@ -1,11 +1,25 @@
+import hashlib
+import json
+import logging
+import math
+import multiprocessing
+import os
+import resource
 import subprocess
 import sys
 
+import numpy as np
 import pyfastaq
 import pysam
 
 class Error (Exception): pass
 
+def peak_child_ram_gb():
+    '''Returns the peak RSS in GB of the biggest child process of this
+    process that has finished (ru_maxrss is in KB on Linux)'''
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024**2
+
+
 def syscall(command, allow_fail=False):
     completed_process = subprocess.run(command, shell=True, stderr=subprocess.PIPE, stdout=subprocess.PIPE, universal_newlines=True)
     if (not allow_fail) and completed_process.returncode != 0:
@@ -18,51 +32,229 @@ def syscall(command, allow_fail=False):
     return completed_process
 
 
-def estimate_max_read_length_and_read_error_rate_from_qual_scores(infile, number_of_reads=10000):
+def _qual_stats_from_reads(reads, number_of_reads):
+    '''Returns tuple (max read length, sum of quality scores, number of bases
+    with quality scores, number of reads), using up to number_of_reads from
+    the iterator of pysam reads. Secondary and supplementary alignments are skipped'''
+    max_read_length = 0
+    read_count = 0
+    quals = []
+
+    for read in reads:
+        if read.is_secondary or read.is_supplementary:
+            continue
+        read_count += 1
+        if read_count > number_of_reads:
+            read_count -= 1
+            break
+        max_read_length = max(max_read_length, read.query_length)
+        if read.query_qualities is not None:
+            quals.append(np.asarray(read.query_qualities, dtype=np.uint8))
+
+    if len(quals) == 0:
+        return max_read_length, 0, 0, read_count
+
+    quals = np.concatenate(quals)
+    return max_read_length, int(quals.sum(dtype=np.uint64)), len(quals), read_count
+
+
+def _qual_stats_from_bam_regions(infile, regions, reads_per_region):
+    '''Returns same as _qual_stats_from_reads, but combined across all the
+    regions. regions = list of (reference name, position) tuples, and
+    reads_per_region reads are taken starting from each position'''
+    max_read_length = 0
+    total = 0
+    base_count = 0
+    read_count = 0
+
+    with pysam.AlignmentFile(infile) as f:
+        for ref_name, position in regions:
+            stats = _qual_stats_from_reads(f.fetch(ref_name, position), reads_per_region)
+            max_read_length = max(max_read_length, stats[0])
+            total += stats[1]
+            base_count += stats[2]
+            read_count += stats[3]
+
+    return max_read_length, total, base_count, read_count
+
+
+def _sample_regions_from_bam_header(ref_names, ref_lengths, number_of_regions):
+    '''Returns list of (reference name, position) tuples, evenly spaced
+    across all of the reference sequences'''
+    genome_length = sum(ref_lengths)
+    if genome_length == 0:
+        return []
+
+    ref_offsets = np.cumsum([0] + list(ref_lengths))
+    regions = []
+    for i in range(number_of_regions):
+        genome_position = int((i + 0.5) * genome_length / number_of_regions)
+        ref_index = int(np.searchsorted(ref_offsets, genome_position, side='right')) - 1
+        region = (ref_names[ref_index], genome_position - int(ref_offsets[ref_index]))
+        if len(regions) == 0 or regions[-1] != region:
+            regions.append(region)
+    return regions
+
+
+def _read_stats_cache_data(infile, number_of_reads, number_of_regions):
+    file_stat = os.stat(infile)
+    return {
+        'reads_file': os.path.abspath(infile),
+        'reads_file_size': file_stat.st_size,
+        'reads_file_mtime': file_stat.st_mtime,
+        'number_of_reads': number_of_reads,
+        'number_of_regions': number_of_regions,
+    }
+
+
+def _read_stats_cache_file(cache_dir, infile):
+    '''Returns name of the read stats cache file for infile in cache_dir.
+    The name includes a hash of the absolute path of infile, so that one
+    directory can be shared by many samples whose reads files have the same name'''
+    path_hash = hashlib.sha1(os.path.abspath(infile).encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, os.path.basename(infile) + '.' + path_hash + '.minos_read_stats.json')
+
+
+def estimate_read_length_and_error_rate_sampled(infile, number_of_reads=10000, number_of_regions=100, threads=1, cache_dir=None):
     '''Estimates the maximum read length, and error rate from a file of reads, using the
     quality scores. Calculated by converting the mean phred quality score
     into the probability (formula is P = 10 ^ (- mean qual / 10)).
     Returns a tuple max_read_length, error_rate.
-    Error rate is None if no quality
-    scores found. Uses the first number_of_reads found in the file.
-    File type can be BAM, SAM, FASTQ and is auto detected'''
-    try:
-        f = pysam.AlignmentFile(infile)
-        filetype = 'pysam'
-    except ValueError:
-        f = pyfastaq.sequences.file_reader(infile)
-        filetype = 'fastaq'
-    except:
-        raise Error('Error opening file ' + infile)
+    Error rate is None if no quality scores found.
+    File type can be BAM, CRAM, SAM, FASTQ, FASTA and is auto detected.
+    If infile is a sorted indexed BAM/CRAM file, then reads are sampled from
+    number_of_regions evenly spaced positions across the genome, instead of
+    only using the first reads in the file. The regions are shared between
+    a pool of "threads" worker processes, each of which opens the reads file.
+    These are processes, not threads, because iterating over the reads is
+    mostly python, which would be serialised by the GIL. Otherwise, uses the first number_of_reads in
+    the file, with threads used by pysam to decompress BAM/CRAM.
+    If cache_dir is given, then the result is saved in a file in that
+    directory, and is reused on the next call if infile has not changed.
+    Nothing is written next to infile, which can be in a read-only directory'''
+    cache_file = None if cache_dir is None else _read_stats_cache_file(cache_dir, infile)
+    cache_data = _read_stats_cache_data(infile, number_of_reads, number_of_regions)
+
+    if cache_file is not None and os.path.exists(cache_file):
+        with open(cache_file) as f:
+            cached = json.load(f)
+        if cached.get('inputs', None) == cache_data:
+            logging.info('Using read length and error rate from cache file ' + cache_file)
+            return cached['max_read_length'], cached['read_error_rate']
 
+    max_read_length = 0
     total = 0
     base_count = 0
-    read_count = 0
-    max_read_length = 0
 
-    for sequence in f:
-        read_count += 1
-        if read_count > number_of_reads:
-            break
+    try:
+        f = pysam.AlignmentFile(infile, threads=threads)
+    except ValueError:
+        f = None
 
-        if filetype == 'pysam':
-            max_read_length = max(max_read_length, sequence.query_length)
-            if sequence.query_qualities is not None:
-                for qual_score in sequence.query_qualities:
-                    total += qual_score
-                base_count += len(sequence.query_qualities)
-        else:
+    if f is None:
+        for sequence in pyfastaq.sequences.file_reader(infile):
+            number_of_reads -= 1
+            if number_of_reads < 0:
+                break
             max_read_length = max(max_read_length, len(sequence))
-            if type(sequence) != pyfastaq.sequences.Fastq:
-                continue
+            if type(sequence) == pyfastaq.sequences.Fastq:
+                quals = np.frombuffer(sequence.qual.encode(), dtype=np.uint8)
+                total += int(quals.sum(dtype=np.uint64)) - 33 * len(quals)
+                base_count += len(quals)
+    else:
+        regions = []
+        if f.has_index():
+            regions = _sample_regions_from_bam_header(f.references, f.lengths, number_of_regions)
+
+        read_count = 0
+        if len(regions) > 0:
+            f.close()
+            reads_per_region = math.ceil(number_of_reads / len(regions))
+            processes = min(threads, len(regions))
+            # Daemonic processes (eg workers of minos adjudicate_batch) cannot
+            # start child processes
+            if multiprocessing.current_process().daemon:
+                processes = 1
+            region_lists = [regions[i::processes] for i in range(processes)]
+            if processes == 1:
+                all_stats = [_qual_stats_from_bam_regions(infile, region_lists[0], reads_per_region)]
+            else:
+                with multiprocessing.Pool(processes) as pool:
+                    all_stats = pool.starmap(_qual_stats_from_bam_regions, [(infile, x, reads_per_region) for x in region_lists])
+            max_read_length = max([x[0] for x in all_stats])
+            total = sum([x[1] for x in all_stats])
+            base_count = sum([x[2] for x in all_stats])
+            read_count = sum([x[3] for x in all_stats])
+
+        # Could be no mapped reads, or not indexed. Either way, use
+        # the reads from the start of the file instead
+        if read_count == 0:
+            if len(regions) > 0:
+                f = pysam.AlignmentFile(infile, threads=threads)
+            max_read_length, total, base_count, read_count = _qual_stats_from_reads(f.fetch(until_eof=True), number_of_reads)
+            f.close()
+
+    error_rate = None if base_count == 0 else pow(10, -(total / base_count) / 10)
 
-            for qual_score in [ord(x) - 33 for x in sequence.qual]:
-                total += qual_score
-            base_count += len(sequence)
+    if cache_file is not None:
+        # Write to a temporary file and rename, so that another process
+        # sharing the cache directory never reads a partly written file
+        tmp_cache_file = cache_file + '.tmp.' + str(os.getpid())
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(tmp_cache_file, 'w') as f:
+                json.dump({'inputs': cache_data, 'max_read_length': max_read_length, 'read_error_rate': error_rate}, f, indent=2, sort_keys=True)
+            os.rename(tmp_cache_file, cache_file)
+        except OSError:
+            logging.warning('Could not write read stats cache file ' + cache_file)
 
-    if base_count == 0:
-        return max_read_length, None
+    return max_read_length, error_rate
 
-    mean_qual_score = total / base_count
-    return max_read_length, pow(10, -mean_qual_score / 10)
 
+def parse_region_string(region):
+    '''Parses region string of the form "chrom:start-end" (1-based, inclusive,
+    as used by samtools). Returns tuple (chrom, start, end), 0-based inclusive'''
+    try:
+        chrom, coords = region.rsplit(':', maxsplit=1)
+        start, end = [int(x.replace(',', '')) - 1 for x in coords.split('-')]
+    except:
+        raise Error('Error parsing region "' + region + '". Must be of the form chrom:start-end')
+
+    if chrom == '' or start < 0 or end < start:
+        raise Error('Error parsing region "' + region + '". Must be of the form chrom:start-end, with 1 <= start <= end')
+    return chrom, start, end
+
+
+def load_regions_bed_file(infile):
+    '''Returns list of regions (chrom, start, end), 0-based inclusive,
+    from a BED file'''
+    regions = []
+    with open(infile) as f:
+        for line in f:
+            if line.strip() == '' or line.startswith('#') or line.startswith('track') or line.startswith('browser'):
+                continue
+            fields = line.rstrip('\n').split('\t')
+            try:
+                chrom, start, end = fields[0], int(fields[1]), int(fields[2]) - 1
+            except:
+                raise Error('Error reading BED file ' + infile + '. Bad line: ' + line.rstrip())
+            if start < 0 or end < start:
+                raise Error('Error reading BED file ' + infile + '. Bad coordinates in line: ' + line.rstrip())
+            regions.append((chrom, start, end))
+    return regions
+
+
+def merge_regions(regions, flank=0):
+    '''Returns dict of chrom -> sorted list of (start, end) that is the union
+    of the regions (each a tuple (chrom, start, end), 0-based inclusive),
+    after adding flank to both ends of each region. Overlapping and touching
+    regions are merged together'''
+    merged = {}
+    for chrom, start, end in sorted(regions):
+        start = max(0, start - flank)
+        end += flank
+        if chrom in merged and start <= merged[chrom][-1][1] + 1:
+            merged[chrom][-1] = (merged[chrom][-1][0], max(end, merged[chrom][-1][1]))
+        else:
+            merged.setdefault(chrom, []).append((start, end))
+    return merged
@@ -1,13 +1,19 @@
+import bisect
 from collections import namedtuple
+import copy
 import itertools
 import logging
 import multiprocessing
 import os
 import pickle
+import shutil
+import time
 
 import cluster_vcf_records
+import pyfastaq
+import pysam
 
-from minos import gramtools
+from minos import gramtools, utils
 
 class Error (Exception): pass
 
@@ -23,18 +29,146 @@ split_file_attributes = [
     'use_start_index',
     'use_end_index',
     'gramtools_build_dir',
+    'ref_fasta', # None, unless the reference was sliced for this split
 ]
-SplitFile = namedtuple('SplitFile', split_file_attributes)
+SplitFile = namedtuple('SplitFile', split_file_attributes, defaults=[None])
+
+
+# Fallback model of the peak RAM (in GB) used by gramtools build and quasimap
+# on a VCF file, as a function of the number of alleles (REF plus ALTs) in
+# the VCF file. It is a tuple (intercept in GB, GB per allele), and is used
+# to choose split sizes from a RAM target, and to decide whether
+# adjudicate needs to split the VCF file.
+# These numbers are not fitted to measurements. They are a rough guess of
+# gramtools using about 0.5GB with a small graph, plus about 50KB for each
+# allele. They are only used when no model is given. A model fitted to real
+# runs can be used instead: VcfChunker saves the peak RAM of each gramtools
+# build in the build's report file, and cost_estimator.calibrate_cost_model()
+# fits its "build_ram" model to those (see the --gramtools_ram_calibration_dir
+# and --gramtools_ram_model options)
+default_gramtools_ram_model = (0.5, 0.00005)
+
+
+def estimate_gramtools_ram(total_alleles, ram_model=None):
+    '''Returns estimated RAM in GB needed by gramtools for a VCF file
+    with the given total number of alleles. ram_model = tuple (intercept,
+    GB per allele). Default is default_gramtools_ram_model'''
+    intercept, ram_per_allele = default_gramtools_ram_model if ram_model is None else ram_model
+    return intercept + ram_per_allele * total_alleles
+
+
+def max_alleles_for_ram(ram, ram_model=None):
+    '''Returns the maximum number of alleles that gramtools can handle
+    using the given RAM in GB, according to estimate_gramtools_ram()'''
+    intercept, ram_per_allele = default_gramtools_ram_model if ram_model is None else ram_model
+    if ram <= intercept:
+        raise Error('RAM target of ' + str(ram) + 'GB is too small. Must be more than ' + str(intercept) + 'GB')
+    if ram_per_allele <= 0:
+        raise Error('GB per allele of gramtools RAM model must be more than zero. Got ' + str(ram_per_allele))
+    return max(1, int((ram - intercept) / ram_per_allele))
+
+
+# Functions that predict the cost of running gramtools on each VCF record,
+# used to choose where to split the VCF file so that each split has the
+# same predicted cost. Each function takes a dict of ref name -> list of
+# VcfRecords, plus a reads file (sorted indexed BAM, which may be None
+# if not needed by the function). Returns dict of ref name -> list of costs
+# of each record. New cost functions can be added to split_cost_functions
+def alleles_cost(vcf_records, reads_file):
+    '''Number of alleles (this is the same as using alleles_per_split)'''
+    return {ref: [1 + len(x.ALT) for x in records] for ref, records in vcf_records.items()}
+
+
+def allele_lengths_cost(vcf_records, reads_file):
+    '''Total length of all the alleles. Long alleles, with
+    more kmers, cost more to build than SNPs'''
+    return {ref: [len(x.REF) + sum([len(y) for y in x.ALT]) for x in records] for ref, records in vcf_records.items()}
+
+
+def read_counts_cost(vcf_records, reads_file, bin_size=10000):
+    '''Reads counted from a coarse scan of the BAM file, using bins of length
+    bin_size. The reads in each bin are shared equally between the
+    records in the bin. Only bins that have at least one record are scanned'''
+    if reads_file is None:
+        raise Error('Reads file needed to calculate read counts split cost')
+    samfile = pysam.AlignmentFile(reads_file, 'rb')
+    costs = {}
+    for ref, records in vcf_records.items():
+        records_per_bin = {}
+        for record in records:
+            records_per_bin[record.POS // bin_size] = records_per_bin.get(record.POS // bin_size, 0) + 1
+        reads_per_record = {}
+        for bin_number, record_count in records_per_bin.items():
+            reads = samfile.count(ref, bin_number * bin_size, (bin_number + 1) * bin_size) if ref in samfile.references else 0
+            reads_per_record[bin_number] = reads / record_count
+        costs[ref] = [reads_per_record[x.POS // bin_size] for x in records]
+    samfile.close()
+    return costs
+
+
+def allele_lengths_and_reads_cost(vcf_records, reads_file):
+    '''allele_lengths_cost (for gramtools build) plus read_counts_cost (for
+    quasimap), each normalised to sum to 1 across all records, so that build
+    and quasimap have equal weight'''
+    costs = {}
+    for cost_function in allele_lengths_cost, read_counts_cost:
+        function_costs = cost_function(vcf_records, reads_file)
+        total = sum([sum(x) for x in function_costs.values()])
+        for ref, ref_costs in function_costs.items():
+            if ref not in costs:
+                costs[ref] = [0] * len(ref_costs)
+            if total > 0:
+                costs[ref] = [x + y / total for x, y in zip(costs[ref], ref_costs)]
+    return costs
+
+
+split_cost_functions = {
+    'alleles': alleles_cost,
+    'allele_lengths': allele_lengths_cost,
+    'allele_lengths_and_reads': allele_lengths_and_reads_cost,
+    'reads': read_counts_cost,
+}
 
 
 def _run_gramtools_build(split_file, ref_fasta, max_read_length, kmer_size):
+    '''Runs gramtools build on one split file. Returns tuple
+    (split file number, error message, wall clock seconds). Error
+    message is None if the build ran successfully'''
     logging.info('Start gramtools build ' + split_file.filename)
-    gramtools.run_gramtools_build(split_file.gramtools_build_dir, split_file.filename, ref_fasta, max_read_length, kmer_size)
+    if split_file.ref_fasta is not None:
+        ref_fasta = split_file.ref_fasta
+    start_time = time.time()
+    previous_peak_ram = utils.peak_child_ram_gb()
+    try:
+        gramtools.run_gramtools_build(split_file.gramtools_build_dir, split_file.filename, ref_fasta, max_read_length, kmer_size)
+    except Exception as e:
+        logging.error('Error running gramtools build on split file ' + split_file.filename + ': ' + str(e))
+        return split_file.file_number, str(e), round(time.time() - start_time, 2)
+
+    wall_clock_seconds = round(time.time() - start_time, 2)
+    total_variants, total_alleles = VcfChunker._total_variants_and_alleles_in_vcf_file(split_file.filename)
+    stats = {
+        'step': 'build',
+        'wall_clock_seconds': wall_clock_seconds,
+        'total_variants': total_variants,
+        'total_alleles': total_alleles,
+    }
+    # The peak RAM of child processes is only known to be from this build if
+    # it went up. Otherwise, an earlier child of this process used more RAM
+    peak_ram = utils.peak_child_ram_gb()
+    if peak_ram > previous_peak_ram:
+        stats['peak_ram_gb'] = round(peak_ram, 3)
+    gramtools.add_minos_stats_to_report(os.path.join(split_file.gramtools_build_dir, 'build_report.json'), stats)
     logging.info('Finish gramtools build ' + split_file.filename)
+    return split_file.file_number, None, wall_clock_seconds
+
+
+def _run_gramtools_build_from_tuple(build_args):
+    return _run_gramtools_build(*build_args)
 
 
 class VcfChunker:
-    def __init__(self, outdir, vcf_infile=None, ref_fasta=None, variants_per_split=None, max_read_length=200, total_splits=100, flank_length=200, gramtools_kmer_size=10, alleles_per_split=None, threads=1):
+    def __init__(self, outdir, vcf_infile=None, ref_fasta=None, variants_per_split=None, max_read_length=200, total_splits=100, flank_length=200, gramtools_kmer_size=10, alleles_per_split=None, threads=1, target_ram_per_split=None, split_cost=None, reads_file=None, slice_reference=False, gramtools_ram_model=None, split_at_gaps=False):
         self.outdir = os.path.abspath(outdir)
         self.metadata_pickle = os.path.join(self.outdir, 'data.pickle')
         self.threads = threads
@@ -51,6 +185,12 @@ class VcfChunker:
             self.variants_per_split = variants_per_split
             self.alleles_per_split = alleles_per_split
             self.total_splits = total_splits
+            self.target_ram_per_split = target_ram_per_split
+            self.gramtools_ram_model = None if gramtools_ram_model is None else tuple(gramtools_ram_model)
+            self.split_cost = split_cost
+            self.reads_file = None if reads_file is None else os.path.abspath(reads_file)
+            self.slice_reference = slice_reference
+            self.split_at_gaps = split_at_gaps
             self.flank_length = flank_length
             self.gramtools_kmer_size = gramtools_kmer_size
             self.max_read_length = max_read_length
@@ -59,6 +199,11 @@ class VcfChunker:
                 raise Error('VCF file not found: ' + self.vcf_infile)
             if not os.path.exists(self.ref_fasta):
                 raise Error('Reference FASTA file not found: ' + self.ref_fasta)
+            if self.split_cost is not None:
+                if self.split_cost not in split_cost_functions:
+                    raise Error('Unknown split_cost "' + str(self.split_cost) + '". Must be one of: ' + ', '.join(sorted(split_cost_functions)))
+                if not (self.variants_per_split is None and self.alleles_per_split is None and self.target_ram_per_split is None):
+                    raise Error('split_cost can only be used with total_splits, not variants_per_split, alleles_per_split or target_ram_per_split')
 
             try:
                 os.mkdir(self.outdir)
@@ -66,6 +211,7 @@ class VcfChunker:
                 raise Error('Error mkdir ' + self.outdir)
 
             self.vcf_split_files = {} # ref name -> list of SplitFile
+            self.build_seconds = {} # split file number -> gramtools build wall clock seconds
 
 
     def _save_metadata(self):
@@ -75,15 +221,27 @@ class VcfChunker:
             'variants_per_split': self.variants_per_split,
             'alleles_per_split': self.alleles_per_split,
             'total_splits': self.total_splits,
+            'target_ram_per_split': self.target_ram_per_split,
+            'gramtools_ram_model': self.gramtools_ram_model,
+            'split_cost': self.split_cost,
+            'reads_file': self.reads_file,
+            'slice_reference': self.slice_reference,
+            'split_at_gaps': self.split_at_gaps,
             'flank_length': self.flank_length,
             'gramtools_kmer_size': self.gramtools_kmer_size,
             'max_read_length': self.max_read_length,
             'total_split_files': self.total_split_files,
             'split_files': self.vcf_split_files,
             'total_input_records': self.total_input_records,
+            'build_seconds': self.build_seconds,
         }
-        with open(self.metadata_pickle, 'wb') as f:
+        # Written to a new file that replaces the old one, instead of
+        # overwriting the old file, because the directory can be a copy
+        # made with hard links that shares the file with the original
+        tmp_pickle = self.metadata_pickle + '.tmp'
+        with open(tmp_pickle, 'wb') as f:
             pickle.dump(metadata, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_pickle, self.metadata_pickle)
 
 
     def _load_existing_data(self):
@@ -95,22 +253,45 @@ class VcfChunker:
         self.variants_per_split = metadata['variants_per_split']
         self.alleles_per_split = metadata['alleles_per_split']
         self.total_splits = metadata['total_splits']
+        self.target_ram_per_split = metadata.get('target_ram_per_split', None)
+        self.gramtools_ram_model = metadata.get('gramtools_ram_model', None)
+        self.split_cost = metadata.get('split_cost', None)
+        self.reads_file = metadata.get('reads_file', None)
+        self.slice_reference = metadata.get('slice_reference', False)
+        self.split_at_gaps = metadata.get('split_at_gaps', False)
         self.flank_length = metadata['flank_length']
         self.gramtools_kmer_size = metadata['gramtools_kmer_size']
         self.max_read_length = metadata['max_read_length']
         self.total_split_files = metadata['total_split_files']
-        self.vcf_split_files = metadata['split_files']
+        self.vcf_split_files = {k: [VcfChunker._move_split_file(x, self.outdir) for x in v] for k, v in metadata['split_files'].items()}
         self.total_input_records = metadata['total_input_records']
+        self.build_seconds = metadata.get('build_seconds', {})
         logging.info('Loaded existing data from chunked VCF directory ' + self.outdir)
 
 
     @classmethod
-    def _chunk_end_indexes_from_vcf_record_list(cls, record_list, start_index, flank_length, total_sites=None, total_alleles=None):
+    def _move_split_file(cls, split_file, outdir):
+        '''Returns split_file, with its paths changed to be in outdir. The
+        paths are saved in the metadata as absolute paths, so need
+        changing if the directory was moved or copied'''
+        return split_file._replace(
+            filename=os.path.join(outdir, os.path.basename(split_file.filename)),
+            gramtools_build_dir=os.path.join(outdir, os.path.basename(split_file.gramtools_build_dir)),
+            ref_fasta=None if split_file.ref_fasta is None else os.path.join(outdir, os.path.basename(split_file.ref_fasta)),
+        )
+
+
+    @classmethod
+    def _chunk_end_indexes_from_vcf_record_list(cls, record_list, start_index, flank_length, total_sites=None, total_alleles=None, total_cost=None, record_costs=None):
         '''Returns tuple of:
            1. last index of VCF record that we want to use for variant calling
            2. index of last variant in the chunk, which can't be used for variant calling
-              but should end up in the gramtools graph'''
-        assert total_sites != total_alleles and (total_sites is not None or total_alleles is not None)
+              but should end up in the gramtools graph
+        Exactly one of total_sites, total_alleles, total_cost must be given.
+        If total_cost is used, then record_costs must be a list of the
+        cost of each record in record_list'''
+        assert [total_sites, total_alleles, total_cost].count(None) == 2
+        assert total_cost is None or record_costs is not None
         file_start_index = start_index
         while file_start_index > 0:
             distance_to_previous_variant = record_list[start_index].POS - record_list[file_start_index - 1].ref_end_pos()
@@ -120,13 +301,20 @@ class VcfChunker:
 
         if total_sites is not None:
             use_vcf_end_index = min(start_index + total_sites - 1, len(record_list) - 1)
-        else:
+        elif total_alleles is not None:
             use_vcf_end_index = start_index
             alleles = 1 + len(record_list[start_index].ALT)
             while use_vcf_end_index < len(record_list) - 1 and alleles <= total_alleles:
                 use_vcf_end_index += 1
                 alleles += 1 + len(record_list[use_vcf_end_index].ALT)
             use_vcf_end_index = max(start_index, use_vcf_end_index - 1)
+        else:
+            use_vcf_end_index = start_index
+            cost = record_costs[start_index]
+            while use_vcf_end_index < len(record_list) - 1 and cost <= total_cost:
+                use_vcf_end_index += 1
+                cost += record_costs[use_vcf_end_index]
+            use_vcf_end_index = max(start_index, use_vcf_end_index - 1)
 
         if use_vcf_end_index == len(record_list) - 1:
             return file_start_index, use_vcf_end_index, use_vcf_end_index
@@ -142,6 +330,196 @@ class VcfChunker:
         return file_start_index, use_vcf_end_index, min(file_end_index, len(record_list) - 1)
 
 
+    @classmethod
+    def _split_indexes_from_vcf_record_stream(cls, records, flank_length, total_sites=None, total_alleles=None, total_cost=None, record_costs=None):
+        '''Streaming version of _chunk_end_indexes_from_vcf_record_list, which
+        makes the same splits. records = iterable of the VcfRecords of
+        one reference sequence, sorted by position. Only a window of records
+        is kept in memory: from the start of the current split's left flank
+        up to the last record read. Flank boundaries are found using bisect
+        on the positions of the records in the window.
+        Yields a tuple for each split: (file start index, use start index,
+        use end index, file end index, list of records from file start
+        to file end index)'''
+        assert [total_sites, total_alleles, total_cost].count(None) == 2
+        assert total_cost is None or record_costs is not None
+        window = []
+        positions = [] # POS of each record in window
+        offset = 0 # index of window[0] in the whole list of records
+        use_start = 0
+        use_end = None
+        cost = 0
+        next_to_count = 0
+        finished = False
+        records = iter(records)
+
+        while not finished:
+            record = next(records, None)
+            if record is None:
+                finished = True
+            else:
+                window.append(record)
+                positions.append(record.POS)
+            last_index = offset + len(window) - 1
+
+            while use_start <= last_index:
+                while use_end is None and next_to_count <= last_index:
+                    if total_sites is not None:
+                        if next_to_count - use_start + 1 == total_sites:
+                            use_end = next_to_count
+                    else:
+                        if total_alleles is not None:
+                            cost += 1 + len(window[next_to_count - offset].ALT)
+                        else:
+                            cost += record_costs[next_to_count]
+                        if cost > (total_cost if total_alleles is None else total_alleles):
+                            use_end = max(use_start, next_to_count - 1)
+                    next_to_count += 1
+
+                if use_end is None:
+                    if not finished:
+                        break
+                    elif total_sites is not None or use_start == last_index:
+                        use_end = last_index
+                    else:
+                        use_end = last_index - 1
+
+                end_record = window[use_end - offset]
+                file_end_window_index = bisect.bisect_right(positions, end_record.ref_end_pos() + flank_length) - 1
+                if file_end_window_index == len(window) - 1 and not finished:
+                    break
+                file_end = offset + file_end_window_index
+
+                # Records before the window are all too far away to be
+                # in the left flank, because they were too far away
+                # from the previous split
+                start_record = window[use_start - offset]
+                min_end = start_record.POS - flank_length
+                file_start = min(use_start, offset + bisect.bisect_left(positions, min_end))
+                while file_start > offset and window[file_start - offset - 1].ref_end_pos() >= min_end:
+                    file_start -= 1
+
+                yield file_start, use_start, use_end, file_end, window[file_start - offset:file_end - offset + 1]
+                del window[:file_start - offset]
+                del positions[:file_start - offset]
+                offset = file_start
+                use_start = use_end + 1
+                use_end = None
+                cost = 0
+                next_to_count = use_start
+
+
+    @classmethod
+    def _split_use_count(cls, record_list, start_index, use_count, variants_per_split=None, alleles_per_split=None):
+        '''Returns the number of records, starting at start_index in
+        record_list, to use in one split when there are use_count records
+        left to put in splits. This is all use_count records, unless that
+        would be more than variants_per_split or alleles_per_split (if given).
+        Always at least one record'''
+        if variants_per_split is not None:
+            return min(use_count, variants_per_split)
+        elif alleles_per_split is None:
+            return use_count
+
+        count = 1
+        alleles = 1 + len(record_list[start_index].ALT)
+        while count < use_count:
+            alleles += 1 + len(record_list[start_index + count].ALT)
+            if alleles > alleles_per_split:
+                break
+            count += 1
+        return count
+
+
+    @classmethod
+    def _shift_vcf_record(cls, record, shift):
+        '''Returns a copy of the VcfRecord record, with shift added to its position'''
+        shifted = copy.copy(record)
+        shifted.POS += shift
+        return shifted
+
+
+    @classmethod
+    def shift_split_vcf_records_to_ref(cls, split_file, vcf_records):
+        '''If split_file has its own slice of the reference, the VCF
+        records made from it have positions relative to the slice. This
+        changes the positions in the list vcf_records to be relative to the
+        whole reference sequence. Does nothing if the reference was not sliced'''
+        if split_file.ref_fasta is not None:
+            for record in vcf_records:
+                record.POS += split_file.chrom_start
+
+
+    @classmethod
+    def _record_groups_separated_by_gaps(cls, records, flank_length):
+        '''records = iterable of the VcfRecords of one reference sequence,
+        sorted by position. Yields tuples (index of first record of the group,
+        list of records), where a new group is started at each record that
+        is more than flank_length after the end of all the previous records.
+        Records in different groups cannot be in each other's flanks'''
+        group = []
+        group_start_index = 0
+        group_end = None
+        for i, record in enumerate(records):
+            if group_end is not None and record.POS - group_end > flank_length:
+                yield group_start_index, group
+                group = []
+                group_start_index = i
+                group_end = None
+            group.append(record)
+            group_end = record.ref_end_pos() if group_end is None else max(group_end, record.ref_end_pos())
+
+        if len(group) > 0:
+            yield group_start_index, group
+
+
+    @classmethod
+    def _vcf_header_lines_and_is_sorted(cls, vcf_file):
+        '''Returns tuple (list of header lines, True/False). The second
+        element is True if and only if the records of each reference sequence are
+        next to each other in the file, and sorted by position'''
+        header_lines = []
+        seen_refs = set()
+        previous_ref = None
+        previous_pos = None
+        f = cluster_vcf_records.vcf_file_read.open_vcf_file_for_reading(vcf_file)
+        is_sorted = True
+        for line in f:
+            if line.startswith('#'):
+                header_lines.append(line.rstrip())
+                continue
+
+            ref, pos = line.split('\t', maxsplit=2)[:2]
+            pos = int(pos)
+            if ref != previous_ref:
+                if ref in seen_refs:
+                    is_sorted = False
+                    break
+                seen_refs.add(ref)
+            elif pos < previous_pos:
+                is_sorted = False
+                break
+            previous_ref = ref
+            previous_pos = pos
+
+        f.close()
+        return header_lines, is_sorted
+
+
+    @classmethod
+    def _vcf_records_by_ref_from_sorted_file(cls, vcf_file):
+        '''Yields tuples (ref name, iterator of VcfRecords), reading vcf_file
+        one line at a time. Records with no ALT are skipped, in the
+        same way as cluster_vcf_records.vcf_file_read.vcf_file_to_dict.
+        Each iterator must be used up before getting the next one'''
+        f = cluster_vcf_records.vcf_file_read.open_vcf_file_for_reading(vcf_file)
+        records = (cluster_vcf_records.vcf_record.VcfRecord(x) for x in f if not x.startswith('#'))
+        records = (x for x in records if len(x.ALT) > 0)
+        for ref_name, ref_records in itertools.groupby(records, key=lambda x: x.CHROM):
+            yield ref_name, ref_records
+        f.close()
+
+
     @classmethod
     def _total_variants_and_alleles_in_vcf_dict(cls, vcf_dict):
         total_variants = 0
@@ -152,72 +530,182 @@ class VcfChunker:
         return total_variants, total_alleles
 
 
+    @classmethod
+    def _total_variants_and_alleles_in_vcf_file(cls, vcf_file):
+        '''Same as _total_variants_and_alleles_in_vcf_dict, but reads the
+        VCF file line by line instead of loading it into memory'''
+        total_variants = 0
+        total_alleles = 0
+        with cluster_vcf_records.vcf_file_read.open_vcf_file_for_reading(vcf_file) as f:
+            for line in f:
+                if line.startswith('#'):
+                    continue
+                total_variants += 1
+                total_alleles += 2 + line.split('\t', maxsplit=5)[4].count(',')
+        return total_variants, total_alleles
+
+
+    def _load_ref_seqs_if_slicing(self):
+        '''Returns dict of ref name -> sequence if slice_reference is True.
+        Otherwise returns None'''
+        if not self.slice_reference:
+            return None
+        ref_seqs = {}
+        pyfastaq.tasks.file_to_dict(self.ref_fasta, ref_seqs)
+        return {k.split()[0]: v.seq for k, v in ref_seqs.items()}
+
+
+    def _make_split_file(self, file_number, ref_name, file_start_index, use_start_index, use_end_index, file_end_index, split_records):
+        '''Returns a SplitFile. split_records = list of VcfRecords from
+        file_start_index to file_end_index'''
+        use_records = split_records[use_start_index - file_start_index:use_end_index - file_start_index + 1]
+        return SplitFile(
+            os.path.join(self.outdir, 'split.' + str(file_number) + '.in.vcf'),
+            file_number,
+            ref_name,
+            max(0, min(split_records[0].POS, use_records[0].POS - self.flank_length)),
+            max(split_records[-1].ref_end_pos(), use_records[-1].ref_end_pos() + self.flank_length),
+            file_start_index,
+            file_end_index,
+            use_start_index,
+            use_end_index,
+            os.path.join(self.outdir, 'split.' + str(file_number) + '.gramtools_build'),
+            os.path.join(self.outdir, 'split.' + str(file_number) + '.ref.fa') if self.slice_reference else None,
+        )
+
+
+    @classmethod
+    def _split_file_record_lines(cls, split_file, split_records):
+        '''Returns list of the lines to write to the split VCF file for the
+        VcfRecords split_records. Positions are shifted if the reference is
+        sliced for the split'''
+        if split_file.ref_fasta is not None:
+            split_records = [VcfChunker._shift_vcf_record(x, -split_file.chrom_start) for x in split_records]
+        return [str(x) for x in split_records]
+
+
+    @classmethod
+    def _write_split_file(cls, split_file, vcf_header_lines, record_lines, ref_seqs):
+        '''Writes the split VCF file, and the reference slice if the
+        reference is sliced for the split'''
+        with open(split_file.filename, 'w') as f:
+            print(*vcf_header_lines, *record_lines, sep='\n', file=f)
+
+        if split_file.ref_fasta is not None:
+            if split_file.chrom not in ref_seqs:
+                raise Error('Sequence ' + split_file.chrom + ' from split VCF file ' + split_file.filename + ' not found in reference FASTA file')
+            ref_slice = pyfastaq.sequences.Fasta(split_file.chrom, ref_seqs[split_file.chrom][split_file.chrom_start:split_file.chrom_end + 1])
+            with open(split_file.ref_fasta, 'w') as f:
+                print(ref_slice, file=f)
+
+
     def make_split_vcf_files(self):
+        '''Writes the split VCF files. The input VCF file is read one record
+        at a time, and each split file is written as soon as its end is
+        found. The whole VCF file is only loaded into memory if split_cost
+        is used (because the costs can depend on all the records), or if the
+        VCF file is not sorted'''
         if len(self.vcf_split_files) > 0:
             return
 
         self.total_split_files = 0
         self.total_input_records = 0
-        vcf_header_lines, vcf_records = cluster_vcf_records.vcf_file_read.vcf_file_to_dict(self.vcf_infile)
-        if self.variants_per_split is None and self.alleles_per_split is None:
-            total_records, total_alleles = VcfChunker._total_variants_and_alleles_in_vcf_dict(vcf_records)
+        vcf_header_lines, is_sorted = VcfChunker._vcf_header_lines_and_is_sorted(self.vcf_infile)
+        if self.split_cost is not None or not is_sorted:
+            if not is_sorted:
+                logging.warning('VCF file ' + self.vcf_infile + ' is not sorted. Loading it into memory to sort it')
+            vcf_header_lines, vcf_records = cluster_vcf_records.vcf_file_read.vcf_file_to_dict(self.vcf_infile)
+            records_by_ref = vcf_records.items()
+        else:
+            vcf_records = None
+            records_by_ref = VcfChunker._vcf_records_by_ref_from_sorted_file(self.vcf_infile)
+
+        record_costs = None
+        if self.variants_per_split is None and self.alleles_per_split is None and self.target_ram_per_split is not None:
+            self.alleles_per_split = max_alleles_for_ram(self.target_ram_per_split, ram_model=self.gramtools_ram_model)
+            logging.info('Using ' + str(self.alleles_per_split) + ' alleles per split, to aim for gramtools RAM of ' + str(self.target_ram_per_split) + 'GB per split, using RAM model (GB, GB per allele) ' + str(default_gramtools_ram_model if self.gramtools_ram_model is None else self.gramtools_ram_model))
+        elif self.split_cost is not None:
+            logging.info('Calculating cost of each VCF record using split cost "' + self.split_cost + '"')
+            record_costs = split_cost_functions[self.split_cost](vcf_records, self.reads_file)
+            total_cost = sum([sum(x) for x in record_costs.values()])
+            cost_per_split = total_cost / self.total_splits
+            logging.info('Total cost ' + str(total_cost) + '. Aiming for cost per split of ' + str(cost_per_split))
+        elif self.variants_per_split is None and self.alleles_per_split is None:
+            if vcf_records is None:
+                total_records, total_alleles = VcfChunker._total_variants_and_alleles_in_vcf_file(self.vcf_infile)
+            else:
+                total_records, total_alleles = VcfChunker._total_variants_and_alleles_in_vcf_dict(vcf_records)
             self.alleles_per_split = 1 + int(total_alleles / self.total_splits)
 
-        for ref_name, vcf_record_list in vcf_records.items():
-            file_end_index = -1
-            use_end_index = -1
-            self.vcf_split_files[ref_name] = []
-            self.total_input_records += len(vcf_record_list)
+        ref_seqs = self._load_ref_seqs_if_slicing()
 
-            while use_end_index < len(vcf_record_list) - 1:
-                if file_end_index == -1:
-                    use_start_index = 0
+        for ref_name, vcf_record_iter in records_by_ref:
+            self.vcf_split_files[ref_name] = []
+            # If split_at_gaps, each group of records is split on its own,
+            # as if it was a separate reference sequence. Indexes in the
+            # group are shifted by the group's start index
+            if self.split_at_gaps:
+                record_groups = VcfChunker._record_groups_separated_by_gaps(vcf_record_iter, self.flank_length)
+            else:
+                record_groups = [(0, vcf_record_iter)]
+
+            for group_start_index, group_records in record_groups:
+                if record_costs is None:
+                    splits = VcfChunker._split_indexes_from_vcf_record_stream(group_records, self.flank_length, total_sites=self.variants_per_split, total_alleles=self.alleles_per_split)
                 else:
-                    use_start_index = self.vcf_split_files[ref_name][-1].use_end_index + 1
-
-                file_start_index, use_end_index, file_end_index = VcfChunker._chunk_end_indexes_from_vcf_record_list(vcf_record_list, use_start_index, self.flank_length, total_sites=self.variants_per_split, total_alleles=self.alleles_per_split)
-                split_file = SplitFile(
-                    os.path.join(self.outdir, 'split.' + str(self.total_split_files) + '.in.vcf'),
-                    self.total_split_files,
-                    ref_name,
-                    max(0, min(vcf_record_list[file_start_index].POS, vcf_record_list[use_start_index].POS - self.flank_length)),
-                    max(vcf_record_list[file_end_index].ref_end_pos(), vcf_record_list[use_end_index].ref_end_pos() + self.flank_length),
-                    file_start_index,
-                    file_end_index,
-                    use_start_index,
-                    use_end_index,
-                    os.path.join(self.outdir, 'split.' + str(self.total_split_files) + '.gramtools_build'),
-                )
-
-                self.vcf_split_files[ref_name].append(split_file)
-
-                with open(split_file.filename, 'w') as f:
-                    print(*vcf_header_lines, sep='\n', file=f)
-                    for i in range(file_start_index, file_end_index + 1, 1):
-                        print(vcf_record_list[i], file=f)
-
-                self.total_split_files += 1
-                logging.info('Made split VCF file ' + split_file.filename + '. Total split files: ' + str(self.total_split_files))
+                    splits = VcfChunker._split_indexes_from_vcf_record_stream(group_records, self.flank_length, total_cost=cost_per_split, record_costs=record_costs[ref_name][group_start_index:])
+
+                for file_start_index, use_start_index, use_end_index, file_end_index, split_records in splits:
+                    file_start_index, use_start_index, use_end_index, file_end_index = [x + group_start_index for x in (file_start_index, use_start_index, use_end_index, file_end_index)]
+                    split_file = self._make_split_file(self.total_split_files, ref_name, file_start_index, use_start_index, use_end_index, file_end_index, split_records)
+                    self.vcf_split_files[ref_name].append(split_file)
+                    self._write_split_file(split_file, vcf_header_lines, self._split_file_record_lines(split_file, split_records), ref_seqs)
+                    self.total_split_files += 1
+                    self.total_input_records += use_end_index - use_start_index + 1
+                    logging.info('Made split VCF file ' + split_file.filename + '. Total split files: ' + str(self.total_split_files))
 
         self._save_metadata()
 
 
-    def run_gramtools_build_on_each_split(self):
+    def run_gramtools_build_on_each_split(self, split_files=None):
+        '''Runs gramtools build on every split file (or only on the list
+        split_files, if given), using self.threads builds
+        in parallel. The splits with the most alleles are started first, so
+        that a long build is not left running on its own at the end.
+        Every build is run, even if some fail. Raises Error at the end if
+        any failed. The wall clock time of each build is saved in the metadata'''
+        if split_files is None:
+            split_files = [x for ref_name in self.vcf_split_files for x in self.vcf_split_files[ref_name]]
+        else:
+            split_files = list(split_files)
+        alleles = {x.file_number: VcfChunker._total_variants_and_alleles_in_vcf_file(x.filename)[1] for x in split_files}
+        split_files.sort(key=lambda x: alleles[x.file_number], reverse=True)
+        build_args = zip(split_files, itertools.repeat(self.ref_fasta), itertools.repeat(self.max_read_length), itertools.repeat(self.gramtools_kmer_size))
+
         if self.threads == 1:
-            for file_list in self.vcf_split_files.values():
-                for split_file in file_list:
-                    gramtools.run_gramtools_build(split_file.gramtools_build_dir, split_file.filename, self.ref_fasta, self.max_read_length, self.gramtools_kmer_size)
+            results = [_run_gramtools_build(*x) for x in build_args]
         else:
             assert self.threads > 1
-            split_files = []
-            for file_list in self.vcf_split_files.values():
-                split_files.extend(file_list)
-
+            # chunksize=1 so that builds start in order of most alleles first
             pool = multiprocessing.Pool(self.threads)
-            pool.starmap(_run_gramtools_build, zip(file_list, itertools.repeat(self.ref_fasta), itertools.repeat(self.max_read_length), itertools.repeat(self.gramtools_kmer_size)))
+            results = list(pool.imap_unordered(_run_gramtools_build_from_tuple, build_args, chunksize=1))
             pool.close()
             pool.join()
 
+        failed = []
+        for file_number, error_message, wall_clock_seconds in results:
+            if error_message is None:
+                self.build_seconds[file_number] = wall_clock_seconds
+            else:
+                failed.append((file_number, error_message))
+
+        self._save_metadata()
+        logging.info('Finished gramtools build on ' + str(len(split_files)) + ' split files. Failed: ' + str(len(failed)))
+        if len(failed) > 0:
+            for file_number, error_message in sorted(failed):
+                logging.error('gramtools build failed on split file ' + str(file_number) + ': ' + error_message)
+            raise Error('gramtools build failed on ' + str(len(failed)) + ' split file(s): ' + ','.join([str(x[0]) for x in sorted(failed)]) + '. See log for details')
+
 
     def make_split_files(self):
         if len(self.vcf_split_files) > 0:
@@ -227,7 +715,174 @@ class VcfChunker:
         self.run_gramtools_build_on_each_split()
 
 
-    def merge_files(self, files_to_merge, outfile):
+    @classmethod
+    def _load_split_file_records(cls, split_file):
+        '''Returns list of (record line, VcfRecord) of the records in the
+        split VCF file. Positions of the VcfRecords are relative to the whole
+        reference sequence, even if the reference is sliced for the split'''
+        lines = []
+        with open(split_file.filename) as f:
+            for line in f:
+                if not line.startswith('#'):
+                    lines.append(line.rstrip('\n'))
+        records = [cluster_vcf_records.vcf_record.VcfRecord(x) for x in lines]
+        VcfChunker.shift_split_vcf_records_to_ref(split_file, records)
+        return list(zip(lines, records))
+
+
+    def _delete_split_files(self, split_file, keep_vcf=False):
+        '''Deletes the files made for split_file: the gramtools build
+        directory and its report, reference slice, and the
+        split VCF file (unless keep_vcf is True)'''
+        if os.path.exists(split_file.gramtools_build_dir):
+            shutil.rmtree(split_file.gramtools_build_dir)
+        to_delete = [split_file.gramtools_build_dir + '.report.json', split_file.ref_fasta]
+        if not keep_vcf:
+            to_delete.append(split_file.filename)
+        for filename in to_delete:
+            if filename is not None and os.path.exists(filename):
+                os.unlink(filename)
+        self.build_seconds.pop(split_file.file_number, None)
+
+
+    def _update_split_vcf_files(self, vcf_infile):
+        '''Updates the split VCF files to use the new VCF file vcf_infile.
+        Each existing split keeps the part of its reference sequence that it
+        used before: a new record goes in the split that has the
+        last used record before it (or the first split of the sequence).
+        The flanks of each split are then found again, and a split is only
+        rebuilt if the records in its VCF file changed (which includes
+        changes in the flanks). Unchanged splits keep their number and build.
+        If a split now has more than variants_per_split or alleles_per_split
+        (whichever was used to make the splits), it is split again: the
+        first part keeps the split number, and the other parts get new
+        split numbers. Splits with no records left are deleted. Records from reference
+        sequences that were not in the old VCF file are split in the same
+        way as make_split_vcf_files(), and get new split numbers.
+        Returns list of the split files that need gramtools build'''
+        if len(self.vcf_split_files) == 0:
+            raise Error('Cannot update split files in ' + self.outdir + ' because no split files made yet')
+
+        vcf_infile = os.path.abspath(vcf_infile)
+        logging.info('Updating split files in ' + self.outdir + ' using VCF file ' + vcf_infile)
+        vcf_header_lines, vcf_records = cluster_vcf_records.vcf_file_read.vcf_file_to_dict(vcf_infile)
+        ref_seqs = self._load_ref_seqs_if_slicing()
+        next_file_number = 1 + max([x.file_number for ref_name in self.vcf_split_files for x in self.vcf_split_files[ref_name]])
+        if self.alleles_per_split is None and self.variants_per_split is None:
+            new_ref_alleles_per_split = 1 + int(VcfChunker._total_variants_and_alleles_in_vcf_dict(vcf_records)[1] / max(1, self.total_split_files))
+        else:
+            new_ref_alleles_per_split = self.alleles_per_split
+        new_split_files = {}
+        to_build = []
+
+        for ref_name, record_list in vcf_records.items():
+            new_split_files[ref_name] = []
+
+            if ref_name in self.vcf_split_files:
+                old_splits = self.vcf_split_files[ref_name]
+                old_records = [VcfChunker._load_split_file_records(x) for x in old_splits]
+                use_starts = [old_records[i][x.use_start_index - x.file_start_index][1].POS for i, x in enumerate(old_splits)]
+                use_counts = [0] * len(old_splits)
+                for record in record_list:
+                    use_counts[max(0, bisect.bisect_right(use_starts, record.POS) - 1)] += 1
+
+                use_start_index = 0
+                for old_split, old_split_records, use_count in zip(old_splits, old_records, use_counts):
+                    if use_count == 0:
+                        logging.info('No records left in split file ' + old_split.filename + '. Deleting it')
+                        self._delete_split_files(old_split)
+                        continue
+
+                    file_number = old_split.file_number
+                    while use_count > 0:
+                        part_count = VcfChunker._split_use_count(record_list, use_start_index, use_count, variants_per_split=self.variants_per_split, alleles_per_split=self.alleles_per_split)
+                        file_start_index, use_end_index, file_end_index = VcfChunker._chunk_end_indexes_from_vcf_record_list(record_list, use_start_index, self.flank_length, total_sites=part_count)
+                        split_records = record_list[file_start_index:file_end_index + 1]
+                        split_file = self._make_split_file(file_number, ref_name, file_start_index, use_start_index, use_end_index, file_end_index, split_records)
+                        new_split_files[ref_name].append(split_file)
+                        record_lines = VcfChunker._split_file_record_lines(split_file, split_records)
+                        if file_number != old_split.file_number:
+                            logging.info('Split file ' + old_split.filename + ' has too many records. Adding new split file ' + split_file.filename)
+                            self._write_split_file(split_file, vcf_header_lines, record_lines, ref_seqs)
+                            to_build.append(split_file)
+                        elif [x[0] for x in old_split_records] != record_lines or split_file.chrom_start != old_split.chrom_start or split_file.chrom_end != old_split.chrom_end:
+                            self._delete_split_files(old_split)
+                            self._write_split_file(split_file, vcf_header_lines, record_lines, ref_seqs)
+                            to_build.append(split_file)
+                        use_start_index = use_end_index + 1
+                        use_count -= part_count
+                        if use_count > 0:
+                            file_number = next_file_number
+                            next_file_number += 1
+            else:
+                splits = VcfChunker._split_indexes_from_vcf_record_stream(record_list, self.flank_length, total_sites=self.variants_per_split, total_alleles=None if self.variants_per_split is not None else new_ref_alleles_per_split)
+                for file_start_index, use_start_index, use_end_index, file_end_index, split_records in splits:
+                    split_file = self._make_split_file(next_file_number, ref_name, file_start_index, use_start_index, use_end_index, file_end_index, split_records)
+                    new_split_files[ref_name].append(split_file)
+                    self._write_split_file(split_file, vcf_header_lines, VcfChunker._split_file_record_lines(split_file, split_records), ref_seqs)
+                    to_build.append(split_file)
+                    next_file_number += 1
+
+        for ref_name, old_splits in self.vcf_split_files.items():
+            if ref_name not in vcf_records:
+                for split_file in old_splits:
+                    logging.info('Reference sequence ' + ref_name + ' not in new VCF file. Deleting split file ' + split_file.filename)
+                    self._delete_split_files(split_file)
+
+        self.vcf_infile = vcf_infile
+        self.vcf_split_files = new_split_files
+        self.total_split_files = sum([len(x) for x in new_split_files.values()])
+        self.total_input_records = sum([len(x) for x in vcf_records.values()])
+        self._save_metadata()
+        logging.info('Split files to rebuild: ' + str(len(to_build)) + '. Unchanged split files: ' + str(self.total_split_files - len(to_build)))
+        return to_build
+
+
+    def update_split_files(self, vcf_infile):
+        '''Updates an existing split directory to use the new VCF file
+        vcf_infile (eg made by adding a few variants to the VCF file used to
+        make the directory). Only the splits that changed are rebuilt.
+        See _update_split_vcf_files() for how the splits are updated.
+        Returns list of the split files that were rebuilt'''
+        to_build = self._update_split_vcf_files(vcf_infile)
+        self.run_gramtools_build_on_each_split(split_files=to_build)
+        return to_build
+
+
+    @classmethod
+    def _write_used_lines_from_split_file(cls, infile, f_out, split_file, write_header, flanks_removed=False):
+        '''Writes the records from the VCF file infile that are in the use range of
+        split_file (and the header lines if write_header is True) to
+        the open file handle f_out. Works on the raw lines, instead of
+        parsing the VCF records. If flanks_removed is True, then infile is
+        assumed to only have the records in the use range.
+        Returns the number of records written'''
+        records_to_skip = 0 if flanks_removed else split_file.use_start_index - split_file.file_start_index
+        records_to_write = split_file.use_end_index - split_file.use_start_index + 1
+        records_written = 0
+
+        with open(infile) as f_in:
+            for line in f_in:
+                if line.startswith('#'):
+                    if write_header:
+                        f_out.write(line)
+                    continue
+                elif records_to_skip > 0:
+                    records_to_skip -= 1
+                    continue
+
+                f_out.write(line if line.endswith('\n') else line + '\n')
+                records_written += 1
+                if records_written == records_to_write:
+                    break
+
+        if records_written != records_to_write:
+            raise Error('Expected ' + str(records_to_write) + ' records to use from file ' + infile + ', but only found ' + str(records_written) + '. Cannot continue')
+
+        return records_written
+
+
+    def merge_files(self, files_to_merge, outfile, flanks_removed=False):
         total_output_records = 0
         printed_header_lines = False
         logging.info('Making merged VCF file ' + outfile)
@@ -237,17 +892,66 @@ class VcfChunker:
                 assert ref_name in files_to_merge
                 assert len(self.vcf_split_files[ref_name]) == len(files_to_merge[ref_name])
                 for i, split_file in enumerate(self.vcf_split_files[ref_name]):
-                    header_lines, records_to_merge = cluster_vcf_records.vcf_file_read.vcf_file_to_list(files_to_merge[ref_name][i])
-                    if not printed_header_lines:
-                        print(*header_lines, sep='\n', file=f)
-                        printed_header_lines = True
-                    start_i = split_file.use_start_index - split_file.file_start_index
-                    end_i = start_i + split_file.use_end_index - split_file.use_start_index
-                    for j in range(start_i, end_i + 1, 1):
-                        total_output_records += 1
-                        print(records_to_merge[j], file=f)
+                    total_output_records += VcfChunker._write_used_lines_from_split_file(files_to_merge[ref_name][i], f, split_file, not printed_header_lines, flanks_removed=flanks_removed)
+                    printed_header_lines = True
 
         if self.total_input_records != total_output_records:
             raise Error('Number of input VCF records = ' + str(self.total_input_records) + ' != ' + str(total_output_records) + ' = numnber of output VCF records. Cannot continue')
 
         logging.info('Finished making merged VCF file. Total records: ' + str(self.total_input_records))
+
+
+class IncrementalSplitMerger:
+    '''Merges split output VCF files into one file as they are made, instead of
+    waiting for all of them to be finished like VcfChunker.merge_files().
+    Call add() when each split is finished, in any order. A split's records
+    are appended to outfile as soon as it and all earlier splits have been
+    added, and splits that finish out of order are held until then.
+    If delete_merged is True, each split file is deleted after it is merged.
+    If flanks_removed is True, the split files are assumed to only have
+    the records in each split's use range.
+    Call finish() at the end, which checks that every split was merged.
+    Can be used as a context manager, which closes outfile on exit'''
+    def __init__(self, chunker, outfile, delete_merged=True, flanks_removed=False):
+        self.chunker = chunker
+        self.outfile = outfile
+        self.delete_merged = delete_merged
+        self.flanks_removed = flanks_removed
+        self.split_files = [x for ref_name in chunker.vcf_split_files for x in chunker.vcf_split_files[ref_name]]
+        self.next_index = 0
+        self.waiting_files = {} # split file number -> filename
+        self.total_output_records = 0
+        self.f_out = open(self.outfile, 'w')
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.f_out.close()
+
+
+    def add(self, file_number, filename):
+        self.waiting_files[file_number] = filename
+
+        while self.next_index < len(self.split_files) and self.split_files[self.next_index].file_number in self.waiting_files:
+            split_file = self.split_files[self.next_index]
+            to_merge = self.waiting_files.pop(split_file.file_number)
+            self.total_output_records += VcfChunker._write_used_lines_from_split_file(to_merge, self.f_out, split_file, self.next_index == 0, flanks_removed=self.flanks_removed)
+            self.f_out.flush()
+            if self.delete_merged:
+                os.unlink(to_merge)
+            self.next_index += 1
+            logging.debug('Merged split file ' + to_merge + ' into ' + self.outfile)
+
+
+    def finish(self):
+        self.f_out.close()
+        if self.next_index != len(self.split_files):
+            raise Error('Only ' + str(self.next_index) + ' of ' + str(len(self.split_files)) + ' split files were merged into ' + self.outfile + '. Cannot continue')
+
+        if self.chunker.total_input_records != self.total_output_records:
+            raise Error('Number of input VCF records = ' + str(self.chunker.total_input_records) + ' != ' + str(self.total_output_records) + ' = numnber of output VCF records. Cannot continue')
+
+        logging.info('Finished making merged VCF file ' + self.outfile + '. Total records: ' + str(self.total_output_records))
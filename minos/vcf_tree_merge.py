@@ -0,0 +1,284 @@
+import datetime
+import gzip
+import heapq
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+import pyfastaq
+from cluster_vcf_records import vcf_file_read, vcf_record
+from cluster_vcf_records import __version__ as cluster_vcf_records_version
+
+class Error (Exception): pass
+
+
+class LazyRefSeqs:
+    '''Dict-like access to the sequences in a FASTA file, without loading
+    the whole file. The start of each sequence in the file is found when this
+    is made. A sequence is only loaded when it is asked for, and only the
+    most recently used sequence is kept in memory. Sequence names are the
+    whole header line, the same as pyfastaq.tasks.file_to_dict()'''
+    def __init__(self, fasta_file):
+        self.fasta_file = fasta_file
+        self.offsets = {} # sequence name -> (start byte, end byte) of the sequence lines
+        self.cached_name = None
+        self.cached_seq = None
+        name = None
+        with open(self.fasta_file, 'rb') as f:
+            offset = 0
+            for line in f:
+                if line.startswith(b'>'):
+                    if name is not None:
+                        self.offsets[name] = (start, offset)
+                    name = line[1:].decode().rstrip()
+                    if name in self.offsets:
+                        raise Error('Duplicate sequence name "' + name + '" in FASTA file ' + self.fasta_file)
+                    start = offset + len(line)
+                offset += len(line)
+            if name is not None:
+                self.offsets[name] = (start, offset)
+
+
+    def __contains__(self, name):
+        return name in self.offsets
+
+
+    def __getitem__(self, name):
+        if name != self.cached_name:
+            start, end = self.offsets[name]
+            with open(self.fasta_file, 'rb') as f:
+                f.seek(start)
+                self.cached_seq = ''.join(f.read(end - start).decode().split())
+            self.cached_name = name
+        return self.cached_seq
+
+
+def _vcf_file_chrom_blocks(infile):
+    '''If the records of each CHROM in the VCF file are in one block, sorted
+    by POS, returns list of tuples (CHROM, start byte, end byte) of the
+    blocks, sorted by CHROM (as strings, which is the order of the merged
+    output). Otherwise returns None'''
+    blocks = []
+    previous_pos = None
+    offset = 0
+    open_function = gzip.open if infile.endswith('.gz') else open
+    with open_function(infile, 'rb') as f:
+        for line in f:
+            if not line.startswith(b'#'):
+                fields = line.split(b'\t', maxsplit=2)
+                chrom = fields[0].decode()
+                pos = int(fields[1])
+                if len(blocks) == 0 or blocks[-1][0] != chrom:
+                    if chrom in [x[0] for x in blocks]:
+                        return None
+                    blocks.append([chrom, offset, None])
+                elif pos < previous_pos:
+                    return None
+                previous_pos = pos
+                blocks[-1][2] = offset + len(line)
+            offset += len(line)
+
+    return sorted([tuple(x) for x in blocks])
+
+
+def _normalised_variants_from_vcf_lines(lines, infile, ref_seqs):
+    '''Yields tuples (ref name, 0-based position, REF, list of ALTs,
+    0-based position before normalising) from the VCF record lines, which
+    are from the file infile. They are filtered and normalised in the same
+    way as cluster_vcf_records.vcf_file_read.vcf_file_to_dict_of_vars(),
+    except that REF is not checked against the reference sequence. That is
+    done by merge_vcf_files_group(), so that the sequences are needed in order'''
+    for line in lines:
+        if line.startswith('#'):
+            continue
+        record = vcf_record.VcfRecord(line)
+        record.remove_asterisk_alts()
+        if len(record.ALT) < 1:
+            continue
+        original_pos = record.POS
+        record.remove_useless_start_nucleotides()
+
+        if record.POS < 0:
+            logging.warning('VCF record with negative POS in file ' + infile + '. Ignoring: ' + str(record))
+            continue
+        elif record.CHROM not in ref_seqs:
+            logging.warning('CHROM not recognised in VCF record in file ' + infile + '. Ignoring: ' + str(record))
+            continue
+
+        yield record.CHROM, record.POS, record.REF, record.ALT, original_pos
+
+
+def _sorted_variants_from_vcf_file(infile, ref_seqs):
+    '''Returns sorted list of tuples (ref name, 0-based position, REF, set of ALTs,
+    infile) from the VCF file infile (see _normalised_variants_from_vcf_lines()).
+    All the variants are loaded into memory, so this is only used when the
+    file cannot be streamed by _stream_variants_from_vcf_file_blocks()'''
+    variants = {}
+    with vcf_file_read.open_vcf_file_for_reading(infile) as f:
+        for ref_name, pos, ref_string, alts, original_pos in _normalised_variants_from_vcf_lines(f, infile, ref_seqs):
+            key = (ref_name, pos, ref_string)
+            if key not in variants:
+                variants[key] = set()
+            variants[key].update(alts)
+
+    return sorted([key + (alts, infile) for key, alts in variants.items()])
+
+
+def _vcf_file_lines_from_blocks(infile, blocks):
+    '''Yields the lines of the blocks (made by _vcf_file_chrom_blocks()) of the
+    VCF file, in the order of the blocks'''
+    open_function = gzip.open if infile.endswith('.gz') else open
+    with open_function(infile, 'rb') as f:
+        for chrom, start, end in blocks:
+            f.seek(start)
+            offset = start
+            while offset < end:
+                line = f.readline()
+                offset += len(line)
+                yield line.decode()
+
+
+def _stream_variants_from_vcf_file_blocks(infile, ref_seqs, blocks):
+    '''Yields the same as _sorted_variants_from_vcf_file(), without loading
+    the file. blocks must be from _vcf_file_chrom_blocks(infile), so that the
+    file is read one CHROM at a time in sorted order.
+    Removing useless start nucleotides can move a variant to a later
+    position, so each variant is held back until a record is read at a
+    later position (or on the next CHROM), because no variant after that
+    can come before it'''
+    pending = {} # (ref name, position, REF) -> set of ALTs
+    heap = []
+    lines = _vcf_file_lines_from_blocks(infile, blocks)
+    for ref_name, pos, ref_string, alts, original_pos in _normalised_variants_from_vcf_lines(lines, infile, ref_seqs):
+        while len(heap) > 0 and (heap[0][0] != ref_name or heap[0][1] < original_pos):
+            key = heapq.heappop(heap)
+            yield key + (pending.pop(key), infile)
+
+        key = (ref_name, pos, ref_string)
+        if key not in pending:
+            pending[key] = set()
+            heapq.heappush(heap, key)
+        pending[key].update(alts)
+
+    while len(heap) > 0:
+        key = heapq.heappop(heap)
+        yield key + (pending.pop(key), infile)
+
+
+def _variants_from_merged_file(infile):
+    '''Yields tuples (ref name, 0-based position, REF, set of ALTs, None) from
+    a VCF file made by merge_vcf_files_group(), which is already sorted,
+    normalised and checked against the reference'''
+    with open(infile) as f:
+        for line in f:
+            if not line.startswith('#'):
+                fields = line.split('\t', maxsplit=5)
+                yield fields[0], int(fields[1]) - 1, fields[3], set(fields[4].split(',')), None
+
+
+def merge_vcf_files_group(infiles, ref_fasta, outfile, inputs_are_merged=False):
+    '''Merges the VCF files infiles into one VCF file of all the variants,
+    which is the same as made by cluster_vcf_records.vcf_merge.merge_vcf_files().
+    Input files where each CHROM is in one block of records sorted by POS
+    (in any order of CHROMs) are streamed. Any other input file is loaded
+    into memory.
+    If inputs_are_merged is True, the input files must have been made by
+    this function, and are streamed without any checks'''
+    if inputs_are_merged:
+        ref_seqs = None
+        iterators = [_variants_from_merged_file(x) for x in infiles]
+    else:
+        if ref_fasta.endswith('.gz'):
+            ref_seqs = {}
+            pyfastaq.tasks.file_to_dict(ref_fasta, ref_seqs)
+        else:
+            ref_seqs = LazyRefSeqs(ref_fasta)
+        iterators = []
+        for infile in infiles:
+            blocks = _vcf_file_chrom_blocks(infile)
+            if blocks is not None:
+                iterators.append(_stream_variants_from_vcf_file_blocks(infile, ref_seqs, blocks))
+            else:
+                logging.info('VCF file not sorted, so loading it into memory to merge: ' + infile)
+                iterators.append(_sorted_variants_from_vcf_file(infile, ref_seqs))
+
+    header_lines = [
+        '##fileformat=VCFv4.2',
+        '##source=cluster_vcf_records, version ' + cluster_vcf_records_version,
+        '##fileDate=' + str(datetime.date.today()),
+        '\t'.join(['#CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO']),
+    ]
+
+    with open(outfile, 'w') as f:
+        print(*header_lines, sep='\n', file=f)
+        current_key = None
+        alts = set()
+        # The variants are in sorted order, so LazyRefSeqs only loads
+        # each reference sequence once
+        for ref_name, pos, ref_string, new_alts, infile in heapq.merge(*iterators, key=lambda x: x[:3]):
+            if infile is not None and ref_seqs[ref_name][pos:pos + len(ref_string)] != ref_string:
+                logging.warning('REF string does not match reference seq in file ' + infile + '. Ignoring: ' + '\t'.join([ref_name, str(pos + 1), ref_string, ','.join(sorted(new_alts))]))
+                continue
+
+            if (ref_name, pos, ref_string) != current_key:
+                if current_key is not None:
+                    print(current_key[0], current_key[1] + 1, '.', current_key[2], ','.join(sorted(alts)), '.', 'PASS', 'SVTYPE=MERGED', sep='\t', file=f)
+                current_key = (ref_name, pos, ref_string)
+                alts = set()
+            alts.update(new_alts)
+
+        if current_key is not None:
+            print(current_key[0], current_key[1] + 1, '.', current_key[2], ','.join(sorted(alts)), '.', 'PASS', 'SVTYPE=MERGED', sep='\t', file=f)
+
+
+def merge_plan(number_of_files, group_size):
+    '''Returns list of the number of groups at each level of the tree
+    merge of number_of_files files, merging group_size files at a time.
+    The last level always has one group, which makes the final output file'''
+    assert group_size > 1
+    plan = []
+    while True:
+        groups = max(1, (number_of_files + group_size - 1) // group_size)
+        plan.append(groups)
+        if groups == 1:
+            return plan
+        number_of_files = groups
+
+
+def merge_vcf_files(infiles, ref_fasta, outfile, group_size=100, threads=1, inputs_are_merged=False):
+    '''Same output as cluster_vcf_records.vcf_merge.merge_vcf_files(), but
+    merges in a tree: groups of group_size input files are merged (threads
+    groups in parallel), then groups of the merged files are merged, and so
+    on until there is one file. Memory use depends on group_size and the
+    size of each input file, instead of on the total number of variants in
+    all the files. The reference is not loaded into memory.
+    If inputs_are_merged is True, the input files must have been made by
+    merge_vcf_files_group() or this function'''
+    outfile = os.path.abspath(outfile)
+    tmp_dir = tempfile.mkdtemp(prefix=os.path.basename(outfile) + '.tmp.merge.', dir=os.path.dirname(outfile))
+    files_to_merge = infiles
+    plan = merge_plan(len(infiles), group_size)
+
+    try:
+        for level, number_of_groups in enumerate(plan):
+            if number_of_groups == 1:
+                outfiles = [outfile]
+            else:
+                outfiles = [os.path.join(tmp_dir, 'level.' + str(level) + '.' + str(i) + '.vcf') for i in range(number_of_groups)]
+            args = [(files_to_merge[i * group_size:(i + 1) * group_size], ref_fasta, outfiles[i], inputs_are_merged or level > 0) for i in range(number_of_groups)]
+            if threads > 1 and number_of_groups > 1:
+                with multiprocessing.Pool(min(threads, number_of_groups)) as pool:
+                    pool.starmap(merge_vcf_files_group, args)
+            else:
+                for arg in args:
+                    merge_vcf_files_group(*arg)
+
+            logging.info('Tree merge level ' + str(level) + ': merged ' + str(len(files_to_merge)) + ' VCF files into ' + str(number_of_groups) + ' files')
+            if level > 0:
+                for filename in files_to_merge:
+                    os.unlink(filename)
+            files_to_merge = outfiles
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -18,6 +18,7 @@ setup(
         'cluster_vcf_records >= 0.9.1',
         'gramtools',
         'matplotlib',
+        'numpy',
         'pandas',
         'pyfastaq >= 3.14.0',
         'pymummer >= 0.11.0',